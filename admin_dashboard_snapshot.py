@@ -0,0 +1,90 @@
+"""
+Admin Dashboard Snapshot - фоновое обновление снапшота админ-статистики
+
+Экраны admin:stats и admin:metrics читают готовый снапшот из памяти и показывают
+время, на которое он актуален ("Данные на ..."), вместо агрегатов по таблицам
+на каждое нажатие кнопки. Фоновая задача обновляет статистику раз в минуту,
+бизнес-метрики (тяжёлый запрос по audit_log) - раз в 5 минут.
+
+Если снапшота ещё нет (первый запрос до первого обновления), он строится синхронно.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+from aiogram import Bot
+import database
+
+logger = logging.getLogger(__name__)
+
+# Интервалы обновления снапшота
+DASHBOARD_STATS_INTERVAL_SECONDS = int(os.getenv("DASHBOARD_STATS_INTERVAL_SECONDS", "60"))
+DASHBOARD_METRICS_INTERVAL_SECONDS = int(os.getenv("DASHBOARD_METRICS_INTERVAL_SECONDS", "300"))
+
+# Снапшоты: (данные, время построения)
+_stats_snapshot: Optional[Tuple[Dict[str, Any], datetime]] = None
+_metrics_snapshot: Optional[Tuple[Dict[str, Any], datetime]] = None
+
+
+async def refresh_stats() -> Tuple[Dict[str, Any], datetime]:
+    """Пересчитать статистику дашборда (database.get_admin_stats) и сохранить снапшот"""
+    global _stats_snapshot
+    _stats_snapshot = (await database.get_admin_stats(), datetime.now())
+    return _stats_snapshot
+
+
+async def refresh_metrics() -> Tuple[Dict[str, Any], datetime]:
+    """Пересчитать бизнес-метрики (database.get_business_metrics) и сохранить снапшот"""
+    global _metrics_snapshot
+    _metrics_snapshot = (await database.get_business_metrics(), datetime.now())
+    return _metrics_snapshot
+
+
+async def get_stats() -> Tuple[Dict[str, Any], datetime]:
+    """
+    Получить статистику дашборда из снапшота
+
+    Returns:
+        Кортеж (stats, as_of): словарь get_admin_stats() и время построения снапшота
+    """
+    if _stats_snapshot is None:
+        return await refresh_stats()
+    return _stats_snapshot
+
+
+async def get_metrics() -> Tuple[Dict[str, Any], datetime]:
+    """
+    Получить бизнес-метрики из снапшота
+
+    Returns:
+        Кортеж (metrics, as_of): словарь get_business_metrics() и время построения снапшота
+    """
+    if _metrics_snapshot is None:
+        return await refresh_metrics()
+    return _metrics_snapshot
+
+
+async def dashboard_snapshot_task(bot: Bot):
+    """Фоновая задача обновления снапшота админ-дашборда"""
+    logger.info(
+        f"Dashboard snapshot task started (stats: {DASHBOARD_STATS_INTERVAL_SECONDS}s, "
+        f"metrics: {DASHBOARD_METRICS_INTERVAL_SECONDS}s)"
+    )
+
+    last_metrics_refresh = 0.0
+    loop = asyncio.get_running_loop()
+
+    while True:
+        try:
+            await refresh_stats()
+            if loop.time() - last_metrics_refresh >= DASHBOARD_METRICS_INTERVAL_SECONDS:
+                await refresh_metrics()
+                last_metrics_refresh = loop.time()
+        except asyncio.CancelledError:
+            logger.info("Dashboard snapshot task cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Error in dashboard_snapshot_task: {e}")
+
+        await asyncio.sleep(DASHBOARD_STATS_INTERVAL_SECONDS)
@@ -0,0 +1,255 @@
+"""
+Audit Writer - буферизованная пакетная запись событий аудита
+
+События audit_log (database._log_audit_event_atomic_standalone,
+database._log_vpn_lifecycle_audit_async) попадают в ограниченную очередь в памяти
+процесса. Фоновая задача пишет их одним COPY (copy_records_to_table) каждые
+AUDIT_FLUSH_BATCH_SIZE событий или AUDIT_FLUSH_INTERVAL_MS миллисекунд,
+вместо отдельного соединения и INSERT на каждое событие.
+
+- Backpressure: при заполненной очереди submit ждёт место до
+  AUDIT_ENQUEUE_TIMEOUT_SECONDS (счётчик delayed), затем событие отбрасывается
+  (счётчик dropped); submit_nowait отбрасывает сразу
+- Ошибка записи пакета: COPY повторяется до AUDIT_FLUSH_RETRIES раз с экспоненциальной
+  задержкой (очередь тем временем копится и даёт backpressure), затем события пишутся
+  по одному - отбрасываются (счётчик dropped) только те, что не записались и так
+- stop() дописывает очередь при остановке бота (main.py, до закрытия пула)
+- Пока писатель не запущен (скрипты, тесты), submit пишет событие сразу
+
+Записи внутри транзакций (database._log_audit_event_atomic) идут мимо очереди:
+они должны откатываться вместе с транзакцией.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import database
+
+logger = logging.getLogger(__name__)
+
+AUDIT_QUEUE_MAX_SIZE = int(os.getenv("AUDIT_QUEUE_MAX_SIZE", "10000"))
+AUDIT_FLUSH_BATCH_SIZE = int(os.getenv("AUDIT_FLUSH_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL_MS = int(os.getenv("AUDIT_FLUSH_INTERVAL_MS", "1000"))
+AUDIT_ENQUEUE_TIMEOUT_SECONDS = float(os.getenv("AUDIT_ENQUEUE_TIMEOUT_SECONDS", "2"))
+AUDIT_STOP_TIMEOUT_SECONDS = float(os.getenv("AUDIT_STOP_TIMEOUT_SECONDS", "10"))
+AUDIT_FLUSH_RETRIES = int(os.getenv("AUDIT_FLUSH_RETRIES", "3"))
+AUDIT_FLUSH_RETRY_BASE_MS = int(os.getenv("AUDIT_FLUSH_RETRY_BASE_MS", "200"))
+
+AUDIT_COLUMNS = ["action", "telegram_id", "target_user", "uuid", "source", "result", "details", "created_at"]
+
+# Счётчики писателя (отдаются в /health)
+AUDIT_WRITER_STATS: Dict[str, int] = {
+    "enqueued": 0,
+    "written": 0,
+    "delayed": 0,
+    "dropped": 0,
+    "batches": 0,
+    "retries": 0,
+    "failed_batches": 0,
+}
+
+AuditRecord = Tuple[Any, ...]
+
+_STOP = object()
+_queue: Optional[asyncio.Queue] = None
+_task: Optional[asyncio.Task] = None
+_accepting = False
+
+
+def _record(
+    action: str,
+    telegram_id: int,
+    target_user: Optional[int],
+    uuid: Optional[str],
+    source: Optional[str],
+    result: Optional[str],
+    details: Optional[str],
+) -> AuditRecord:
+    # Время события фиксируется при постановке в очередь, а не при записи пакета
+    return (action, telegram_id, target_user, uuid, source, result, details, datetime.now())
+
+
+async def write_records(records: List[AuditRecord]) -> None:
+    """Записать события в audit_log одним COPY"""
+    pool = await database.get_pool()
+    async with pool.acquire() as conn:
+        await conn.copy_records_to_table("audit_log", records=records, columns=AUDIT_COLUMNS)
+
+
+def is_running() -> bool:
+    """Писатель запущен и принимает события в очередь"""
+    return _accepting and _task is not None and not _task.done()
+
+
+async def submit(
+    action: str,
+    telegram_id: int,
+    target_user: Optional[int] = None,
+    details: Optional[str] = None,
+    uuid: Optional[str] = None,
+    source: Optional[str] = None,
+    result: Optional[str] = None,
+) -> bool:
+    """
+    Поставить событие в очередь записи (с ожиданием места при заполненной очереди)
+
+    Returns:
+        True - событие принято (или записано сразу), False - отброшено
+    """
+    record = _record(action, telegram_id, target_user, uuid, source, result, details)
+    if not is_running():
+        await write_records([record])
+        return True
+
+    try:
+        _queue.put_nowait(record)
+    except asyncio.QueueFull:
+        AUDIT_WRITER_STATS["delayed"] += 1
+        try:
+            await asyncio.wait_for(_queue.put(record), AUDIT_ENQUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            AUDIT_WRITER_STATS["dropped"] += 1
+            logger.warning(f"Audit queue full, event dropped: action={action}, user={telegram_id}")
+            return False
+    AUDIT_WRITER_STATS["enqueued"] += 1
+    return True
+
+
+def submit_nowait(
+    action: str,
+    telegram_id: int,
+    target_user: Optional[int] = None,
+    details: Optional[str] = None,
+    uuid: Optional[str] = None,
+    source: Optional[str] = None,
+    result: Optional[str] = None,
+) -> bool:
+    """Поставить событие в очередь без ожидания (при заполненной очереди - отбросить)"""
+    if not is_running():
+        return False
+    try:
+        _queue.put_nowait(_record(action, telegram_id, target_user, uuid, source, result, details))
+    except asyncio.QueueFull:
+        AUDIT_WRITER_STATS["dropped"] += 1
+        logger.warning(f"Audit queue full, event dropped: action={action}, user={telegram_id}")
+        return False
+    AUDIT_WRITER_STATS["enqueued"] += 1
+    return True
+
+
+async def _write_each(batch: List[AuditRecord]) -> int:
+    """Записать события по одному на одном соединении (изолирует запись, из-за которой падает COPY)"""
+    written = 0
+    pool = await database.get_pool()
+    async with pool.acquire() as conn:
+        for record in batch:
+            try:
+                await conn.copy_records_to_table("audit_log", records=[record], columns=AUDIT_COLUMNS)
+                written += 1
+            except Exception as e:
+                logger.error(f"Audit event dropped: action={record[0]}, user={record[1]}, error={e}")
+    return written
+
+
+async def _flush(batch: List[AuditRecord]) -> None:
+    for attempt in range(AUDIT_FLUSH_RETRIES):
+        try:
+            await write_records(batch)
+            AUDIT_WRITER_STATS["written"] += len(batch)
+            AUDIT_WRITER_STATS["batches"] += 1
+            return
+        except Exception as e:
+            logger.warning(f"Failed to write audit batch: size={len(batch)}, attempt={attempt + 1}, error={e}")
+            if attempt + 1 < AUDIT_FLUSH_RETRIES:
+                AUDIT_WRITER_STATS["retries"] += 1
+                await asyncio.sleep(AUDIT_FLUSH_RETRY_BASE_MS / 1000 * 2 ** attempt)
+
+    # Пакет не записался целиком: пишем по одному, отбрасываем только незаписанные события
+    AUDIT_WRITER_STATS["failed_batches"] += 1
+    try:
+        written = await _write_each(batch)
+    except Exception as e:
+        written = 0
+        logger.error(f"Failed to write audit events one by one: size={len(batch)}, error={e}")
+    AUDIT_WRITER_STATS["written"] += written
+    AUDIT_WRITER_STATS["dropped"] += len(batch) - written
+    if written < len(batch):
+        logger.error(f"Audit batch partially dropped: size={len(batch)}, dropped={len(batch) - written}")
+
+
+async def _run(queue: asyncio.Queue) -> None:
+    """Цикл писателя: пакет до AUDIT_FLUSH_BATCH_SIZE событий или AUDIT_FLUSH_INTERVAL_MS"""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = loop.time() + AUDIT_FLUSH_INTERVAL_MS / 1000
+        while len(batch) < AUDIT_FLUSH_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        await _flush(batch)
+
+    # Остановка: дописываем всё, что успело попасть в очередь
+    remaining = []
+    while not queue.empty():
+        item = queue.get_nowait()
+        if item is not _STOP:
+            remaining.append(item)
+    for start in range(0, len(remaining), AUDIT_FLUSH_BATCH_SIZE):
+        await _flush(remaining[start:start + AUDIT_FLUSH_BATCH_SIZE])
+
+
+def start() -> asyncio.Task:
+    """Запустить фоновую задачу писателя (повторный вызов возвращает ту же задачу)"""
+    global _queue, _task, _accepting
+    if not is_running():
+        _queue = asyncio.Queue(maxsize=AUDIT_QUEUE_MAX_SIZE)
+        _task = asyncio.create_task(_run(_queue))
+        _accepting = True
+        logger.info(
+            f"Audit writer started (batch: {AUDIT_FLUSH_BATCH_SIZE}, interval: {AUDIT_FLUSH_INTERVAL_MS}ms, "
+            f"queue: {AUDIT_QUEUE_MAX_SIZE})"
+        )
+    return _task
+
+
+async def stop() -> None:
+    """Дописать очередь и остановить писателя; новые события после этого пишутся сразу"""
+    global _task, _accepting
+    task = _task
+    if task is None:
+        return
+    # С этого момента submit пишет сразу: события после маркера остановки не теряются
+    _accepting = False
+    if not task.done():
+        try:
+            await asyncio.wait_for(_queue.put(_STOP), AUDIT_STOP_TIMEOUT_SECONDS)
+            await asyncio.wait_for(asyncio.shield(task), AUDIT_STOP_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.error(f"Audit writer did not flush in {AUDIT_STOP_TIMEOUT_SECONDS}s, pending={_queue.qsize()}")
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    _task = None
+    logger.info(f"Audit writer stopped: {get_stats()}")
+
+
+def get_stats() -> Dict[str, int]:
+    """Счётчики писателя и текущая длина очереди"""
+    return {**AUDIT_WRITER_STATS, "queued": _queue.qsize() if _queue is not None else 0}
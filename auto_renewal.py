@@ -2,10 +2,13 @@
 import asyncio
 import logging
 import os
+import time
 from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
 from aiogram import Bot
 import database
 import localization
+import telegram_gateway
 import config
 
 logger = logging.getLogger(__name__)
@@ -24,7 +27,208 @@ if RENEWAL_WINDOW_HOURS < 1:
 RENEWAL_WINDOW = timedelta(hours=RENEWAL_WINDOW_HOURS)
 
 
-async def process_auto_renewals(bot: Bot):
+# Параллельных продлений (у каждого своё соединение и транзакция; пул БД - 10 соединений)
+AUTO_RENEWAL_CONCURRENCY = int(os.getenv("AUTO_RENEWAL_CONCURRENCY", "4"))
+
+# Исходы продления одной подписки
+RENEWAL_RENEWED = "renewed"
+RENEWAL_SKIPPED = "skipped"
+RENEWAL_INSUFFICIENT_BALANCE = "insufficient_balance"
+RENEWAL_FAILED = "failed"
+
+# Метрики автопродления (отдаются в /health): итоги с запуска и последний цикл
+AUTO_RENEWAL_STATS: Dict[str, Any] = {
+    "cycles": 0,
+    "renewed": 0,
+    "failed": 0,
+    "last_cycle": {},
+}
+
+
+def parse_tariff(tariff_str: Optional[str]) -> Tuple[str, int]:
+    """
+    Тариф последнего платежа -> (tariff_type, period_days)
+    
+    Формат может быть: "basic_30", "plus_90" или legacy "1", "3", "6", "12".
+    Без платежа или для неизвестного тарифа - Basic на 30 дней.
+    """
+    if not tariff_str:
+        return "basic", 30
+    if "_" in tariff_str:
+        parts = tariff_str.split("_")
+        tariff_type = parts[0] or "basic"
+        try:
+            period_days = int(parts[1])
+        except (ValueError, IndexError):
+            period_days = 30
+    else:
+        # Legacy формат: число месяцев, по умолчанию Basic
+        tariff_type = "basic"
+        try:
+            period_days = int(tariff_str) * 30
+        except ValueError:
+            period_days = 30
+    
+    if tariff_type not in config.TARIFFS or period_days not in config.TARIFFS[tariff_type]:
+        return "basic", 30
+    return tariff_type, period_days
+
+
+async def _renewal_price(telegram_id: int, tariff_type: str, period_days: int) -> float:
+    """Цена продления в рублях со скидками (VIP, персональная) - та же логика, что при покупке"""
+    base_price = config.TARIFFS[tariff_type][period_days]["price"]
+    if await database.is_vip_user(telegram_id):
+        return float(int(base_price * 0.70))  # 30% скидка
+    personal_discount = await database.get_user_discount(telegram_id)
+    if personal_discount:
+        return float(int(base_price * (1 - personal_discount["discount_percent"] / 100)))
+    return float(base_price)
+
+
+class _RenewalRollback(Exception):
+    """Продление невалидно: транзакция (вместе со списанием) откатывается"""
+
+
+async def renew_subscription(bot: Bot, subscription, last_tariff: Optional[str], now: datetime) -> str:
+    """
+    Продлить одну подписку с баланса в собственной транзакции
+    
+    Списание (проводка ledger с ключом идемпотентности), продление и запись платежа
+    выполняются на одном соединении в одной транзакции: при любой ошибке откатывается
+    всё, включая списание. Цена считается до захвата соединения - во время транзакции
+    воркер не берёт из пула других соединений.
+    
+    Returns:
+        Исход: RENEWAL_RENEWED | RENEWAL_SKIPPED | RENEWAL_INSUFFICIENT_BALANCE | RENEWAL_FAILED
+    """
+    telegram_id = subscription["telegram_id"]
+    language = subscription.get("language", "ru")
+    
+    tariff_type, period_days = parse_tariff(last_tariff)
+    amount_rubles = await _renewal_price(telegram_id, tariff_type, period_days)
+    amount_kopecks = int(amount_rubles * 100)
+    
+    # Баланс пользователя (в копейках из БД, конвертируем в рубли)
+    balance_rubles = (subscription.get("balance", 0) or 0) / 100.0
+    if balance_rubles < amount_rubles:
+        # Баланса не хватает - ничего не делаем, auto_renew не отключаем, не уведомляем
+        logger.debug(
+            f"Insufficient balance for auto-renewal: user={telegram_id}, "
+            f"balance={balance_rubles:.2f} RUB, required={amount_rubles:.2f} RUB"
+        )
+        return RENEWAL_INSUFFICIENT_BALANCE
+    
+    duration = timedelta(days=period_days)
+    months = period_days // 30
+    tariff_name = "Basic" if tariff_type == "basic" else "Plus"
+    
+    pool = await database.get_pool()
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Дополнительная проверка: подписка ещё не обработана
+                # (SKIP LOCKED: строку, заблокированную другим воркером, пропускаем)
+                current_sub = await conn.fetchrow(
+                    """SELECT auto_renew, expires_at, last_auto_renewal_at 
+                       FROM subscriptions 
+                       WHERE telegram_id = $1
+                       FOR UPDATE SKIP LOCKED""",
+                    telegram_id
+                )
+                
+                if not current_sub or not current_sub["auto_renew"]:
+                    logger.debug(f"Subscription {telegram_id} no longer has auto_renew enabled, skipping")
+                    return RENEWAL_SKIPPED
+                
+                # Если автопродление было менее 12 часов назад - пропускаем (защита от повторного списания)
+                last_renewal = current_sub["last_auto_renewal_at"]
+                if last_renewal and (now - last_renewal).total_seconds() < 43200:
+                    logger.debug(f"Subscription {telegram_id} was already processed recently, skipping")
+                    return RENEWAL_SKIPPED
+                
+                # Списываем баланс в транзакции продления; ключ - продлеваемый период
+                # (повторное списание за тот же expires_at невозможно)
+                ledger = await database._apply_ledger_entry(
+                    conn, telegram_id, -amount_kopecks, "subscription_payment",
+                    source="auto_renew",
+                    description=f"Автопродление подписки {tariff_name} на {months} месяц(ев)",
+                    idempotency_key=f"auto_renew:{telegram_id}:{current_sub['expires_at']:%Y%m%d%H%M%S}"
+                )
+                if ledger["status"] == database.LEDGER_INSUFFICIENT_FUNDS:
+                    logger.debug(f"Insufficient balance for auto-renewal at debit: user={telegram_id}")
+                    return RENEWAL_INSUFFICIENT_BALANCE
+                if ledger["status"] == database.LEDGER_DUPLICATE:
+                    logger.warning(f"Auto-renewal already charged for this period: user={telegram_id}")
+                    return RENEWAL_SKIPPED
+                if ledger["status"] != database.LEDGER_APPLIED:
+                    logger.error(f"Failed to debit balance for auto-renewal: user={telegram_id}, status={ledger['status']}")
+                    return RENEWAL_FAILED
+                
+                # Продлеваем подписку через единую функцию grant_access
+                # grant_access() определит, что это продление (UUID не будет пересоздан)
+                result = await database.grant_access(
+                    telegram_id=telegram_id,
+                    duration=duration,
+                    source="auto_renew",
+                    admin_telegram_id=None,
+                    admin_grant_days=None,
+                    conn=conn  # Используем соединение транзакции для атомарности
+                )
+                
+                expires_at = result["subscription_end"]
+                action_type = result.get("action", "unknown")
+                
+                # ВАЛИДАЦИЯ: При автопродлении UUID НЕ должен пересоздаваться
+                if action_type != "renewal" or result.get("vless_url") is not None:
+                    raise _RenewalRollback(
+                        f"UUID was regenerated instead of renewal: action={action_type}, "
+                        f"has_vless_url={result.get('vless_url') is not None}"
+                    )
+                if expires_at is None:
+                    raise _RenewalRollback("grant_access returned expires_at=None")
+                
+                # Отмечаем, что автопродление было выполнено (защита от повторного списания)
+                await conn.execute(
+                    "UPDATE subscriptions SET last_auto_renewal_at = $1 WHERE telegram_id = $2",
+                    now, telegram_id
+                )
+                
+                # Создаем запись о платеже для аналитики
+                await conn.execute(
+                    "INSERT INTO payments (telegram_id, tariff, amount, status) VALUES ($1, $2, $3, 'approved')",
+                    telegram_id, f"{tariff_type}_{period_days}", amount_kopecks  # Сохраняем в копейках
+                )
+    except _RenewalRollback as e:
+        # Транзакция откатилась вместе со списанием - возврат не нужен
+        logger.error(f"Auto-renewal ERROR, rolled back: user={telegram_id}, reason={e}")
+        return RENEWAL_FAILED
+    
+    # Уведомление - после фиксации транзакции (строка подписки не заблокирована на время отправки)
+    expires_str = expires_at.strftime("%d.%m.%Y")
+    try:
+        text = localization.get_text(
+            language,
+            "auto_renewal_success",
+            days=duration.days,
+            expires_date=expires_str,
+            amount=amount_rubles
+        )
+    except (KeyError, TypeError):
+        # Fallback на старый формат, если локализация не обновлена
+        text = f"✅ Подписка автоматически продлена на {duration.days} дней.\n\nДействует до: {expires_str}\nС баланса списано: {amount_rubles:.2f} ₽"
+    try:
+        await bot.send_message(telegram_id, text)
+    except Exception as e:
+        logger.warning(f"Failed to send auto-renewal notification: user={telegram_id}, error={e}")
+    
+    logger.info(
+        f"Auto-renewal successful: user={telegram_id}, tariff={tariff_type}, period_days={period_days}, "
+        f"amount={amount_rubles} RUB, expires_at={expires_str}"
+    )
+    return RENEWAL_RENEWED
+
+
+async def process_auto_renewals(bot: Bot) -> Dict[str, Any]:
     """
     Обработать автопродление подписок, которые истекают в течение RENEWAL_WINDOW
     
@@ -35,21 +239,27 @@ async def process_auto_renewals(bot: Bot):
     - Если баланса хватает: продлеваем через grant_access() (без создания нового UUID)
     - Если баланса не хватает: ничего не делаем (auto-expiry обработает)
     
+    Тарифы последних платежей всех кандидатов загружаются одним запросом
+    (database.get_last_approved_tariffs), продления выполняются параллельно
+    (не больше AUTO_RENEWAL_CONCURRENCY), каждое в своей транзакции.
+    
     Защита от повторного списания:
     - Используется last_auto_renewal_at для отслеживания последнего автопродления
-    - Одна подписка обрабатывается только один раз за цикл
+    - Строка подписки блокируется FOR UPDATE SKIP LOCKED на время продления
     - Идемпотентность: при рестарте не будет двойного списания
-    - Атомарные транзакции для баланса и подписки
+    
+    Returns:
+        Метрики цикла (также сохраняются в AUTO_RENEWAL_STATS["last_cycle"])
     """
-    pool = await database.get_pool()
-    async with pool.acquire() as conn:
-        # Находим подписки, которые истекают в течение RENEWAL_WINDOW и имеют auto_renew = true
-        # Исключаем подписки, которые уже были обработаны в этом цикле (защита от повторного списания)
-        now = datetime.now()
-        renewal_threshold = now + RENEWAL_WINDOW
-        
-        subscriptions = await conn.fetch(
-            """SELECT s.*, u.language, u.balance
+    started = time.monotonic()
+    now = datetime.now()
+    renewal_threshold = now + RENEWAL_WINDOW
+    
+    # Кандидаты ограничены окном RENEWAL_WINDOW; читаем потоково пакетами
+    candidates = [
+        subscription
+        async for subscription in database.stream_rows(
+            """SELECT s.telegram_id, u.language, u.balance
                FROM subscriptions s
                JOIN users u ON s.telegram_id = u.telegram_id
                WHERE s.status = 'active'
@@ -60,210 +270,57 @@ async def process_auto_renewals(bot: Bot):
                AND (s.last_auto_renewal_at IS NULL OR s.last_auto_renewal_at < s.expires_at - INTERVAL '12 hours')""",
             renewal_threshold, now
         )
-        
-        logger.info(
-            f"Auto-renewal check: Found {len(subscriptions)} subscriptions expiring within {RENEWAL_WINDOW_HOURS} hours"
+    ]
+    
+    outcomes = {
+        RENEWAL_RENEWED: 0,
+        RENEWAL_SKIPPED: 0,
+        RENEWAL_INSUFFICIENT_BALANCE: 0,
+        RENEWAL_FAILED: 0,
+    }
+    if candidates:
+        last_tariffs = await database.get_last_approved_tariffs(
+            [subscription["telegram_id"] for subscription in candidates]
         )
+        semaphore = asyncio.Semaphore(AUTO_RENEWAL_CONCURRENCY)
         
-        for sub_row in subscriptions:
-            subscription = dict(sub_row)
+        async def _renew(subscription) -> str:
             telegram_id = subscription["telegram_id"]
-            language = subscription.get("language", "ru")
-            
-            # Используем транзакцию для атомарности операции
-            async with conn.transaction():
+            async with semaphore:
                 try:
-                    # Дополнительная проверка: убеждаемся, что подписка еще не была обработана
-                    # (защита от race condition при параллельных вызовах)
-                    current_sub = await conn.fetchrow(
-                        """SELECT auto_renew, expires_at, last_auto_renewal_at 
-                           FROM subscriptions 
-                           WHERE telegram_id = $1
-                           FOR UPDATE SKIP LOCKED""",  # SKIP LOCKED allows parallel workers to skip locked rows
-                        telegram_id
-                    )
-                    
-                    if not current_sub or not current_sub["auto_renew"]:
-                        logger.debug(f"Subscription {telegram_id} no longer has auto_renew enabled, skipping")
-                        continue
-                    
-                    # Проверяем, не была ли подписка уже обработана
-                    last_renewal = current_sub.get("last_auto_renewal_at")
-                    if last_renewal:
-                        if isinstance(last_renewal, str):
-                            last_renewal = datetime.fromisoformat(last_renewal)
-                        # Если автопродление было менее 12 часов назад - пропускаем (защита от повторного списания)
-                        if (now - last_renewal).total_seconds() < 43200:  # 12 часов
-                            logger.debug(f"Subscription {telegram_id} was already processed recently, skipping")
-                            continue
-                    
-                    # Получаем последний утвержденный платеж для определения тарифа
-                    last_payment = await database.get_last_approved_payment(telegram_id)
-                    
-                    # Парсим тариф из последнего платежа
-                    # Формат может быть: "basic_30", "plus_90" или legacy "1", "3", "6", "12"
-                    if not last_payment:
-                        # Если нет платежа, используем дефолтный тариф Basic на 30 дней (1 месяц)
-                        tariff_type = "basic"
-                        period_days = 30
-                    else:
-                        tariff_str = last_payment.get("tariff", "basic_30")
-                        # Парсим формат "basic_30" или "plus_90"
-                        if "_" in tariff_str:
-                            parts = tariff_str.split("_")
-                            tariff_type = parts[0] if len(parts) > 0 else "basic"
-                            try:
-                                period_days = int(parts[1]) if len(parts) > 1 else 30
-                            except (ValueError, IndexError):
-                                period_days = 30
-                        else:
-                            # Legacy формат: "1", "3", "6", "12" -> конвертируем в новый формат
-                            # По умолчанию используем Basic
-                            tariff_type = "basic"
-                            try:
-                                months = int(tariff_str)
-                                period_days = months * 30
-                            except ValueError:
-                                period_days = 30
-                    
-                    # Получаем базовую цену из новой структуры тарифов
-                    if tariff_type not in config.TARIFFS or period_days not in config.TARIFFS[tariff_type]:
-                        # Если тариф не найден, используем Basic 30 дней
-                        tariff_type = "basic"
-                        period_days = 30
-                    
-                    base_price = config.TARIFFS[tariff_type][period_days]["price"]
-                    
-                    # Применяем скидки (VIP, персональная) - та же логика, что при покупке
-                    is_vip = await database.is_vip_user(telegram_id)
-                    if is_vip:
-                        amount_rubles = float(int(base_price * 0.70))  # 30% скидка
-                    else:
-                        personal_discount = await database.get_user_discount(telegram_id)
-                        if personal_discount:
-                            discount_percent = personal_discount["discount_percent"]
-                            amount_rubles = float(int(base_price * (1 - discount_percent / 100)))
-                        else:
-                            amount_rubles = float(base_price)
-                    
-                    # Получаем баланс пользователя (в копейках из БД, конвертируем в рубли)
-                    user_balance_kopecks = subscription.get("balance", 0) or 0
-                    balance_rubles = user_balance_kopecks / 100.0
-                    
-                    if balance_rubles >= amount_rubles:
-                        # Баланса хватает - продлеваем подписку
-                        duration = timedelta(days=period_days)
-                        
-                        # Списываем баланс (source = auto_renew для идентификации)
-                        months = period_days // 30
-                        tariff_name = "Basic" if tariff_type == "basic" else "Plus"
-                        success = await database.decrease_balance(
-                            telegram_id=telegram_id,
-                            amount=amount_rubles,
-                            source="auto_renew",
-                            description=f"Автопродление подписки {tariff_name} на {months} месяц(ев)"
-                        )
-                        
-                        if not success:
-                            logger.error(f"Failed to decrease balance for auto-renewal: user={telegram_id}")
-                            continue
-                        
-                        # Продлеваем подписку через единую функцию grant_access
-                        # source="auto_renew" для корректного аудита и аналитики
-                        # grant_access() автоматически определит, что это продление (UUID не будет пересоздан)
-                        result = await database.grant_access(
-                            telegram_id=telegram_id,
-                            duration=duration,
-                            source="auto_renew",  # Используем source="auto_renew" для аудита
-                            admin_telegram_id=None,
-                            admin_grant_days=None,
-                            conn=conn  # Используем существующее соединение для атомарности
-                        )
-                        
-                        expires_at = result["subscription_end"]
-                        action_type = result.get("action", "unknown")
-                        
-                        # ВАЛИДАЦИЯ: При автопродлении UUID НЕ должен пересоздаваться
-                        # grant_access() должен вернуть action="renewal" и vless_url=None
-                        if action_type != "renewal" or result.get("vless_url") is not None:
-                            logger.error(
-                                f"Auto-renewal ERROR: UUID was regenerated instead of renewal! "
-                                f"user={telegram_id}, action={action_type}, has_vless_url={result.get('vless_url') is not None}"
-                            )
-                            # Это критическая ошибка - UUID не должен был пересоздаться
-                            # Возвращаем деньги на баланс
-                            await database.increase_balance(
-                                telegram_id=telegram_id,
-                                amount=amount_rubles,
-                                source="refund",
-                                description=f"Возврат средств: ошибка автопродления (UUID пересоздан)"
-                            )
-                            continue
-                        
-                        # Получаем vpn_key из существующей подписки (UUID не менялся)
-                        subscription_row = await conn.fetchrow(
-                            "SELECT vpn_key FROM subscriptions WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                        vpn_key = None
-                        if subscription_row and subscription_row.get("vpn_key"):
-                            vpn_key = subscription_row["vpn_key"]
-                        else:
-                            # Fallback: используем UUID (не должно быть, но на всякий случай)
-                            vpn_key = result.get("uuid", "")
-                        
-                        if expires_at is None:
-                            logger.error(f"Failed to renew subscription for auto-renewal: user={telegram_id}, expires_at=None")
-                            # Возвращаем деньги на баланс
-                            await database.increase_balance(
-                                telegram_id=telegram_id,
-                                amount=amount_rubles,
-                                source="refund",
-                                description=f"Возврат средств за неудачное автопродление"
-                            )
-                            continue
-                        
-                        # Отмечаем, что автопродление было выполнено (защита от повторного списания)
-                        await conn.execute(
-                            "UPDATE subscriptions SET last_auto_renewal_at = $1 WHERE telegram_id = $2",
-                            now, telegram_id
-                        )
-                        
-                        # Создаем запись о платеже для аналитики
-                        tariff_str = f"{tariff_type}_{period_days}"
-                        await conn.execute(
-                            "INSERT INTO payments (telegram_id, tariff, amount, status) VALUES ($1, $2, $3, 'approved')",
-                            telegram_id, tariff_str, int(amount_rubles * 100)  # Сохраняем в копейках
-                        )
-                        
-                        # Отправляем уведомление пользователю
-                        expires_str = expires_at.strftime("%d.%m.%Y")
-                        duration_days = duration.days
-                        try:
-                            text = localization.get_text(
-                                language,
-                                "auto_renewal_success",
-                                days=duration_days,
-                                expires_date=expires_str,
-                                amount=amount_rubles
-                            )
-                        except (KeyError, TypeError):
-                            # Fallback на старый формат, если локализация не обновлена
-                            text = f"✅ Подписка автоматически продлена на {duration_days} дней.\n\nДействует до: {expires_str}\nС баланса списано: {amount_rubles:.2f} ₽"
-                        
-                        await bot.send_message(telegram_id, text)
-                        
-                        logger.info(f"Auto-renewal successful: user={telegram_id}, tariff={tariff_type}, period_days={period_days}, amount={amount_rubles} RUB, expires_at={expires_str}")
-                        
-                    else:
-                        # Баланса не хватает - ничего не делаем (как указано в требованиях)
-                        logger.debug(f"Insufficient balance for auto-renewal: user={telegram_id}, balance={balance_rubles:.2f} RUB, required={amount_rubles:.2f} RUB")
-                        # НЕ отключаем auto_renew автоматически (пользователь может пополнить баланс)
-                        # НЕ отправляем уведомление (как указано в требованиях)
-                    
+                    return await renew_subscription(bot, subscription, last_tariffs.get(telegram_id), now)
                 except Exception as e:
+                    # Ошибка одной подписки не останавливает цикл; её транзакция откатывается
                     logger.exception(f"Error processing auto-renewal for user {telegram_id}: {e}")
-                    # При ошибке транзакция откатывается автоматически
+                    return RENEWAL_FAILED
+        
+        for outcome in await asyncio.gather(*(_renew(subscription) for subscription in candidates)):
+            outcomes[outcome] += 1
+    
+    duration = time.monotonic() - started
+    cycle = {
+        "candidates": len(candidates),
+        **outcomes,
+        "duration_ms": round(duration * 1000, 1),
+        "renewals_per_second": round(len(candidates) / duration, 1) if candidates and duration > 0 else 0.0,
+        "finished_at": datetime.now().isoformat(),
+    }
+    AUTO_RENEWAL_STATS["cycles"] += 1
+    AUTO_RENEWAL_STATS["renewed"] += outcomes[RENEWAL_RENEWED]
+    AUTO_RENEWAL_STATS["failed"] += outcomes[RENEWAL_FAILED]
+    AUTO_RENEWAL_STATS["last_cycle"] = cycle
+    
+    logger.info(
+        f"Auto-renewal check: processed {len(candidates)} subscriptions expiring within {RENEWAL_WINDOW_HOURS} hours "
+        f"(renewed={outcomes[RENEWAL_RENEWED]}, insufficient_balance={outcomes[RENEWAL_INSUFFICIENT_BALANCE]}, "
+        f"skipped={outcomes[RENEWAL_SKIPPED]}, failed={outcomes[RENEWAL_FAILED]}, {cycle['duration_ms']}ms)"
+    )
+    return cycle
+
+
+def get_stats() -> Dict[str, Any]:
+    """Метрики автопродления: итоги и последний цикл"""
+    return {**AUTO_RENEWAL_STATS, "last_cycle": dict(AUTO_RENEWAL_STATS["last_cycle"])}
 
 
 async def auto_renewal_task(bot: Bot):
@@ -280,6 +337,8 @@ async def auto_renewal_task(bot: Bot):
     - Атомарность (баланс и подписка обновляются в одной транзакции)
     - UUID стабильность (продление без пересоздания UUID через grant_access)
     """
+    # Уведомление о списании за продление - подтверждение оплаты
+    telegram_gateway.set_lane(telegram_gateway.LANE_PAYMENT)
     logger.info(
         f"Auto-renewal task started: interval={AUTO_RENEWAL_INTERVAL_SECONDS}s, "
         f"renewal_window={RENEWAL_WINDOW_HOURS}h"
@@ -0,0 +1,86 @@
+"""
+Balance Reconciliation - периодическая сверка баланса с ledger
+
+Фоновая задача сверяет кэшированный снапшот users.balance с суммой проводок
+в balance_transactions (append-only ledger). Расхождения логируются и
+отправляются администратору (только при изменении набора расхождений,
+чтобы не спамить одним и тем же отчётом).
+
+Сверка ничего не исправляет автоматически: исправление оформляется
+компенсирующей проводкой через increase_balance / decrease_balance.
+"""
+import asyncio
+import logging
+import os
+from aiogram import Bot
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+# Интервал сверки (по умолчанию 6 часов)
+RECONCILIATION_INTERVAL_SECONDS = int(os.getenv("BALANCE_RECONCILIATION_INTERVAL_SECONDS", str(6 * 60 * 60)))
+
+# Отпечаток последнего отправленного отчёта (не отправляем повторно тот же набор расхождений)
+_last_reported_fingerprint = None
+
+
+async def run_reconciliation(bot: Bot) -> dict:
+    """
+    Выполнить одну сверку и уведомить администратора о новых расхождениях
+
+    Returns:
+        Результат database.reconcile_balances()
+    """
+    global _last_reported_fingerprint
+
+    result = await database.reconcile_balances()
+    mismatch_count = result["mismatch_count"]
+
+    if mismatch_count == 0:
+        logger.info("Balance reconciliation: snapshot matches ledger for all users")
+        _last_reported_fingerprint = None
+        return result
+
+    logger.warning(f"Balance reconciliation: {mismatch_count} users with snapshot/ledger mismatch")
+
+    fingerprint = tuple((m["telegram_id"], m["difference"]) for m in result["mismatches"])
+    if fingerprint == _last_reported_fingerprint:
+        return result
+
+    lines = [
+        f"{m['telegram_id']}: баланс {m['balance'] / 100:.2f} ₽, ledger {m['ledger_sum'] / 100:.2f} ₽ "
+        f"(разница {m['difference'] / 100:+.2f} ₽)"
+        for m in result["mismatches"][:20]
+    ]
+    text = (
+        "⚠️ <b>Сверка баланса: найдены расхождения</b>\n\n"
+        f"Пользователей с расхождением: {mismatch_count}\n\n"
+        + "\n".join(lines)
+    )
+    try:
+        await bot.send_message(config.ADMIN_TELEGRAM_ID, text, parse_mode="HTML")
+        _last_reported_fingerprint = fingerprint
+    except Exception as e:
+        logger.error(f"Failed to send balance reconciliation report to admin: {e}")
+
+    return result
+
+
+async def balance_reconciliation_task(bot: Bot):
+    """Фоновая задача периодической сверки баланса с ledger"""
+    logger.info(f"Balance reconciliation task started (interval: {RECONCILIATION_INTERVAL_SECONDS} seconds)")
+
+    # Небольшая задержка при старте, чтобы не нагружать БД во время запуска
+    await asyncio.sleep(300)
+
+    while True:
+        try:
+            await run_reconciliation(bot)
+        except asyncio.CancelledError:
+            logger.info("Balance reconciliation task cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Error in balance_reconciliation_task: {e}")
+
+        await asyncio.sleep(RECONCILIATION_INTERVAL_SECONDS)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: concurrent balance debits
+
+Сравнивает старую схему списания (SELECT balance + UPDATE в транзакции)
+с ledger-списанием (database.decrease_balance: один условный UPDATE ... RETURNING + проводка)
+при N конкурентных списаниях с одного пользователя.
+
+Проверяет инварианты:
+- баланс не уходит в минус
+- снапшот users.balance совпадает с суммой проводок
+
+Запуск (нужна БД с применёнными миграциями):
+    DATABASE_URL=postgres://... python bench_balance_debits.py [concurrency] [debits]
+"""
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("ADMIN_TELEGRAM_ID", "1")
+os.environ.setdefault("ENVIRONMENT", "dev")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+import database  # noqa: E402
+
+BENCH_USER_ID = -900000001
+START_BALANCE_KOPECKS = 100_000
+DEBIT_RUBLES = 1.0
+
+
+async def _reset_user(conn):
+    await conn.execute("""
+        INSERT INTO users (telegram_id, username, language, balance)
+        VALUES ($1, 'bench_balance', 'ru', 0)
+        ON CONFLICT (telegram_id) DO NOTHING
+    """, BENCH_USER_ID)
+    current = await conn.fetchval("SELECT balance FROM users WHERE telegram_id = $1", BENCH_USER_ID)
+    # Доводим баланс до стартового значения проводкой (ledger append-only)
+    async with conn.transaction():
+        await database._apply_ledger_entry(
+            conn, BENCH_USER_ID, START_BALANCE_KOPECKS - current, "admin_adjustment",
+            source="benchmark", description="bench reset", allow_negative=True
+        )
+
+
+async def _legacy_debit(pool, amount_kopecks: int) -> bool:
+    """Старая схема: SELECT balance, проверка в Python, UPDATE"""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            current = await conn.fetchval(
+                "SELECT balance FROM users WHERE telegram_id = $1 FOR UPDATE", BENCH_USER_ID
+            )
+            if current < amount_kopecks:
+                return False
+            await conn.execute(
+                "UPDATE users SET balance = balance - $1 WHERE telegram_id = $2",
+                amount_kopecks, BENCH_USER_ID
+            )
+            await conn.execute(
+                """INSERT INTO balance_transactions (user_id, amount, type, source, description)
+                   VALUES ($1, $2, 'subscription_payment', 'benchmark', 'legacy debit')""",
+                BENCH_USER_ID, -amount_kopecks
+            )
+            return True
+
+
+async def _run(name: str, debit, concurrency: int, debits: int):
+    pool = await database.get_pool()
+    async with pool.acquire() as conn:
+        await _reset_user(conn)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            ok = await debit()
+            latencies.append(time.perf_counter() - started)
+            return ok
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(debits)))
+    elapsed = time.perf_counter() - started
+
+    async with pool.acquire() as conn:
+        balance = await conn.fetchval("SELECT balance FROM users WHERE telegram_id = $1", BENCH_USER_ID)
+        ledger_sum = await conn.fetchval(
+            "SELECT COALESCE(SUM(amount), 0)::BIGINT FROM balance_transactions WHERE user_id = $1", BENCH_USER_ID
+        )
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(
+        f"{name:8s} ok={sum(results):5d}/{debits} {debits / elapsed:8.1f} debits/s "
+        f"p50={p50:.2f}ms p99={p99:.2f}ms balance={balance} ledger_sum={ledger_sum}"
+    )
+    assert balance >= 0, "balance went negative"
+    assert balance == ledger_sum, "snapshot diverged from ledger"
+
+
+async def main():
+    if not os.getenv("DATABASE_URL"):
+        print("ERROR: DATABASE_URL not set", file=sys.stderr)
+        sys.exit(1)
+
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    debits = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    pool = await database.get_pool()
+    amount_kopecks = int(DEBIT_RUBLES * 100)
+    try:
+        await _run("legacy", lambda: _legacy_debit(pool, amount_kopecks), concurrency, debits)
+        await _run(
+            "ledger",
+            lambda: database.decrease_balance(BENCH_USER_ID, DEBIT_RUBLES, source="benchmark"),
+            concurrency, debits
+        )
+    finally:
+        await database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
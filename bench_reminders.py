@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark: цикл умных уведомлений reminders.send_smart_notifications
+
+Создаёт N тестовых пользователей с активными подписками (отрицательные telegram_id),
+каждой SEND_EVERY-й подписке положено уведомление "нет трафика 20 минут".
+Сравнивает:
+- per-row: прежняя схема (database.get_user на каждую подписку, последовательная
+  отправка, отдельный UPDATE флага на каждое уведомление)
+- batched: reminders.send_smart_notifications (язык в запросе, параллельная отправка,
+  один UPDATE ... FROM unnest за цикл)
+
+Отправка эмулируется задержкой SEND_LATENCY_MS (бот без сети, без telegram_gateway),
+поэтому время цикла - это накладные расходы БД и Python плюс ожидание отправок.
+
+Запуск (нужна БД с применёнными миграциями):
+    DATABASE_URL=postgres://... python bench_reminders.py [subscriptions] [send_latency_ms]
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("ADMIN_TELEGRAM_ID", "1")
+os.environ.setdefault("ENVIRONMENT", "dev")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+import database  # noqa: E402
+import reminders  # noqa: E402
+
+BENCH_ID_BASE = -910000000
+SEND_EVERY = 10
+
+
+class FakeBot:
+    """Бот без сети: отправка занимает send_latency секунд"""
+
+    def __init__(self, send_latency: float):
+        self.send_latency = send_latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+
+
+async def _seed(conn, count: int):
+    await _cleanup(conn)
+    await conn.execute("""
+        INSERT INTO users (telegram_id, username, language)
+        SELECT $1 - g, 'bench_reminders', 'ru' FROM generate_series(1, $2) AS g
+    """, BENCH_ID_BASE, count)
+    # Каждой SEND_EVERY-й подписке положено уведомление (активирована 30 минут назад, трафика нет),
+    # остальные активированы только что
+    await conn.execute("""
+        INSERT INTO subscriptions (telegram_id, uuid, vpn_key, expires_at, status, source, activated_at, last_bytes)
+        SELECT $1 - g, 'bench-' || g, 'bench', NOW() + INTERVAL '30 days', 'active', 'payment',
+               CASE WHEN g % $3 = 0 THEN NOW() - INTERVAL '30 minutes' ELSE NOW() END, 0
+        FROM generate_series(1, $2) AS g
+    """, BENCH_ID_BASE, count, SEND_EVERY)
+
+
+async def _cleanup(conn):
+    await conn.execute("DELETE FROM subscriptions WHERE telegram_id <= $1 AND telegram_id > $1 - 10000000", BENCH_ID_BASE)
+    await conn.execute("DELETE FROM users WHERE telegram_id <= $1 AND telegram_id > $1 - 10000000", BENCH_ID_BASE)
+
+
+async def _reset_flags(conn):
+    await conn.execute("""
+        UPDATE subscriptions
+        SET smart_notif_no_traffic_20m_sent = FALSE, last_notification_sent_at = NULL
+        WHERE telegram_id <= $1 AND telegram_id > $1 - 10000000
+    """, BENCH_ID_BASE)
+
+
+async def _per_row_cycle(bot: FakeBot):
+    """Прежняя схема цикла (только правило 1 - остальные подпискам не положены)"""
+    pool = await database.get_pool()
+    now = datetime.now()
+    async for subscription in database.stream_rows("""
+        SELECT telegram_id, activated_at, last_bytes, smart_notif_no_traffic_20m_sent
+        FROM subscriptions
+        WHERE status = 'active' AND uuid IS NOT NULL AND expires_at > NOW()
+    """):
+        user = await database.get_user(subscription["telegram_id"])
+        language = user.get("language", "ru") if user else "ru"
+        if ((now - subscription["activated_at"]).total_seconds() >= 20 * 60
+                and not subscription["last_bytes"]
+                and not subscription["smart_notif_no_traffic_20m_sent"]):
+            await bot.send_message(subscription["telegram_id"], language)
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    """UPDATE subscriptions
+                       SET smart_notif_no_traffic_20m_sent = TRUE, last_notification_sent_at = $1
+                       WHERE telegram_id = $2""",
+                    now, subscription["telegram_id"]
+                )
+
+
+async def _run(name: str, cycle, send_latency: float):
+    pool = await database.get_pool()
+    async with pool.acquire() as conn:
+        await _reset_flags(conn)
+    bot = FakeBot(send_latency)
+    started = time.perf_counter()
+    await cycle(bot)
+    elapsed = time.perf_counter() - started
+    async with pool.acquire() as conn:
+        marked = await conn.fetchval("""
+            SELECT COUNT(*) FROM subscriptions
+            WHERE telegram_id <= $1 AND telegram_id > $1 - 10000000
+            AND smart_notif_no_traffic_20m_sent
+        """, BENCH_ID_BASE)
+    print(f"{name:8s} cycle={elapsed:8.2f}s sent={bot.sent:6d} flags_marked={marked:6d}")
+    assert marked == bot.sent, "sent notifications and flags diverged"
+
+
+async def main():
+    if not os.getenv("DATABASE_URL"):
+        print("ERROR: DATABASE_URL not set", file=sys.stderr)
+        sys.exit(1)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    send_latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 30.0) / 1000
+
+    pool = await database.get_pool()
+    try:
+        async with pool.acquire() as conn:
+            await _seed(conn, count)
+        print(f"subscriptions={count}, due={count // SEND_EVERY}, send_latency={send_latency * 1000:.0f}ms")
+        await _run("per-row", _per_row_cycle, send_latency)
+        await _run("batched", reminders.send_smart_notifications, send_latency)
+    finally:
+        async with pool.acquire() as conn:
+            await _cleanup(conn)
+        await database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: dict(row) по SELECT * против записей с __slots__ по проекции
+
+Читает подписки и пользователей двумя способами:
+- dict:  SELECT * + [dict(row) for row in rows] (прежняя схема)
+- slots: SELECT <проекция> + [Subscription.from_row(row) ...] (db_records)
+
+Для каждого способа печатает время запроса с упаковкой (p50 по повторам)
+и пиковую память Python (tracemalloc) на удержание результата.
+
+Запуск (нужна БД с данными):
+    DATABASE_URL=postgres://... python bench_row_records.py [limit] [repeats]
+"""
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("ADMIN_TELEGRAM_ID", "1")
+os.environ.setdefault("ENVIRONMENT", "dev")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+import database  # noqa: E402
+from db_records import Subscription, User  # noqa: E402
+
+
+async def _measure(pool, query: str, limit: int, pack, repeats: int):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(query, limit)
+        result = pack(rows)
+        timings.append(time.perf_counter() - started)
+        del rows, result
+
+    # Память: сколько аллоцируется на выборку и упаковку, и сколько удерживает результат
+    async with pool.acquire() as conn:
+        gc.collect()
+        tracemalloc.start()
+        rows = await conn.fetch(query, limit)
+        result = pack(rows)
+        del rows
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    timings.sort()
+    return len(result), timings[len(timings) // 2] * 1000, peak, retained
+
+
+async def _compare(pool, table: str, record_cls, limit: int, repeats: int):
+    variants = [
+        ("dict", f"SELECT * FROM {table} LIMIT $1", lambda rows: [dict(row) for row in rows]),
+        (
+            "slots",
+            f"SELECT {record_cls.columns_sql()} FROM {table} LIMIT $1",
+            lambda rows: [record_cls.from_row(row) for row in rows],
+        ),
+    ]
+    for name, query, pack in variants:
+        count, p50_ms, peak, retained = await _measure(pool, query, limit, pack, repeats)
+        print(
+            f"{table:14s} {name:6s} rows={count:7d} p50={p50_ms:8.2f}ms "
+            f"peak={peak / 1024:10.1f}KiB retained={retained / 1024:10.1f}KiB"
+        )
+
+
+async def main():
+    if not os.getenv("DATABASE_URL"):
+        print("ERROR: DATABASE_URL not set", file=sys.stderr)
+        sys.exit(1)
+
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    pool = await database.get_pool()
+    try:
+        await _compare(pool, "subscriptions", Subscription, limit, repeats)
+        await _compare(pool, "users", User, limit, repeats)
+    finally:
+        await database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,169 @@
+"""
+Broadcast Worker - фоновое выполнение рассылок
+
+Обработчик подтверждения рассылки только создаёт задание (broadcasts.job_status =
+queued), отправку выполняет этот воркер:
+- получатели сегмента читаются потоково (database.stream_rows) пакетами
+  по BROADCAST_BATCH_SIZE, с контрольной точки last_telegram_id
+- сообщения пакета отправляются параллельно (не больше BROADCAST_CONCURRENCY
+  одновременно), темп задаёт telegram_gateway (полоса рассылок)
+- после пакета результаты пишутся в broadcast_log одним COPY вместе с контрольной
+  точкой (database.checkpoint_broadcast_job); после рестарта рассылка продолжается
+  с первого неподтверждённого пакета
+- пауза / отмена из админ-панели проверяются после каждого пакета
+- задание выполняет одна реплика: воркер держит аренду задания
+  (BROADCAST_WORKER_ID) и продлевает её на каждой контрольной точке; задание
+  упавшей реплики берётся другой после истечения аренды
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram import Bot
+import database
+import telegram_gateway
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "200"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_POLL_INTERVAL_SECONDS = int(os.getenv("BROADCAST_POLL_INTERVAL_SECONDS", "5"))
+
+# Владелец аренды заданий рассылки (реплика и процесс)
+BROADCAST_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+TYPE_EMOJI = {
+    "info": "ℹ️",
+    "maintenance": "🔧",
+    "security": "🔒",
+    "promo": "🎯",
+}
+
+
+def build_messages(job: Dict[str, Any]) -> Dict[Optional[str], str]:
+    """Тексты рассылки по вариантам: {None: текст} или {"A": ..., "B": ...} для A/B теста"""
+    emoji = TYPE_EMOJI.get(job["type"], "📢")
+    if job["is_ab_test"]:
+        return {
+            "A": f"{emoji} {job['title']}\n\n{job['message_a']}",
+            "B": f"{emoji} {job['title']}\n\n{job['message_b']}",
+        }
+    return {None: f"{emoji} {job['title']}\n\n{job['message']}"}
+
+
+async def _send_one(
+    bot: Bot,
+    semaphore: asyncio.Semaphore,
+    telegram_id: int,
+    messages: Dict[Optional[str], str]
+) -> Tuple[int, str, Optional[str]]:
+    # Вариант A/B выбирается случайно 50/50 (и для неудачных отправок)
+    variant = random.choice(["A", "B"]) if None not in messages else None
+    async with semaphore:
+        try:
+            await bot.send_message(telegram_id, messages[variant])
+            return telegram_id, "sent", variant
+        except Exception as e:
+            logger.warning(f"Broadcast send failed: user={telegram_id}, error={e}")
+            return telegram_id, "failed", variant
+
+
+async def run_broadcast_job(bot: Bot, job: Dict[str, Any]) -> Optional[str]:
+    """
+    Выполнить задание рассылки с его контрольной точки
+
+    Returns:
+        Итоговый job_status (completed, либо paused / cancelled, если задание остановили;
+        None, если аренда задания перешла к другому воркеру)
+    """
+    broadcast_id = job["id"]
+    query = database.BROADCAST_SEGMENT_QUERIES.get(job["segment"])
+    if query is None:
+        logger.warning(f"Broadcast {broadcast_id}: unknown segment {job['segment']}, cancelling")
+        await database.set_broadcast_job_status(broadcast_id, "cancel")
+        return database.BROADCAST_JOB_CANCELLED
+
+    messages = build_messages(job)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    logger.info(
+        f"Broadcast {broadcast_id} running: segment={job['segment']}, total={job['total_recipients']}, "
+        f"resume_after={job['last_telegram_id']}"
+    )
+
+    batch = []
+
+    async def _flush() -> str:
+        results = await asyncio.gather(*(_send_one(bot, semaphore, tid, messages) for tid in batch))
+        status = await database.checkpoint_broadcast_job(broadcast_id, list(results), batch[-1], BROADCAST_WORKER_ID)
+        batch.clear()
+        return status
+
+    async for row in database.stream_rows(query, batch_size=BROADCAST_BATCH_SIZE, after=job["last_telegram_id"]):
+        batch.append(row["telegram_id"])
+        if len(batch) >= BROADCAST_BATCH_SIZE:
+            status = await _flush()
+            if status != database.BROADCAST_JOB_RUNNING:
+                logger.info(f"Broadcast {broadcast_id} stopped: status={status}")
+                return status
+    if batch:
+        status = await _flush()
+        if status != database.BROADCAST_JOB_RUNNING:
+            logger.info(f"Broadcast {broadcast_id} stopped: status={status}")
+            return status
+
+    finished = await database.finish_broadcast_job(broadcast_id, BROADCAST_WORKER_ID)
+    if finished is None:
+        return database.BROADCAST_JOB_CANCELLED
+    await _report(bot, finished)
+    return database.BROADCAST_JOB_COMPLETED
+
+
+async def _report(bot: Bot, job: Dict[str, Any]) -> None:
+    """Аудит и итог рассылки администратору, создавшему её"""
+    broadcast_id = job["id"]
+    await database._log_audit_event_atomic_standalone(
+        "broadcast_sent",
+        job["sent_by"],
+        None,
+        f"Broadcast ID: {broadcast_id}, Segment: {job['segment']}, "
+        f"Sent: {job['sent_count']}, Failed: {job['failed_count']}"
+    )
+    try:
+        with telegram_gateway.lane(telegram_gateway.LANE_INTERACTIVE):
+            await bot.send_message(
+                job["sent_by"],
+                f"✅ Уведомление отправлено\n\n"
+                f"📊 Статистика:\n"
+                f"✅ Отправлено: {job['sent_count']}\n"
+                f"❌ Ошибок: {job['failed_count']}\n"
+                f"📝 ID уведомления: {broadcast_id}"
+            )
+    except Exception as e:
+        logger.warning(f"Failed to send broadcast report to admin: broadcast={broadcast_id}, error={e}")
+
+
+async def broadcast_worker_task(bot: Bot):
+    """Фоновая задача выполнения заданий рассылки"""
+    logger.info(
+        f"Broadcast worker started (batch: {BROADCAST_BATCH_SIZE}, concurrency: {BROADCAST_CONCURRENCY})"
+    )
+    telegram_gateway.set_lane(telegram_gateway.LANE_BROADCAST)
+
+    while True:
+        try:
+            job = await database.claim_next_broadcast_job(BROADCAST_WORKER_ID)
+            if job is not None:
+                status = await run_broadcast_job(bot, job)
+                logger.info(f"Broadcast {job['id']} finished: status={status}")
+                # Сразу проверяем следующее задание
+                continue
+        except asyncio.CancelledError:
+            logger.info("Broadcast worker task cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Error in broadcast_worker_task: {e}")
+
+        await asyncio.sleep(BROADCAST_POLL_INTERVAL_SECONDS)
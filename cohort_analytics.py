@@ -0,0 +1,48 @@
+"""
+Cohort Analytics - инкрементальный расчёт когорт удержания
+
+Фоновая задача дочитывает новые события subscription_history после водяного
+знака (database.process_cohort_events_batch) и обновляет компактные таблицы
+user_cohorts / cohort_activity. Первый запуск на существующей базе догоняет
+историю пакетами, дальше обрабатываются только новые события.
+"""
+import asyncio
+import logging
+import os
+from aiogram import Bot
+import database
+
+logger = logging.getLogger(__name__)
+
+COHORT_BATCH_SIZE = int(os.getenv("COHORT_BATCH_SIZE", "5000"))
+COHORT_INTERVAL_SECONDS = int(os.getenv("COHORT_INTERVAL_SECONDS", "600"))
+
+
+async def process_pending_events() -> int:
+    """Обработать все накопившиеся события пакетами. Возвращает количество событий"""
+    total = 0
+    while True:
+        processed = await database.process_cohort_events_batch(COHORT_BATCH_SIZE)
+        total += processed
+        if processed < COHORT_BATCH_SIZE:
+            return total
+        # Отдаём управление между пакетами, чтобы догон истории не занимал event loop
+        await asyncio.sleep(0)
+
+
+async def cohort_analytics_task(bot: Bot):
+    """Фоновая задача обновления когортной аналитики"""
+    logger.info(f"Cohort analytics task started (interval: {COHORT_INTERVAL_SECONDS} seconds)")
+
+    while True:
+        try:
+            processed = await process_pending_events()
+            if processed:
+                logger.info(f"Cohort analytics: processed {processed} subscription history events")
+        except asyncio.CancelledError:
+            logger.info("Cohort analytics task cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Error in cohort_analytics_task: {e}")
+
+        await asyncio.sleep(COHORT_INTERVAL_SECONDS)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Перевод журналов audit_log, broadcast_log и balance_transactions в помесячно
+секционированные таблицы (функции миграции 019)
+
+Выполняется отдельно от старта бота, в окно низкой нагрузки; бот может работать.
+Для каждой ещё не переведённой таблицы:
+1. создаётся секционированная копия <таблица>_partitioned с индексами;
+2. строки копируются пакетами по PARTITION_CONVERSION_BATCH_SIZE, каждый пакет -
+   короткая транзакция, живая таблица не блокируется;
+3. под ACCESS EXCLUSIVE докопируются строки, вставленные после последнего пакета,
+   и копия подменяет таблицу. Блокировка ждётся не дольше
+   PARTITION_CONVERSION_LOCK_TIMEOUT, при неудаче шаг повторяется.
+
+Прерванный запуск можно повторить: копирование продолжается с места остановки
+(таблица partition_conversions). Время копирования - порядка минуты на 10 млн строк,
+запросы к журналам в это время не ждут; под блокировкой - только хвост.
+
+Запуск:
+    python convert_log_partitions.py               # все журналы
+    python convert_log_partitions.py <таблица>     # один журнал
+"""
+import asyncio
+import logging
+import os
+import sys
+
+import database
+import partition_maintenance
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+PARTITION_CONVERSION_BATCH_SIZE = int(os.getenv("PARTITION_CONVERSION_BATCH_SIZE", "10000"))
+PARTITION_CONVERSION_BATCH_PAUSE_SECONDS = float(os.getenv("PARTITION_CONVERSION_BATCH_PAUSE_SECONDS", "0.05"))
+PARTITION_CONVERSION_SWITCH_ATTEMPTS = int(os.getenv("PARTITION_CONVERSION_SWITCH_ATTEMPTS", "20"))
+PARTITION_CONVERSION_SWITCH_RETRY_SECONDS = float(os.getenv("PARTITION_CONVERSION_SWITCH_RETRY_SECONDS", "10"))
+
+
+async def convert_table(table: str) -> bool:
+    """
+    Перевести одну таблицу
+
+    Returns:
+        True если таблица переведена (или уже была секционирована)
+    """
+    if not await database.start_partition_conversion(table, partition_maintenance.PARTITION_PREMAKE_MONTHS):
+        logger.info(f"{table}: already partitioned")
+        return True
+
+    copied = 0
+    while True:
+        batch = await database.copy_partition_conversion_batch(table, PARTITION_CONVERSION_BATCH_SIZE)
+        copied += batch
+        if batch < PARTITION_CONVERSION_BATCH_SIZE:
+            break
+        if copied % (PARTITION_CONVERSION_BATCH_SIZE * 100) == 0:
+            logger.info(f"{table}: copied {copied} rows")
+        await asyncio.sleep(PARTITION_CONVERSION_BATCH_PAUSE_SECONDS)
+    logger.info(f"{table}: copied {copied} rows in batches, switching")
+
+    for attempt in range(1, PARTITION_CONVERSION_SWITCH_ATTEMPTS + 1):
+        tail = await database.finish_partition_conversion(table)
+        if tail is not None:
+            logger.info(f"{table}: partitioned, {tail} rows copied under lock")
+            return True
+        logger.warning(f"{table}: lock not acquired (attempt {attempt}), retrying")
+        # Пока ждём, набежавшие строки докопируются пакетом, хвост под блокировкой не растёт
+        await asyncio.sleep(PARTITION_CONVERSION_SWITCH_RETRY_SECONDS)
+        await database.copy_partition_conversion_batch(table, PARTITION_CONVERSION_BATCH_SIZE)
+
+    logger.error(f"{table}: lock not acquired after {PARTITION_CONVERSION_SWITCH_ATTEMPTS} attempts")
+    return False
+
+
+async def main():
+    tables = sys.argv[1:] or list(database.PARTITIONED_LOG_TABLES)
+    try:
+        for table in tables:
+            if not await convert_table(table):
+                sys.exit(1)
+        print(f"✅ Partitioned: {', '.join(tables)}")
+    finally:
+        await database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
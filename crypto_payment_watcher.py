@@ -1,164 +1,311 @@
-"""Фоновая задача для автоматической проверки статуса CryptoBot платежей"""
+"""Фоновая задача для автоматической проверки статуса CryptoBot платежей
+
+Адаптивный опрос (webhook-aware):
+- каждые CRYPTO_POLL_TICK_SECONDS выбираются pending purchases, которым пора
+  проверить статус; все они проверяются одним запросом getInvoices
+- интервал проверки растёт экспоненциально с возрастом покупки: новые invoice
+  опрашиваются часто (CRYPTO_POLL_MIN_INTERVAL_SECONDS), старые - не чаще
+  CRYPTO_POLL_MAX_INTERVAL_SECONDS
+- пока webhook CryptoBot исправен (последний webhook не старше
+  CRYPTO_WEBHOOK_HEALTHY_SECONDS и опрос не находил оплат, пропущенных webhook),
+  опрос работает как страховка: не чаще CRYPTO_POLL_SAFETY_NET_SECONDS
+- метрики (вызовы API, подтверждения, задержка подтверждения) - get_stats() в /health
+"""
 import asyncio
 import logging
-from datetime import datetime, timedelta
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, Optional
 from aiogram import Bot
 from aiogram.exceptions import TelegramForbiddenError
 import database
 import localization
+import telegram_gateway
 from payments import cryptobot
 
 logger = logging.getLogger(__name__)
 
-# Интервал проверки: 30 секунд
+# Интервал очистки истёкших покупок: 30 секунд
 CHECK_INTERVAL_SECONDS = 30
 
+CRYPTO_POLL_TICK_SECONDS = float(os.getenv("CRYPTO_POLL_TICK_SECONDS", "5"))
+CRYPTO_POLL_MIN_INTERVAL_SECONDS = float(os.getenv("CRYPTO_POLL_MIN_INTERVAL_SECONDS", "5"))
+CRYPTO_POLL_MAX_INTERVAL_SECONDS = float(os.getenv("CRYPTO_POLL_MAX_INTERVAL_SECONDS", "300"))
+# Каждые CRYPTO_POLL_BACKOFF_STEP_SECONDS возраста покупки интервал удваивается
+CRYPTO_POLL_BACKOFF_STEP_SECONDS = float(os.getenv("CRYPTO_POLL_BACKOFF_STEP_SECONDS", "60"))
+CRYPTO_POLL_SAFETY_NET_SECONDS = float(os.getenv("CRYPTO_POLL_SAFETY_NET_SECONDS", "300"))
+CRYPTO_WEBHOOK_HEALTHY_SECONDS = float(os.getenv("CRYPTO_WEBHOOK_HEALTHY_SECONDS", "3600"))
+
+LATENCY_SAMPLES = 500
+
+# Метрики опроса (отдаются в /health)
+CRYPTO_WATCHER_STATS: Dict[str, int] = {
+    "api_calls": 0,
+    "api_errors": 0,
+    "invoices_checked": 0,
+    "confirmed_by_poll": 0,
+    "confirmed_by_webhook": 0,
+    "webhooks_received": 0,
+}
+
+# Время оплаты -> подтверждение покупки (секунды) по источнику подтверждения
+_confirmation_latency: Dict[str, Deque[float]] = {
+    "poll": deque(maxlen=LATENCY_SAMPLES),
+    "webhook": deque(maxlen=LATENCY_SAMPLES),
+}
+_last_webhook_at: Optional[float] = None
+_last_missed_webhook_at: Optional[float] = None
+# purchase_id -> время последней проверки (monotonic)
+_last_checked: Dict[str, float] = {}
+
+
+def record_webhook() -> None:
+    """Отметить полученный (подписанный) webhook CryptoBot"""
+    global _last_webhook_at
+    _last_webhook_at = time.monotonic()
+    CRYPTO_WATCHER_STATS["webhooks_received"] += 1
+
+
+def record_confirmation(source: str, paid_at: Any = None) -> None:
+    """Учесть подтверждённую оплату (source: poll | webhook) и её задержку от paid_at"""
+    global _last_missed_webhook_at
+    CRYPTO_WATCHER_STATS[f"confirmed_by_{source}"] += 1
+    if source == "poll":
+        # Оплату нашёл опрос, а не webhook: webhook не считается исправным до следующего
+        _last_missed_webhook_at = time.monotonic()
+    if paid_at:
+        try:
+            paid = datetime.fromisoformat(str(paid_at).replace("Z", "+00:00"))
+            if paid.tzinfo is None:
+                paid = paid.replace(tzinfo=timezone.utc)
+            _confirmation_latency[source].append(max(0.0, (datetime.now(timezone.utc) - paid).total_seconds()))
+        except ValueError:
+            pass
+
+
+def webhooks_healthy(now: Optional[float] = None) -> bool:
+    """Webhook недавно приходил и после него опрос не находил пропущенных оплат"""
+    if _last_webhook_at is None:
+        return False
+    now = time.monotonic() if now is None else now
+    if now - _last_webhook_at > CRYPTO_WEBHOOK_HEALTHY_SECONDS:
+        return False
+    return _last_missed_webhook_at is None or _last_missed_webhook_at < _last_webhook_at
+
+
+def poll_interval(age_seconds: float, healthy_webhooks: bool) -> float:
+    """Интервал проверки invoice: экспоненциальный рост с возрастом, страховочный при исправном webhook"""
+    steps = max(0, int(age_seconds // CRYPTO_POLL_BACKOFF_STEP_SECONDS))
+    interval = min(CRYPTO_POLL_MAX_INTERVAL_SECONDS, CRYPTO_POLL_MIN_INTERVAL_SECONDS * 2 ** min(steps, 30))
+    if healthy_webhooks:
+        interval = max(interval, CRYPTO_POLL_SAFETY_NET_SECONDS)
+    return interval
+
+
+def _latency_percentile(samples: Deque[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 1)
+
+
+def get_stats() -> Dict[str, Any]:
+    """Метрики опроса CryptoBot: вызовы API, подтверждения, задержка подтверждения (с)"""
+    stats: Dict[str, Any] = dict(CRYPTO_WATCHER_STATS)
+    stats["webhook_healthy"] = webhooks_healthy()
+    stats["last_webhook_seconds_ago"] = (
+        round(time.monotonic() - _last_webhook_at, 1) if _last_webhook_at is not None else None
+    )
+    stats["tracked_purchases"] = len(_last_checked)
+    for source, samples in _confirmation_latency.items():
+        stats[f"{source}_confirmation_s_p50"] = _latency_percentile(samples, 0.5)
+        stats[f"{source}_confirmation_s_p95"] = _latency_percentile(samples, 0.95)
+    return stats
+
+
+async def _confirm_paid_invoice(bot: Bot, purchase: Dict[str, Any], invoice_status: Dict[str, Any]) -> None:
+    """Финализировать покупку по оплаченному invoice и отправить подтверждение"""
+    purchase_id = purchase["purchase_id"]
+    telegram_id = purchase["telegram_id"]
+    invoice_id_str = purchase["provider_invoice_id"]
+    invoice_id = invoice_status.get("invoice_id")
+    
+    payload = invoice_status.get("payload", "")
+    if not payload.startswith("purchase:"):
+        logger.error(f"Invalid payload format in CryptoBot invoice: invoice_id={invoice_id}, payload={payload}")
+        return
+    
+    # Получаем сумму оплаты (USD string from API, convert back to RUB)
+    amount_usd_str = invoice_status.get("amount", "0")
+    try:
+        amount_usd = float(amount_usd_str) if amount_usd_str else 0.0
+        amount_rubles = amount_usd * cryptobot.RUB_TO_USD_RATE
+    except (ValueError, TypeError):
+        logger.error(f"Invalid amount in invoice status: {amount_usd_str}, invoice_id={invoice_id}")
+        return
+    
+    # Финализируем покупку
+    result = await database.finalize_purchase(
+        purchase_id=purchase_id,
+        payment_provider="cryptobot",
+        amount_rubles=amount_rubles,
+        invoice_id=invoice_id_str
+    )
+    
+    if not result or not result.get("success"):
+        logger.error(f"Crypto payment finalization failed: purchase_id={purchase_id}, invoice_id={invoice_id}")
+        return
+    
+    record_confirmation("poll", invoice_status.get("paid_at"))
+    
+    # Проверяем, является ли это пополнением баланса
+    is_balance_topup = result.get("is_balance_topup", False)
+    
+    user = await database.get_user(telegram_id)
+    language = user.get("language", "ru") if user else "ru"
+    
+    if is_balance_topup:
+        # Отправляем подтверждение пополнения баланса
+        amount = result.get("amount", amount_rubles)
+        text = localization.get_text(
+            language,
+            "balance_topup_success",
+            amount=amount,
+            default=f"✅ Баланс успешно пополнен на {amount:.2f} ₽"
+        )
+        
+        try:
+            await bot.send_message(telegram_id, text, parse_mode="HTML")
+            logger.info(
+                f"Crypto balance top-up auto-confirmed: user={telegram_id}, purchase_id={purchase_id}, "
+                f"invoice_id={invoice_id}, amount={amount} RUB"
+            )
+        except TelegramForbiddenError:
+            logger.info(f"User {telegram_id} blocked bot, skipping balance top-up confirmation message")
+        except Exception as e:
+            logger.error(f"Error sending balance top-up confirmation to user {telegram_id}: {e}")
+    else:
+        # Отправляем подтверждение покупки подписки
+        payment_id = result["payment_id"]
+        expires_at = result["expires_at"]
+        vpn_key = result["vpn_key"]
+        
+        expires_str = expires_at.strftime("%d.%m.%Y")
+        text = localization.get_text(language, "payment_approved", date=expires_str)
+        
+        # Импорт здесь для избежания circular import
+        import handlers
+        try:
+            await bot.send_message(telegram_id, text, reply_markup=handlers.get_vpn_key_keyboard(language), parse_mode="HTML")
+            await bot.send_message(telegram_id, f"<code>{vpn_key}</code>", parse_mode="HTML")
+            logger.info(
+                f"Crypto payment auto-confirmed: user={telegram_id}, purchase_id={purchase_id}, "
+                f"invoice_id={invoice_id}, payment_id={payment_id}"
+            )
+        except TelegramForbiddenError:
+            logger.info(f"User {telegram_id} blocked bot, skipping confirmation message")
+        except Exception as e:
+            logger.error(f"Error sending confirmation to user {telegram_id}: {e}")
+
 
-async def check_crypto_payments(bot: Bot):
+async def check_crypto_payments(bot: Bot) -> int:
     """
-    Проверка статуса CryptoBot платежей для всех pending purchases
+    Проверка статуса CryptoBot платежей для pending purchases, которым пора проверку
     
     Логика:
-    1. Получаем все pending purchases где provider_invoice_id IS NOT NULL
-    2. Для каждого проверяем статус invoice через CryptoBot API
-    3. Если invoice статус='paid' → финализируем покупку
-    4. Отправляем пользователю подтверждение с VPN ключом
+    1. Получаем pending purchases где provider_invoice_id IS NOT NULL (с возрастом)
+    2. Отбираем те, чей интервал poll_interval(возраст) истёк с последней проверки
+    3. Проверяем статусы всех отобранных invoice одним запросом к CryptoBot API
+       (cryptobot.check_invoices_status)
+    4. Если invoice статус='paid' → финализируем покупку и отправляем подтверждение
     
     КРИТИЧНО:
     - Idempotent: finalize_purchase защищен от повторной обработки
     - Не блокирует другие pending purchases при ошибке
     - Логирует только критичные ошибки
+    
+    Returns:
+        Количество проверенных invoice (0 - запроса к API не было)
     """
     if not cryptobot.is_enabled():
-        return
+        return 0
     
     try:
         pool = await database.get_pool()
         async with pool.acquire() as conn:
-            # Получаем pending purchases с provider_invoice_id (т.е. CryptoBot purchases)
             # Только не истёкшие покупки: status = 'pending' AND expires_at > (NOW() AT TIME ZONE 'UTC')
             pending_purchases = await conn.fetch(
-                """SELECT * FROM pending_purchases 
+                """SELECT purchase_id, telegram_id, provider_invoice_id,
+                          EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - created_at)) AS age_seconds
+                   FROM pending_purchases 
                    WHERE status = 'pending' 
                    AND provider_invoice_id IS NOT NULL
                    AND expires_at > (NOW() AT TIME ZONE 'UTC')
                    ORDER BY created_at DESC
                    LIMIT 100"""
             )
-            
-            if not pending_purchases:
-                return
-            
-            logger.info(f"Crypto payment watcher: checking {len(pending_purchases)} pending purchases")
-            
-            for row in pending_purchases:
-                purchase = dict(row)
-                purchase_id = purchase["purchase_id"]
-                telegram_id = purchase["telegram_id"]
-                invoice_id_str = purchase.get("provider_invoice_id")
-                
-                if not invoice_id_str:
-                    continue
-                
-                try:
-                    # Преобразуем invoice_id в int для CryptoBot API
-                    invoice_id = int(invoice_id_str)
-                    
-                    # Проверяем статус invoice через CryptoBot API
-                    invoice_status = await cryptobot.check_invoice_status(invoice_id)
-                    status = invoice_status.get("status")
-                    
-                    if status != "paid":
-                        # Оплата еще не выполнена
-                        continue
-                    
-                    # Оплата успешна - финализируем покупку
-                    payload = invoice_status.get("payload", "")
-                    if not payload.startswith("purchase:"):
-                        logger.error(f"Invalid payload format in CryptoBot invoice: invoice_id={invoice_id}, payload={payload}")
-                        continue
-                    
-                    # Получаем сумму оплаты (USD string from API, convert back to RUB)
-                    amount_usd_str = invoice_status.get("amount", "0")
-                    try:
-                        amount_usd = float(amount_usd_str) if amount_usd_str else 0.0
-                        from payments.cryptobot import RUB_TO_USD_RATE
-                        amount_rubles = amount_usd * RUB_TO_USD_RATE
-                    except (ValueError, TypeError):
-                        logger.error(f"Invalid amount in invoice status: {amount_usd_str}, invoice_id={invoice_id}")
-                        continue
-                    
-                    # Финализируем покупку
-                    result = await database.finalize_purchase(
-                        purchase_id=purchase_id,
-                        payment_provider="cryptobot",
-                        amount_rubles=amount_rubles,
-                        invoice_id=invoice_id_str
-                    )
-                    
-                    if not result or not result.get("success"):
-                        logger.error(f"Crypto payment finalization failed: purchase_id={purchase_id}, invoice_id={invoice_id}")
-                        continue
-                    
-                    # Проверяем, является ли это пополнением баланса
-                    is_balance_topup = result.get("is_balance_topup", False)
-                    
-                    user = await database.get_user(telegram_id)
-                    language = user.get("language", "ru") if user else "ru"
-                    
-                    if is_balance_topup:
-                        # Отправляем подтверждение пополнения баланса
-                        amount = result.get("amount", amount_rubles)
-                        text = localization.get_text(
-                            language,
-                            "balance_topup_success",
-                            amount=amount,
-                            default=f"✅ Баланс успешно пополнен на {amount:.2f} ₽"
-                        )
-                        
-                        try:
-                            await bot.send_message(telegram_id, text, parse_mode="HTML")
-                            logger.info(
-                                f"Crypto balance top-up auto-confirmed: user={telegram_id}, purchase_id={purchase_id}, "
-                                f"invoice_id={invoice_id}, amount={amount} RUB"
-                            )
-                        except TelegramForbiddenError:
-                            logger.info(f"User {telegram_id} blocked bot, skipping balance top-up confirmation message")
-                        except Exception as e:
-                            logger.error(f"Error sending balance top-up confirmation to user {telegram_id}: {e}")
-                    else:
-                        # Отправляем подтверждение покупки подписки
-                        payment_id = result["payment_id"]
-                        expires_at = result["expires_at"]
-                        vpn_key = result["vpn_key"]
-                        
-                        expires_str = expires_at.strftime("%d.%m.%Y")
-                        text = localization.get_text(language, "payment_approved", date=expires_str)
-                        
-                        # Импорт здесь для избежания circular import
-                        import handlers
-                        try:
-                            await bot.send_message(telegram_id, text, reply_markup=handlers.get_vpn_key_keyboard(language), parse_mode="HTML")
-                            await bot.send_message(telegram_id, f"<code>{vpn_key}</code>", parse_mode="HTML")
-                            logger.info(
-                                f"Crypto payment auto-confirmed: user={telegram_id}, purchase_id={purchase_id}, "
-                                f"invoice_id={invoice_id}, payment_id={payment_id}"
-                            )
-                        except TelegramForbiddenError:
-                            logger.info(f"User {telegram_id} blocked bot, skipping confirmation message")
-                        except Exception as e:
-                            logger.error(f"Error sending confirmation to user {telegram_id}: {e}")
-                    
-                except ValueError as e:
-                    # Pending purchase уже обработан (idempotency)
-                    logger.debug(f"Crypto payment already processed: purchase_id={purchase_id}, invoice_id={invoice_id_str}, error={e}")
-                except Exception as e:
-                    # Ошибка для одной покупки не должна ломать весь процесс
-                    logger.error(f"Error checking crypto payment for purchase {purchase_id}: {e}", exc_info=True)
-                    continue
+        
+        now = time.monotonic()
+        # Забываем покупки, которые больше не pending
+        pending_ids = {row["purchase_id"] for row in pending_purchases}
+        for purchase_id in [p for p in _last_checked if p not in pending_ids]:
+            del _last_checked[purchase_id]
+        
+        healthy = webhooks_healthy(now)
+        due = {}
+        for row in pending_purchases:
+            last_checked = _last_checked.get(row["purchase_id"])
+            age_seconds = float(row["age_seconds"] or 0)
+            if last_checked is not None and now - last_checked < poll_interval(age_seconds, healthy):
+                continue
+            try:
+                due[int(row["provider_invoice_id"])] = dict(row)
+            except (TypeError, ValueError):
+                logger.error(
+                    f"Invalid CryptoBot invoice_id: purchase_id={row['purchase_id']}, "
+                    f"invoice_id={row['provider_invoice_id']}"
+                )
+        
+        if not due:
+            return 0
+        
+        logger.debug(f"Crypto payment watcher: checking {len(due)}/{len(pending_purchases)} pending purchases")
+        for purchase in due.values():
+            _last_checked[purchase["purchase_id"]] = now
+        
+        # Статусы всех отобранных invoice - один (при >1000 invoice - несколько) запрос getInvoices
+        CRYPTO_WATCHER_STATS["api_calls"] += 1
+        try:
+            invoice_statuses = await cryptobot.check_invoices_status(list(due))
+        except Exception:
+            CRYPTO_WATCHER_STATS["api_errors"] += 1
+            raise
+        CRYPTO_WATCHER_STATS["invoices_checked"] += len(due)
+        
+        for invoice_id, purchase in due.items():
+            invoice_status = invoice_statuses.get(invoice_id)
+            if invoice_status is None or invoice_status.get("status") != "paid":
+                # Оплата еще не выполнена (или invoice не найден)
+                continue
+            try:
+                await _confirm_paid_invoice(bot, purchase, invoice_status)
+            except ValueError as e:
+                # Pending purchase уже обработан (idempotency)
+                logger.debug(
+                    f"Crypto payment already processed: purchase_id={purchase['purchase_id']}, "
+                    f"invoice_id={invoice_id}, error={e}"
+                )
+            except Exception as e:
+                # Ошибка для одной покупки не должна ломать весь процесс
+                logger.error(f"Error checking crypto payment for purchase {purchase['purchase_id']}: {e}", exc_info=True)
+        
+        return len(due)
                     
     except Exception as e:
         logger.exception(f"Error in check_crypto_payments: {e}")
+        return 0
 
 
 async def cleanup_expired_purchases():
@@ -209,26 +356,31 @@ async def crypto_payment_watcher_task(bot: Bot):
     """
     Фоновая задача для автоматической проверки CryptoBot платежей
     
-    Запускается каждые CHECK_INTERVAL_SECONDS (30 секунд)
+    Тик каждые CRYPTO_POLL_TICK_SECONDS: проверяются только invoice, которым пора
+    (см. poll_interval); очистка истёкших покупок - каждые CHECK_INTERVAL_SECONDS
     """
-    logger.info(f"Crypto payment watcher task started: interval={CHECK_INTERVAL_SECONDS}s")
-    
-    # Первая проверка сразу при запуске
-    try:
-        await check_crypto_payments(bot)
-        await cleanup_expired_purchases()
-    except Exception as e:
-        logger.exception(f"Error in initial crypto payment check: {e}")
+    logger.info(
+        f"Crypto payment watcher task started: tick={CRYPTO_POLL_TICK_SECONDS}s, "
+        f"interval={CRYPTO_POLL_MIN_INTERVAL_SECONDS}-{CRYPTO_POLL_MAX_INTERVAL_SECONDS}s, "
+        f"safety_net={CRYPTO_POLL_SAFETY_NET_SECONDS}s"
+    )
+    telegram_gateway.set_lane(telegram_gateway.LANE_PAYMENT)
     
+    last_cleanup = None
     while True:
         try:
-            await asyncio.sleep(CHECK_INTERVAL_SECONDS)
             await check_crypto_payments(bot)
-            await cleanup_expired_purchases()
+            if last_cleanup is None or time.monotonic() - last_cleanup >= CHECK_INTERVAL_SECONDS:
+                last_cleanup = time.monotonic()
+                await cleanup_expired_purchases()
         except asyncio.CancelledError:
             logger.info("Crypto payment watcher task cancelled")
             break
         except Exception as e:
             logger.exception(f"Error in crypto payment watcher task: {e}")
-            # При ошибке ждем половину интервала перед повтором
-            await asyncio.sleep(CHECK_INTERVAL_SECONDS // 2)
+        
+        try:
+            await asyncio.sleep(CRYPTO_POLL_TICK_SECONDS)
+        except asyncio.CancelledError:
+            logger.info("Crypto payment watcher task cancelled")
+            break
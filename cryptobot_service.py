@@ -3,15 +3,20 @@ Crypto Bot (Telegram Crypto Pay) Integration
 
 Handles invoice creation and webhook processing for cryptocurrency payments.
 """
+import asyncio
 import os
 import json
 import hmac
 import hashlib
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import httpx
 from aiohttp import web
 from aiogram import Bot
+import crypto_payment_watcher
+import database
+import redis_client
+import telegram_gateway
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +27,27 @@ CRYPTOBOT_API_URL = os.getenv("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api")
 
 ALLOWED_ASSETS = ["USDT", "TON", "BTC"]
 
+# Webhook: быстрый ответ после записи в inbox (cryptobot_webhook_events), обработка в пуле воркеров
+CRYPTOBOT_WEBHOOK_WORKERS = int(os.getenv("CRYPTOBOT_WEBHOOK_WORKERS", "4"))
+CRYPTOBOT_WEBHOOK_POLL_INTERVAL_SECONDS = float(os.getenv("CRYPTOBOT_WEBHOOK_POLL_INTERVAL_SECONDS", "5"))
+CRYPTOBOT_WEBHOOK_DEDUPE_TTL_SECONDS = int(os.getenv("CRYPTOBOT_WEBHOOK_DEDUPE_TTL_SECONDS", "86400"))
+CRYPTOBOT_WEBHOOK_STOP_TIMEOUT_SECONDS = float(os.getenv("CRYPTOBOT_WEBHOOK_STOP_TIMEOUT_SECONDS", "30"))
+WEBHOOK_DEDUPE_KEY_PREFIX = "cryptobot:webhook:invoice:"
+
+# Счётчики webhook (отдаются в /health)
+WEBHOOK_STATS: Dict[str, int] = {
+    "received": 0,
+    "duplicates": 0,
+    "enqueued": 0,
+    "enqueue_errors": 0,
+    "processed": 0,
+    "failed": 0,
+}
+
+_wakeup: Optional[asyncio.Event] = None
+_workers: List[asyncio.Task] = []
+_stopping = False
+
 
 def is_enabled() -> bool:
     """Check if Crypto Bot is configured"""
@@ -194,66 +220,52 @@ async def create_balance_invoice(
     return result
 
 
-async def handle_webhook(request: web.Request, bot: Bot) -> web.Response:
-    """
-    Handle Crypto Bot webhook
-    
-    Requirements:
-    - Always returns 200 OK
-    - Validates webhook signature
-    - Processes only invoice_paid events
-    - Idempotent: duplicate payments are ignored
-    """
-    if not is_enabled():
-        logger.warning("Crypto Bot webhook received but service is disabled")
-        return web.json_response({"status": "disabled"}, status=200)
-    
-    if not database.DB_READY:
-        logger.warning("Crypto Bot webhook: DB not ready")
-        return web.json_response({"status": "degraded"}, status=200)
-    
-    # Verify signature
-    signature = request.headers.get("X-Crypto-Pay-API-Signature", "")
-    if not signature:
-        logger.warning("Crypto Bot webhook: missing signature")
-        return web.json_response({"status": "unauthorized"}, status=200)
-    
+async def _is_processed(invoice_id: str) -> bool:
+    """Быстрая проверка повторной доставки: invoice уже обработан (ключ Redis ставится после обработки)"""
+    client = await redis_client.get_redis_client()
+    if client is None:
+        return False
     try:
-        body_bytes = await request.read()
-        if not _verify_webhook_signature(body_bytes, signature):
-            logger.warning("Crypto Bot webhook: invalid signature")
-            return web.json_response({"status": "unauthorized"}, status=200)
-        
-        body = json.loads(body_bytes.decode())
+        return bool(await client.exists(f"{WEBHOOK_DEDUPE_KEY_PREFIX}{invoice_id}"))
     except Exception as e:
-        logger.error(f"Crypto Bot webhook: invalid JSON: {e}")
-        return web.json_response({"status": "invalid"}, status=200)
+        logger.warning(f"Crypto Bot webhook: dedupe unavailable, invoice_id={invoice_id}, error={e}")
+        return False
+
+
+async def _mark_processed(invoice_id: str) -> None:
+    """Отметить invoice обработанным в Redis (повторные доставки отсекаются без обращения к БД)"""
+    client = await redis_client.get_redis_client()
+    if client is None:
+        return
+    try:
+        await client.set(f"{WEBHOOK_DEDUPE_KEY_PREFIX}{invoice_id}", "1", ex=CRYPTOBOT_WEBHOOK_DEDUPE_TTL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Crypto Bot webhook: failed to set dedupe key, invoice_id={invoice_id}, error={e}")
+
+
+async def process_paid_invoice(bot: Bot, invoice: Dict[str, Any]) -> str:
+    """
+    Process a paid invoice from the webhook: verify and finalize the purchase, notify the user
     
-    # Process only invoice_paid events
-    update_type = body.get("update_type")
-    if update_type != "invoice_paid":
-        logger.debug(f"Crypto Bot webhook: ignored update_type={update_type}")
-        return web.json_response({"status": "ignored"}, status=200)
+    Idempotent: already processed purchases are skipped (pending_purchases.status,
+    finalize_purchase).
     
-    invoice = body.get("payload", {})
+    Returns:
+        Processing status (ok, already_processed, not_found, invalid, amount_mismatch, error)
+    """
     invoice_id = invoice.get("invoice_id")
-    status = invoice.get("status")
-    
-    if status != "paid":
-        logger.info(f"Crypto Bot webhook: invoice not paid, status={status}, invoice_id={invoice_id}")
-        return web.json_response({"status": "ignored"}, status=200)
     
     # Parse payload
     payload_raw = invoice.get("payload")
     if not payload_raw:
         logger.error(f"Crypto Bot webhook: missing payload, invoice_id={invoice_id}")
-        return web.json_response({"status": "invalid"}, status=200)
+        return "invalid"
     
     try:
         payload_data = json.loads(payload_raw)
     except Exception as e:
         logger.error(f"Crypto Bot webhook: failed to parse payload: {e}")
-        return web.json_response({"status": "invalid"}, status=200)
+        return "invalid"
     
     purchase_id = payload_data.get("purchase_id")
     telegram_id = payload_data.get("telegram_user_id")
@@ -262,27 +274,26 @@ async def handle_webhook(request: web.Request, bot: Bot) -> web.Response:
     
     if not all([purchase_id, telegram_id, tariff, period_days]):
         logger.error(f"Crypto Bot webhook: missing required fields in payload: {payload_data}")
-        return web.json_response({"status": "invalid"}, status=200)
+        return "invalid"
     
     try:
         telegram_id = int(telegram_id)
         period_days = int(period_days)
     except (ValueError, TypeError) as e:
         logger.error(f"Crypto Bot webhook: invalid telegram_id or period_days: {e}")
-        return web.json_response({"status": "invalid"}, status=200)
+        return "invalid"
     
     # Get pending purchase (без проверки expires_at - оплата может прийти после истечения)
-    import database
     logger.info(f"Crypto Bot webhook: looking for purchase: purchase_id={purchase_id}, user={telegram_id}")
     pending_purchase = await database.get_pending_purchase(purchase_id, telegram_id, check_expiry=False)
     if not pending_purchase:
         logger.warning(f"Crypto Bot webhook: pending purchase not found: purchase_id={purchase_id}, user={telegram_id}")
-        return web.json_response({"status": "not_found"}, status=200)
+        return "not_found"
     
     purchase_status = pending_purchase.get("status")
     if purchase_status != "pending":
         logger.info(f"Crypto Bot webhook: purchase already processed: purchase_id={purchase_id}, status={purchase_status}")
-        return web.json_response({"status": "already_processed"}, status=200)
+        return "already_processed"
     
     logger.info(f"Crypto Bot webhook: valid pending purchase found: purchase_id={purchase_id}, user={telegram_id}, tariff={pending_purchase.get('tariff')}, period_days={pending_purchase.get('period_days')}")
     
@@ -308,7 +319,7 @@ async def handle_webhook(request: web.Request, bot: Bot) -> web.Response:
             f"reason=amount_mismatch, expected={expected_amount_rubles:.2f} RUB, "
             f"actual={amount_rubles:.2f} RUB, diff={amount_diff:.2f} RUB"
         )
-        return web.json_response({"status": "amount_mismatch"}, status=200)
+        return "amount_mismatch"
     
     logger.info(
         f"payment_verified: provider=cryptobot, user={telegram_id}, purchase_id={purchase_id}, "
@@ -331,6 +342,8 @@ async def handle_webhook(request: web.Request, bot: Bot) -> web.Response:
             logger.error(f"Crypto Bot webhook: {error_msg}")
             raise Exception(error_msg)
         
+        crypto_payment_watcher.record_confirmation("webhook", invoice.get("paid_at"))
+        
         payment_id = result["payment_id"]
         expires_at = result["expires_at"]
         vpn_key = result["vpn_key"]
@@ -346,28 +359,217 @@ async def handle_webhook(request: web.Request, bot: Bot) -> web.Response:
         text = localization.get_text(language, "payment_approved", date=expires_str)
         
         from handlers import get_vpn_key_keyboard
-        await bot.send_message(telegram_id, text, reply_markup=get_vpn_key_keyboard(language), parse_mode="HTML")
-        await bot.send_message(telegram_id, f"<code>{vpn_key}</code>", parse_mode="HTML")
+        with telegram_gateway.lane(telegram_gateway.LANE_PAYMENT):
+            await bot.send_message(telegram_id, text, reply_markup=get_vpn_key_keyboard(language), parse_mode="HTML")
+            await bot.send_message(telegram_id, f"<code>{vpn_key}</code>", parse_mode="HTML")
         
         logger.info(f"Crypto Bot payment processed successfully: user={telegram_id}, payment_id={payment_id}, invoice_id={invoice_id}, purchase_id={purchase_id}, subscription_activated=True, vpn_key_issued=True")
         
     except ValueError as e:
         # Pending purchase уже обработан или не найден - это нормально при повторных callback
         logger.info(f"Crypto Bot webhook: purchase already processed (ValueError): purchase_id={purchase_id}, error={e}")
-        return web.json_response({"status": "already_processed"}, status=200)
+        return "already_processed"
     except Exception as e:
         logger.exception(f"Crypto Bot webhook: finalize_purchase failed: user={telegram_id}, purchase_id={purchase_id}, error={e}")
         # Payment remains in 'pending' status for manual review
-        return web.json_response({"status": "error"}, status=200)
+        return "error"
     
-    return web.json_response({"status": "ok"}, status=200)
+    return "ok"
+
+
+async def handle_webhook(request: web.Request, bot: Bot) -> web.Response:
+    """
+    Handle Crypto Bot webhook
+    
+    Requirements:
+    - Returns 200 OK once the event is handled or durably recorded
+    - Returns 503 if a paid invoice could not be recorded (the provider redelivers it)
+    - Validates webhook signature
+    - Processes only invoice_paid events
+    - Idempotent: duplicate payments are ignored
+    
+    Fast ack: the handler only verifies the signature, dedupes by invoice_id
+    (Redis key of processed invoices, then the unique invoice_id of the inbox) and
+    writes the invoice to cryptobot_webhook_events; finalize_purchase (VPN
+    provisioning) and the Telegram sends run in the worker pool (start_workers).
+    """
+    if not is_enabled():
+        logger.warning("Crypto Bot webhook received but service is disabled")
+        return web.json_response({"status": "disabled"}, status=200)
+    
+    if not database.DB_READY:
+        logger.warning("Crypto Bot webhook: DB not ready")
+        return web.json_response({"status": "degraded"}, status=200)
+    
+    # Verify signature
+    signature = request.headers.get("X-Crypto-Pay-API-Signature", "")
+    if not signature:
+        logger.warning("Crypto Bot webhook: missing signature")
+        return web.json_response({"status": "unauthorized"}, status=200)
+    
+    try:
+        body_bytes = await request.read()
+        if not _verify_webhook_signature(body_bytes, signature):
+            logger.warning("Crypto Bot webhook: invalid signature")
+            return web.json_response({"status": "unauthorized"}, status=200)
+        
+        body = json.loads(body_bytes.decode())
+    except Exception as e:
+        logger.error(f"Crypto Bot webhook: invalid JSON: {e}")
+        return web.json_response({"status": "invalid"}, status=200)
+    
+    # Подписанный webhook дошёл: опрос статусов переходит в страховочный режим
+    crypto_payment_watcher.record_webhook()
+    WEBHOOK_STATS["received"] += 1
+    
+    # Process only invoice_paid events
+    update_type = body.get("update_type")
+    if update_type != "invoice_paid":
+        logger.debug(f"Crypto Bot webhook: ignored update_type={update_type}")
+        return web.json_response({"status": "ignored"}, status=200)
+    
+    invoice = body.get("payload", {})
+    invoice_id = invoice.get("invoice_id")
+    status = invoice.get("status")
+    
+    if status != "paid":
+        logger.info(f"Crypto Bot webhook: invoice not paid, status={status}, invoice_id={invoice_id}")
+        return web.json_response({"status": "ignored"}, status=200)
+    
+    if invoice_id is None:
+        logger.error("Crypto Bot webhook: missing invoice_id")
+        return web.json_response({"status": "invalid"}, status=200)
+    
+    invoice_id = str(invoice_id)
+    if await _is_processed(invoice_id):
+        WEBHOOK_STATS["duplicates"] += 1
+        logger.info(f"Crypto Bot webhook: duplicate delivery ignored, invoice_id={invoice_id}")
+        return web.json_response({"status": "duplicate"}, status=200)
+    
+    try:
+        event_id = await database.enqueue_cryptobot_webhook_event(invoice_id, json.dumps(invoice))
+    except Exception as e:
+        # Не записали - не подтверждаем: провайдер доставит webhook повторно
+        WEBHOOK_STATS["enqueue_errors"] += 1
+        logger.error(f"Crypto Bot webhook: failed to record invoice, invoice_id={invoice_id}, error={e}")
+        return web.json_response({"status": "retry"}, status=503)
+    
+    if event_id is None:
+        WEBHOOK_STATS["duplicates"] += 1
+        logger.info(f"Crypto Bot webhook: invoice already recorded, invoice_id={invoice_id}")
+        return web.json_response({"status": "duplicate"}, status=200)
+    
+    WEBHOOK_STATS["enqueued"] += 1
+    if _wakeup is not None:
+        _wakeup.set()
+    return web.json_response({"status": "queued"}, status=200)
+
+
+async def process_event(bot: Bot, event: Dict[str, Any]) -> str:
+    """
+    Обработать взятое событие inbox и зафиксировать итог
+    
+    Успех (любой статус, кроме error) - событие done и ключ dedupe в Redis;
+    ошибка - повтор с экспоненциальной задержкой, после
+    database.CRYPTOBOT_WEBHOOK_MAX_ATTEMPTS попыток - failed.
+    """
+    invoice_id = event["invoice_id"]
+    error = "processing error"
+    try:
+        status = await process_paid_invoice(bot, json.loads(event["payload"]))
+    except asyncio.CancelledError:
+        # Остановка воркера: событие возвращается в очередь без траты попытки
+        await database.release_cryptobot_webhook_event(event["id"])
+        raise
+    except Exception as e:
+        logger.exception(f"Crypto Bot webhook: processing failed: invoice_id={invoice_id}, error={e}")
+        status = "error"
+        error = str(e)
+    
+    if status == "error":
+        WEBHOOK_STATS["failed"] += 1
+        new_status = await database.fail_cryptobot_webhook_event(event["id"], event["attempts"], error)
+        logger.warning(
+            f"Crypto Bot webhook: invoice processing deferred, invoice_id={invoice_id}, "
+            f"attempt={event['attempts']}, status={new_status}"
+        )
+    else:
+        WEBHOOK_STATS["processed"] += 1
+        await database.complete_cryptobot_webhook_event(event["id"], status)
+        await _mark_processed(invoice_id)
+    return status
+
+
+async def _worker(bot: Bot) -> None:
+    """Воркер inbox: берёт события по одному, пока пул не останавливают"""
+    telegram_gateway.set_lane(telegram_gateway.LANE_PAYMENT)
+    while not _stopping:
+        try:
+            event = await database.claim_cryptobot_webhook_event()
+        except Exception as e:
+            logger.error(f"Crypto Bot webhook worker: failed to claim event: {e}")
+            event = None
+        if event is not None:
+            await process_event(bot, event)
+            continue
+        # Очередь пуста: ждём новый webhook или следующий опрос (события других реплик, повторы)
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), CRYPTOBOT_WEBHOOK_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+def is_running() -> bool:
+    """Пул воркеров запущен"""
+    return not _stopping and any(not task.done() for task in _workers)
+
+
+def start_workers(bot: Bot) -> List[asyncio.Task]:
+    """Запустить пул воркеров обработки webhook (повторный вызов возвращает тот же пул)"""
+    global _wakeup, _workers, _stopping
+    if not is_running():
+        _stopping = False
+        _wakeup = asyncio.Event()
+        _workers = [asyncio.create_task(_worker(bot)) for _ in range(CRYPTOBOT_WEBHOOK_WORKERS)]
+        logger.info(f"Crypto Bot webhook workers started (workers: {CRYPTOBOT_WEBHOOK_WORKERS})")
+    return _workers
+
+
+async def stop_workers() -> None:
+    """
+    Остановить воркеры: текущие события дообрабатываются до таймаута, затем
+    воркеры отменяются и их события возвращаются в очередь (они остаются в inbox)
+    """
+    global _workers, _stopping
+    workers = [task for task in _workers if not task.done()]
+    _stopping = True
+    if workers:
+        _wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.gather(*workers)), CRYPTOBOT_WEBHOOK_STOP_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.error(
+                f"Crypto Bot webhook workers did not finish in {CRYPTOBOT_WEBHOOK_STOP_TIMEOUT_SECONDS}s, "
+                f"cancelling; unfinished events return to the inbox"
+            )
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    _workers = []
+    logger.info(f"Crypto Bot webhook workers stopped: {get_stats()}")
+
+
+def get_stats() -> Dict[str, int]:
+    """Счётчики webhook и число работающих воркеров"""
+    return {**WEBHOOK_STATS, "workers": sum(1 for task in _workers if not task.done())}
 
 
 async def register_webhook_route(app: web.Application, bot: Bot):
-    """Register Crypto Bot webhook route"""
+    """Register Crypto Bot webhook route and start the processing workers"""
     async def webhook_handler(request: web.Request) -> web.Response:
         return await handle_webhook(request, bot)
     
     app.router.add_post("/webhooks/cryptobot", webhook_handler)
+    start_workers(bot)
     logger.info("Crypto Bot webhook registered: POST /webhooks/cryptobot")
-
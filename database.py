@@ -1,15 +1,20 @@
+import asyncio
 import asyncpg
 import os
 import sys
 import hashlib
+import inspect
 import base64
+import gzip
 import uuid
+import time
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, Tuple, TYPE_CHECKING, List
+from typing import Optional, Dict, Any, Tuple, TYPE_CHECKING, List, AsyncIterator
 from enum import Enum
 import logging
 import config
 import vpn_utils
+from db_records import User, Subscription, Payment, PendingPurchase
 # outline_api removed - use vpn_utils instead
 
 if TYPE_CHECKING:
@@ -39,6 +44,14 @@ class DBInitStatus(str, Enum):
 
 DB_INIT_STATUS: DBInitStatus = DBInitStatus.PENDING
 
+# Длительность этапов init_db (мс) и признак пропуска легаси-DDL, для логов и /health
+DB_INIT_TIMINGS: Dict[str, Any] = {}
+
+# Запись об отпечатке легаси-схемы в schema_state
+LEGACY_SCHEMA_STATE_NAME = "legacy_schema"
+# Принудительно выполнить легаси-DDL даже при совпадении отпечатка
+DB_FORCE_SCHEMA_SYNC = os.getenv("DB_FORCE_SCHEMA_SYNC", "").lower() in ("1", "true", "yes")
+
 
 # ====================================================================================
 # SAFE DATA HELPERS: Утилиты для безопасной обработки NULL значений
@@ -133,6 +146,65 @@ async def close_pool():
         logger.info("Database connection pool closed")
 
 
+# Размер пакета stream_rows по умолчанию
+STREAM_ROWS_BATCH_SIZE = 500
+
+
+async def stream_rows(
+    query: str,
+    *args,
+    batch_size: int = STREAM_ROWS_BATCH_SIZE,
+    key: str = "telegram_id",
+    after: Any = None
+) -> AsyncIterator[asyncpg.Record]:
+    """
+    Потоково перебрать результат запроса пакетами (keyset-пагинация по уникальной колонке)
+    
+    Запрос оборачивается в подзапрос и читается порциями
+    WHERE key > <последний ключ> ORDER BY key LIMIT batch_size. Соединение берётся из пула
+    только на время чтения пакета и не удерживается, пока вызывающий код обрабатывает
+    строки (отправка сообщений, вызовы VPN API), транзакция на всё время обхода не нужна.
+    Строки, изменённые во время обхода, читаются в состоянии на момент чтения их пакета.
+    
+    Args:
+        query: SELECT без ORDER BY/LIMIT; должен возвращать колонку key с уникальными значениями
+        *args: Параметры запроса ($1, $2, ...)
+        batch_size: Размер пакета
+        key: Имя уникальной колонки результата для keyset-пагинации
+        after: Начать со строк, где key > after (продолжение обхода с контрольной точки)
+    
+    Yields:
+        asyncpg.Record (поддерживает row["col"] и row.get("col"))
+    
+    Usage:
+        async for row in database.stream_rows("SELECT telegram_id, ... FROM subscriptions WHERE ..."):
+            ...
+    """
+    key_param = len(args) + 1
+    limit_param = len(args) + 2
+    first_page = f"SELECT * FROM ({query}) AS stream_q ORDER BY stream_q.{key} LIMIT ${key_param}"
+    next_page = (
+        f"SELECT * FROM ({query}) AS stream_q WHERE stream_q.{key} > ${key_param} "
+        f"ORDER BY stream_q.{key} LIMIT ${limit_param}"
+    )
+    
+    pool = await get_pool()
+    last_key = after
+    while True:
+        async with pool.acquire() as conn:
+            if last_key is None:
+                rows = await conn.fetch(first_page, *args, batch_size)
+            else:
+                rows = await conn.fetch(next_page, *args, last_key, batch_size)
+        
+        for row in rows:
+            yield row
+        
+        if len(rows) < batch_size:
+            return
+        last_key = rows[-1][key]
+
+
 def ensure_db_ready() -> bool:
     """
     Проверка готовности базы данных перед выполнением операций
@@ -154,6 +226,12 @@ async def init_db() -> bool:
     """
     Инициализация базы данных и создание таблиц
     
+    Порядок: версионные миграции, затем легаси-DDL (_apply_legacy_schema).
+    Оба шага выполняются под advisory lock (migrations.migration_lock), поэтому
+    одновременно стартующие реплики не конкурируют за блокировки DDL.
+    Легаси-DDL пропускается, если сохранённый отпечаток схемы совпадает с текущим.
+    Длительность этапов сохраняется в DB_INIT_TIMINGS.
+    
     Returns:
         True если инициализация успешна, False если произошла ошибка
         
@@ -162,11 +240,14 @@ async def init_db() -> bool:
     """
     global DB_READY, DB_INIT_STATUS
     DB_INIT_STATUS = DBInitStatus.PENDING
+    DB_INIT_TIMINGS.clear()
+    init_started = time.perf_counter()
     pool = await get_pool()
     
     # ====================================================================================
     # VERSIONED MIGRATIONS: Применяем миграции перед созданием таблиц
     # ====================================================================================
+    phase_started = time.perf_counter()
     try:
         import migrations
         migrations_success = await migrations.run_migrations_safe(pool)
@@ -179,453 +260,512 @@ async def init_db() -> bool:
         logger.exception(f"Error applying migrations: {e}")
         DB_INIT_STATUS = DBInitStatus.FAILED
         return False
+    DB_INIT_TIMINGS["migrations_ms"] = round((time.perf_counter() - phase_started) * 1000, 1)
     
+    # ====================================================================================
+    # LEGACY SCHEMA: Пропускаем, если отпечаток схемы не изменился
+    # ====================================================================================
+    phase_started = time.perf_counter()
     async with pool.acquire() as conn:
-        # Таблица users
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE NOT NULL,
-                username TEXT,
-                language TEXT DEFAULT 'ru',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Миграция: добавляем referral_level, если его нет
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_level TEXT DEFAULT 'base' CHECK (referral_level IN ('base', 'vip'))")
-        except Exception:
-            pass
-        
-        # Таблица pending_purchases - контекст покупки для защиты от устаревших кнопок
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS pending_purchases (
-                id SERIAL PRIMARY KEY,
-                purchase_id TEXT UNIQUE NOT NULL,
-                telegram_id BIGINT NOT NULL,
-                tariff TEXT NOT NULL CHECK (tariff IN ('basic', 'plus')),
-                period_days INTEGER NOT NULL,
-                price_kopecks INTEGER NOT NULL,
-                promo_code TEXT,
-                status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'paid', 'expired')),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP
-            )
-        """)
-        
-        # Миграция: устанавливаем expires_at для существующих pending purchases с NULL expires_at
-        try:
-            await conn.execute("""
-                UPDATE pending_purchases 
-                SET expires_at = created_at + INTERVAL '30 minutes'
-                WHERE expires_at IS NULL
-                AND status = 'pending'
-            """)
-        except Exception:
-            pass
-        
-        # Создаем индексы для быстрого поиска
-        try:
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_status ON pending_purchases(status)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_telegram_id ON pending_purchases(telegram_id)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_purchase_id ON pending_purchases(purchase_id)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_expires_at ON pending_purchases(expires_at)")
-        except Exception:
-            # Индексы уже существуют
-            pass
-        
-        # Таблица payments
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT NOT NULL,
-                tariff TEXT NOT NULL,
-                amount INTEGER,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                purchase_id TEXT
-            )
-        """)
-        
-        # Таблица subscriptions
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE NOT NULL,
-                outline_key_id INTEGER,
-                vpn_key TEXT,
-                expires_at TIMESTAMP NOT NULL,
-                reminder_sent BOOLEAN DEFAULT FALSE,
-                reminder_3d_sent BOOLEAN DEFAULT FALSE,
-                reminder_24h_sent BOOLEAN DEFAULT FALSE,
-                reminder_3h_sent BOOLEAN DEFAULT FALSE,
-                reminder_6h_sent BOOLEAN DEFAULT FALSE,
-                admin_grant_days INTEGER DEFAULT NULL,
-                auto_renew BOOLEAN DEFAULT FALSE
-            )
-        """)
-        
-        # Миграция: добавляем auto_renew, если его нет
-        try:
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS auto_renew BOOLEAN DEFAULT FALSE")
-        except Exception:
-            pass
-        
-        # Миграция: добавляем поле для защиты от повторного автопродления
-        try:
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS last_auto_renewal_at TIMESTAMP")
-        except Exception:
-            pass
-        
-        # Миграция: добавляем last_notification_sent_at для автопродления
-        try:
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS last_notification_sent_at TIMESTAMP")
-        except Exception:
-            pass
-        
-        # Миграция: добавляем новые поля для напоминаний, если их нет
-        try:
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_3d_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_24h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS outline_key_id INTEGER")
-            # Делаем vpn_key nullable для поддержки старых записей
-            await conn.execute("ALTER TABLE subscriptions ALTER COLUMN vpn_key DROP NOT NULL")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_3h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_6h_sent BOOLEAN DEFAULT FALSE")
-            
-            # Trial notification flags (без миграции - используем существующую структуру)
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_6h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_18h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_30h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_42h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_54h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_60h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_71h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS admin_grant_days INTEGER DEFAULT NULL")
-            # Поля для умных уведомлений
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS activated_at TIMESTAMP")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS last_bytes BIGINT DEFAULT 0")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS first_traffic_at TIMESTAMP")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_no_traffic_20m_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_no_traffic_24h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_first_connection_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_3days_usage_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_7days_before_expiry_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_expiry_day_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_expired_24h_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_vip_offer_sent BOOLEAN DEFAULT FALSE")
-            # Поле для anti-spam защиты (минимальный интервал между уведомлениями)
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS last_notification_sent_at TIMESTAMP")
-            
-            # Xray Core migration: добавляем uuid, status, source для VLESS
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS uuid TEXT")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'active'")
-            await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS source TEXT DEFAULT 'payment'")
-        except Exception:
-            # Колонки уже существуют
-            pass
-        
-        # Миграция: добавляем поле balance в users (хранится в копейках как INTEGER)
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS balance INTEGER NOT NULL DEFAULT 0")
-        except Exception:
-            pass
-        
-        # Trial usage tracking (без миграций - используем ALTER TABLE IF NOT EXISTS)
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_used_at TIMESTAMP")
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_expires_at TIMESTAMP")
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_completed_sent BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS smart_offer_sent BOOLEAN DEFAULT FALSE")
-        except Exception:
-            # Если колонка уже существует (в том числе как NUMERIC), игнорируем ошибку
-            # Это безопасно, так как мы всегда работаем с копейками
-            pass
-        
-        # Таблица balance_transactions
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS balance_transactions (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                amount NUMERIC NOT NULL,
-                type TEXT NOT NULL,
-                source TEXT,
-                description TEXT,
-                related_user_id BIGINT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Миграция: добавляем related_user_id, если его нет
-        try:
-            await conn.execute("ALTER TABLE balance_transactions ADD COLUMN IF NOT EXISTS related_user_id BIGINT")
-        except Exception:
-            pass
-        
-        # Миграция: добавляем поле source в balance_transactions, если его нет
-        try:
-            await conn.execute("ALTER TABLE balance_transactions ADD COLUMN IF NOT EXISTS source TEXT")
-            # Меняем тип amount на NUMERIC для точности
-            await conn.execute("ALTER TABLE balance_transactions ALTER COLUMN amount TYPE NUMERIC USING amount::NUMERIC")
-        except Exception:
-            # Колонка уже существует или ошибка миграции
-            pass
-        
-        # Миграция: добавляем поля для реферальной программы
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_code TEXT")
-            # Добавляем referrer_id (или referred_by для обратной совместимости)
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT")
-            # Если есть referred_by, но нет referrer_id - копируем данные
-            await conn.execute("""
-                UPDATE users 
-                SET referrer_id = referred_by 
-                WHERE referrer_id IS NULL AND referred_by IS NOT NULL
-            """)
-            # Создаем индекс для быстрого поиска по referral_code
-            await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code) WHERE referral_code IS NOT NULL")
-            # Создаем индекс для быстрого поиска по referrer_id
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id) WHERE referrer_id IS NOT NULL")
-        except Exception:
-            # Колонки уже существуют
-            pass
-        
-        # Таблица referrals (партнёрская программа)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS referrals (
-                id SERIAL PRIMARY KEY,
-                referrer_user_id BIGINT NOT NULL,
-                referred_user_id BIGINT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_rewarded BOOLEAN DEFAULT FALSE,
-                reward_amount INTEGER DEFAULT 0,
-                UNIQUE (referred_user_id)
-            )
-        """)
-        
-        # Создаём индекс для быстрого поиска по партнёру
-        try:
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_user_id)")
-        except Exception:
-            pass
-        
-        # Миграция: переименовываем колонки, если они еще старые
-        try:
-            await conn.execute("ALTER TABLE referrals RENAME COLUMN referrer_id TO referrer_user_id")
-        except Exception:
-            pass
-        try:
-            await conn.execute("ALTER TABLE referrals RENAME COLUMN referred_id TO referred_user_id")
-        except Exception:
-            pass
-        try:
-            await conn.execute("ALTER TABLE referrals RENAME COLUMN rewarded TO is_rewarded")
-        except Exception:
-            pass
-        try:
-            await conn.execute("ALTER TABLE referrals ADD COLUMN IF NOT EXISTS reward_amount INTEGER DEFAULT 0")
-        except Exception:
-            pass
-        try:
-            await conn.execute("ALTER TABLE referrals ADD COLUMN IF NOT EXISTS first_paid_at TIMESTAMP")
-        except Exception:
-            pass
-        
-        # Таблица referral_rewards - история всех начислений реферального кешбэка
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS referral_rewards (
-                id SERIAL PRIMARY KEY,
-                referrer_id BIGINT NOT NULL,
-                buyer_id BIGINT NOT NULL,
-                purchase_id TEXT,
-                purchase_amount INTEGER NOT NULL,
-                percent INTEGER NOT NULL,
-                reward_amount INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Создаём индексы для быстрого поиска
-        try:
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_referrer ON referral_rewards(referrer_id)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_buyer ON referral_rewards(buyer_id)")
-            # Частичный уникальный индекс для предотвращения дубликатов начислений по одному purchase_id
-            await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_rewards_unique_buyer_purchase ON referral_rewards(buyer_id, purchase_id) WHERE purchase_id IS NOT NULL")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_purchase_id ON referral_rewards(purchase_id) WHERE purchase_id IS NOT NULL")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_created_at ON referral_rewards(created_at)")
-        except Exception:
-            pass
-        
-        # Таблица vpn_keys
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS vpn_keys (
-                id SERIAL PRIMARY KEY,
-                vpn_key TEXT UNIQUE NOT NULL,
-                is_used BOOLEAN DEFAULT FALSE,
-                assigned_to BIGINT,
-                assigned_at TIMESTAMP
-            )
-        """)
-        
-        # Таблица audit_log
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS audit_log (
-                id SERIAL PRIMARY KEY,
-                action TEXT NOT NULL,
-                telegram_id BIGINT NOT NULL,
-                target_user BIGINT,
-                details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Миграция: добавляем колонки для VPN lifecycle audit (если их нет)
-        try:
-            await conn.execute("ALTER TABLE audit_log ADD COLUMN IF NOT EXISTS uuid TEXT")
-            await conn.execute("ALTER TABLE audit_log ADD COLUMN IF NOT EXISTS source TEXT")
-            await conn.execute("ALTER TABLE audit_log ADD COLUMN IF NOT EXISTS result TEXT CHECK (result IN ('success', 'error'))")
-            # Создаём индекс для быстрого поиска по UUID
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_uuid ON audit_log(uuid) WHERE uuid IS NOT NULL")
-            # Создаём индекс для быстрого поиска по action
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_action ON audit_log(action)")
-            # Создаём индекс для быстрого поиска по source
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_source ON audit_log(source) WHERE source IS NOT NULL")
-        except Exception:
-            # Колонки уже существуют
-            pass
-        
-        # Таблица subscription_history
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS subscription_history (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT NOT NULL,
-                vpn_key TEXT NOT NULL,
-                start_date TIMESTAMP NOT NULL,
-                end_date TIMESTAMP NOT NULL,
-                action_type TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Таблица broadcasts
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS broadcasts (
-                id SERIAL PRIMARY KEY,
-                title TEXT NOT NULL,
-                message TEXT,
-                message_a TEXT,
-                message_b TEXT,
-                is_ab_test BOOLEAN DEFAULT FALSE,
-                type TEXT NOT NULL,
-                segment TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                sent_by BIGINT NOT NULL
-            )
-        """)
-        
-        # Добавляем колонки для миграции
-        try:
-            await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS segment TEXT")
-            await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS is_ab_test BOOLEAN DEFAULT FALSE")
-            await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS message_a TEXT")
-            await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS message_b TEXT")
-        except Exception:
-            # Колонки уже существуют или таблицы нет
-            pass
-        
-        # Таблица broadcast_log
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS broadcast_log (
-                id SERIAL PRIMARY KEY,
-                broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
-                telegram_id BIGINT NOT NULL,
-                status TEXT NOT NULL,
-                variant TEXT,
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        async with migrations.migration_lock(conn):
+            fingerprint = _legacy_schema_fingerprint()
+            stored_fingerprint = await conn.fetchval(
+                "SELECT fingerprint FROM schema_state WHERE name = $1", LEGACY_SCHEMA_STATE_NAME
             )
-        """)
-        
-        # Добавляем колонку variant для миграции
-        try:
-            await conn.execute("ALTER TABLE broadcast_log ADD COLUMN IF NOT EXISTS variant TEXT")
-        except Exception:
-            # Колонка уже существует или таблицы нет
-            pass
+            if stored_fingerprint == fingerprint and not DB_FORCE_SCHEMA_SYNC:
+                DB_INIT_TIMINGS["legacy_schema_skipped"] = True
+                logger.info(f"Legacy schema up to date (fingerprint {fingerprint[:12]}), DDL skipped")
+            else:
+                await _apply_legacy_schema(conn)
+                await conn.execute(
+                    """INSERT INTO schema_state (name, fingerprint, updated_at)
+                       VALUES ($1, $2, NOW())
+                       ON CONFLICT (name) DO UPDATE SET
+                           fingerprint = EXCLUDED.fingerprint,
+                           updated_at = NOW()""",
+                    LEGACY_SCHEMA_STATE_NAME, fingerprint
+                )
+                DB_INIT_TIMINGS["legacy_schema_skipped"] = False
+                logger.info(f"Legacy schema applied, fingerprint recorded: {fingerprint[:12]}")
+    DB_INIT_TIMINGS["legacy_schema_ms"] = round((time.perf_counter() - phase_started) * 1000, 1)
+    DB_INIT_TIMINGS["total_ms"] = round((time.perf_counter() - init_started) * 1000, 1)
+    logger.info(
+        f"Database init timings: migrations={DB_INIT_TIMINGS['migrations_ms']}ms, "
+        f"legacy_schema={DB_INIT_TIMINGS['legacy_schema_ms']}ms "
+        f"(skipped={DB_INIT_TIMINGS['legacy_schema_skipped']}), total={DB_INIT_TIMINGS['total_ms']}ms"
+    )
+    
+    # Успешная инициализация
+    DB_READY = True
+    DB_INIT_STATUS = DBInitStatus.READY
+    return True
 
-        # Таблица incident_settings (режим инцидента)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS incident_settings (
-                id SERIAL PRIMARY KEY,
-                is_active BOOLEAN DEFAULT FALSE,
-                incident_text TEXT,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Таблица user_discounts (персональные скидки)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_discounts (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE NOT NULL,
-                discount_percent INTEGER NOT NULL,
-                expires_at TIMESTAMP NULL,
-                created_by BIGINT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Таблица vip_users (VIP-статус)
+
+def _legacy_schema_fingerprint() -> str:
+    """
+    Отпечаток легаси-схемы: исходный код _apply_legacy_schema и _init_promo_codes
+    плюс список файлов миграций. Любая правка DDL или новая миграция меняет отпечаток.
+    """
+    import migrations
+    digest = hashlib.sha256()
+    digest.update(inspect.getsource(_apply_legacy_schema).encode("utf-8"))
+    digest.update(inspect.getsource(_init_promo_codes).encode("utf-8"))
+    for version, path in migrations.get_migration_files():
+        digest.update(f"{version}:{path.name}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+async def _apply_legacy_schema(conn):
+    """
+    Легаси-DDL: таблицы, колонки и индексы, созданные до системы миграций, и начальные данные
+    
+    Все операторы идемпотентны. Выполняется только при изменении отпечатка схемы
+    (см. _legacy_schema_fingerprint), иначе init_db пропускает этот блок.
+    """
+    # Таблица users
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            username TEXT,
+            language TEXT DEFAULT 'ru',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Миграция: добавляем referral_level, если его нет
+    try:
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_level TEXT DEFAULT 'base' CHECK (referral_level IN ('base', 'vip'))")
+    except Exception:
+        pass
+    
+    # Таблица pending_purchases - контекст покупки для защиты от устаревших кнопок
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS pending_purchases (
+            id SERIAL PRIMARY KEY,
+            purchase_id TEXT UNIQUE NOT NULL,
+            telegram_id BIGINT NOT NULL,
+            tariff TEXT NOT NULL CHECK (tariff IN ('basic', 'plus')),
+            period_days INTEGER NOT NULL,
+            price_kopecks INTEGER NOT NULL,
+            promo_code TEXT,
+            status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'paid', 'expired')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP
+        )
+    """)
+    
+    # Миграция: устанавливаем expires_at для существующих pending purchases с NULL expires_at
+    try:
         await conn.execute("""
-            CREATE TABLE IF NOT EXISTS vip_users (
-                telegram_id BIGINT UNIQUE NOT NULL PRIMARY KEY,
-                granted_by BIGINT NOT NULL,
-                granted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            UPDATE pending_purchases 
+            SET expires_at = created_at + INTERVAL '30 minutes'
+            WHERE expires_at IS NULL
+            AND status = 'pending'
         """)
-        
-        # Таблица promo_codes (промокоды)
+    except Exception:
+        pass
+    
+    # Создаем индексы для быстрого поиска
+    try:
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_status ON pending_purchases(status)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_telegram_id ON pending_purchases(telegram_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_purchase_id ON pending_purchases(purchase_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_expires_at ON pending_purchases(expires_at)")
+    except Exception:
+        # Индексы уже существуют
+        pass
+    
+    # Таблица payments
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            tariff TEXT NOT NULL,
+            amount INTEGER,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            purchase_id TEXT
+        )
+    """)
+    
+    # Таблица subscriptions
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            outline_key_id INTEGER,
+            vpn_key TEXT,
+            expires_at TIMESTAMP NOT NULL,
+            reminder_sent BOOLEAN DEFAULT FALSE,
+            reminder_3d_sent BOOLEAN DEFAULT FALSE,
+            reminder_24h_sent BOOLEAN DEFAULT FALSE,
+            reminder_3h_sent BOOLEAN DEFAULT FALSE,
+            reminder_6h_sent BOOLEAN DEFAULT FALSE,
+            admin_grant_days INTEGER DEFAULT NULL,
+            auto_renew BOOLEAN DEFAULT FALSE
+        )
+    """)
+    
+    # Миграция: добавляем auto_renew, если его нет
+    try:
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS auto_renew BOOLEAN DEFAULT FALSE")
+    except Exception:
+        pass
+    
+    # Миграция: добавляем поле для защиты от повторного автопродления
+    try:
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS last_auto_renewal_at TIMESTAMP")
+    except Exception:
+        pass
+    
+    # Миграция: добавляем last_notification_sent_at для автопродления
+    try:
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS last_notification_sent_at TIMESTAMP")
+    except Exception:
+        pass
+    
+    # Миграция: добавляем новые поля для напоминаний, если их нет
+    try:
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_3d_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_24h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS outline_key_id INTEGER")
+        # Делаем vpn_key nullable для поддержки старых записей
+        await conn.execute("ALTER TABLE subscriptions ALTER COLUMN vpn_key DROP NOT NULL")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_3h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS reminder_6h_sent BOOLEAN DEFAULT FALSE")
+        
+        # Trial notification flags (без миграции - используем существующую структуру)
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_6h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_18h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_30h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_42h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_54h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_60h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS trial_notif_71h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS admin_grant_days INTEGER DEFAULT NULL")
+        # Поля для умных уведомлений
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS activated_at TIMESTAMP")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS last_bytes BIGINT DEFAULT 0")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS first_traffic_at TIMESTAMP")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_no_traffic_20m_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_no_traffic_24h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_first_connection_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_3days_usage_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_7days_before_expiry_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_expiry_day_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_expired_24h_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS smart_notif_vip_offer_sent BOOLEAN DEFAULT FALSE")
+        # Поле для anti-spam защиты (минимальный интервал между уведомлениями)
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS last_notification_sent_at TIMESTAMP")
+        
+        # Xray Core migration: добавляем uuid, status, source для VLESS
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS uuid TEXT")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'active'")
+        await conn.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS source TEXT DEFAULT 'payment'")
+    except Exception:
+        # Колонки уже существуют
+        pass
+    
+    # Миграция: добавляем поле balance в users (хранится в копейках как INTEGER)
+    try:
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS balance INTEGER NOT NULL DEFAULT 0")
+    except Exception:
+        pass
+    
+    # Trial usage tracking (без миграций - используем ALTER TABLE IF NOT EXISTS)
+    try:
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_used_at TIMESTAMP")
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_expires_at TIMESTAMP")
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_completed_sent BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS smart_offer_sent BOOLEAN DEFAULT FALSE")
+    except Exception:
+        # Если колонка уже существует (в том числе как NUMERIC), игнорируем ошибку
+        # Это безопасно, так как мы всегда работаем с копейками
+        pass
+    
+    # Таблица balance_transactions
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS balance_transactions (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount NUMERIC NOT NULL,
+            type TEXT NOT NULL,
+            source TEXT,
+            description TEXT,
+            related_user_id BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Миграция: добавляем related_user_id, если его нет
+    try:
+        await conn.execute("ALTER TABLE balance_transactions ADD COLUMN IF NOT EXISTS related_user_id BIGINT")
+    except Exception:
+        pass
+    
+    # Миграция: добавляем поле source в balance_transactions, если его нет
+    try:
+        await conn.execute("ALTER TABLE balance_transactions ADD COLUMN IF NOT EXISTS source TEXT")
+        # Меняем тип amount на NUMERIC для точности
+        await conn.execute("ALTER TABLE balance_transactions ALTER COLUMN amount TYPE NUMERIC USING amount::NUMERIC")
+    except Exception:
+        # Колонка уже существует или ошибка миграции
+        pass
+    
+    # Миграция: добавляем поля для реферальной программы
+    try:
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_code TEXT")
+        # Добавляем referrer_id (или referred_by для обратной совместимости)
+        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT")
+        # Если есть referred_by, но нет referrer_id - копируем данные
         await conn.execute("""
-            CREATE TABLE IF NOT EXISTS promo_codes (
-                code TEXT UNIQUE NOT NULL PRIMARY KEY,
-                discount_percent INTEGER NOT NULL,
-                max_uses INTEGER NULL,
-                used_count INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            UPDATE users 
+            SET referrer_id = referred_by 
+            WHERE referrer_id IS NULL AND referred_by IS NOT NULL
         """)
-        
-        # Таблица promo_usage_logs (логи использования промокодов)
+        # Создаем индекс для быстрого поиска по referral_code
+        await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code) WHERE referral_code IS NOT NULL")
+        # Создаем индекс для быстрого поиска по referrer_id
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id) WHERE referrer_id IS NOT NULL")
+    except Exception:
+        # Колонки уже существуют
+        pass
+    
+    # Таблица referrals (партнёрская программа)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS referrals (
+            id SERIAL PRIMARY KEY,
+            referrer_user_id BIGINT NOT NULL,
+            referred_user_id BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_rewarded BOOLEAN DEFAULT FALSE,
+            reward_amount INTEGER DEFAULT 0,
+            UNIQUE (referred_user_id)
+        )
+    """)
+    
+    # Создаём индекс для быстрого поиска по партнёру
+    try:
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_user_id)")
+    except Exception:
+        pass
+    
+    # Миграция: переименовываем колонки, если они еще старые
+    try:
+        await conn.execute("ALTER TABLE referrals RENAME COLUMN referrer_id TO referrer_user_id")
+    except Exception:
+        pass
+    try:
+        await conn.execute("ALTER TABLE referrals RENAME COLUMN referred_id TO referred_user_id")
+    except Exception:
+        pass
+    try:
+        await conn.execute("ALTER TABLE referrals RENAME COLUMN rewarded TO is_rewarded")
+    except Exception:
+        pass
+    try:
+        await conn.execute("ALTER TABLE referrals ADD COLUMN IF NOT EXISTS reward_amount INTEGER DEFAULT 0")
+    except Exception:
+        pass
+    try:
+        await conn.execute("ALTER TABLE referrals ADD COLUMN IF NOT EXISTS first_paid_at TIMESTAMP")
+    except Exception:
+        pass
+    
+    # Таблица referral_rewards - история всех начислений реферального кешбэка
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_rewards (
+            id SERIAL PRIMARY KEY,
+            referrer_id BIGINT NOT NULL,
+            buyer_id BIGINT NOT NULL,
+            purchase_id TEXT,
+            purchase_amount INTEGER NOT NULL,
+            percent INTEGER NOT NULL,
+            reward_amount INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Создаём индексы для быстрого поиска
+    try:
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_referrer ON referral_rewards(referrer_id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_buyer ON referral_rewards(buyer_id)")
+        # Частичный уникальный индекс для предотвращения дубликатов начислений по одному purchase_id
+        await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_rewards_unique_buyer_purchase ON referral_rewards(buyer_id, purchase_id) WHERE purchase_id IS NOT NULL")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_purchase_id ON referral_rewards(purchase_id) WHERE purchase_id IS NOT NULL")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_created_at ON referral_rewards(created_at)")
+    except Exception:
+        pass
+    
+    # Таблица vpn_keys
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS vpn_keys (
+            id SERIAL PRIMARY KEY,
+            vpn_key TEXT UNIQUE NOT NULL,
+            is_used BOOLEAN DEFAULT FALSE,
+            assigned_to BIGINT,
+            assigned_at TIMESTAMP
+        )
+    """)
+    
+    # Таблица audit_log
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id SERIAL PRIMARY KEY,
+            action TEXT NOT NULL,
+            telegram_id BIGINT NOT NULL,
+            target_user BIGINT,
+            details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Миграция: добавляем колонки для VPN lifecycle audit (если их нет)
+    try:
+        await conn.execute("ALTER TABLE audit_log ADD COLUMN IF NOT EXISTS uuid TEXT")
+        await conn.execute("ALTER TABLE audit_log ADD COLUMN IF NOT EXISTS source TEXT")
+        await conn.execute("ALTER TABLE audit_log ADD COLUMN IF NOT EXISTS result TEXT CHECK (result IN ('success', 'error'))")
+        # Создаём индекс для быстрого поиска по UUID
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_uuid ON audit_log(uuid) WHERE uuid IS NOT NULL")
+        # Создаём индекс для быстрого поиска по action
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_action ON audit_log(action)")
+        # Создаём индекс для быстрого поиска по source
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_source ON audit_log(source) WHERE source IS NOT NULL")
+    except Exception:
+        # Колонки уже существуют
+        pass
+    
+    # Таблица subscription_history
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscription_history (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            vpn_key TEXT NOT NULL,
+            start_date TIMESTAMP NOT NULL,
+            end_date TIMESTAMP NOT NULL,
+            action_type TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Таблица broadcasts
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            title TEXT NOT NULL,
+            message TEXT,
+            message_a TEXT,
+            message_b TEXT,
+            is_ab_test BOOLEAN DEFAULT FALSE,
+            type TEXT NOT NULL,
+            segment TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_by BIGINT NOT NULL
+        )
+    """)
+    
+    # Добавляем колонки для миграции
+    try:
+        await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS segment TEXT")
+        await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS is_ab_test BOOLEAN DEFAULT FALSE")
+        await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS message_a TEXT")
+        await conn.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS message_b TEXT")
+    except Exception:
+        # Колонки уже существуют или таблицы нет
+        pass
+    
+    # Таблица broadcast_log
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_log (
+            id SERIAL PRIMARY KEY,
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            telegram_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            variant TEXT,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Добавляем колонку variant для миграции
+    try:
+        await conn.execute("ALTER TABLE broadcast_log ADD COLUMN IF NOT EXISTS variant TEXT")
+    except Exception:
+        # Колонка уже существует или таблицы нет
+        pass
+
+    # Таблица incident_settings (режим инцидента)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS incident_settings (
+            id SERIAL PRIMARY KEY,
+            is_active BOOLEAN DEFAULT FALSE,
+            incident_text TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Таблица user_discounts (персональные скидки)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_discounts (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            discount_percent INTEGER NOT NULL,
+            expires_at TIMESTAMP NULL,
+            created_by BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Таблица vip_users (VIP-статус)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS vip_users (
+            telegram_id BIGINT UNIQUE NOT NULL PRIMARY KEY,
+            granted_by BIGINT NOT NULL,
+            granted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Таблица promo_codes (промокоды)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS promo_codes (
+            code TEXT UNIQUE NOT NULL PRIMARY KEY,
+            discount_percent INTEGER NOT NULL,
+            max_uses INTEGER NULL,
+            used_count INTEGER DEFAULT 0,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_promo_codes_code_upper ON promo_codes (UPPER(code))
+    """)
+    
+    # Таблица promo_usage_logs (логи использования промокодов)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS promo_usage_logs (
+            id SERIAL PRIMARY KEY,
+            promo_code TEXT NOT NULL,
+            telegram_id BIGINT NOT NULL,
+            tariff TEXT NOT NULL,
+            discount_percent INTEGER NOT NULL,
+            price_before INTEGER NOT NULL,
+            price_after INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Создаём одну строку, если её нет
+    existing = await conn.fetchval("SELECT COUNT(*) FROM incident_settings")
+    if existing == 0:
         await conn.execute("""
-            CREATE TABLE IF NOT EXISTS promo_usage_logs (
-                id SERIAL PRIMARY KEY,
-                promo_code TEXT NOT NULL,
-                telegram_id BIGINT NOT NULL,
-                tariff TEXT NOT NULL,
-                discount_percent INTEGER NOT NULL,
-                price_before INTEGER NOT NULL,
-                price_after INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            INSERT INTO incident_settings (is_active, incident_text)
+            VALUES (FALSE, NULL)
         """)
-        
-        # Создаём одну строку, если её нет
-        existing = await conn.fetchval("SELECT COUNT(*) FROM incident_settings")
-        if existing == 0:
-            await conn.execute("""
-                INSERT INTO incident_settings (is_active, incident_text)
-                VALUES (FALSE, NULL)
-            """)
-        
-        # Инициализируем промокоды, если их нет
-        await _init_promo_codes(conn)
-        
-        logger.info("Database tables initialized")
-    # Успешная инициализация
-    DB_READY = True
-    DB_INIT_STATUS = DBInitStatus.READY
-    return True
+    
+    # Инициализируем промокоды, если их нет
+    await _init_promo_codes(conn)
+    
+    logger.info("Database tables initialized")
 
 
 async def _init_promo_codes(conn):
@@ -643,7 +783,7 @@ async def _init_promo_codes(conn):
         INSERT INTO promo_codes (code, discount_percent, max_uses, is_active)
         VALUES
             ('ELVIRA064', 64, 50, TRUE),
-            ('YAbx30', 30, NULL, TRUE),
+            ('YABX30', 30, NULL, TRUE),
             ('FAM50', 50, 50, TRUE),
             ('COURIER30', 30, 40, TRUE)
         ON CONFLICT (code) DO UPDATE SET
@@ -653,14 +793,52 @@ async def _init_promo_codes(conn):
     """)
 
 
-async def get_user(telegram_id: int) -> Optional[Dict[str, Any]]:
+async def get_user(telegram_id: int) -> Optional[User]:
     """Получить пользователя по Telegram ID"""
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT * FROM users WHERE telegram_id = $1", telegram_id
+            f"SELECT {User.columns_sql()} FROM users WHERE telegram_id = $1", telegram_id
         )
-        return dict(row) if row else None
+        return User.from_row(row)
+
+
+async def mark_user_unreachable(telegram_id: int) -> bool:
+    """
+    Отметить пользователя недоступным (постоянная ошибка отправки)
+
+    Returns:
+        True, если отметка поставлена сейчас (а не была раньше)
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        result = await conn.execute(
+            """UPDATE users SET unreachable_since = NOW()
+               WHERE telegram_id = $1 AND unreachable_since IS NULL""",
+            telegram_id
+        )
+    return result == "UPDATE 1"
+
+
+async def clear_user_unreachable(telegram_id: int) -> bool:
+    """
+    Снять отметку недоступности (пользователь прислал апдейт)
+
+    Отметку могла поставить любая реплика (рассылки и напоминания), поэтому
+    проверка всегда идёт в БД: UPDATE по первичному ключу с условием
+    unreachable_since IS NOT NULL ничего не пишет, если отметки нет.
+
+    Returns:
+        True, если отметка была и снята
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        result = await conn.execute(
+            """UPDATE users SET unreachable_since = NULL
+               WHERE telegram_id = $1 AND unreachable_since IS NOT NULL""",
+            telegram_id
+        )
+    return result == "UPDATE 1"
 
 
 async def get_user_balance(telegram_id: int) -> float:
@@ -687,18 +865,156 @@ async def get_user_balance(telegram_id: int) -> float:
         return float(balance) if balance else 0.0
 
 
-async def increase_balance(telegram_id: int, amount: float, source: str = "telegram_payment", description: Optional[str] = None) -> bool:
+# ==================== БАЛАНС: LEDGER ====================
+#
+# balance_transactions - append-only журнал проводок (UPDATE/DELETE запрещены триггером,
+# см. migrations/011_balance_ledger.sql). users.balance - кэшированный снапшот баланса,
+# который меняется только вместе с записью проводки в одной транзакции.
+# Все суммы в копейках.
+
+LEDGER_APPLIED = "applied"
+LEDGER_DUPLICATE = "duplicate"
+LEDGER_INSUFFICIENT_FUNDS = "insufficient_funds"
+LEDGER_USER_NOT_FOUND = "user_not_found"
+
+
+async def _apply_ledger_entry(
+    conn,
+    telegram_id: int,
+    amount_kopecks: int,
+    transaction_type: str,
+    source: Optional[str] = None,
+    description: Optional[str] = None,
+    related_user_id: Optional[int] = None,
+    idempotency_key: Optional[str] = None,
+    allow_negative: bool = False
+) -> Dict[str, Any]:
+    """
+    Применить проводку: изменить снапшот users.balance и дописать запись в ledger
+    
+    ВАЖНО: Вызывается внутри транзакции вызывающего кода.
+    
+    Списание выполняется одним условным UPDATE ... RETURNING (без SELECT перед UPDATE),
+    поэтому блокировка строки пользователя держится минимальное время.
+    Если передан idempotency_key, строка пользователя блокируется заранее и
+    повторная проводка с тем же ключом не применяется (статус duplicate).
+    
+    Args:
+        conn: Соединение с БД (внутри транзакции)
+        telegram_id: Telegram ID пользователя
+        amount_kopecks: Сумма в копейках (положительная - начисление, отрицательная - списание)
+        transaction_type: Тип транзакции ('topup', 'cashback', 'subscription_payment', ...)
+        source: Источник транзакции
+        description: Описание транзакции
+        related_user_id: Связанный пользователь (например, реферал для кешбэка)
+        idempotency_key: Ключ идемпотентности (опционально)
+        allow_negative: Разрешить уход баланса в минус
+    
+    Returns:
+        {"status": LEDGER_*, "balance": баланс после операции в копейках или None}
+    """
+    if idempotency_key:
+        current_balance = await conn.fetchval(
+            "SELECT balance FROM users WHERE telegram_id = $1 FOR UPDATE", telegram_id
+        )
+        if current_balance is None:
+            return {"status": LEDGER_USER_NOT_FOUND, "balance": None}
+        existing = await conn.fetchval(
+            "SELECT 1 FROM balance_idempotency_keys WHERE idempotency_key = $1", idempotency_key
+        )
+        if existing is not None:
+            logger.info(
+                f"Ledger entry already applied: user={telegram_id}, idempotency_key={idempotency_key}"
+            )
+            return {"status": LEDGER_DUPLICATE, "balance": current_balance}
+    
+    new_balance = await conn.fetchval(
+        """UPDATE users SET balance = balance + $1
+           WHERE telegram_id = $2 AND ($3 OR balance + $1 >= 0)
+           RETURNING balance""",
+        amount_kopecks, telegram_id, allow_negative
+    )
+    if new_balance is None:
+        user_exists = await conn.fetchval(
+            "SELECT 1 FROM users WHERE telegram_id = $1", telegram_id
+        )
+        if not user_exists:
+            return {"status": LEDGER_USER_NOT_FOUND, "balance": None}
+        return {"status": LEDGER_INSUFFICIENT_FUNDS, "balance": None}
+    
+    await conn.execute(
+        """INSERT INTO balance_transactions
+           (user_id, amount, type, source, description, related_user_id, idempotency_key, balance_after)
+           VALUES ($1, $2, $3, $4, $5, $6, $7, $8)""",
+        telegram_id, amount_kopecks, transaction_type, source, description,
+        related_user_id, idempotency_key, new_balance
+    )
+    return {"status": LEDGER_APPLIED, "balance": new_balance}
+
+
+async def reconcile_balances(limit: int = 100) -> Dict[str, Any]:
+    """
+    Сверить снапшот users.balance с суммой проводок в ledger
+    
+    Args:
+        limit: Максимальное количество расхождений в ответе
+    
+    Returns:
+        {"mismatch_count": int, "mismatches": [{"telegram_id", "balance", "ledger_sum", "difference"}], "checked_at": datetime}
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT u.telegram_id,
+                   u.balance,
+                   COALESCE(l.ledger_sum, 0)::BIGINT AS ledger_sum,
+                   COUNT(*) OVER () AS mismatch_count
+            FROM users u
+            LEFT JOIN (
+                SELECT user_id, SUM(amount) AS ledger_sum
+                FROM balance_transactions
+                GROUP BY user_id
+            ) l ON l.user_id = u.telegram_id
+            WHERE u.balance <> COALESCE(l.ledger_sum, 0)
+            ORDER BY ABS(u.balance - COALESCE(l.ledger_sum, 0)) DESC
+            LIMIT $1
+        """, limit)
+    
+    mismatches = [
+        {
+            "telegram_id": row["telegram_id"],
+            "balance": row["balance"],
+            "ledger_sum": row["ledger_sum"],
+            "difference": row["balance"] - row["ledger_sum"],
+        }
+        for row in rows
+    ]
+    return {
+        "mismatch_count": rows[0]["mismatch_count"] if rows else 0,
+        "mismatches": mismatches,
+        "checked_at": datetime.now(),
+    }
+
+
+async def increase_balance(
+    telegram_id: int,
+    amount: float,
+    source: str = "telegram_payment",
+    description: Optional[str] = None,
+    idempotency_key: Optional[str] = None
+) -> bool:
     """
-    Увеличить баланс пользователя (атомарно)
+    Увеличить баланс пользователя (атомарно, через ledger)
     
     Args:
         telegram_id: Telegram ID пользователя
         amount: Сумма в рублях (положительное число)
         source: Источник пополнения ('telegram_payment', 'admin', 'referral')
         description: Описание транзакции
+        idempotency_key: Ключ идемпотентности (повторный вызов с тем же ключом не начисляет повторно)
     
     Returns:
-        True если успешно, False при ошибке
+        True если успешно (или уже было применено), False при ошибке
     """
     if amount <= 0:
         logger.error(f"Invalid amount for increase_balance: {amount}")
@@ -707,49 +1023,51 @@ async def increase_balance(telegram_id: int, amount: float, source: str = "teleg
     # Конвертируем рубли в копейки для хранения
     amount_kopecks = int(amount * 100)
     
+    # Определяем тип транзакции на основе source
+    transaction_type = "topup"
+    if source == "referral" or source == "referral_reward":
+        transaction_type = "cashback"
+    elif source == "admin" or source == "admin_adjustment":
+        transaction_type = "admin_adjustment"
+    
     pool = await get_pool()
     async with pool.acquire() as conn:
         async with conn.transaction():
             try:
-                # Обновляем баланс
-                await conn.execute(
-                    "UPDATE users SET balance = balance + $1 WHERE telegram_id = $2",
-                    amount_kopecks, telegram_id
-                )
-                
-                # Определяем тип транзакции на основе source
-                transaction_type = "topup"
-                if source == "referral" or source == "referral_reward":
-                    transaction_type = "cashback"
-                elif source == "admin" or source == "admin_adjustment":
-                    transaction_type = "admin_adjustment"
-                
-                # Записываем транзакцию
-                await conn.execute(
-                    """INSERT INTO balance_transactions (user_id, amount, type, source, description)
-                       VALUES ($1, $2, $3, $4, $5)""",
-                    telegram_id, amount_kopecks, transaction_type, source, description
+                result = await _apply_ledger_entry(
+                    conn, telegram_id, amount_kopecks, transaction_type,
+                    source=source, description=description, idempotency_key=idempotency_key
                 )
+                if result["status"] == LEDGER_USER_NOT_FOUND:
+                    logger.error(f"User {telegram_id} not found")
+                    return False
                 
-                logger.info(f"Increased balance by {amount} RUB ({amount_kopecks} kopecks) for user {telegram_id}, source={source}")
+                logger.info(f"Increased balance by {amount} RUB ({amount_kopecks} kopecks) for user {telegram_id}, source={source}, status={result['status']}")
                 return True
             except Exception as e:
                 logger.exception(f"Error increasing balance for user {telegram_id}")
                 return False
 
 
-async def decrease_balance(telegram_id: int, amount: float, source: str = "subscription_payment", description: Optional[str] = None) -> bool:
+async def decrease_balance(
+    telegram_id: int,
+    amount: float,
+    source: str = "subscription_payment",
+    description: Optional[str] = None,
+    idempotency_key: Optional[str] = None
+) -> bool:
     """
-    Уменьшить баланс пользователя (атомарно)
+    Уменьшить баланс пользователя (атомарно, через ledger)
     
     Args:
         telegram_id: Telegram ID пользователя
         amount: Сумма в рублях (положительное число)
         source: Источник списания ('subscription_payment', 'admin', 'refund')
         description: Описание транзакции
+        idempotency_key: Ключ идемпотентности (повторный вызов с тем же ключом не списывает повторно)
     
     Returns:
-        True если успешно, False при ошибке или недостатке средств
+        True если успешно (или уже было применено), False при ошибке или недостатке средств
     """
     if amount <= 0:
         logger.error(f"Invalid amount for decrease_balance: {amount}")
@@ -758,46 +1076,32 @@ async def decrease_balance(telegram_id: int, amount: float, source: str = "subsc
     # Конвертируем рубли в копейки для хранения
     amount_kopecks = int(amount * 100)
     
+    # Определяем тип транзакции на основе source
+    transaction_type = "subscription_payment"
+    if source == "admin" or source == "admin_adjustment":
+        transaction_type = "admin_adjustment"
+    elif source == "auto_renew":
+        transaction_type = "subscription_payment"  # Автопродление - это тоже оплата подписки
+    elif source == "refund":
+        transaction_type = "topup"  # Возврат средств
+    
     pool = await get_pool()
     async with pool.acquire() as conn:
         async with conn.transaction():
             try:
-                # Проверяем баланс
-                current_balance = await conn.fetchval(
-                    "SELECT balance FROM users WHERE telegram_id = $1", telegram_id
+                # Проверка средств и списание - одним условным UPDATE (amount отрицательный для списания)
+                result = await _apply_ledger_entry(
+                    conn, telegram_id, -amount_kopecks, transaction_type,
+                    source=source, description=description, idempotency_key=idempotency_key
                 )
-                
-                if current_balance is None:
+                if result["status"] == LEDGER_USER_NOT_FOUND:
                     logger.error(f"User {telegram_id} not found")
                     return False
-                
-                if current_balance < amount_kopecks:
-                    logger.warning(f"Insufficient balance for user {telegram_id}: {current_balance} < {amount_kopecks}")
+                if result["status"] == LEDGER_INSUFFICIENT_FUNDS:
+                    logger.warning(f"Insufficient balance for user {telegram_id}: < {amount_kopecks}")
                     return False
                 
-                # Обновляем баланс
-                await conn.execute(
-                    "UPDATE users SET balance = balance - $1 WHERE telegram_id = $2",
-                    amount_kopecks, telegram_id
-                )
-                
-                # Определяем тип транзакции на основе source
-                transaction_type = "subscription_payment"
-                if source == "admin" or source == "admin_adjustment":
-                    transaction_type = "admin_adjustment"
-                elif source == "auto_renew":
-                    transaction_type = "subscription_payment"  # Автопродление - это тоже оплата подписки
-                elif source == "refund":
-                    transaction_type = "topup"  # Возврат средств
-                
-                # Записываем транзакцию (amount отрицательный для списания)
-                await conn.execute(
-                    """INSERT INTO balance_transactions (user_id, amount, type, source, description)
-                       VALUES ($1, $2, $3, $4, $5)""",
-                    telegram_id, -amount_kopecks, transaction_type, source, description
-                )
-                
-                logger.info(f"Decreased balance by {amount} RUB ({amount_kopecks} kopecks) for user {telegram_id}, source={source}")
+                logger.info(f"Decreased balance by {amount} RUB ({amount_kopecks} kopecks) for user {telegram_id}, source={source}, status={result['status']}")
                 return True
             except Exception as e:
                 logger.exception(f"Error decreasing balance for user {telegram_id}")
@@ -808,6 +1112,10 @@ async def log_balance_transaction(telegram_id: int, amount: float, transaction_t
     """
     Записать транзакцию баланса (без изменения баланса)
     
+    ВНИМАНИЕ: Запись без изменения снапшота users.balance будет отмечена
+    сверкой reconcile_balances как расхождение. Для изменения баланса
+    используйте increase_balance / decrease_balance.
+    
     Args:
         telegram_id: Telegram ID пользователя
         amount: Сумма в рублях (может быть отрицательной)
@@ -838,7 +1146,7 @@ async def log_balance_transaction(telegram_id: int, amount: float, transaction_t
 # Старые функции для совместимости
 async def add_balance(telegram_id: int, amount: int, transaction_type: str, description: Optional[str] = None) -> bool:
     """
-    Добавить средства на баланс пользователя (атомарно)
+    Добавить средства на баланс пользователя (атомарно, через ledger)
     
     Args:
         telegram_id: Telegram ID пользователя
@@ -857,18 +1165,12 @@ async def add_balance(telegram_id: int, amount: int, transaction_type: str, desc
     async with pool.acquire() as conn:
         async with conn.transaction():
             try:
-                # Обновляем баланс
-                await conn.execute(
-                    "UPDATE users SET balance = balance + $1 WHERE telegram_id = $2",
-                    amount, telegram_id
-                )
-                
-                # Записываем транзакцию
-                await conn.execute(
-                    """INSERT INTO balance_transactions (user_id, amount, type, description)
-                       VALUES ($1, $2, $3, $4)""",
-                    telegram_id, amount, transaction_type, description
+                result = await _apply_ledger_entry(
+                    conn, telegram_id, amount, transaction_type, description=description
                 )
+                if result["status"] == LEDGER_USER_NOT_FOUND:
+                    logger.error(f"User {telegram_id} not found")
+                    return False
                 
                 logger.info(f"Added {amount} kopecks to balance for user {telegram_id}, type={transaction_type}")
                 return True
@@ -879,7 +1181,7 @@ async def add_balance(telegram_id: int, amount: int, transaction_type: str, desc
 
 async def subtract_balance(telegram_id: int, amount: int, transaction_type: str, description: Optional[str] = None) -> bool:
     """
-    Списать средства с баланса пользователя (атомарно)
+    Списать средства с баланса пользователя (атомарно, через ledger)
     
     Args:
         telegram_id: Telegram ID пользователя
@@ -896,33 +1198,17 @@ async def subtract_balance(telegram_id: int, amount: int, transaction_type: str,
     
     pool = await get_pool()
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            try:
-                # Проверяем баланс
-                current_balance = await conn.fetchval(
-                    "SELECT balance FROM users WHERE telegram_id = $1", telegram_id
-                )
-                
-                if current_balance is None:
-                    logger.error(f"User {telegram_id} not found")
-                    return False
-                
-                if current_balance < amount:
-                    logger.warning(f"Insufficient balance for user {telegram_id}: {current_balance} < {amount}")
-                    return False
-                
-                # Обновляем баланс
-                await conn.execute(
-                    "UPDATE users SET balance = balance - $1 WHERE telegram_id = $2",
-                    amount, telegram_id
-                )
-                
-                # Записываем транзакцию (amount отрицательный для списания)
-                await conn.execute(
-                    """INSERT INTO balance_transactions (user_id, amount, type, description)
-                       VALUES ($1, $2, $3, $4)""",
-                    telegram_id, -amount, transaction_type, description
+        async with conn.transaction():
+            try:
+                result = await _apply_ledger_entry(
+                    conn, telegram_id, -amount, transaction_type, description=description
                 )
+                if result["status"] == LEDGER_USER_NOT_FOUND:
+                    logger.error(f"User {telegram_id} not found")
+                    return False
+                if result["status"] == LEDGER_INSUFFICIENT_FUNDS:
+                    logger.warning(f"Insufficient balance for user {telegram_id}: < {amount}")
+                    return False
                 
                 logger.info(f"Subtracted {amount} kopecks from balance for user {telegram_id}, type={transaction_type}")
                 return True
@@ -931,7 +1217,7 @@ async def subtract_balance(telegram_id: int, amount: int, transaction_type: str,
                 return False
 
 
-async def find_user_by_id_or_username(telegram_id: Optional[int] = None, username: Optional[str] = None) -> Optional[Dict[str, Any]]:
+async def find_user_by_id_or_username(telegram_id: Optional[int] = None, username: Optional[str] = None) -> Optional[User]:
     """Найти пользователя по Telegram ID или username
     
     Args:
@@ -949,15 +1235,15 @@ async def find_user_by_id_or_username(telegram_id: Optional[int] = None, usernam
         if telegram_id is not None:
             # Поиск по ID имеет приоритет
             row = await conn.fetchrow(
-                "SELECT * FROM users WHERE telegram_id = $1", telegram_id
+                f"SELECT {User.columns_sql()} FROM users WHERE telegram_id = $1", telegram_id
             )
-            return dict(row) if row else None
+            return User.from_row(row)
         elif username is not None:
             # Поиск по username (case-insensitive)
             row = await conn.fetchrow(
-                "SELECT * FROM users WHERE LOWER(username) = LOWER($1)", username
+                f"SELECT {User.columns_sql()} FROM users WHERE LOWER(username) = LOWER($1)", username
             )
-            return dict(row) if row else None
+            return User.from_row(row)
         else:
             return None
 
@@ -1009,14 +1295,14 @@ async def create_user(telegram_id: int, username: Optional[str] = None, language
             )
 
 
-async def find_user_by_referral_code(referral_code: str) -> Optional[Dict[str, Any]]:
+async def find_user_by_referral_code(referral_code: str) -> Optional[User]:
     """Найти пользователя по referral_code"""
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT * FROM users WHERE referral_code = $1", referral_code
+            f"SELECT {User.columns_sql()} FROM users WHERE referral_code = $1", referral_code
         )
-        return dict(row) if row else None
+        return User.from_row(row)
 
 
 async def register_referral(referrer_user_id: int, referred_user_id: int) -> bool:
@@ -1045,24 +1331,30 @@ async def register_referral(referrer_user_id: int, referred_user_id: int) -> boo
             if existing:
                 return False
             
-            # Создаем запись о реферале
-            await conn.execute(
-                """INSERT INTO referrals (referrer_user_id, referred_user_id, is_rewarded, reward_amount)
-                   VALUES ($1, $2, FALSE, 0)
-                   ON CONFLICT (referred_user_id) DO NOTHING""",
-                referrer_user_id, referred_user_id
-            )
-            
-            # Обновляем referrer_id у пользователя (устанавливается только один раз)
-            # Также обновляем referred_by для обратной совместимости
-            await conn.execute(
-                """UPDATE users 
-                   SET referrer_id = $1, referred_by = $1 
-                   WHERE telegram_id = $2 
-                   AND referrer_id IS NULL 
-                   AND referred_by IS NULL""",
-                referrer_user_id, referred_user_id
-            )
+            async with conn.transaction():
+                # Создаем запись о реферале
+                result = await conn.execute(
+                    """INSERT INTO referrals (referrer_user_id, referred_user_id, is_rewarded, reward_amount)
+                       VALUES ($1, $2, FALSE, 0)
+                       ON CONFLICT (referred_user_id) DO NOTHING""",
+                    referrer_user_id, referred_user_id
+                )
+                if result != "INSERT 0 1":
+                    return False
+                
+                # Обновляем счётчик приглашённых реферера
+                await _increment_referrer_stats(conn, referrer_user_id, invited=1)
+                
+                # Обновляем referrer_id у пользователя (устанавливается только один раз)
+                # Также обновляем referred_by для обратной совместимости
+                await conn.execute(
+                    """UPDATE users 
+                       SET referrer_id = $1, referred_by = $1 
+                       WHERE telegram_id = $2 
+                       AND referrer_id IS NULL 
+                       AND referred_by IS NULL""",
+                    referrer_user_id, referred_user_id
+                )
             
             logger.info(f"Referral registered: referrer={referrer_user_id}, referred={referred_user_id}")
             return True
@@ -1071,6 +1363,81 @@ async def register_referral(referrer_user_id: int, referred_user_id: int) -> boo
             return False
 
 
+async def _increment_referrer_stats(
+    conn,
+    referrer_id: int,
+    invited: int = 0,
+    paid: int = 0,
+    cashback_kopecks: int = 0,
+    revenue_kopecks: int = 0
+):
+    """
+    Инкрементально обновить счётчики реферера в referrer_stats (внутри транзакции вызывающего кода)
+    
+    Первое приглашение (invited > 0) фиксирует first_referral_date.
+    """
+    await conn.execute(
+        """INSERT INTO referrer_stats (
+               referrer_id, invited_count, paid_count, total_cashback_kopecks,
+               total_revenue_kopecks, first_referral_date, updated_at
+           )
+           VALUES ($1, $2, $3, $4, $5, CASE WHEN $2 > 0 THEN NOW() END, NOW())
+           ON CONFLICT (referrer_id) DO UPDATE SET
+               invited_count = referrer_stats.invited_count + EXCLUDED.invited_count,
+               paid_count = referrer_stats.paid_count + EXCLUDED.paid_count,
+               total_cashback_kopecks = referrer_stats.total_cashback_kopecks + EXCLUDED.total_cashback_kopecks,
+               total_revenue_kopecks = referrer_stats.total_revenue_kopecks + EXCLUDED.total_revenue_kopecks,
+               first_referral_date = COALESCE(referrer_stats.first_referral_date, EXCLUDED.first_referral_date),
+               updated_at = NOW()""",
+        referrer_id, invited, paid, cashback_kopecks, revenue_kopecks
+    )
+
+
+async def get_referrer_stats(referrer_id: int) -> Dict[str, int]:
+    """
+    Получить счётчики реферера (одно чтение по первичному ключу)
+    
+    Returns:
+        Словарь с ключами: invited_count, paid_count, total_cashback_kopecks
+        (нули, если реферер ещё никого не приглашал)
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT invited_count, paid_count, total_cashback_kopecks FROM referrer_stats WHERE referrer_id = $1",
+            referrer_id
+        )
+    if not row:
+        return {"invited_count": 0, "paid_count": 0, "total_cashback_kopecks": 0}
+    return {
+        "invited_count": safe_int(row["invited_count"]),
+        "paid_count": safe_int(row["paid_count"]),
+        "total_cashback_kopecks": safe_int(row["total_cashback_kopecks"]),
+    }
+
+
+async def rebuild_referrer_stats(referrer_id: Optional[int] = None) -> int:
+    """
+    Пересчитать счётчики referrer_stats из истории (backfill / repair)
+    
+    Пересчёт выполняет SQL-функция rebuild_referrer_stats() из миграции 013
+    (та же, что делает первичное заполнение).
+    
+    Args:
+        referrer_id: Пересчитать только одного реферера (None - всех)
+    
+    Returns:
+        Количество пересчитанных рефереров
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            count = await conn.fetchval("SELECT rebuild_referrer_stats($1::BIGINT)", referrer_id) or 0
+    
+    logger.info(f"Referrer stats rebuilt: referrers={count}, scope={referrer_id or 'all'}")
+    return count
+
+
 async def get_referral_stats(telegram_id: int) -> Dict[str, int]:
     """
     Получить статистику рефералов для пользователя
@@ -1112,24 +1479,10 @@ async def get_referral_cashback_percent(partner_id: int) -> int:
     SAFE: Всегда возвращает валидный процент, даже если данных нет
     """
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            # Считаем количество РЕФЕРАЛОВ, КОТОРЫЕ ОПЛАТИЛИ (из referral_rewards)
-            paid_referrals_count_val = await conn.fetchval(
-                """SELECT COUNT(DISTINCT rr.buyer_id)
-                   FROM referral_rewards rr
-                   WHERE rr.referrer_id = $1""",
-                partner_id
-            )
-            paid_referrals_count = safe_int(paid_referrals_count_val)
-        
-        # Определяем процент по прогрессивной шкале
-        if paid_referrals_count >= 50:
-            return 45
-        elif paid_referrals_count >= 25:
-            return 25
-        else:
-            return 10
+        # Количество РЕФЕРАЛОВ, КОТОРЫЕ ОПЛАТИЛИ (счётчик referrer_stats)
+        stats = await get_referrer_stats(partner_id)
+        # Та же шкала, что при начислении кешбэка (_process_referral_reward_atomic)
+        return calculate_referral_percent(stats["paid_count"])
     except Exception as e:
         logger.exception(f"Error in get_referral_cashback_percent for partner_id={partner_id}: {e}")
         # Возвращаем безопасное значение по умолчанию
@@ -1159,373 +1512,622 @@ def calculate_referral_percent(invited_count: int) -> int:
         return 10
 
 
-async def get_referral_level_info(partner_id: int) -> Dict[str, Any]:
+async def get_referral_level_info(partner_id: int) -> Dict[str, Any]:
+    """
+    Получить информацию об уровне реферала и прогрессе до следующего уровня
+    
+    ВАЖНО: Уровень определяется по количеству РЕФЕРАЛОВ, КОТОРЫЕ ОПЛАТИЛИ подписку
+    (не по количеству приглашённых, а по количеству оплативших)
+    
+    Args:
+        partner_id: Telegram ID партнёра
+    
+    Returns:
+        Словарь с ключами:
+        - current_level: текущий процент (10, 25 или 45)
+        - referrals_count: текущее количество приглашённых
+        - paid_referrals_count: количество рефералов, которые оплатили подписку
+        - next_level: следующий процент (25, 45 или None)
+        - referrals_to_next: сколько нужно оплативших рефералов до следующего уровня (или None)
+        - total_cashback: общая сумма заработанного кешбэка в рублях
+    
+    SAFE: Всегда возвращает валидный словарь с безопасными значениями по умолчанию
+    """
+    try:
+        # Одно чтение по первичному ключу из referrer_stats (счётчики поддерживаются инкрементально)
+        stats = await get_referrer_stats(partner_id)
+        referrals_count = stats["invited_count"]
+        paid_referrals_count = stats["paid_count"]
+        total_cashback = stats["total_cashback_kopecks"] / 100.0
+        
+        # Определяем текущий уровень и следующий НА ОСНОВЕ ОПЛАТИВШИХ
+        if paid_referrals_count >= 50:
+            current_level = 45
+            next_level = None
+            referrals_to_next = None
+        elif paid_referrals_count >= 25:
+            current_level = 25
+            next_level = 45
+            referrals_to_next = 50 - paid_referrals_count
+        else:
+            current_level = 10
+            next_level = 25
+            referrals_to_next = 25 - paid_referrals_count
+        
+        return {
+            "current_level": current_level,
+            "referrals_count": referrals_count,
+            "paid_referrals_count": paid_referrals_count,
+            "next_level": next_level,
+            "referrals_to_next": referrals_to_next,
+            "total_cashback": total_cashback
+        }
+    except Exception as e:
+        logger.exception(f"Error in get_referral_level_info for partner_id={partner_id}: {e}")
+        # Возвращаем безопасные значения по умолчанию
+        return {
+            "current_level": 10,
+            "referrals_count": 0,
+            "paid_referrals_count": 0,
+            "next_level": 25,
+            "referrals_to_next": 25,
+            "total_cashback": 0.0
+        }
+
+
+async def get_total_cashback_earned(partner_id: int) -> float:
+    """
+    Получить общую сумму заработанного кешбэка партнёром
+    
+    Args:
+        partner_id: Telegram ID партнёра
+    
+    Returns:
+        Сумма кешбэка в рублях (0.0 если данных нет)
+    
+    SAFE: Всегда возвращает float, даже если данных нет
+    """
+    try:
+        # Счётчик referrer_stats (поддерживается инкрементально при начислении кешбэка)
+        stats = await get_referrer_stats(partner_id)
+        return stats["total_cashback_kopecks"] / 100.0  # Конвертируем из копеек в рубли
+    except Exception as e:
+        logger.exception(f"Error in get_total_cashback_earned for partner_id={partner_id}: {e}")
+        return 0.0
+
+
+async def process_referral_reward_cashback(referred_user_id: int, payment_amount_rubles: float) -> bool:
+    """
+    DEPRECATED: Используйте process_referral_reward вместо этой функции.
+    Оставлена для обратной совместимости.
+    """
+    result = await process_referral_reward(
+        buyer_id=referred_user_id,
+        purchase_id=None,
+        amount_rubles=payment_amount_rubles
+    )
+    return result.get("success", False)
+
+
+async def _process_referral_reward_cashback_OLD(referred_user_id: int, payment_amount_rubles: float) -> bool:
+    """
+    Начислить кешбэк партнёру при КАЖДОЙ оплате приглашенного пользователя
+    
+    DEPRECATED: Используйте process_referral_reward вместо этой функции.
+    Оставлена для обратной совместимости.
+    
+    Args:
+        referred_user_id: Telegram ID приглашенного пользователя, который совершил оплату
+        payment_amount_rubles: Сумма оплаты в рублях
+    
+    Returns:
+        True если кешбэк начислен, False если партнёр не найден или ошибка
+    """
+    # Вызываем новую функцию без purchase_id (для legacy поддержки)
+    result = await process_referral_reward(
+        buyer_id=referred_user_id,
+        purchase_id=None,
+        amount_rubles=payment_amount_rubles
+    )
+    return result.get("success", False)
+
+
+async def process_referral_reward(
+    buyer_id: int,
+    purchase_id: Optional[str],
+    amount_rubles: float,
+    conn=None
+) -> Dict[str, Any]:
+    """
+    Начислить реферальный кешбэк рефереру при успешной активации подписки покупателя.
+    
+    КРИТИЧЕСКИ ВАЖНО:
+    - Начисление происходит ТОЛЬКО при успешной активации подписки (source='payment')
+    - НЕ начисляется при admin-grant, test-access, free-access
+    - Защита от повторного начисления за один purchase_id
+    - Защита от самореферала
+    
+    Args:
+        buyer_id: Telegram ID покупателя, который оплатил подписку
+        purchase_id: ID покупки (для защиты от повторного начисления). Если None - начисление происходит без защиты
+        amount_rubles: Сумма оплаты в рублях
+        conn: Соединение с БД. Если передано - начисление выполняется во вложенной транзакции
+              (savepoint) вызывающего кода, ошибки пробрасываются вызывающему коду
+    
+    Returns:
+        Словарь с результатом:
+        {
+            "success": bool,
+            "referrer_id": Optional[int],
+            "percent": Optional[int],
+            "reward_amount": Optional[float],
+            "message": str
+        }
+    """
+    if conn is not None:
+        async with conn.transaction():
+            return await _process_referral_reward_atomic(conn, buyer_id, purchase_id, amount_rubles)
+    
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                return await _process_referral_reward_atomic(conn, buyer_id, purchase_id, amount_rubles)
+        except Exception as e:
+            logger.exception(f"Error processing referral reward: buyer_id={buyer_id}, purchase_id={purchase_id}: {e}")
+            return {
+                "success": False,
+                "referrer_id": None,
+                "percent": None,
+                "reward_amount": None,
+                "message": f"Error: {str(e)}"
+            }
+
+
+async def _process_referral_reward_atomic(
+    conn,
+    buyer_id: int,
+    purchase_id: Optional[str],
+    amount_rubles: float
+) -> Dict[str, Any]:
+    """Начисление реферального кешбэка внутри транзакции (см. process_referral_reward)"""
+    # 1. Получаем реферера покупателя
+    user = await conn.fetchrow(
+        "SELECT referrer_id FROM users WHERE telegram_id = $1",
+        buyer_id
+    )
+    
+    if not user:
+        logger.debug(f"process_referral_reward: User {buyer_id} not found")
+        return {
+            "success": False,
+            "referrer_id": None,
+            "percent": None,
+            "reward_amount": None,
+            "message": "User not found"
+        }
+    
+    referrer_id = user.get("referrer_id")
+    
+    if not referrer_id:
+        # Пользователь не был приглашён через реферальную программу
+        logger.debug(f"process_referral_reward: User {buyer_id} has no referrer")
+        return {
+            "success": False,
+            "referrer_id": None,
+            "percent": None,
+            "reward_amount": None,
+            "message": "No referrer"
+        }
+    
+    # 2. ЗАЩИТА ОТ САМОРЕФЕРАЛА
+    if referrer_id == buyer_id:
+        logger.warning(f"process_referral_reward: Self-referral detected: user {buyer_id}")
+        return {
+            "success": False,
+            "referrer_id": referrer_id,
+            "percent": None,
+            "reward_amount": None,
+            "message": "Self-referral detected"
+        }
+    
+    # 3. ЗАЩИТА ОТ ПОВТОРНОГО НАЧИСЛЕНИЯ (если purchase_id указан)
+    if purchase_id:
+        existing_reward = await conn.fetchrow(
+            "SELECT id FROM referral_rewards WHERE buyer_id = $1 AND purchase_id = $2",
+            buyer_id, purchase_id
+        )
+        
+        if existing_reward:
+            logger.warning(
+                f"process_referral_reward: Duplicate reward attempt detected: "
+                f"buyer_id={buyer_id}, purchase_id={purchase_id}"
+            )
+            return {
+                "success": False,
+                "referrer_id": referrer_id,
+                "percent": None,
+                "reward_amount": None,
+                "message": "Reward already processed for this purchase"
+            }
+    
+    # 4. Обновляем first_paid_at в referrals, если это первый платеж реферала
+    referral_row = await conn.fetchrow(
+        "SELECT first_paid_at FROM referrals WHERE referrer_user_id = $1 AND referred_user_id = $2",
+        referrer_id, buyer_id
+    )
+    
+    if not referral_row:
+        # Создаем запись в referrals, если её нет
+        inserted = await conn.fetchval(
+            """INSERT INTO referrals (referrer_user_id, referred_user_id, first_paid_at)
+               VALUES ($1, $2, NOW())
+               ON CONFLICT (referred_user_id) DO UPDATE
+               SET first_paid_at = COALESCE(referrals.first_paid_at, NOW())
+               RETURNING (xmax = 0)""",
+            referrer_id, buyer_id
+        )
+        if inserted:
+            await _increment_referrer_stats(conn, referrer_id, invited=1)
+    elif not referral_row.get("first_paid_at"):
+        # Обновляем first_paid_at, если он еще не установлен
+        await conn.execute(
+            "UPDATE referrals SET first_paid_at = NOW() WHERE referrer_user_id = $1 AND referred_user_id = $2 AND first_paid_at IS NULL",
+            referrer_id, buyer_id
+        )
+    
+    # 5. Определяем процент кешбэка на основе количества оплативших рефералов
+    # Источник - счётчик referrer_stats.paid_count, тот же, что показывает экран партнёра.
+    # Строка блокируется до конца транзакции: параллельные начисления одному рефереру
+    # выполняются по очереди и видят начисления друг друга
+    paid_count = safe_int(await conn.fetchval(
+        "SELECT paid_count FROM referrer_stats WHERE referrer_id = $1 FOR UPDATE",
+        referrer_id
+    ))
+    is_first_reward_for_buyer = not await conn.fetchval(
+        "SELECT EXISTS(SELECT 1 FROM referral_rewards WHERE buyer_id = $1 AND referrer_id = $2)",
+        buyer_id, referrer_id
+    )
+    # Первая оплата покупателя учитывается в уровне сразу (счётчик растёт в шаге 9)
+    paid_referrals_count = paid_count + (1 if is_first_reward_for_buyer else 0)
+    percent = calculate_referral_percent(paid_referrals_count)
+    
+    # Вычисляем сколько осталось до следующего уровня
+    if paid_referrals_count < 25:
+        next_level_threshold = 25
+        referrals_needed = 25 - paid_referrals_count
+    elif paid_referrals_count < 50:
+        next_level_threshold = 50
+        referrals_needed = 50 - paid_referrals_count
+    else:
+        next_level_threshold = None
+        referrals_needed = 0
+    
+    # 6. Рассчитываем сумму кешбэка (в копейках)
+    purchase_amount_kopecks = int(amount_rubles * 100)
+    reward_amount_kopecks = int(purchase_amount_kopecks * percent / 100)
+    reward_amount_rubles = reward_amount_kopecks / 100.0
+    
+    if reward_amount_kopecks <= 0:
+        logger.warning(
+            f"process_referral_reward: Invalid reward amount: "
+            f"{reward_amount_kopecks} kopecks for payment {amount_rubles} RUB, percent={percent}%"
+        )
+        return {
+            "success": False,
+            "referrer_id": referrer_id,
+            "percent": percent,
+            "reward_amount": None,
+            "message": "Invalid reward amount"
+        }
+    
+    # 7-8. Начисляем кешбэк на баланс реферера (проводка в ledger)
+    ledger_result = await _apply_ledger_entry(
+        conn, referrer_id, reward_amount_kopecks, "cashback",
+        source="referral",
+        description=f"Реферальный кешбэк {percent}% за оплату пользователя {buyer_id}",
+        related_user_id=buyer_id,
+        idempotency_key=f"referral_reward:{buyer_id}:{purchase_id}" if purchase_id else None
+    )
+    if ledger_result["status"] != LEDGER_APPLIED:
+        # Проводка уже была применена или реферер удалён: историю и счётчики не трогаем
+        logger.warning(
+            f"process_referral_reward: cashback not applied: status={ledger_result['status']}, "
+            f"referrer={referrer_id}, buyer={buyer_id}, purchase_id={purchase_id}"
+        )
+        return {
+            "success": False,
+            "referrer_id": referrer_id,
+            "percent": percent,
+            "reward_amount": None,
+            "message": f"Cashback not applied: {ledger_result['status']}"
+        }
+    
+    # 9. Создаём запись в referral_rewards (история начислений) и обновляем счётчики реферера
+    await conn.execute(
+        """INSERT INTO referral_rewards 
+           (referrer_id, buyer_id, purchase_id, purchase_amount, percent, reward_amount)
+           VALUES ($1, $2, $3, $4, $5, $6)""",
+        referrer_id, buyer_id, purchase_id, purchase_amount_kopecks, percent, reward_amount_kopecks
+    )
+    await _increment_referrer_stats(
+        conn, referrer_id,
+        paid=1 if is_first_reward_for_buyer else 0,
+        cashback_kopecks=reward_amount_kopecks,
+        revenue_kopecks=purchase_amount_kopecks
+    )
+    
+    # 10. Логируем событие
+    details = (
+        f"Referral reward awarded: referrer={referrer_id} ({percent}%), "
+        f"buyer={buyer_id}, purchase_id={purchase_id}, "
+        f"purchase={amount_rubles:.2f} RUB, reward={reward_amount_rubles:.2f} RUB "
+        f"({reward_amount_kopecks} kopecks), paid_referrals_count={paid_referrals_count}"
+    )
+    await _log_audit_event_atomic(
+        conn,
+        "referral_reward",
+        referrer_id,
+        buyer_id,
+        details
+    )
+    
+    logger.info(
+        f"Referral reward awarded: referrer={referrer_id}, buyer={buyer_id}, "
+        f"percent={percent}%, amount={reward_amount_rubles:.2f} RUB, "
+        f"paid_referrals_count={paid_referrals_count}"
+    )
+    
+    return {
+        "success": True,
+        "referrer_id": referrer_id,
+        "percent": percent,
+        "reward_amount": reward_amount_rubles,
+        "paid_referrals_count": paid_referrals_count,
+        "next_level_threshold": next_level_threshold,
+        "referrals_needed": referrals_needed,
+        "message": "Reward awarded successfully"
+    }
+
+
+# ==================== РЕФЕРАЛЬНЫЙ OUTBOX ====================
+#
+# Платёжная транзакция только пишет событие в referral_reward_outbox (одна вставка),
+# начисление кешбэка и уведомление реферера выполняет referral_outbox_worker пакетами.
+
+REFERRAL_OUTBOX_MAX_ATTEMPTS = 5
+REFERRAL_OUTBOX_RETRY_BASE_SECONDS = 30
+
+
+async def _enqueue_referral_reward_atomic(
+    conn,
+    buyer_id: int,
+    amount_kopecks: int,
+    event_key: str,
+    purchase_id: Optional[str] = None,
+    action_type: str = "покупку"
+) -> bool:
+    """
+    Записать событие оплаты в outbox в транзакции вызывающего кода
+    
+    Строка создаётся только если у покупателя есть реферер (не он сам).
+    Повторная запись с тем же event_key игнорируется.
+    
+    Returns:
+        True если событие поставлено в очередь
+    """
+    result = await conn.execute("""
+        INSERT INTO referral_reward_outbox (event_key, buyer_id, purchase_id, amount_kopecks, action_type)
+        SELECT $1, u.telegram_id, $3, $4, $5
+        FROM users u
+        WHERE u.telegram_id = $2
+          AND u.referrer_id IS NOT NULL
+          AND u.referrer_id <> u.telegram_id
+        ON CONFLICT (event_key) DO NOTHING
+    """, event_key, buyer_id, purchase_id, amount_kopecks, action_type)
+    return result == "INSERT 0 1"
+
+
+async def enqueue_referral_reward(
+    buyer_id: int,
+    amount_rubles: float,
+    event_key: str,
+    purchase_id: Optional[str] = None,
+    action_type: str = "покупку"
+) -> bool:
     """
-    Получить информацию об уровне реферала и прогрессе до следующего уровня
-    
-    ВАЖНО: Уровень определяется по количеству РЕФЕРАЛОВ, КОТОРЫЕ ОПЛАТИЛИ подписку
-    (не по количеству приглашённых, а по количеству оплативших)
+    Поставить начисление реферального кешбэка в очередь (outbox)
     
     Args:
-        partner_id: Telegram ID партнёра
+        buyer_id: Telegram ID покупателя
+        amount_rubles: Сумма оплаты в рублях
+        event_key: Уникальный ключ события оплаты (например, "purchase:<purchase_id>")
+        purchase_id: ID покупки (опционально)
+        action_type: Тип действия для уведомления ("покупку", "продление", "пополнение")
     
     Returns:
-        Словарь с ключами:
-        - current_level: текущий процент (10, 25 или 45)
-        - referrals_count: текущее количество приглашённых (из таблицы referrals)
-        - paid_referrals_count: количество рефералов, которые оплатили подписку (из referral_rewards)
-        - next_level: следующий процент (25, 45 или None)
-        - referrals_to_next: сколько нужно оплативших рефералов до следующего уровня (или None)
-    
-    SAFE: Всегда возвращает валидный словарь с безопасными значениями по умолчанию
+        True если событие поставлено в очередь
     """
-    try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            # Считаем количество приглашённых пользователей (из таблицы referrals)
-            # Безопасная обработка NULL
-            referrals_count_val = await conn.fetchval(
-                "SELECT COUNT(*) FROM referrals WHERE referrer_user_id = $1",
-                partner_id
-            )
-            referrals_count = safe_int(referrals_count_val)
-            
-            # Считаем количество РЕФЕРАЛОВ, КОТОРЫЕ ОПЛАТИЛИ подписку (из referral_rewards)
-            # Это важное отличие: уровень определяется по оплатившим, а не по приглашённым
-            paid_referrals_count_val = await conn.fetchval(
-                """SELECT COUNT(DISTINCT rr.buyer_id)
-                   FROM referral_rewards rr
-                   WHERE rr.referrer_id = $1""",
-                partner_id
-            )
-            paid_referrals_count = safe_int(paid_referrals_count_val)
-            
-            # Определяем текущий уровень и следующий НА ОСНОВЕ ОПЛАТИВШИХ
-            if paid_referrals_count >= 50:
-                current_level = 45
-                next_level = None
-                referrals_to_next = None
-            elif paid_referrals_count >= 25:
-                current_level = 25
-                next_level = 45
-                referrals_to_next = 50 - paid_referrals_count
-            else:
-                current_level = 10
-                next_level = 25
-                referrals_to_next = 25 - paid_referrals_count
-            
-            return {
-                "current_level": current_level,
-                "referrals_count": referrals_count,
-                "paid_referrals_count": paid_referrals_count,
-                "next_level": next_level,
-                "referrals_to_next": referrals_to_next
-            }
-    except Exception as e:
-        logger.exception(f"Error in get_referral_level_info for partner_id={partner_id}: {e}")
-        # Возвращаем безопасные значения по умолчанию
-        return {
-            "current_level": 10,
-            "referrals_count": 0,
-            "paid_referrals_count": 0,
-            "next_level": 25,
-            "referrals_to_next": 25
-        }
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await _enqueue_referral_reward_atomic(
+            conn, buyer_id, int(amount_rubles * 100), event_key,
+            purchase_id=purchase_id, action_type=action_type
+        )
 
 
-async def get_total_cashback_earned(partner_id: int) -> float:
+async def process_referral_reward_outbox_batch(limit: int = 50) -> Tuple[List[Dict[str, Any]], int]:
     """
-    Получить общую сумму заработанного кешбэка партнёром
+    Обработать пакет событий из referral_reward_outbox
+    
+    Пакет выбирается с FOR UPDATE SKIP LOCKED (несколько воркеров не мешают друг другу)
+    и обрабатывается в одной транзакции: каждое начисление - во вложенной транзакции (savepoint),
+    вместе с отметкой строки outbox как обработанной. Поэтому начисление выполняется ровно
+    один раз, даже для оплат без purchase_id. Ошибочные события откладываются с экспоненциальной
+    задержкой, после REFERRAL_OUTBOX_MAX_ATTEMPTS попыток помечаются как failed.
     
     Args:
-        partner_id: Telegram ID партнёра
+        limit: Максимальный размер пакета
     
     Returns:
-        Сумма кешбэка в рублях (0.0 если данных нет)
-    
-    SAFE: Всегда возвращает float, даже если данных нет
+        Кортеж (processed, claimed):
+        - processed: список обработанных событий {"id", "buyer_id", "amount_rubles", "action_type", "result"}
+        - claimed: сколько строк outbox взято в пакет, включая отложенные из-за ошибки
     """
-    try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            # Суммируем все транзакции типа 'cashback' для партнёра
-            # COALESCE гарантирует, что NULL станет 0
-            total_kopecks_val = await conn.fetchval(
-                """SELECT COALESCE(SUM(amount), 0) 
-                   FROM balance_transactions 
-                   WHERE user_id = $1 AND type = 'cashback'""",
-                partner_id
-            )
-            total_kopecks = safe_int(total_kopecks_val)
+    processed = []
+    rows = []
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            rows = await conn.fetch("""
+                SELECT id, buyer_id, purchase_id, amount_kopecks, action_type, attempts
+                FROM referral_reward_outbox
+                WHERE status = 'pending' AND available_at <= NOW()
+                ORDER BY id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            """, limit)
             
-            return total_kopecks / 100.0  # Конвертируем из копеек в рубли
-    except Exception as e:
-        logger.exception(f"Error in get_total_cashback_earned for partner_id={partner_id}: {e}")
-        return 0.0
+            for row in rows:
+                amount_rubles = row["amount_kopecks"] / 100.0
+                try:
+                    result = await process_referral_reward(
+                        buyer_id=row["buyer_id"],
+                        purchase_id=row["purchase_id"],
+                        amount_rubles=amount_rubles,
+                        conn=conn
+                    )
+                    await conn.execute(
+                        """UPDATE referral_reward_outbox
+                           SET status = 'done', attempts = attempts + 1, processed_at = NOW(), last_error = $2
+                           WHERE id = $1""",
+                        row["id"], None if result.get("success") else result.get("message")
+                    )
+                    processed.append({
+                        "id": row["id"],
+                        "buyer_id": row["buyer_id"],
+                        "amount_rubles": amount_rubles,
+                        "action_type": row["action_type"],
+                        "result": result,
+                    })
+                except Exception as e:
+                    attempts = row["attempts"] + 1
+                    status = "failed" if attempts >= REFERRAL_OUTBOX_MAX_ATTEMPTS else "pending"
+                    retry_delay = REFERRAL_OUTBOX_RETRY_BASE_SECONDS * (2 ** (attempts - 1))
+                    logger.exception(
+                        f"Referral outbox event failed: id={row['id']}, buyer_id={row['buyer_id']}, "
+                        f"attempt={attempts}, status={status}: {e}"
+                    )
+                    await conn.execute(
+                        """UPDATE referral_reward_outbox
+                           SET status = $2, attempts = $3, last_error = $4,
+                               available_at = NOW() + ($5 * INTERVAL '1 second')
+                           WHERE id = $1""",
+                        row["id"], status, attempts, str(e)[:500], retry_delay
+                    )
+    
+    if processed:
+        rewarded = sum(1 for item in processed if item["result"].get("success"))
+        logger.info(f"Referral outbox batch processed: events={len(processed)}, rewarded={rewarded}")
+    return processed, len(rows)
 
 
-async def process_referral_reward_cashback(referred_user_id: int, payment_amount_rubles: float) -> bool:
+# ==================== CRYPTO BOT WEBHOOK INBOX ====================
+#
+# Webhook подтверждается только после записи invoice в cryptobot_webhook_events;
+# обработку выполняют воркеры cryptobot_service, взятая строка держится арендой.
+
+CRYPTOBOT_WEBHOOK_MAX_ATTEMPTS = 5
+CRYPTOBOT_WEBHOOK_RETRY_BASE_SECONDS = 30
+CRYPTOBOT_WEBHOOK_LEASE_SECONDS = int(os.getenv("CRYPTOBOT_WEBHOOK_LEASE_SECONDS", "300"))
+
+
+async def enqueue_cryptobot_webhook_event(invoice_id: str, payload: str) -> Optional[int]:
     """
-    DEPRECATED: Используйте process_referral_reward вместо этой функции.
-    Оставлена для обратной совместимости.
+    Записать оплаченный invoice из webhook в inbox
+    
+    Returns:
+        ID события или None, если invoice уже записан (повторная доставка)
     """
-    result = await process_referral_reward(
-        buyer_id=referred_user_id,
-        purchase_id=None,
-        amount_rubles=payment_amount_rubles
-    )
-    return result.get("success", False)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval("""
+            INSERT INTO cryptobot_webhook_events (invoice_id, payload)
+            VALUES ($1, $2)
+            ON CONFLICT (invoice_id) DO NOTHING
+            RETURNING id
+        """, invoice_id, payload)
 
 
-async def _process_referral_reward_cashback_OLD(referred_user_id: int, payment_amount_rubles: float) -> bool:
+async def claim_cryptobot_webhook_event() -> Optional[Dict[str, Any]]:
     """
-    Начислить кешбэк партнёру при КАЖДОЙ оплате приглашенного пользователя
-    
-    DEPRECATED: Используйте process_referral_reward вместо этой функции.
-    Оставлена для обратной совместимости.
+    Взять в работу следующее событие inbox (ожидающее или с истёкшей арендой)
     
-    Args:
-        referred_user_id: Telegram ID приглашенного пользователя, который совершил оплату
-        payment_amount_rubles: Сумма оплаты в рублях
+    Событие получает аренду на CRYPTOBOT_WEBHOOK_LEASE_SECONDS: если воркер
+    не завершит его (падение, деплой), после истечения аренды событие возьмёт другой.
     
     Returns:
-        True если кешбэк начислен, False если партнёр не найден или ошибка
+        {"id", "invoice_id", "payload", "attempts"} или None, если очередь пуста
     """
-    # Вызываем новую функцию без purchase_id (для legacy поддержки)
-    result = await process_referral_reward(
-        buyer_id=referred_user_id,
-        purchase_id=None,
-        amount_rubles=payment_amount_rubles
-    )
-    return result.get("success", False)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            UPDATE cryptobot_webhook_events
+            SET status = 'processing', attempts = attempts + 1,
+                locked_until = NOW() + ($1 * INTERVAL '1 second')
+            WHERE id = (
+                SELECT id FROM cryptobot_webhook_events
+                WHERE (status = 'pending' AND available_at <= NOW())
+                   OR (status = 'processing' AND locked_until < NOW())
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, invoice_id, payload, attempts
+        """, CRYPTOBOT_WEBHOOK_LEASE_SECONDS)
+        return dict(row) if row else None
 
 
-async def process_referral_reward(
-    buyer_id: int,
-    purchase_id: Optional[str],
-    amount_rubles: float
-) -> Dict[str, Any]:
+async def complete_cryptobot_webhook_event(event_id: int, result: str) -> None:
+    """Отметить событие inbox обработанным"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE cryptobot_webhook_events
+            SET status = 'done', result = $2, locked_until = NULL, processed_at = NOW()
+            WHERE id = $1
+        """, event_id, result)
+
+
+async def fail_cryptobot_webhook_event(event_id: int, attempts: int, error: str) -> str:
     """
-    Начислить реферальный кешбэк рефереру при успешной активации подписки покупателя.
-    
-    КРИТИЧЕСКИ ВАЖНО:
-    - Начисление происходит ТОЛЬКО при успешной активации подписки (source='payment')
-    - НЕ начисляется при admin-grant, test-access, free-access
-    - Защита от повторного начисления за один purchase_id
-    - Защита от самореферала
-    
-    Args:
-        buyer_id: Telegram ID покупателя, который оплатил подписку
-        purchase_id: ID покупки (для защиты от повторного начисления). Если None - начисление происходит без защиты
-        amount_rubles: Сумма оплаты в рублях
+    Отложить событие inbox после ошибки обработки (экспоненциальная задержка)
     
     Returns:
-        Словарь с результатом:
-        {
-            "success": bool,
-            "referrer_id": Optional[int],
-            "percent": Optional[int],
-            "reward_amount": Optional[float],
-            "message": str
-        }
+        Новый статус: pending, либо failed после CRYPTOBOT_WEBHOOK_MAX_ATTEMPTS попыток
     """
+    status = "failed" if attempts >= CRYPTOBOT_WEBHOOK_MAX_ATTEMPTS else "pending"
+    retry_delay = CRYPTOBOT_WEBHOOK_RETRY_BASE_SECONDS * (2 ** (attempts - 1))
     pool = await get_pool()
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            try:
-                # 1. Получаем реферера покупателя
-                user = await conn.fetchrow(
-                    "SELECT referrer_id FROM users WHERE telegram_id = $1",
-                    buyer_id
-                )
-                
-                if not user:
-                    logger.debug(f"process_referral_reward: User {buyer_id} not found")
-                    return {
-                        "success": False,
-                        "referrer_id": None,
-                        "percent": None,
-                        "reward_amount": None,
-                        "message": "User not found"
-                    }
-                
-                referrer_id = user.get("referrer_id")
-                
-                if not referrer_id:
-                    # Пользователь не был приглашён через реферальную программу
-                    logger.debug(f"process_referral_reward: User {buyer_id} has no referrer")
-                    return {
-                        "success": False,
-                        "referrer_id": None,
-                        "percent": None,
-                        "reward_amount": None,
-                        "message": "No referrer"
-                    }
-                
-                # 2. ЗАЩИТА ОТ САМОРЕФЕРАЛА
-                if referrer_id == buyer_id:
-                    logger.warning(f"process_referral_reward: Self-referral detected: user {buyer_id}")
-                    return {
-                        "success": False,
-                        "referrer_id": referrer_id,
-                        "percent": None,
-                        "reward_amount": None,
-                        "message": "Self-referral detected"
-                    }
-                
-                # 3. ЗАЩИТА ОТ ПОВТОРНОГО НАЧИСЛЕНИЯ (если purchase_id указан)
-                if purchase_id:
-                    existing_reward = await conn.fetchrow(
-                        "SELECT id FROM referral_rewards WHERE buyer_id = $1 AND purchase_id = $2",
-                        buyer_id, purchase_id
-                    )
-                    
-                    if existing_reward:
-                        logger.warning(
-                            f"process_referral_reward: Duplicate reward attempt detected: "
-                            f"buyer_id={buyer_id}, purchase_id={purchase_id}"
-                        )
-                        return {
-                            "success": False,
-                            "referrer_id": referrer_id,
-                            "percent": None,
-                            "reward_amount": None,
-                            "message": "Reward already processed for this purchase"
-                        }
-                
-                # 4. Обновляем first_paid_at в referrals, если это первый платеж реферала
-                referral_row = await conn.fetchrow(
-                    "SELECT first_paid_at FROM referrals WHERE referrer_user_id = $1 AND referred_user_id = $2",
-                    referrer_id, buyer_id
-                )
-                
-                if not referral_row:
-                    # Создаем запись в referrals, если её нет
-                    await conn.execute(
-                        """INSERT INTO referrals (referrer_user_id, referred_user_id, first_paid_at)
-                           VALUES ($1, $2, NOW())
-                           ON CONFLICT (referred_user_id) DO UPDATE
-                           SET first_paid_at = COALESCE(referrals.first_paid_at, NOW())""",
-                        referrer_id, buyer_id
-                    )
-                elif not referral_row.get("first_paid_at"):
-                    # Обновляем first_paid_at, если он еще не установлен
-                    await conn.execute(
-                        "UPDATE referrals SET first_paid_at = NOW() WHERE referrer_user_id = $1 AND referred_user_id = $2 AND first_paid_at IS NULL",
-                        referrer_id, buyer_id
-                    )
-                
-                # 5. Определяем процент кешбэка на основе количества оплативших рефералов
-                # Считаем количество рефералов, которые ХОТЯ БЫ ОДИН РАЗ оплатили подписку
-                # Используем referrals.first_paid_at как источник истины
-                paid_referrals_count = await conn.fetchval(
-                    """SELECT COUNT(DISTINCT referred_user_id)
-                       FROM referrals
-                       WHERE referrer_user_id = $1 AND first_paid_at IS NOT NULL""",
-                    referrer_id
-                ) or 0
-                
-                # Определяем процент по прогрессивной шкале
-                if paid_referrals_count >= 50:
-                    percent = 45
-                elif paid_referrals_count >= 25:
-                    percent = 25
-                else:
-                    percent = 10
-                
-                # Вычисляем сколько осталось до следующего уровня
-                if paid_referrals_count < 25:
-                    next_level_threshold = 25
-                    referrals_needed = 25 - paid_referrals_count
-                elif paid_referrals_count < 50:
-                    next_level_threshold = 50
-                    referrals_needed = 50 - paid_referrals_count
-                else:
-                    next_level_threshold = None
-                    referrals_needed = 0
-                
-                # 6. Рассчитываем сумму кешбэка (в копейках)
-                purchase_amount_kopecks = int(amount_rubles * 100)
-                reward_amount_kopecks = int(purchase_amount_kopecks * percent / 100)
-                reward_amount_rubles = reward_amount_kopecks / 100.0
-                
-                if reward_amount_kopecks <= 0:
-                    logger.warning(
-                        f"process_referral_reward: Invalid reward amount: "
-                        f"{reward_amount_kopecks} kopecks for payment {amount_rubles} RUB, percent={percent}%"
-                    )
-                    return {
-                        "success": False,
-                        "referrer_id": referrer_id,
-                        "percent": percent,
-                        "reward_amount": None,
-                        "message": "Invalid reward amount"
-                    }
-                
-                # 7. Начисляем кешбэк на баланс реферера
-                await conn.execute(
-                    "UPDATE users SET balance = balance + $1 WHERE telegram_id = $2",
-                    reward_amount_kopecks, referrer_id
-                )
-                
-                # 8. Записываем транзакцию баланса
-                await conn.execute(
-                    """INSERT INTO balance_transactions (user_id, amount, type, source, description, related_user_id)
-                       VALUES ($1, $2, $3, $4, $5, $6)""",
-                    referrer_id, reward_amount_kopecks, "cashback", "referral",
-                    f"Реферальный кешбэк {percent}% за оплату пользователя {buyer_id}",
-                    buyer_id
-                )
-                
-                # 9. Создаём запись в referral_rewards (история начислений)
-                await conn.execute(
-                    """INSERT INTO referral_rewards 
-                       (referrer_id, buyer_id, purchase_id, purchase_amount, percent, reward_amount)
-                       VALUES ($1, $2, $3, $4, $5, $6)""",
-                    referrer_id, buyer_id, purchase_id, purchase_amount_kopecks, percent, reward_amount_kopecks
-                )
-                
-                # 10. Логируем событие
-                details = (
-                    f"Referral reward awarded: referrer={referrer_id} ({percent}%), "
-                    f"buyer={buyer_id}, purchase_id={purchase_id}, "
-                    f"purchase={amount_rubles:.2f} RUB, reward={reward_amount_rubles:.2f} RUB "
-                    f"({reward_amount_kopecks} kopecks), paid_referrals_count={paid_referrals_count}"
-                )
-                await _log_audit_event_atomic(
-                    conn,
-                    "referral_reward",
-                    referrer_id,
-                    buyer_id,
-                    details
-                )
-                
-                logger.info(
-                    f"Referral reward awarded: referrer={referrer_id}, buyer={buyer_id}, "
-                    f"percent={percent}%, amount={reward_amount_rubles:.2f} RUB, "
-                    f"paid_referrals_count={paid_referrals_count}"
-                )
-                
-                return {
-                    "success": True,
-                    "referrer_id": referrer_id,
-                    "percent": percent,
-                    "reward_amount": reward_amount_rubles,
-                    "paid_referrals_count": paid_referrals_count,
-                    "next_level_threshold": next_level_threshold,
-                    "referrals_needed": referrals_needed,
-                    "message": "Reward awarded successfully"
-                }
-                
-            except Exception as e:
-                logger.exception(f"Error processing referral reward: buyer_id={buyer_id}, purchase_id={purchase_id}: {e}")
-                return {
-                    "success": False,
-                    "referrer_id": None,
-                    "percent": None,
-                    "reward_amount": None,
-                    "message": f"Error: {str(e)}"
-                }
+        await conn.execute("""
+            UPDATE cryptobot_webhook_events
+            SET status = $2, last_error = $3, locked_until = NULL,
+                available_at = NOW() + ($4 * INTERVAL '1 second')
+            WHERE id = $1
+        """, event_id, status, error[:500], retry_delay)
+    return status
+
+
+async def release_cryptobot_webhook_event(event_id: int) -> None:
+    """Вернуть взятое событие в очередь без траты попытки (остановка воркера)"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE cryptobot_webhook_events
+            SET status = 'pending', attempts = GREATEST(attempts - 1, 0), locked_until = NULL
+            WHERE id = $1 AND status = 'processing'
+        """, event_id)
 
 
 async def update_user_language(telegram_id: int, language: str):
@@ -1548,15 +2150,15 @@ async def update_username(telegram_id: int, username: Optional[str]):
         )
 
 
-async def get_pending_payment_by_user(telegram_id: int) -> Optional[Dict[str, Any]]:
+async def get_pending_payment_by_user(telegram_id: int) -> Optional[Payment]:
     """Получить pending платеж пользователя"""
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT * FROM payments WHERE telegram_id = $1 AND status = 'pending'",
+            f"SELECT {Payment.columns_sql()} FROM payments WHERE telegram_id = $1 AND status = 'pending'",
             telegram_id
         )
-        return dict(row) if row else None
+        return Payment.from_row(row)
 
 
 async def create_payment(telegram_id: int, tariff: str) -> Optional[int]:
@@ -1616,17 +2218,17 @@ async def create_payment(telegram_id: int, tariff: str) -> Optional[int]:
         return payment_id
 
 
-async def get_payment(payment_id: int) -> Optional[Dict[str, Any]]:
+async def get_payment(payment_id: int) -> Optional[Payment]:
     """Получить платеж по ID"""
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT * FROM payments WHERE id = $1", payment_id
+            f"SELECT {Payment.columns_sql()} FROM payments WHERE id = $1", payment_id
         )
-        return dict(row) if row else None
+        return Payment.from_row(row)
 
 
-async def get_last_approved_payment(telegram_id: int) -> Optional[Dict[str, Any]]:
+async def get_last_approved_payment(telegram_id: int) -> Optional[Payment]:
     """Получить последний утверждённый платёж пользователя
     
     Args:
@@ -1638,13 +2240,36 @@ async def get_last_approved_payment(telegram_id: int) -> Optional[Dict[str, Any]
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            """SELECT * FROM payments 
+            f"""SELECT {Payment.columns_sql()} FROM payments
                WHERE telegram_id = $1 AND status = 'approved'
                ORDER BY created_at DESC
                LIMIT 1""",
             telegram_id
         )
-        return dict(row) if row else None
+        return Payment.from_row(row)
+
+
+async def get_last_approved_tariffs(telegram_ids: List[int]) -> Dict[int, str]:
+    """Тарифы последних утверждённых платежей пользователей одним запросом
+
+    Args:
+        telegram_ids: Telegram ID пользователей
+
+    Returns:
+        Словарь telegram_id -> tariff (пользователи без платежей отсутствуют)
+    """
+    if not telegram_ids:
+        return {}
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """SELECT DISTINCT ON (telegram_id) telegram_id, tariff
+               FROM payments
+               WHERE telegram_id = ANY($1::bigint[]) AND status = 'approved'
+               ORDER BY telegram_id, created_at DESC""",
+            telegram_ids
+        )
+        return {row["telegram_id"]: row["tariff"] for row in rows}
 
 
 async def update_payment_status(payment_id: int, status: str, admin_telegram_id: Optional[int] = None):
@@ -1774,7 +2399,7 @@ async def check_and_disable_expired_subscription(telegram_id: int) -> bool:
                 return False
 
 
-async def get_subscription(telegram_id: int) -> Optional[Dict[str, Any]]:
+async def get_subscription(telegram_id: int) -> Optional[Subscription]:
     """Получить активную подписку пользователя
     
     Активной считается подписка, у которой:
@@ -1792,13 +2417,14 @@ async def get_subscription(telegram_id: int) -> Optional[Dict[str, Any]]:
     async with pool.acquire() as conn:
         now = datetime.now()
         row = await conn.fetchrow(
-            "SELECT * FROM subscriptions WHERE telegram_id = $1 AND status = 'active' AND expires_at > $2",
+            f"SELECT {Subscription.columns_sql()} FROM subscriptions "
+            "WHERE telegram_id = $1 AND status = 'active' AND expires_at > $2",
             telegram_id, now
         )
-        return dict(row) if row else None
+        return Subscription.from_row(row)
 
 
-async def get_subscription_any(telegram_id: int) -> Optional[Dict[str, Any]]:
+async def get_subscription_any(telegram_id: int) -> Optional[Subscription]:
     """Получить подписку пользователя независимо от статуса (активная или истекшая)
     
     Возвращает подписку, если она существует, даже если expires_at <= now.
@@ -1806,10 +2432,10 @@ async def get_subscription_any(telegram_id: int) -> Optional[Dict[str, Any]]:
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT * FROM subscriptions WHERE telegram_id = $1",
+            f"SELECT {Subscription.columns_sql()} FROM subscriptions WHERE telegram_id = $1",
             telegram_id
         )
-        return dict(row) if row else None
+        return Subscription.from_row(row)
 
 
 async def has_any_subscription(telegram_id: int) -> bool:
@@ -1977,7 +2603,7 @@ async def is_trial_available(telegram_id: int) -> bool:
         return True
 
 
-async def get_active_subscription(subscription_id: int) -> Optional[Dict[str, Any]]:
+async def get_active_subscription(subscription_id: int) -> Optional[Subscription]:
     """Получить активную подписку по ID
     
     Args:
@@ -1992,13 +2618,13 @@ async def get_active_subscription(subscription_id: int) -> Optional[Dict[str, An
     async with pool.acquire() as conn:
         now = datetime.now()
         row = await conn.fetchrow(
-            """SELECT * FROM subscriptions 
+            f"""SELECT {Subscription.columns_sql()} FROM subscriptions
                WHERE id = $1 
                AND status = 'active' 
                AND expires_at > $2""",
             subscription_id, now
         )
-        return dict(row) if row else None
+        return Subscription.from_row(row)
 
 
 async def update_subscription_uuid(subscription_id: int, new_uuid: str) -> None:
@@ -2021,7 +2647,7 @@ async def update_subscription_uuid(subscription_id: int, new_uuid: str) -> None:
         logger.info(f"Subscription UUID updated: subscription_id={subscription_id}, new_uuid={new_uuid[:8]}...")
 
 
-async def get_all_active_subscriptions() -> List[Dict[str, Any]]:
+async def get_all_active_subscriptions() -> List[Subscription]:
     """Получить все активные подписки
     
     Returns:
@@ -2031,13 +2657,13 @@ async def get_all_active_subscriptions() -> List[Dict[str, Any]]:
     async with pool.acquire() as conn:
         now = datetime.now()
         rows = await conn.fetch(
-            """SELECT * FROM subscriptions 
+            f"""SELECT {Subscription.columns_sql()} FROM subscriptions
                WHERE status = 'active' 
                AND expires_at > $1
                ORDER BY id ASC""",
             now
         )
-        return [dict(row) for row in rows]
+        return [Subscription.from_row(row) for row in rows]
 
 
 async def reissue_subscription_key(subscription_id: int) -> str:
@@ -2181,21 +2807,20 @@ async def _log_vpn_lifecycle_audit_async(
         result: Результат операции ('success' или 'error')
         details: Дополнительные детали (опционально)
     """
+    import audit_writer
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            # Безопасное логирование UUID (только первые 8 символов в БД)
-            uuid_safe = f"{uuid[:8]}..." if uuid and len(uuid) > 8 else (uuid or None)
-            
-            await conn.execute(
-                """INSERT INTO audit_log (action, telegram_id, target_user, uuid, source, result, details)
-                   VALUES ($1, $2, $3, $4, $5, $6, $7)""",
-                action, telegram_id, telegram_id, uuid_safe, source, result, details
-            )
-            logger.debug(
-                f"VPN audit logged: action={action}, user={telegram_id}, uuid={uuid_safe}, "
-                f"source={source}, result={result}"
-            )
+        # Безопасное логирование UUID (только первые 8 символов в БД)
+        uuid_safe = f"{uuid[:8]}..." if uuid and len(uuid) > 8 else (uuid or None)
+        
+        # Событие уходит в буфер audit_writer и пишется пакетом
+        await audit_writer.submit(
+            action, telegram_id, target_user=telegram_id, details=details,
+            uuid=uuid_safe, source=source, result=result
+        )
+        logger.debug(
+            f"VPN audit logged: action={action}, user={telegram_id}, uuid={uuid_safe}, "
+            f"source={source}, result={result}"
+        )
     except Exception as e:
         # Не блокируем основной flow при ошибках логирования
         logger.warning(f"Failed to log VPN audit event: action={action}, user={telegram_id}, error={e}")
@@ -2212,11 +2837,20 @@ def _log_vpn_lifecycle_audit_fire_and_forget(
     """
     Записать событие VPN lifecycle в audit_log (fire-and-forget, не блокирует).
     
-    Создаёт async task для логирования, не ожидает завершения.
+    Если запущен audit_writer, событие ставится в его очередь без ожидания,
+    иначе создаётся async task для логирования (не ожидает завершения).
     Используется когда нужно залогировать событие вне async контекста.
     """
     import asyncio
+    import audit_writer
     try:
+        if audit_writer.is_running():
+            uuid_safe = f"{uuid[:8]}..." if uuid and len(uuid) > 8 else (uuid or None)
+            audit_writer.submit_nowait(
+                action, telegram_id, target_user=telegram_id, details=details,
+                uuid=uuid_safe, source=source, result=result
+            )
+            return
         loop = asyncio.get_event_loop()
         if loop.is_running():
             # Если event loop уже запущен, создаём task
@@ -2254,7 +2888,9 @@ async def _log_subscription_history_atomic(conn, telegram_id: int, vpn_key: str,
 async def _log_audit_event_atomic_standalone(action: str, telegram_id: int, target_user: Optional[int] = None, details: Optional[str] = None):
     """Записать событие аудита в таблицу audit_log (standalone версия)
     
-    Создает свою транзакцию. Используется когда нужно записать событие вне существующей транзакции.
+    Используется когда нужно записать событие вне существующей транзакции.
+    Событие ставится в буфер audit_writer и пишется пакетом (без запущенного
+    писателя - сразу).
     
     Args:
         action: Тип действия (например, 'payment_approved', 'payment_rejected', 'vpn_key_issued', 'subscription_renewed')
@@ -2262,10 +2898,8 @@ async def _log_audit_event_atomic_standalone(action: str, telegram_id: int, targ
         target_user: Telegram ID пользователя, над которым выполнено действие (опционально)
         details: Дополнительные детали действия (опционально)
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            await _log_audit_event_atomic(conn, action, telegram_id, target_user, details)
+    import audit_writer
+    await audit_writer.submit(action, telegram_id, target_user=target_user, details=details)
 
 
 async def reissue_vpn_key_atomic(telegram_id: int, admin_telegram_id: int) -> Tuple[Optional[str], Optional[str]]:
@@ -2979,6 +3613,7 @@ async def approve_payment_atomic(payment_id: int, months: int, admin_telegram_id
     - создает VPN-ключ через Xray API (если нужен новый)
     - создает/продлевает subscription с VPN-ключом
     - записывает событие в audit_log
+    - ставит реферальный кешбэк в очередь (outbox)
     
     Логика выдачи ключей:
     - Использует единую функцию grant_access()
@@ -2989,6 +3624,8 @@ async def approve_payment_atomic(payment_id: int, months: int, admin_telegram_id
         payment_id: ID платежа
         months: Количество месяцев подписки
         admin_telegram_id: Telegram ID администратора, который выполняет approve
+        bot: Не используется (уведомление рефереру отправляет referral_outbox_worker),
+             оставлен для совместимости
     
     Returns:
         (expires_at, is_renewal, vpn_key) или (None, False, None) при ошибке или отсутствии ключей
@@ -3064,118 +3701,16 @@ async def approve_payment_atomic(payment_id: int, months: int, admin_telegram_id
                 details = f"Payment ID: {payment_id}, Tariff: {months} months, Expires: {expires_at.isoformat()}, UUID: {result['uuid']}, VPN: {vpn_key_display}..."
                 await _log_audit_event_atomic(conn, audit_action_type, admin_telegram_id, telegram_id, details)
                 
-                # 8. Обрабатываем реферальный кешбэк (только при первой оплате, не при продлении)
+                # 8. Ставим реферальный кешбэк в очередь (только при первой оплате, не при продлении)
+                # Начисление и уведомление реферера выполняет referral_outbox_worker после коммита
                 if not is_renewal:
-                    # Проверяем, есть ли у пользователя реферер
-                    user_row = await conn.fetchrow(
-                        "SELECT referrer_id, referred_by FROM users WHERE telegram_id = $1", telegram_id
+                    await _enqueue_referral_reward_atomic(
+                        conn,
+                        buyer_id=telegram_id,
+                        amount_kopecks=payment.get("amount", 0),
+                        event_key=f"payment:{payment_id}",
+                        action_type="покупку"
                     )
-                    if user_row:
-                        # Используем referrer_id, если есть, иначе referred_by (для обратной совместимости)
-                        referrer_id = user_row.get("referrer_id") or user_row.get("referred_by")
-                        
-                        if referrer_id:
-                            # ЗАЩИТА ОТ РЕФЕРАЛЬНОГО ФРОДА: invited_user_id НЕ должен быть равен referrer_id
-                            if referrer_id == telegram_id:
-                                logger.warning(
-                                    f"REFERRAL FRAUD: Cashback blocked - invited_user_id ({telegram_id}) == referrer_id ({referrer_id}). "
-                                    f"Payment ID: {payment_id}, Amount: {payment.get('amount', 0) / 100.0:.2f} RUB"
-                                )
-                            else:
-                                # Проверяем, что кешбэк еще не был начислен за этого пользователя
-                                referral_row = await conn.fetchrow(
-                                    "SELECT is_rewarded FROM referrals WHERE referrer_user_id = $1 AND referred_user_id = $2",
-                                    referrer_id, telegram_id
-                                )
-                                
-                                # Начисляем кешбэк только если он еще не был начислен (is_rewarded = FALSE)
-                                if referral_row and not referral_row.get("is_rewarded"):
-                                    try:
-                                        # Получаем сумму платежа в рублях
-                                        payment_amount_rubles = payment.get("amount", 0) / 100.0  # Конвертируем из копеек
-                                        
-                                        if payment_amount_rubles > 0:
-                                            # Получаем процент кешбэка на основе количества приглашённых
-                                            referrals_count = await conn.fetchval(
-                                                "SELECT COUNT(*) FROM referrals WHERE referrer_user_id = $1",
-                                                referrer_id
-                                            ) or 0
-                                            
-                                            # Определяем процент кешбэка (прогрессивная шкала)
-                                            if referrals_count >= 50:
-                                                cashback_percent = 45
-                                            elif referrals_count >= 25:
-                                                cashback_percent = 25
-                                            else:
-                                                cashback_percent = 10
-                                            
-                                            # Рассчитываем кешбэк (в копейках)
-                                            cashback_rubles = payment_amount_rubles * (cashback_percent / 100.0)
-                                            cashback_kopecks = int(cashback_rubles * 100)
-                                            
-                                            if cashback_kopecks > 0:
-                                                # Начисляем кешбэк на баланс реферера
-                                                await conn.execute(
-                                                    "UPDATE users SET balance = balance + $1 WHERE telegram_id = $2",
-                                                    cashback_kopecks, referrer_id
-                                                )
-                                                
-                                                # Записываем транзакцию баланса
-                                                await conn.execute(
-                                                    """INSERT INTO balance_transactions (user_id, amount, type, source, description, related_user_id)
-                                                       VALUES ($1, $2, $3, $4, $5, $6)""",
-                                                    referrer_id, cashback_kopecks, "cashback", "referral",
-                                                    f"Реферальный кешбэк {cashback_percent}% за оплату пользователя {telegram_id}",
-                                                    telegram_id
-                                                )
-                                                
-                                                # Помечаем кешбэк как начисленный (только один раз за пользователя)
-                                                await conn.execute(
-                                                    "UPDATE referrals SET is_rewarded = TRUE, reward_amount = $1 WHERE referrer_user_id = $2 AND referred_user_id = $3",
-                                                    cashback_kopecks, referrer_id, telegram_id
-                                                )
-                                                
-                                                # Получаем обновлённый баланс реферера для уведомления
-                                                referrer_balance_row = await conn.fetchrow(
-                                                    "SELECT balance FROM users WHERE telegram_id = $1", referrer_id
-                                                )
-                                                referrer_balance = referrer_balance_row["balance"] / 100.0 if referrer_balance_row else 0.0
-                                                
-                                                # Логируем событие
-                                                details = f"Referral cashback awarded: referrer={referrer_id} ({cashback_percent}%), referred={telegram_id}, payment={payment_amount_rubles:.2f} RUB, cashback={cashback_rubles:.2f} RUB ({cashback_kopecks} kopecks)"
-                                                await _log_audit_event_atomic(
-                                                    conn,
-                                                    "referral_cashback",
-                                                    referrer_id,
-                                                    telegram_id,
-                                                    details
-                                                )
-                                                
-                                                logger.info(f"Referral cashback awarded: referrer_id={referrer_id}, referred_id={telegram_id}, percent={cashback_percent}%, amount={cashback_rubles:.2f} RUB")
-                                                
-                                                # Отправляем уведомление рефереру о начислении кешбэка (вне транзакции)
-                                                if bot:
-                                                    try:
-                                                        notification_text = (
-                                                            f"🔥 Вам начислен кешбэк!\n"
-                                                            f"Ваш друг оформил подписку.\n"
-                                                            f"💰 Начислено: {cashback_rubles:.2f} ₽\n"
-                                                            f"Баланс: {referrer_balance:.2f} ₽"
-                                                        )
-                                                        await bot.send_message(
-                                                            chat_id=referrer_id,
-                                                            text=notification_text
-                                                        )
-                                                        logger.info(f"Referral cashback notification sent to referrer_id={referrer_id}, cashback={cashback_rubles:.2f} RUB")
-                                                    except Exception as e:
-                                                        # Не блокируем транзакцию при ошибке отправки уведомления
-                                                        logger.warning(f"Failed to send referral cashback notification to referrer_id={referrer_id}: {e}")
-                                            else:
-                                                logger.warning(f"Invalid cashback amount: {cashback_kopecks} kopecks for payment {payment_amount_rubles} RUB")
-                                    except Exception as e:
-                                        logger.exception(f"Error processing referral cashback for referred_id={telegram_id}")
-                                else:
-                                    logger.debug(f"Referral cashback already awarded for referrer_id={referrer_id}, referred_id={telegram_id}")
                 
                 logger.info(f"Payment {payment_id} approved atomically for user {telegram_id}, is_renewal={is_renewal}")
                 return expires_at, is_renewal, final_vpn_key
@@ -3190,9 +3725,9 @@ async def get_pending_payments() -> list:
     pool = await get_pool()
     async with pool.acquire() as conn:
         rows = await conn.fetch(
-            "SELECT * FROM payments WHERE status = 'pending' ORDER BY created_at DESC"
+            f"SELECT {Payment.columns_sql()} FROM payments WHERE status = 'pending' ORDER BY created_at DESC"
         )
-        return [dict(row) for row in rows]
+        return [Payment.from_row(row) for row in rows]
 
 
 async def get_subscriptions_needing_reminder() -> list:
@@ -3209,14 +3744,14 @@ async def get_subscriptions_needing_reminder() -> list:
     pool = await get_pool()
     async with pool.acquire() as conn:
         rows = await conn.fetch(
-            """SELECT * FROM subscriptions 
+            f"""SELECT {Subscription.columns_sql()} FROM subscriptions
                WHERE expires_at > $1 
                AND expires_at <= $2
                AND reminder_sent = FALSE
                ORDER BY expires_at ASC""",
             now, reminder_date
         )
-        return [dict(row) for row in rows]
+        return [Subscription.from_row(row) for row in rows]
 
 
 async def mark_reminder_sent(telegram_id: int):
@@ -3244,19 +3779,146 @@ async def mark_reminder_flag_sent(telegram_id: int, flag_name: str):
         )
 
 
+# Флаги отправленных уведомлений подписки (reminders.py)
+SUBSCRIPTION_NOTIFICATION_FLAGS = (
+    "smart_notif_no_traffic_20m_sent",
+    "smart_notif_no_traffic_24h_sent",
+    "smart_notif_first_connection_sent",
+    "smart_notif_3days_usage_sent",
+    "smart_notif_7days_before_expiry_sent",
+    "smart_notif_3days_before_expiry_sent",
+    "smart_notif_expiry_day_sent",
+    "smart_notif_expired_24h_sent",
+    "smart_notif_vip_offer_sent",
+    "reminder_3d_sent",
+    "reminder_24h_sent",
+    "reminder_3h_sent",
+    "reminder_6h_sent",
+)
+
+
+async def mark_notification_flags_sent(sent: List[Tuple[int, str, Optional[datetime]]]) -> int:
+    """Отметить отправленные уведомления подписок одним UPDATE ... FROM unnest
+
+    Args:
+        sent: Список (telegram_id, имя флага, notified_at); notified_at не None
+              обновляет last_notification_sent_at (anti-spam интервал)
+
+    Returns:
+        Количество обновлённых подписок
+    """
+    if not sent:
+        return 0
+    for _, flag_name, _ in sent:
+        if flag_name not in SUBSCRIPTION_NOTIFICATION_FLAGS:
+            raise ValueError(f"Unknown notification flag: {flag_name}")
+
+    flag_updates = ",\n               ".join(
+        f"{flag} = s.{flag} OR v.flag = '{flag}'" for flag in SUBSCRIPTION_NOTIFICATION_FLAGS
+    )
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        result = await conn.execute(
+            f"""UPDATE subscriptions s
+               SET {flag_updates},
+               last_notification_sent_at = COALESCE(v.notified_at, s.last_notification_sent_at)
+               FROM unnest($1::bigint[], $2::text[], $3::timestamp[]) AS v(telegram_id, flag, notified_at)
+               WHERE s.telegram_id = v.telegram_id""",
+            [telegram_id for telegram_id, _, _ in sent],
+            [flag_name for _, flag_name, _ in sent],
+            [notified_at for _, _, notified_at in sent]
+        )
+    return int(result.split()[-1])
+
+
+# Часы расписания trial-уведомлений (колонки subscriptions.trial_notif_<hours>h_sent)
+TRIAL_NOTIFICATION_HOURS = (6, 18, 30, 42, 54, 60, 71)
+
+
+async def mark_trial_notifications_sent(sent: List[Tuple[int, int]]) -> int:
+    """Отметить trial-уведомления отправленными одним UPDATE ... FROM unnest
+
+    Args:
+        sent: Список (telegram_id, hours) - часы из TRIAL_NOTIFICATION_HOURS
+
+    Returns:
+        Количество обновлённых подписок
+    """
+    if not sent:
+        return 0
+    for _, hours in sent:
+        if hours not in TRIAL_NOTIFICATION_HOURS:
+            raise ValueError(f"Unknown trial notification: {hours}h")
+
+    flag_updates = ",\n               ".join(
+        f"trial_notif_{hours}h_sent = s.trial_notif_{hours}h_sent OR v.hours = {hours}"
+        for hours in TRIAL_NOTIFICATION_HOURS
+    )
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        result = await conn.execute(
+            f"""UPDATE subscriptions s
+               SET {flag_updates}
+               FROM unnest($1::bigint[], $2::int[]) AS v(telegram_id, hours)
+               WHERE s.telegram_id = v.telegram_id
+               AND s.source = 'trial' AND s.status = 'active'""",
+            [telegram_id for telegram_id, _ in sent],
+            [hours for _, hours in sent]
+        )
+    return int(result.split()[-1])
+
+
+# ==================== ПРОМОКОДЫ ====================
+
+# In-process TTL-кэш промокодов: код -> (время истечения по monotonic, данные промокода)
+# Кэш обслуживает только проверку при вводе кода; списание использования
+# всегда выполняется условным UPDATE в БД, поэтому устаревший used_count в кэше безопасен.
+PROMO_CACHE_TTL_SECONDS = 60
+_promo_cache: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}
+
+
+def normalize_promo_code(code: str) -> str:
+    """Привести код промокода к каноническому виду (без пробелов, верхний регистр)"""
+    return (code or "").strip().upper()
+
+
+def invalidate_promo_cache(code: Optional[str] = None):
+    """Сбросить кэш промокодов (один код или весь кэш)"""
+    if code is None:
+        _promo_cache.clear()
+    else:
+        _promo_cache.pop(normalize_promo_code(code), None)
+
+
 async def get_promo_code(code: str) -> Optional[Dict[str, Any]]:
-    """Получить промокод по коду"""
+    """Получить промокод по коду (точное совпадение по нормализованному коду, без кэша)"""
+    normalized = normalize_promo_code(code)
+    if not normalized:
+        return None
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT * FROM promo_codes WHERE UPPER(code) = UPPER($1)", code
+            "SELECT * FROM promo_codes WHERE code = $1", normalized
         )
         return dict(row) if row else None
 
 
+async def _get_promo_code_cached(code: str) -> Optional[Dict[str, Any]]:
+    """Получить промокод через TTL-кэш (кэшируются и отсутствующие коды)"""
+    normalized = normalize_promo_code(code)
+    now = time.monotonic()
+    cached = _promo_cache.get(normalized)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    
+    promo = await get_promo_code(normalized)
+    _promo_cache[normalized] = (now + PROMO_CACHE_TTL_SECONDS, promo)
+    return promo
+
+
 async def check_promo_code_valid(code: str) -> Optional[Dict[str, Any]]:
     """Проверить, валиден ли промокод и вернуть его данные"""
-    promo = await get_promo_code(code)
+    promo = await _get_promo_code_cached(code)
     if not promo:
         return None
     
@@ -3274,38 +3936,44 @@ async def check_promo_code_valid(code: str) -> Optional[Dict[str, Any]]:
     return promo
 
 
-async def increment_promo_code_use(code: str):
-    """Увеличить счетчик использований промокода"""
+async def increment_promo_code_use(code: str) -> bool:
+    """
+    Списать одно использование промокода
+    
+    Выполняется одним условным UPDATE без SELECT ... FOR UPDATE:
+    блокировка строки держится только на время самого оператора, поэтому
+    конкурентные списания популярного промокода не выстраиваются в очередь.
+    При достижении лимита промокод деактивируется в том же операторе.
+    
+    Returns:
+        True если использование списано, False если промокод не найден,
+        неактивен или лимит исчерпан
+    """
+    normalized = normalize_promo_code(code)
     pool = await get_pool()
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            # Получаем текущее значение used_count и max_uses
-            row = await conn.fetchrow(
-                "SELECT used_count, max_uses FROM promo_codes WHERE UPPER(code) = UPPER($1) FOR UPDATE",
-                code
-            )
-            if not row:
-                return
-            
-            used_count = row["used_count"]
-            max_uses = row["max_uses"]
-            
-            # Увеличиваем счетчик
-            new_count = used_count + 1
-            
-            # Если достигли лимита, деактивируем промокод
-            if max_uses is not None and new_count >= max_uses:
-                await conn.execute("""
-                    UPDATE promo_codes 
-                    SET used_count = $1, is_active = FALSE 
-                    WHERE UPPER(code) = UPPER($2)
-                """, new_count, code)
-            else:
-                await conn.execute("""
-                    UPDATE promo_codes 
-                    SET used_count = $1 
-                    WHERE UPPER(code) = UPPER($2)
-                """, new_count, code)
+        row = await conn.fetchrow("""
+            UPDATE promo_codes
+            SET used_count = used_count + 1,
+                is_active = CASE
+                    WHEN max_uses IS NOT NULL AND used_count + 1 >= max_uses THEN FALSE
+                    ELSE is_active
+                END
+            WHERE code = $1
+              AND is_active = TRUE
+              AND (max_uses IS NULL OR used_count < max_uses)
+            RETURNING used_count, max_uses, is_active
+        """, normalized)
+    
+    if not row:
+        logger.warning(f"Promo code use not counted (inactive or limit reached): code={normalized}")
+        invalidate_promo_cache(normalized)
+        return False
+    
+    # Деактивированный промокод должен сразу перестать приниматься
+    if not row["is_active"]:
+        invalidate_promo_cache(normalized)
+    return True
 
 
 async def log_promo_code_usage(
@@ -3323,7 +3991,7 @@ async def log_promo_code_usage(
             INSERT INTO promo_usage_logs 
             (promo_code, telegram_id, tariff, discount_percent, price_before, price_after)
             VALUES ($1, $2, $3, $4, $5, $6)
-        """, promo_code.upper(), telegram_id, tariff, discount_percent, price_before, price_after)
+        """, normalize_promo_code(promo_code), telegram_id, tariff, discount_percent, price_before, price_after)
 
 
 async def get_promo_stats() -> list:
@@ -3383,26 +4051,45 @@ async def get_subscriptions_for_reminders() -> list:
     """Получить все активные подписки, которым нужно отправить напоминания
     
     Returns список подписок с информацией о типе (админ-доступ или оплаченный тариф)
+    
+    Фильтр status/uuid совпадает с частичным индексом idx_subscriptions_status_expires_at,
+    последнее действие берётся по индексу subscription_history (telegram_id, created_at DESC).
+    Язык пользователя (language) выбирается тем же запросом,
+    недоступные пользователи (users.unreachable_since) исключаются.
     """
     pool = await get_pool()
     async with pool.acquire() as conn:
         now = datetime.now()
         rows = await conn.fetch(
-            """SELECT s.*, 
+            """SELECT s.*, COALESCE(u.language, 'ru') AS language,
                       (SELECT action_type FROM subscription_history 
                        WHERE telegram_id = s.telegram_id 
                        ORDER BY created_at DESC LIMIT 1) as last_action_type
                FROM subscriptions s
-               WHERE s.expires_at > $1
+               LEFT JOIN users u ON u.telegram_id = s.telegram_id
+               WHERE s.status = 'active'
+               AND s.uuid IS NOT NULL
+               AND s.expires_at > $1
+               AND u.unreachable_since IS NULL
                ORDER BY s.expires_at ASC""",
             now
         )
         return [dict(row) for row in rows]
 
 
+async def _fetchrow_on_own_connection(query: str, *args):
+    """Выполнить запрос на отдельном соединении пула (для параллельных агрегатов через asyncio.gather)"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(query, *args)
+
+
 async def get_admin_stats() -> Dict[str, int]:
     """Получить статистику для админ-дашборда
     
+    Один FILTER-агрегат на таблицу (users, subscriptions, payments, vpn_keys),
+    запросы выполняются параллельно на отдельных соединениях.
+    
     Returns:
         Словарь с ключами:
         - total_users: всего пользователей
@@ -3413,52 +4100,42 @@ async def get_admin_stats() -> Dict[str, int]:
         - rejected_payments: отклонённых платежей
         - free_vpn_keys: свободных VPN-ключей
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        now = datetime.now()
-        
-        # Всего пользователей
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-        
-        # Активных подписок (expires_at > now)
-        active_subscriptions = await conn.fetchval(
-            "SELECT COUNT(*) FROM subscriptions WHERE expires_at > $1",
-            now
-        )
-        
-        # Истёкших подписок (expires_at <= now)
-        expired_subscriptions = await conn.fetchval(
-            "SELECT COUNT(*) FROM subscriptions WHERE expires_at <= $1",
+    now = datetime.now()
+    
+    users_row, subscriptions_row, payments_row, vpn_keys_row = await asyncio.gather(
+        _fetchrow_on_own_connection("SELECT COUNT(*) AS total FROM users"),
+        _fetchrow_on_own_connection(
+            """SELECT COUNT(*) FILTER (WHERE expires_at > $1) AS active,
+                      COUNT(*) FILTER (WHERE expires_at <= $1) AS expired
+               FROM subscriptions""",
             now
-        )
-        
-        # Всего платежей
-        total_payments = await conn.fetchval("SELECT COUNT(*) FROM payments")
-        
-        # Подтверждённых платежей
-        approved_payments = await conn.fetchval(
-            "SELECT COUNT(*) FROM payments WHERE status = 'approved'"
-        )
-        
-        # Отклонённых платежей
-        rejected_payments = await conn.fetchval(
-            "SELECT COUNT(*) FROM payments WHERE status = 'rejected'"
-        )
-        
-        # Свободных VPN-ключей
-        free_vpn_keys = await conn.fetchval(
-            "SELECT COUNT(*) FROM vpn_keys WHERE is_used = FALSE"
-        )
-        
-        return {
-            "total_users": total_users or 0,
-            "active_subscriptions": active_subscriptions or 0,
-            "expired_subscriptions": expired_subscriptions or 0,
-            "total_payments": total_payments or 0,
-            "approved_payments": approved_payments or 0,
-            "rejected_payments": rejected_payments or 0,
-            "free_vpn_keys": free_vpn_keys or 0,
-        }
+        ),
+        _fetchrow_on_own_connection(
+            """SELECT COUNT(*) AS total,
+                      COUNT(*) FILTER (WHERE status = 'approved') AS approved,
+                      COUNT(*) FILTER (WHERE status = 'rejected') AS rejected
+               FROM payments"""
+        ),
+        _fetchrow_on_own_connection("SELECT COUNT(*) FILTER (WHERE is_used = FALSE) AS free FROM vpn_keys"),
+    )
+    
+    return {
+        "total_users": users_row["total"] or 0,
+        "active_subscriptions": subscriptions_row["active"] or 0,
+        "expired_subscriptions": subscriptions_row["expired"] or 0,
+        "total_payments": payments_row["total"] or 0,
+        "approved_payments": payments_row["approved"] or 0,
+        "rejected_payments": payments_row["rejected"] or 0,
+        "free_vpn_keys": vpn_keys_row["free"] or 0,
+    }
+
+
+# Ключи сортировки админ-лидерборда → колонка referrer_stats (для каждой есть индекс (колонка, referrer_id))
+REFERRAL_LEADERBOARD_SORT_COLUMNS = {
+    "total_revenue": "total_revenue_kopecks",
+    "invited_count": "invited_count",
+    "cashback_paid": "total_cashback_kopecks",
+}
 
 
 async def get_admin_referral_stats(
@@ -3466,17 +4143,24 @@ async def get_admin_referral_stats(
     sort_by: str = "total_revenue",  # "total_revenue", "invited_count", "cashback_paid"
     sort_order: str = "DESC",  # "ASC", "DESC"
     limit: int = 50,
-    offset: int = 0
+    offset: int = 0,
+    after: Optional[Tuple[int, int]] = None
 ) -> List[Dict[str, Any]]:
     """
     Получить агрегированную статистику по всем рефералам для админ-дашборда
     
+    Читает счётчики referrer_stats (поддерживаются инкрементально, см. migrations/013)
+    по индексу ключа сортировки (migrations/014), без агрегации истории на каждый запрос.
+    Оплатившие и доход - по начисленным реферальным вознаграждениям, тот же счётчик
+    определяет текущий уровень кешбэка.
+    
     Args:
         search_query: Поисковый запрос (telegram_id или username)
         sort_by: Поле для сортировки ("total_revenue", "invited_count", "cashback_paid")
         sort_order: Порядок сортировки ("ASC", "DESC")
         limit: Максимальное количество записей
-        offset: Смещение для пагинации
+        offset: Смещение для пагинации (используется, только если не указан after)
+        after: Keyset-курсор (sort_value, referrer_id) последней строки предыдущей страницы
     
     Returns:
         Список словарей с агрегированной статистикой по каждому рефереру:
@@ -3489,134 +4173,84 @@ async def get_admin_referral_stats(
         - total_cashback_paid: Общий выплаченный кешбэк (рубли)
         - current_cashback_percent: Текущий процент кешбэка
         - first_referral_date: Дата первого приглашения
+        - sort_value: Значение ключа сортировки (для keyset-курсора следующей страницы)
+    """
+    sort_column = REFERRAL_LEADERBOARD_SORT_COLUMNS.get(sort_by, "total_revenue_kopecks")
+    descending = str(sort_order).upper() != "ASC"
+    direction = "DESC" if descending else "ASC"
+    
+    where_clauses = ["l.invited_count > 0"]
+    params = []
+    
+    # Фильтр по поисковому запросу
+    if search_query:
+        try:
+            # Пробуем найти по telegram_id
+            params.append(int(search_query))
+            where_clauses.append(f"l.referrer_id = ${len(params)}")
+        except ValueError:
+            # Иначе ищем по username
+            params.append(f"%{search_query}%")
+            where_clauses.append(f"LOWER(u.username) LIKE LOWER(${len(params)})")
+    
+    # Keyset-пагинация: сравнение строк совпадает с порядком индекса (колонка, referrer_id)
+    if after is not None:
+        params.extend([int(after[0]), int(after[1])])
+        comparison = "<" if descending else ">"
+        where_clauses.append(f"(l.{sort_column}, l.referrer_id) {comparison} (${len(params) - 1}, ${len(params)})")
+    
+    params.append(limit)
+    pagination = f"LIMIT ${len(params)}"
+    if after is None and offset:
+        params.append(offset)
+        pagination += f" OFFSET ${len(params)}"
+    
+    query = f"""
+        SELECT l.referrer_id, u.username, l.invited_count, l.paid_count,
+               l.total_revenue_kopecks, l.total_cashback_kopecks, l.first_referral_date,
+               l.{sort_column} AS sort_value
+        FROM referrer_stats l
+        LEFT JOIN users u ON u.telegram_id = l.referrer_id
+        WHERE {" AND ".join(where_clauses)}
+        ORDER BY l.{sort_column} {direction}, l.referrer_id {direction}
+        {pagination}
     """
+    
     pool = await get_pool()
     async with pool.acquire() as conn:
-        # Базовый запрос для агрегированной статистики
-        # Используем подзапросы для корректной агрегации
-        base_query = """
-            SELECT 
-                u.telegram_id AS referrer_id,
-                u.username,
-                COALESCE(ref_stats.invited_count, 0) AS invited_count,
-                COALESCE(paid_stats.paid_count, 0) AS paid_count,
-                COALESCE(MIN(r.created_at), NULL) AS first_referral_date,
-                COALESCE(revenue_stats.total_revenue_kopecks, 0) AS total_invited_revenue_kopecks,
-                COALESCE(cashback_stats.total_cashback_kopecks, 0) AS total_cashback_paid_kopecks
-            FROM users u
-            LEFT JOIN referrals r ON u.telegram_id = r.referrer_user_id
-            LEFT JOIN (
-                SELECT referrer_user_id, COUNT(DISTINCT referred_user_id) AS invited_count
-                FROM referrals
-                GROUP BY referrer_user_id
-            ) ref_stats ON u.telegram_id = ref_stats.referrer_user_id
-            LEFT JOIN (
-                SELECT r.referrer_user_id, COUNT(DISTINCT r.referred_user_id) AS paid_count
-                FROM referrals r
-                INNER JOIN payments p ON r.referred_user_id = p.telegram_id AND p.status = 'approved'
-                GROUP BY r.referrer_user_id
-            ) paid_stats ON u.telegram_id = paid_stats.referrer_user_id
-            LEFT JOIN (
-                SELECT r.referrer_user_id, SUM(p.amount) AS total_revenue_kopecks
-                FROM referrals r
-                INNER JOIN payments p ON r.referred_user_id = p.telegram_id AND p.status = 'approved'
-                GROUP BY r.referrer_user_id
-            ) revenue_stats ON u.telegram_id = revenue_stats.referrer_user_id
-            LEFT JOIN (
-                SELECT bt.user_id AS referrer_user_id, SUM(bt.amount) AS total_cashback_kopecks
-                FROM balance_transactions bt
-                WHERE bt.type = 'cashback' AND bt.source = 'referral'
-                GROUP BY bt.user_id
-            ) cashback_stats ON u.telegram_id = cashback_stats.referrer_user_id
-        """
-        
-        where_clauses = []
-        params = []
-        param_index = 1
-        
-        # Фильтр по поисковому запросу
-        if search_query:
-            try:
-                # Пробуем найти по telegram_id
-                telegram_id = int(search_query)
-                where_clauses.append(f"u.telegram_id = ${param_index}")
-                params.append(telegram_id)
-                param_index += 1
-            except ValueError:
-                # Иначе ищем по username
-                where_clauses.append(f"LOWER(u.username) LIKE LOWER(${param_index})")
-                params.append(f"%{search_query}%")
-                param_index += 1
-        
-        # Фильтр: показываем только рефереров (тех, кто пригласил хотя бы одного)
-        where_clauses.append(f"ref_stats.invited_count > 0 OR EXISTS (SELECT 1 FROM referrals r2 WHERE r2.referrer_user_id = u.telegram_id)")
-        
-        # Группировка по рефереру
-        group_by = "GROUP BY u.telegram_id, u.username, ref_stats.invited_count, paid_stats.paid_count, revenue_stats.total_revenue_kopecks, cashback_stats.total_cashback_kopecks"
-        
-        # Сортировка
-        sort_column_map = {
-            "total_revenue": "total_invited_revenue_kopecks",
-            "invited_count": "invited_count",
-            "cashback_paid": "total_cashback_paid_kopecks"
-        }
-        sort_column = sort_column_map.get(sort_by, "total_invited_revenue_kopecks")
-        order_by = f"ORDER BY {sort_column} {sort_order}, u.telegram_id ASC"
-        
-        # Пагинация
-        limit_clause = f"LIMIT ${param_index} OFFSET ${param_index + 1}"
-        params.extend([limit, offset])
-        
-        # Собираем полный запрос
-        where_clause = "WHERE " + " AND ".join(where_clauses) if where_clauses else ""
-        full_query = f"{base_query} {where_clause} {group_by} {order_by} {limit_clause}"
-        
-        rows = await conn.fetch(full_query, *params)
-        
-        # Обрабатываем результаты с безопасной обработкой NULL
-        result = []
-        for row in rows:
-            try:
-                referrer_id = row["referrer_id"]
-                if referrer_id is None:
-                    continue  # Пропускаем строки без referrer_id
-                
-                # Безопасное извлечение значений с обработкой NULL
-                invited_count = safe_int(row.get("invited_count"))
-                paid_count = safe_int(row.get("paid_count"))
-                
-                # Вычисляем процент конверсии (защита от деления на 0)
-                conversion_percent = (paid_count / invited_count * 100) if invited_count > 0 else 0.0
-                
-                # Конвертируем из копеек в рубли с безопасной обработкой NULL
-                total_invited_revenue_kopecks = safe_int(row.get("total_invited_revenue_kopecks"))
-                total_cashback_paid_kopecks = safe_int(row.get("total_cashback_paid_kopecks"))
-                total_invited_revenue = total_invited_revenue_kopecks / 100.0
-                total_cashback_paid = total_cashback_paid_kopecks / 100.0
-                
-                # Определяем текущий процент кешбэка (безопасно)
-                try:
-                    current_cashback_percent = await get_referral_cashback_percent(referrer_id)
-                except Exception as e:
-                    logger.warning(f"Error getting cashback percent for referrer_id={referrer_id}: {e}")
-                    current_cashback_percent = 10  # Значение по умолчанию
-                
-                result.append({
-                    "referrer_id": referrer_id,
-                    "username": row.get("username") or f"ID{referrer_id}",
-                    "invited_count": invited_count,
-                    "paid_count": paid_count,
-                    "conversion_percent": round(conversion_percent, 2),
-                    "total_invited_revenue": round(total_invited_revenue, 2),
-                    "total_cashback_paid": round(total_cashback_paid, 2),
-                    "current_cashback_percent": current_cashback_percent,
-                    "first_referral_date": row.get("first_referral_date")
-                })
-            except Exception as e:
-                logger.exception(f"Error processing row in get_admin_referral_stats: {e}, row={dict(row)}")
-                continue  # Пропускаем проблемные строки, но продолжаем обработку
-        
-        return result
+        rows = await conn.fetch(query, *params)
+    
+    # Обрабатываем результаты с безопасной обработкой NULL
+    result = []
+    for row in rows:
+        try:
+            referrer_id = row["referrer_id"]
+            invited_count = safe_int(row["invited_count"])
+            paid_count = safe_int(row["paid_count"])
+            
+            # Вычисляем процент конверсии (защита от деления на 0)
+            conversion_percent = (paid_count / invited_count * 100) if invited_count > 0 else 0.0
+            
+            # Уровень кешбэка - по той же шкале и тому же счётчику оплативших, что и начисление
+            current_cashback_percent = calculate_referral_percent(paid_count)
+            
+            result.append({
+                "referrer_id": referrer_id,
+                "username": row["username"] or f"ID{referrer_id}",
+                "invited_count": invited_count,
+                "paid_count": paid_count,
+                "conversion_percent": round(conversion_percent, 2),
+                "total_invited_revenue": round(safe_int(row["total_revenue_kopecks"]) / 100.0, 2),
+                "total_cashback_paid": round(safe_int(row["total_cashback_kopecks"]) / 100.0, 2),
+                "current_cashback_percent": current_cashback_percent,
+                "first_referral_date": row["first_referral_date"],
+                "sort_value": safe_int(row["sort_value"])
+            })
+        except Exception as e:
+            logger.exception(f"Error processing row in get_admin_referral_stats: {e}, row={dict(row)}")
+            continue  # Пропускаем проблемные строки, но продолжаем обработку
+    
+    return result
 
 
 async def get_admin_referral_detail(referrer_id: int) -> Optional[Dict[str, Any]]:
@@ -3980,7 +4614,7 @@ async def calculate_final_price(
     # ПРИОРИТЕТ 0: Промокод (высший приоритет, перекрывает все остальные скидки)
     promo_data = None
     if promo_code:
-        promo_data = await check_promo_code_valid(promo_code.upper())
+        promo_data = await check_promo_code_valid(promo_code)
     
     has_promo = promo_data is not None
     
@@ -4087,7 +4721,7 @@ async def create_pending_purchase(
         return purchase_id
 
 
-async def get_pending_purchase(purchase_id: str, telegram_id: int, check_expiry: bool = True) -> Optional[Dict[str, Any]]:
+async def get_pending_purchase(purchase_id: str, telegram_id: int, check_expiry: bool = True) -> Optional[PendingPurchase]:
     """
     Получить pending покупку по purchase_id с валидацией
     
@@ -4104,20 +4738,20 @@ async def get_pending_purchase(purchase_id: str, telegram_id: int, check_expiry:
         if check_expiry:
             # При обычной проверке (создание покупки) проверяем срок действия
             purchase = await conn.fetchrow(
-                """SELECT * FROM pending_purchases 
+                f"""SELECT {PendingPurchase.columns_sql()} FROM pending_purchases
                    WHERE purchase_id = $1 AND telegram_id = $2 AND status = 'pending' AND expires_at > NOW()""",
                 purchase_id, telegram_id
             )
         else:
             # При оплате (webhook) не проверяем срок - покупка может быть оплачена после expires_at
             purchase = await conn.fetchrow(
-                """SELECT * FROM pending_purchases 
+                f"""SELECT {PendingPurchase.columns_sql()} FROM pending_purchases
                    WHERE purchase_id = $1 AND telegram_id = $2 AND status = 'pending'""",
                 purchase_id, telegram_id
             )
         
         if purchase:
-            return dict(purchase)
+            return PendingPurchase.from_row(purchase)
         else:
             logger.warning(f"Invalid pending purchase: purchase_id={purchase_id}, telegram_id={telegram_id}, check_expiry={check_expiry}")
             return None
@@ -4214,7 +4848,7 @@ async def finalize_purchase(
     3. Создает payment record
     4. Активирует подписку через grant_access
     5. Обновляет payment → status='approved'
-    6. Обрабатывает реферальный кешбэк
+    6. Ставит реферальный кешбэк в очередь (outbox)
     
     КРИТИЧНО: Все операции в одной транзакции БД.
     Если любой шаг падает → rollback, логирование, исключение.
@@ -4246,7 +4880,7 @@ async def finalize_purchase(
         async with conn.transaction():
             # STEP 1: Получаем и проверяем pending_purchase
             pending_row = await conn.fetchrow(
-                "SELECT * FROM pending_purchases WHERE purchase_id = $1",
+                f"SELECT {PendingPurchase.columns_sql()} FROM pending_purchases WHERE purchase_id = $1",
                 purchase_id
             )
             
@@ -4255,7 +4889,7 @@ async def finalize_purchase(
                 logger.error(f"finalize_purchase: payment_rejected: reason=purchase_not_found, {error_msg}")
                 raise ValueError(error_msg)
             
-            pending_purchase = dict(pending_row)
+            pending_purchase = PendingPurchase.from_row(pending_row)
             telegram_id = pending_purchase["telegram_id"]
             status = pending_purchase.get("status")
             
@@ -4326,7 +4960,8 @@ async def finalize_purchase(
                     telegram_id=telegram_id,
                     amount=amount_rubles,
                     source="cryptobot" if payment_provider == "cryptobot" else "telegram_payment",
-                    description=f"Balance top-up via {payment_provider}"
+                    description=f"Balance top-up via {payment_provider}",
+                    idempotency_key=f"purchase:{purchase_id}"
                 )
                 
                 if not balance_increased:
@@ -4458,18 +5093,16 @@ async def finalize_purchase(
                 payment_id
             )
             
-            # STEP 7: Обрабатываем реферальный кешбэк
-            referral_reward_result = None
-            try:
-                referral_reward_result = await process_referral_reward(
-                    buyer_id=telegram_id,
-                    purchase_id=purchase_id,
-                    amount_rubles=amount_rubles
-                )
-                logger.info(f"finalize_purchase: referral_reward_processed: purchase_id={purchase_id}, user={telegram_id}, success={referral_reward_result.get('success', False)}")
-            except Exception as e:
-                # Реферальный кешбэк не критичен - логируем и продолжаем
-                logger.warning(f"finalize_purchase: referral reward failed: purchase_id={purchase_id}, error={e}")
+            # STEP 7: Ставим реферальный кешбэк в очередь (outbox, в этой же транзакции)
+            # Начисление и уведомление реферера выполняет referral_outbox_worker
+            referral_reward_queued = await _enqueue_referral_reward_atomic(
+                conn,
+                buyer_id=telegram_id,
+                amount_kopecks=int(amount_rubles * 100),
+                event_key=f"purchase:{purchase_id}",
+                purchase_id=purchase_id,
+                action_type="продление" if is_renewal else "покупку"
+            )
             
             # КРИТИЧНО: Логируем активацию подписки и выдачу ключа для аудита
             logger.info(
@@ -4496,7 +5129,7 @@ async def finalize_purchase(
                 "expires_at": expires_at,
                 "vpn_key": vpn_key,
                 "is_renewal": is_renewal,
-                "referral_reward": referral_reward_result  # Добавляем результат реферального кешбэка
+                "referral_reward_queued": referral_reward_queued
             }
 
 
@@ -4523,32 +5156,126 @@ async def expire_old_pending_purchases() -> int:
         return 0
 
 
-async def get_all_users_for_export() -> list:
-    """Получить всех пользователей для экспорта
+# ==================== ПОТОКОВЫЙ ЭКСПОРТ (COPY → gzip CSV) ====================
+#
+# Экспорт выполняется через COPY (...) TO STDOUT: строки не материализуются в памяти,
+# сервер отдаёт CSV порциями, которые сразу пишутся в gzip-поток. Память процесса
+# не зависит от размера таблицы.
+
+# Таймаут COPY выгрузки: command_timeout пула (30 с) оборвал бы выгрузку большой таблицы
+EXPORT_TIMEOUT_SECONDS = float(os.getenv("EXPORT_TIMEOUT_SECONDS", "3600"))
+
+# export_type → (SELECT для COPY, поддерживает ли фильтр по датам created_at)
+# Фильтр по датам: $1 - начало периода (включительно), $2 - конец (не включительно)
+EXPORT_QUERIES: Dict[str, Tuple[str, bool]] = {
+    "users": ("""
+        SELECT id AS "ID", telegram_id AS "Telegram ID", username AS "Username",
+               language AS "Language", to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS "Created At"
+        FROM users
+        ORDER BY created_at DESC
+    """, False),
+    "subscriptions": ("""
+        SELECT id AS "ID", telegram_id AS "Telegram ID", vpn_key AS "VPN Key",
+               to_char(expires_at, 'YYYY-MM-DD HH24:MI:SS') AS "Expires At",
+               CASE WHEN reminder_sent THEN 'Да' ELSE 'Нет' END AS "Reminder Sent"
+        FROM subscriptions
+        WHERE expires_at > NOW()
+        ORDER BY expires_at DESC
+    """, False),
+    "payments": ("""
+        SELECT id AS "ID", telegram_id AS "Telegram ID", tariff AS "Tariff",
+               round(amount / 100.0, 2) AS "Amount RUB", status AS "Status",
+               to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS "Created At"
+        FROM payments
+        WHERE created_at >= $1 AND created_at < $2
+        ORDER BY id
+    """, True),
+    "balance_transactions": ("""
+        SELECT id AS "ID", user_id AS "Telegram ID", round(amount / 100.0, 2) AS "Amount RUB",
+               type AS "Type", source AS "Source", description AS "Description",
+               related_user_id AS "Related User ID",
+               round(balance_after / 100.0, 2) AS "Balance After RUB",
+               to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS "Created At"
+        FROM balance_transactions
+        WHERE created_at >= $1 AND created_at < $2
+        ORDER BY id
+    """, True),
+    "referral_rewards": ("""
+        SELECT id AS "ID", referrer_id AS "Referrer ID", buyer_id AS "Buyer ID",
+               purchase_id AS "Purchase ID", round(purchase_amount / 100.0, 2) AS "Purchase RUB",
+               percent AS "Percent", round(reward_amount / 100.0, 2) AS "Reward RUB",
+               to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS "Created At"
+        FROM referral_rewards
+        WHERE created_at >= $1 AND created_at < $2
+        ORDER BY id
+    """, True),
+}
+
+
+def export_supports_date_range(export_type: str) -> bool:
+    """Поддерживает ли тип экспорта фильтр по периоду (created_at)"""
+    return EXPORT_QUERIES.get(export_type, ("", False))[1]
+
+
+async def stream_export_csv_gz(
+    export_type: str,
+    path: str,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+) -> int:
+    """
+    Выгрузить данные в gzip-сжатый CSV файл потоком (COPY ... TO STDOUT)
+    
+    Args:
+        export_type: Тип экспорта (ключ EXPORT_QUERIES)
+        path: Путь к создаваемому .csv.gz файлу
+        date_from: Начало периода (для типов с фильтром; None - без нижней границы)
+        date_to: Конец периода, не включительно (None - текущий момент)
     
     Returns:
-        Список словарей с данными пользователей
+        Количество выгруженных строк
+    
+    Raises:
+        ValueError: Неизвестный тип экспорта
     """
+    if export_type not in EXPORT_QUERIES:
+        raise ValueError(f"Unknown export type: {export_type}")
+    
+    query, has_date_range = EXPORT_QUERIES[export_type]
+    args = []
+    if has_date_range:
+        args = [date_from or datetime(1970, 1, 1), date_to or datetime.now()]
+    
     pool = await get_pool()
     async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT * FROM users ORDER BY created_at DESC")
-        return [dict(row) for row in rows]
+        rows = await _copy_query_to_csv_gz(conn, path, query, *args)
+    
+    logger.info(f"Export streamed: type={export_type}, rows={rows}, path={path}")
+    return rows
 
 
-async def get_active_subscriptions_for_export() -> list:
-    """Получить все активные подписки для экспорта
+async def _copy_query_to_csv_gz(conn, path: str, query: str, *args) -> int:
+    """
+    COPY (query) TO STDOUT в gzip-сжатый CSV с заголовком. Возвращает количество строк
     
-    Returns:
-        Список словарей с данными активных подписок
+    Сжатие и запись на диск выполняются в потоке (asyncio.to_thread) и не блокируют
+    event loop; следующий фрагмент COPY читается после записи предыдущего.
+    COPY ограничен EXPORT_TIMEOUT_SECONDS, а не таймаутом команд пула.
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        now = datetime.now()
-        rows = await conn.fetch(
-            "SELECT * FROM subscriptions WHERE expires_at > $1 ORDER BY expires_at DESC",
-            now
+    gz_file = await asyncio.to_thread(gzip.open, path, "wb")
+    try:
+        async def _write_chunk(chunk: bytes):
+            await asyncio.to_thread(gz_file.write, chunk)
+        
+        status = await conn.copy_from_query(
+            query, *args, output=_write_chunk, format="csv", header=True,
+            timeout=EXPORT_TIMEOUT_SECONDS
         )
-        return [dict(row) for row in rows]
+    finally:
+        await asyncio.to_thread(gz_file.close)
+    
+    # status: "COPY <n>"
+    return safe_int(status.split()[-1]) if status else 0
 
 
 # Функция get_vpn_keys_stats удалена - больше не используется
@@ -4613,6 +5340,9 @@ async def get_user_extended_stats(telegram_id: int) -> Dict[str, Any]:
 async def get_business_metrics() -> Dict[str, Any]:
     """Получить бизнес-метрики сервиса
     
+    Один запрос на источник (audit_log + payments, subscription_history, payments),
+    запросы выполняются параллельно на отдельных соединениях.
+    
     Returns:
         Словарь с метриками:
         - avg_payment_approval_time_seconds: среднее время подтверждения оплаты (в секундах)
@@ -4620,12 +5350,11 @@ async def get_business_metrics() -> Dict[str, Any]:
         - avg_renewals_per_user: среднее количество продлений на пользователя
         - approval_rate_percent: процент подтвержденных платежей
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    approval_row, history_row, payments_row = await asyncio.gather(
         # 1. Среднее время подтверждения оплаты
         # Используем audit_log для получения времени подтверждения
         # Парсим Payment ID из details поля через CTE
-        avg_approval_time = await conn.fetchval(
+        _fetchrow_on_own_connection(
             """WITH payment_approvals AS (
                 SELECT 
                     al.created_at as approved_at,
@@ -4634,47 +5363,50 @@ async def get_business_metrics() -> Dict[str, Any]:
                 WHERE al.action IN ('payment_approved', 'subscription_renewed')
                 AND al.details LIKE 'Payment ID: %'
             )
-            SELECT AVG(EXTRACT(EPOCH FROM (pa.approved_at - p.created_at))) 
+            SELECT AVG(EXTRACT(EPOCH FROM (pa.approved_at - p.created_at))) AS avg_approval_time
             FROM payment_approvals pa
             JOIN payments p ON p.id = pa.payment_id
             WHERE p.status = 'approved'"""
-        )
-        
-        # 2. Среднее время жизни подписки (из subscription_history)
-        # Используем только завершенные подписки (end_date < now)
-        avg_lifetime = await conn.fetchval(
+        ),
+        # 2-3. Среднее время жизни завершённых подписок и продления на пользователя (subscription_history)
+        _fetchrow_on_own_connection(
             """SELECT AVG(EXTRACT(EPOCH FROM (end_date - start_date)) / 86400.0)
-               FROM subscription_history
-               WHERE end_date IS NOT NULL
-               AND end_date < NOW()"""
-        )
-        
-        # 3. Среднее количество продлений на пользователя
-        total_renewals = await conn.fetchval(
-            """SELECT COUNT(*) FROM subscription_history WHERE action_type = 'renewal'"""
-        )
-        total_users_with_subscriptions = await conn.fetchval(
-            """SELECT COUNT(DISTINCT telegram_id) FROM subscription_history"""
-        )
-        avg_renewals = 0.0
-        if total_users_with_subscriptions and total_users_with_subscriptions > 0:
-            avg_renewals = (total_renewals or 0) / total_users_with_subscriptions
-        
+                          FILTER (WHERE end_date IS NOT NULL AND end_date < NOW()) AS avg_lifetime,
+                      COUNT(*) FILTER (WHERE action_type = 'renewal') AS total_renewals,
+                      COUNT(DISTINCT telegram_id) AS total_users
+               FROM subscription_history"""
+        ),
         # 4. Процент подтвержденных платежей
-        total_payments = await conn.fetchval("SELECT COUNT(*) FROM payments")
-        approved_payments = await conn.fetchval(
-            "SELECT COUNT(*) FROM payments WHERE status = 'approved'"
-        )
-        approval_rate = 0.0
-        if total_payments and total_payments > 0:
-            approval_rate = ((approved_payments or 0) / total_payments) * 100
-        
-        return {
-            "avg_payment_approval_time_seconds": float(avg_approval_time) if avg_approval_time else None,
-            "avg_subscription_lifetime_days": float(avg_lifetime) if avg_lifetime else None,
-            "avg_renewals_per_user": float(avg_renewals) if avg_renewals else 0.0,
-            "approval_rate_percent": float(approval_rate) if approval_rate else 0.0,
-        }
+        _fetchrow_on_own_connection(
+            """SELECT COUNT(*) AS total,
+                      COUNT(*) FILTER (WHERE status = 'approved') AS approved
+               FROM payments"""
+        ),
+    )
+    
+    avg_approval_time = approval_row["avg_approval_time"]
+    avg_lifetime = history_row["avg_lifetime"]
+    
+    avg_renewals = 0.0
+    total_users_with_subscriptions = history_row["total_users"]
+    if total_users_with_subscriptions and total_users_with_subscriptions > 0:
+        avg_renewals = (history_row["total_renewals"] or 0) / total_users_with_subscriptions
+    
+    approval_rate = 0.0
+    total_payments = payments_row["total"]
+    if total_payments and total_payments > 0:
+        approval_rate = ((payments_row["approved"] or 0) / total_payments) * 100
+    
+    return {
+        "avg_payment_approval_time_seconds": float(avg_approval_time) if avg_approval_time else None,
+        "avg_subscription_lifetime_days": float(avg_lifetime) if avg_lifetime else None,
+        "avg_renewals_per_user": float(avg_renewals) if avg_renewals else 0.0,
+        "approval_rate_percent": float(approval_rate) if approval_rate else 0.0,
+    }
+
+
+# Окно свежих записей для get_last_audit_logs (дни): запрос читает 1-2 последние секции
+AUDIT_LOG_RECENT_DAYS = int(os.getenv("AUDIT_LOG_RECENT_DAYS", "31"))
 
 
 async def get_last_audit_logs(limit: int = 10) -> list:
@@ -4688,16 +5420,26 @@ async def get_last_audit_logs(limit: int = 10) -> list:
     """
     pool = await get_pool()
     async with pool.acquire() as conn:
+        # Граница по created_at отсекает старые помесячные секции (partition pruning)
         rows = await conn.fetch(
             """SELECT * FROM audit_log 
+               WHERE created_at >= NOW() - make_interval(days => $2)
                ORDER BY created_at DESC 
                LIMIT $1""",
-            limit
+            limit, AUDIT_LOG_RECENT_DAYS
         )
+        if len(rows) < limit:
+            # За последние дни записей меньше limit - дочитываем без границы
+            rows = await conn.fetch(
+                """SELECT * FROM audit_log 
+                   ORDER BY created_at DESC 
+                   LIMIT $1""",
+                limit
+            )
         return [dict(row) for row in rows]
 
 
-async def create_broadcast(title: str, message: str, broadcast_type: str, segment: str, sent_by: int, is_ab_test: bool = False, message_a: str = None, message_b: str = None) -> int:
+async def create_broadcast(title: str, message: str, broadcast_type: str, segment: str, sent_by: int, is_ab_test: bool = False, message_a: str = None, message_b: str = None, queue_job: bool = False) -> int:
     """Создать новое уведомление
     
     Args:
@@ -4709,92 +5451,275 @@ async def create_broadcast(title: str, message: str, broadcast_type: str, segmen
         is_ab_test: Является ли уведомление A/B тестом
         message_a: Текст варианта A (для A/B тестов)
         message_b: Текст варианта B (для A/B тестов)
+        queue_job: Поставить рассылку в очередь фонового воркера (broadcast_worker)
     
     Returns:
         ID созданного уведомления
     """
+    job_status = "queued" if queue_job else "completed"
     pool = await get_pool()
     async with pool.acquire() as conn:
         if is_ab_test:
             row = await conn.fetchrow(
-                """INSERT INTO broadcasts (title, message_a, message_b, is_ab_test, type, segment, sent_by)
-                   VALUES ($1, $2, $3, TRUE, $4, $5, $6)
+                """INSERT INTO broadcasts (title, message_a, message_b, is_ab_test, type, segment, sent_by, job_status)
+                   VALUES ($1, $2, $3, TRUE, $4, $5, $6, $7)
                    RETURNING id""",
-                title, message_a, message_b, broadcast_type, segment, sent_by
+                title, message_a, message_b, broadcast_type, segment, sent_by, job_status
             )
         else:
             row = await conn.fetchrow(
-                """INSERT INTO broadcasts (title, message, is_ab_test, type, segment, sent_by)
-                   VALUES ($1, $2, FALSE, $3, $4, $5)
+                """INSERT INTO broadcasts (title, message, is_ab_test, type, segment, sent_by, job_status)
+                   VALUES ($1, $2, FALSE, $3, $4, $5, $6)
                    RETURNING id""",
-                title, message, broadcast_type, segment, sent_by
+                title, message, broadcast_type, segment, sent_by, job_status
+            )
+        return row["id"]
+
+
+async def get_broadcast(broadcast_id: int) -> Optional[Dict[str, Any]]:
+    """Получить уведомление по ID"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT * FROM broadcasts WHERE id = $1", broadcast_id
+        )
+        return dict(row) if row else None
+
+
+async def get_all_users_telegram_ids() -> list:
+    """Получить список всех Telegram ID пользователей"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT telegram_id FROM users")
+        return [row["telegram_id"] for row in rows]
+
+
+# Получатели рассылки по сегменту: SELECT telegram_id (уникальный) без ORDER BY/LIMIT,
+# годится для stream_rows
+BROADCAST_SEGMENT_QUERIES: Dict[str, str] = {
+    "all_users": "SELECT telegram_id FROM users WHERE unreachable_since IS NULL",
+    "active_subscriptions": """SELECT DISTINCT u.telegram_id
+                               FROM users u
+                               INNER JOIN subscriptions s ON u.telegram_id = s.telegram_id
+                               WHERE s.expires_at > NOW()
+                               AND u.unreachable_since IS NULL""",
+}
+
+
+async def get_users_by_segment(segment: str) -> list:
+    """Получить список Telegram ID пользователей по сегменту
+    
+    Args:
+        segment: Сегмент получателей (all_users | active_subscriptions)
+    
+    Returns:
+        Список Telegram ID пользователей
+    """
+    query = BROADCAST_SEGMENT_QUERIES.get(segment)
+    if query is None:
+        logging.warning(f"Unknown segment: {segment}, returning empty list")
+        return []
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(query)
+        return [row["telegram_id"] for row in rows]
+
+
+async def log_broadcast_send(broadcast_id: int, telegram_id: int, status: str, variant: str = None):
+    """Записать результат отправки уведомления
+    
+    Args:
+        broadcast_id: ID уведомления
+        telegram_id: Telegram ID пользователя
+        status: Статус отправки (sent | failed)
+        variant: Вариант сообщения (A или B для A/B тестов)
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """INSERT INTO broadcast_log (broadcast_id, telegram_id, status, variant)
+               VALUES ($1, $2, $3, $4)""",
+            broadcast_id, telegram_id, status, variant
+        )
+
+
+# Статусы заданий рассылки (broadcasts.job_status)
+BROADCAST_JOB_QUEUED = "queued"
+BROADCAST_JOB_RUNNING = "running"
+BROADCAST_JOB_PAUSED = "paused"
+BROADCAST_JOB_CANCELLED = "cancelled"
+BROADCAST_JOB_COMPLETED = "completed"
+
+# Допустимые переходы по командам администратора: команда -> (новый статус, из каких статусов)
+BROADCAST_JOB_TRANSITIONS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "pause": (BROADCAST_JOB_PAUSED, (BROADCAST_JOB_QUEUED, BROADCAST_JOB_RUNNING)),
+    "resume": (BROADCAST_JOB_QUEUED, (BROADCAST_JOB_PAUSED,)),
+    "cancel": (BROADCAST_JOB_CANCELLED, (BROADCAST_JOB_QUEUED, BROADCAST_JOB_RUNNING, BROADCAST_JOB_PAUSED)),
+}
+
+# Аренда задания воркером; продлевается на каждой контрольной точке (пакет - единицы секунд)
+BROADCAST_JOB_LEASE_SECONDS = int(os.getenv("BROADCAST_JOB_LEASE_SECONDS", "300"))
+
+
+async def claim_next_broadcast_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Взять следующее незавершённое задание рассылки и перевести его в running
+    
+    Воркер получает аренду задания (locked_by, lease_until) на
+    BROADCAST_JOB_LEASE_SECONDS и продлевает её на каждой контрольной точке.
+    Задание running берётся повторно только с истёкшей арендой (воркер упал
+    или реплика перезапущена) и продолжается с контрольной точки (last_telegram_id);
+    пока аренда действует, другие реплики его не берут. При первом запуске
+    фиксируются started_at и число получателей сегмента.
+    
+    Args:
+        worker_id: Идентификатор воркера (процесса), держащего аренду
+    
+    Returns:
+        Словарь с полями broadcasts или None, если заданий нет
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                """SELECT * FROM broadcasts
+                   WHERE job_status = 'queued'
+                      OR (job_status = 'running' AND (lease_until IS NULL OR lease_until < NOW()))
+                   ORDER BY id
+                   LIMIT 1
+                   FOR UPDATE SKIP LOCKED"""
+            )
+            if row is None:
+                return None
+            total = row["total_recipients"]
+            if total is None and row["segment"] in BROADCAST_SEGMENT_QUERIES:
+                total = await conn.fetchval(
+                    f"SELECT COUNT(*) FROM ({BROADCAST_SEGMENT_QUERIES[row['segment']]}) AS recipients"
+                )
+            row = await conn.fetchrow(
+                """UPDATE broadcasts
+                   SET job_status = 'running',
+                       started_at = COALESCE(started_at, NOW()),
+                       total_recipients = $2,
+                       locked_by = $3,
+                       lease_until = NOW() + ($4 * INTERVAL '1 second')
+                   WHERE id = $1
+                   RETURNING *""",
+                row["id"], total, worker_id, BROADCAST_JOB_LEASE_SECONDS
+            )
+            return dict(row)
+
+
+async def checkpoint_broadcast_job(
+    broadcast_id: int,
+    results: List[Tuple[int, str, Optional[str]]],
+    last_telegram_id: int,
+    worker_id: str
+) -> Optional[str]:
+    """
+    Записать результаты пакета отправок, сдвинуть контрольную точку и продлить аренду
+    
+    broadcast_log пишется одним COPY, счётчики и last_telegram_id обновляются
+    в той же транзакции: после рестарта пакет либо учтён целиком, либо
+    отправляется заново. Если аренда задания перешла к другому воркеру,
+    пакет не записывается.
+    
+    Args:
+        broadcast_id: ID уведомления
+        results: Список (telegram_id, status, variant) по получателям пакета
+        last_telegram_id: Последний обработанный получатель
+        worker_id: Идентификатор воркера, держащего аренду
+    
+    Returns:
+        Текущий job_status задания или None, если аренда потеряна
+        (воркер останавливается, если статус не running)
+    """
+    sent = sum(1 for _, status, _ in results if status == "sent")
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            job_status = await conn.fetchval(
+                """UPDATE broadcasts
+                   SET last_telegram_id = $2,
+                       sent_count = sent_count + $3,
+                       failed_count = failed_count + $4,
+                       lease_until = NOW() + ($6 * INTERVAL '1 second')
+                   WHERE id = $1 AND locked_by = $5
+                   RETURNING job_status""",
+                broadcast_id, last_telegram_id, sent, len(results) - sent, worker_id, BROADCAST_JOB_LEASE_SECONDS
             )
-        return row["id"]
+            if job_status is None:
+                logger.warning(f"Broadcast {broadcast_id}: lease lost by {worker_id}, batch not recorded")
+                return None
+            if results:
+                await conn.copy_records_to_table(
+                    "broadcast_log",
+                    records=[(broadcast_id, telegram_id, status, variant) for telegram_id, status, variant in results],
+                    columns=["broadcast_id", "telegram_id", "status", "variant"]
+                )
+            return job_status
 
 
-async def get_broadcast(broadcast_id: int) -> Optional[Dict[str, Any]]:
-    """Получить уведомление по ID"""
+async def finish_broadcast_job(broadcast_id: int, worker_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Отметить задание завершённым (если его не поставили на паузу, не отменили
+    и аренда не перешла к другому воркеру) и снять аренду
+    
+    Returns:
+        Словарь с полями broadcasts после завершения или None
+    """
     pool = await get_pool()
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT * FROM broadcasts WHERE id = $1", broadcast_id
+            """UPDATE broadcasts
+               SET job_status = 'completed', finished_at = NOW(), locked_by = NULL, lease_until = NULL
+               WHERE id = $1 AND job_status = 'running' AND locked_by = $2
+               RETURNING *""",
+            broadcast_id, worker_id
         )
         return dict(row) if row else None
 
 
-async def get_all_users_telegram_ids() -> list:
-    """Получить список всех Telegram ID пользователей"""
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT telegram_id FROM users")
-        return [row["telegram_id"] for row in rows]
-
-
-async def get_users_by_segment(segment: str) -> list:
-    """Получить список Telegram ID пользователей по сегменту
+async def set_broadcast_job_status(broadcast_id: int, command: str) -> bool:
+    """
+    Пауза / продолжение / отмена задания рассылки
     
     Args:
-        segment: Сегмент получателей (all_users | active_subscriptions)
+        broadcast_id: ID уведомления
+        command: pause | resume | cancel
     
     Returns:
-        Список Telegram ID пользователей
+        True, если статус изменён (переход допустим из текущего статуса)
     """
+    if command not in BROADCAST_JOB_TRANSITIONS:
+        raise ValueError(f"Unknown broadcast job command: {command}")
+    new_status, from_statuses = BROADCAST_JOB_TRANSITIONS[command]
     pool = await get_pool()
     async with pool.acquire() as conn:
-        if segment == "all_users":
-            rows = await conn.fetch("SELECT telegram_id FROM users")
-            return [row["telegram_id"] for row in rows]
-        elif segment == "active_subscriptions":
-            now = datetime.now()
-            rows = await conn.fetch(
-                """SELECT DISTINCT u.telegram_id 
-                   FROM users u
-                   INNER JOIN subscriptions s ON u.telegram_id = s.telegram_id
-                   WHERE s.expires_at > $1""",
-                now
-            )
-            return [row["telegram_id"] for row in rows]
-        else:
-            logging.warning(f"Unknown segment: {segment}, returning empty list")
-            return []
+        updated = await conn.fetchval(
+            """UPDATE broadcasts
+               SET job_status = $2,
+                   finished_at = CASE WHEN $2 = 'cancelled' THEN NOW() ELSE finished_at END
+               WHERE id = $1 AND job_status = ANY($3::text[])
+               RETURNING id""",
+            broadcast_id, new_status, list(from_statuses)
+        )
+        return updated is not None
 
 
-async def log_broadcast_send(broadcast_id: int, telegram_id: int, status: str, variant: str = None):
-    """Записать результат отправки уведомления
-    
-    Args:
-        broadcast_id: ID уведомления
-        telegram_id: Telegram ID пользователя
-        status: Статус отправки (sent | failed)
-        variant: Вариант сообщения (A или B для A/B тестов)
-    """
+async def get_broadcast_jobs(limit: int = 10) -> List[Dict[str, Any]]:
+    """Последние задания рассылки с прогрессом (для админ-панели)"""
     pool = await get_pool()
     async with pool.acquire() as conn:
-        await conn.execute(
-            """INSERT INTO broadcast_log (broadcast_id, telegram_id, status, variant)
-               VALUES ($1, $2, $3, $4)""",
-            broadcast_id, telegram_id, status, variant
+        rows = await conn.fetch(
+            """SELECT id, title, segment, job_status, total_recipients, sent_count, failed_count,
+                      created_at, started_at, finished_at
+               FROM broadcasts
+               ORDER BY id DESC
+               LIMIT $1""",
+            limit
         )
+        return [dict(row) for row in rows]
 
 
 async def get_broadcast_stats(broadcast_id: int) -> Dict[str, int]:
@@ -4808,15 +5733,16 @@ async def get_broadcast_stats(broadcast_id: int) -> Dict[str, int]:
     """
     pool = await get_pool()
     async with pool.acquire() as conn:
-        sent_count = await conn.fetchval(
-            "SELECT COUNT(*) FROM broadcast_log WHERE broadcast_id = $1 AND status = 'sent'",
-            broadcast_id
-        )
-        failed_count = await conn.fetchval(
-            "SELECT COUNT(*) FROM broadcast_log WHERE broadcast_id = $1 AND status = 'failed'",
+        # Лог уведомления не старше самого уведомления: секции до его создания не читаются
+        row = await conn.fetchrow(
+            """SELECT COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+                      COUNT(*) FILTER (WHERE status = 'failed') AS failed
+               FROM broadcast_log
+               WHERE broadcast_id = $1
+               AND sent_at >= COALESCE((SELECT created_at FROM broadcasts WHERE id = $1), '-infinity')""",
             broadcast_id
         )
-        return {"sent": sent_count or 0, "failed": failed_count or 0}
+        return {"sent": row["sent"] or 0, "failed": row["failed"] or 0}
 
 
 async def get_incident_settings() -> Dict[str, Any]:
@@ -5355,16 +6281,15 @@ async def get_total_revenue() -> float:
     """
     Получить общий доход от всех успешных платежей
     
+    Читает дневной rollup daily_metrics (одна строка на день), а не payments.
+    
     Returns:
         Общий доход в рублях (только утвержденные платежи)
     """
     pool = await get_pool()
     async with pool.acquire() as conn:
-        # Суммируем все утвержденные платежи
         total_kopecks = await conn.fetchval(
-            """SELECT COALESCE(SUM(amount), 0) 
-               FROM payments 
-               WHERE status = 'approved'"""
+            "SELECT COALESCE(SUM(revenue_kopecks), 0) FROM daily_metrics"
         ) or 0
         
         return total_kopecks / 100.0  # Конвертируем из копеек в рубли
@@ -5376,18 +6301,29 @@ async def get_paying_users_count() -> int:
     
     Returns:
         Количество уникальных пользователей с хотя бы одним утвержденным платежом
+        (сумма новых платящих пользователей по дням из daily_metrics)
     """
     pool = await get_pool()
     async with pool.acquire() as conn:
         count = await conn.fetchval(
-            """SELECT COUNT(DISTINCT telegram_id) 
-               FROM payments 
-               WHERE status = 'approved'"""
+            "SELECT COALESCE(SUM(new_paying_users), 0) FROM daily_metrics"
         ) or 0
         
         return count
 
 
+async def _get_revenue_totals() -> Tuple[int, int]:
+    """Общий доход (копейки) и число платящих пользователей из daily_metrics одним запросом"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT COALESCE(SUM(revenue_kopecks), 0) AS revenue_kopecks,
+                      COALESCE(SUM(new_paying_users), 0) AS paying_users
+               FROM daily_metrics"""
+        )
+    return safe_int(row["revenue_kopecks"]), safe_int(row["paying_users"])
+
+
 async def get_user_ltv(telegram_id: int) -> float:
     """
     Получить LTV (Lifetime Value) пользователя
@@ -5417,26 +6353,15 @@ async def get_average_ltv() -> float:
     """
     Получить средний LTV по всем пользователям
     
+    Средний LTV = общий доход / количество платящих пользователей (из daily_metrics)
+    
     Returns:
         Средний LTV в рублях
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        # Получаем LTV для каждого пользователя
-        ltv_data = await conn.fetch(
-            """SELECT telegram_id, COALESCE(SUM(amount), 0) as total_payments
-               FROM payments
-               WHERE status = 'approved'
-               GROUP BY telegram_id"""
-        )
-        
-        if not ltv_data:
-            return 0.0
-        
-        total_ltv = sum(row["total_payments"] for row in ltv_data)
-        avg_ltv = total_ltv / len(ltv_data)
-        
-        return avg_ltv / 100.0  # Конвертируем из копеек в рубли
+    revenue_kopecks, paying_users = await _get_revenue_totals()
+    if paying_users <= 0:
+        return 0.0
+    return revenue_kopecks / paying_users / 100.0  # Конвертируем из копеек в рубли
 
 
 async def get_arpu() -> float:
@@ -5448,28 +6373,9 @@ async def get_arpu() -> float:
     Returns:
         ARPU в рублях
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        # Общий доход (только утвержденные платежи)
-        total_revenue_kopecks = await conn.fetchval(
-            """SELECT COALESCE(SUM(amount), 0) 
-               FROM payments 
-               WHERE status = 'approved'"""
-        ) or 0
-        
-        total_revenue = total_revenue_kopecks / 100.0
-        
-        # Количество платящих пользователей
-        paying_users_count = await conn.fetchval(
-            """SELECT COUNT(DISTINCT telegram_id) 
-               FROM payments 
-               WHERE status = 'approved'"""
-        ) or 0
-        
-        # ARPU = общий доход / платящие пользователи
-        arpu = total_revenue / paying_users_count if paying_users_count > 0 else 0.0
-        
-        return arpu
+    revenue_kopecks, paying_users = await _get_revenue_totals()
+    # ARPU = общий доход / платящие пользователи
+    return revenue_kopecks / 100.0 / paying_users if paying_users > 0 else 0.0
 
 
 async def get_ltv() -> float:
@@ -5477,24 +6383,12 @@ async def get_ltv() -> float:
     Получить средний LTV (Lifetime Value) по всем платящим пользователям
     
     LTV = средняя сумма всех платежей пользователя за подписки
+    (AVG по пользователям = общий доход / платящие пользователи)
     
     Returns:
         Средний LTV в рублях
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        # Получаем средний LTV через агрегацию (оптимизированный запрос)
-        avg_ltv_kopecks = await conn.fetchval(
-            """SELECT COALESCE(AVG(user_total), 0)
-               FROM (
-                   SELECT telegram_id, SUM(amount) as user_total
-                   FROM payments
-                   WHERE status = 'approved'
-                   GROUP BY telegram_id
-               ) as user_ltvs"""
-        ) or 0
-        
-        return avg_ltv_kopecks / 100.0  # Конвертируем из копеек в рубли
+    return await get_average_ltv()
 
 
 async def get_referral_analytics() -> Dict[str, Any]:
@@ -5556,6 +6450,29 @@ async def get_referral_analytics() -> Dict[str, Any]:
         }
 
 
+async def _get_metrics_for_period(start_date: datetime, end_date: datetime) -> Dict[str, Any]:
+    """Суммы daily_metrics за дни [start_date, end_date)"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT COALESCE(SUM(revenue_kopecks), 0) AS revenue_kopecks,
+                      COALESCE(SUM(payments_count), 0) AS payments_count,
+                      COALESCE(SUM(new_users), 0) AS new_users,
+                      COALESCE(SUM(new_subscriptions), 0) AS new_subscriptions,
+                      COALESCE(SUM(new_paying_users), 0) AS new_paying_users
+               FROM daily_metrics
+               WHERE day >= $1 AND day < $2""",
+            start_date.date(), end_date.date()
+        )
+    return {
+        "revenue": safe_int(row["revenue_kopecks"]) / 100.0,
+        "payments_count": safe_int(row["payments_count"]),
+        "new_users": safe_int(row["new_users"]),
+        "new_subscriptions": safe_int(row["new_subscriptions"]),
+        "new_paying_users": safe_int(row["new_paying_users"]),
+    }
+
+
 async def get_daily_summary(date: Optional[datetime] = None) -> Dict[str, Any]:
     """
     Получить ежедневную сводку
@@ -5564,7 +6481,7 @@ async def get_daily_summary(date: Optional[datetime] = None) -> Dict[str, Any]:
         date: Дата для сводки (если None, используется сегодня)
     
     Returns:
-        Словарь с ключами: revenue, payments_count, new_users, new_subscriptions
+        Словарь с ключами: revenue, payments_count, new_users, new_subscriptions, new_paying_users
     """
     if date is None:
         date = datetime.now()
@@ -5572,51 +6489,8 @@ async def get_daily_summary(date: Optional[datetime] = None) -> Dict[str, Any]:
     start_date = date.replace(hour=0, minute=0, second=0, microsecond=0)
     end_date = start_date + timedelta(days=1)
     
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        # Доход за день (утвержденные платежи)
-        revenue_kopecks = await conn.fetchval(
-            """SELECT COALESCE(SUM(amount), 0) 
-               FROM payments 
-               WHERE status = 'approved' 
-               AND created_at >= $1 AND created_at < $2""",
-            start_date, end_date
-        ) or 0
-        
-        revenue = revenue_kopecks / 100.0
-        
-        # Количество платежей
-        payments_count = await conn.fetchval(
-            """SELECT COUNT(*) 
-               FROM payments 
-               WHERE status = 'approved' 
-               AND created_at >= $1 AND created_at < $2""",
-            start_date, end_date
-        ) or 0
-        
-        # Новые пользователи
-        new_users = await conn.fetchval(
-            """SELECT COUNT(*) 
-               FROM users 
-               WHERE created_at >= $1 AND created_at < $2""",
-            start_date, end_date
-        ) or 0
-        
-        # Новые подписки
-        new_subscriptions = await conn.fetchval(
-            """SELECT COUNT(*) 
-               FROM subscriptions 
-               WHERE created_at >= $1 AND created_at < $2""",
-            start_date, end_date
-        ) or 0
-        
-        return {
-            "date": start_date.strftime("%Y-%m-%d"),
-            "revenue": revenue,
-            "payments_count": payments_count,
-            "new_users": new_users,
-            "new_subscriptions": new_subscriptions
-        }
+    summary = await _get_metrics_for_period(start_date, end_date)
+    return {"date": start_date.strftime("%Y-%m-%d"), **summary}
 
 
 async def get_monthly_summary(year: int, month: int) -> Dict[str, Any]:
@@ -5628,7 +6502,7 @@ async def get_monthly_summary(year: int, month: int) -> Dict[str, Any]:
         month: Месяц (1-12)
     
     Returns:
-        Словарь с ключами: revenue, payments_count, new_users, new_subscriptions
+        Словарь с ключами: revenue, payments_count, new_users, new_subscriptions, new_paying_users
     """
     start_date = datetime(year, month, 1)
     if month == 12:
@@ -5636,49 +6510,392 @@ async def get_monthly_summary(year: int, month: int) -> Dict[str, Any]:
     else:
         end_date = datetime(year, month + 1, 1)
     
+    summary = await _get_metrics_for_period(start_date, end_date)
+    return {"year": year, "month": month, **summary}
+
+
+async def rebuild_daily_metrics() -> int:
+    """
+    Пересчитать daily_metrics из истории (backfill / repair)
+    
+    Пересчёт выполняет SQL-функция rebuild_daily_metrics() из миграции 015
+    (та же, что делает первичное заполнение).
+    
+    Returns:
+        Количество пересчитанных дней
+    """
     pool = await get_pool()
     async with pool.acquire() as conn:
-        # Доход за месяц (утвержденные платежи)
-        revenue_kopecks = await conn.fetchval(
-            """SELECT COALESCE(SUM(amount), 0) 
-               FROM payments 
-               WHERE status = 'approved' 
-               AND created_at >= $1 AND created_at < $2""",
-            start_date, end_date
-        ) or 0
-        
-        revenue = revenue_kopecks / 100.0
-        
-        # Количество платежей
-        payments_count = await conn.fetchval(
-            """SELECT COUNT(*) 
-               FROM payments 
-               WHERE status = 'approved' 
-               AND created_at >= $1 AND created_at < $2""",
-            start_date, end_date
-        ) or 0
-        
-        # Новые пользователи
-        new_users = await conn.fetchval(
-            """SELECT COUNT(*) 
-               FROM users 
-               WHERE created_at >= $1 AND created_at < $2""",
-            start_date, end_date
-        ) or 0
-        
-        # Новые подписки
-        new_subscriptions = await conn.fetchval(
-            """SELECT COUNT(*) 
-               FROM subscriptions 
-               WHERE created_at >= $1 AND created_at < $2""",
-            start_date, end_date
-        ) or 0
-        
-        return {
-            "year": year,
-            "month": month,
-            "revenue": revenue,
-            "payments_count": payments_count,
-            "new_users": new_users,
-            "new_subscriptions": new_subscriptions
-        }
+        async with conn.transaction():
+            days = await conn.fetchval("SELECT rebuild_daily_metrics()") or 0
+    
+    logger.info(f"Daily metrics rebuilt: days={days}")
+    return days
+
+
+
+# ============================================================================
+# КОГОРТЫ И ОТТОК
+# ============================================================================
+#
+# Когорта - неделя первой оплаченной подписки пользователя. Для каждой когорты
+# cohort_activity хранит число пользователей, у которых оплаченный период подписки
+# (start_date..end_date покупки или продления) покрывает неделю N от старта когорты.
+# События читаются из subscription_history пакетами после водяного знака, полный
+# пересчёт истории не нужен.
+
+# Типы событий subscription_history, означающие оплаченный период подписки
+COHORT_EVENT_TYPES = ["purchase", "renewal", "auto_renew"]
+COHORT_WATERMARK_NAME = "subscription_cohorts"
+
+
+def _cohort_batch_upper_id(
+    last_id: int,
+    ids: List[int],
+    settled_id: int
+) -> int:
+    """
+    Граница пакета: последний id перед первым неокончательным пропуском
+    
+    Пропуск в последовательности id - либо откаченная вставка, либо транзакция,
+    которая ещё не закоммитилась. Пропуски до settled_id окончательны (все транзакции,
+    которые могли их занимать, завершены), дальше пакет не идёт.
+    """
+    upper_id = last_id
+    for event_id in ids:
+        if event_id != upper_id + 1 and event_id - 1 > settled_id:
+            break
+        upper_id = event_id
+    return upper_id
+
+
+async def process_cohort_events_batch(limit: int = 5000) -> int:
+    """
+    Обработать очередной пакет событий subscription_history для когортной аналитики
+    
+    Водяной знак блокируется (FOR UPDATE) на время пакета, поэтому параллельные
+    обработчики не учитывают одно событие дважды. Водяной знак не переходит пропуск в id,
+    пока вставка с этим id может быть ещё не закоммичена (см. migrations/016).
+    
+    Args:
+        limit: Максимальное количество событий истории в пакете
+    
+    Returns:
+        Количество обработанных событий (0 - обработчик догнал историю)
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            watermark = await conn.fetchrow(
+                """SELECT last_id, gap_check_id, gap_check_xid,
+                          pg_snapshot_xmin(pg_current_snapshot())::TEXT::BIGINT AS snapshot_xmin,
+                          pg_snapshot_xmax(pg_current_snapshot())::TEXT::BIGINT AS snapshot_xmax
+                   FROM analytics_watermarks WHERE name = $1 FOR UPDATE""",
+                COHORT_WATERMARK_NAME
+            )
+            if watermark is None:
+                logger.warning("process_cohort_events_batch: watermark row missing (migration 016 not applied?)")
+                return 0
+            last_id = watermark["last_id"]
+            
+            ids = [row["id"] for row in await conn.fetch(
+                "SELECT id FROM subscription_history WHERE id > $1 ORDER BY id LIMIT $2",
+                last_id, limit
+            )]
+            if not ids:
+                return 0
+            
+            gap_check_id = watermark["gap_check_id"]
+            gap_check_xid = watermark["gap_check_xid"]
+            check_settled = gap_check_xid is not None and watermark["snapshot_xmin"] >= gap_check_xid
+            settled_id = gap_check_id if check_settled else last_id
+            upper_id = _cohort_batch_upper_id(last_id, ids, settled_id)
+            
+            if upper_id < ids[-1] and (gap_check_xid is None or check_settled):
+                # Упёрлись в пропуск: запоминаем, после завершения каких транзакций он станет окончательным
+                gap_check_id, gap_check_xid = ids[-1], watermark["snapshot_xmax"]
+            
+            if upper_id > last_id:
+                # 1. Новые пользователи: когорта - неделя первого оплаченного события
+                await conn.execute(
+                    """INSERT INTO user_cohorts (telegram_id, cohort_week, first_purchase_at)
+                       SELECT DISTINCT ON (telegram_id)
+                              telegram_id, date_trunc('week', created_at)::DATE, created_at
+                       FROM subscription_history
+                       WHERE id > $1 AND id <= $2 AND action_type = ANY($3::TEXT[])
+                       ORDER BY telegram_id, id
+                       ON CONFLICT (telegram_id) DO NOTHING""",
+                    last_id, upper_id, COHORT_EVENT_TYPES
+                )
+                
+                # 2. Активность: недели, покрытые оплаченным периодом события;
+                # каждая пара (пользователь, неделя от старта) учитывается один раз
+                await conn.execute(
+                    """WITH events AS (
+                           SELECT DISTINCT h.telegram_id, c.cohort_week, c.last_active_period, covered.period
+                           FROM subscription_history h
+                           JOIN user_cohorts c ON c.telegram_id = h.telegram_id
+                           CROSS JOIN LATERAL generate_series(
+                               GREATEST((date_trunc('week', h.start_date)::DATE - c.cohort_week) / 7, 0),
+                               (date_trunc('week', h.end_date - INTERVAL '1 second')::DATE - c.cohort_week) / 7
+                           ) AS covered(period)
+                           WHERE h.id > $1 AND h.id <= $2 AND h.action_type = ANY($3::TEXT[])
+                       ),
+                       fresh AS (
+                           SELECT telegram_id, cohort_week, period FROM events
+                           WHERE period > last_active_period
+                       ),
+                       counted AS (
+                           INSERT INTO cohort_activity (cohort_week, period, active_users)
+                           SELECT cohort_week, period, COUNT(*)
+                           FROM fresh
+                           GROUP BY cohort_week, period
+                           ON CONFLICT (cohort_week, period) DO UPDATE SET
+                               active_users = cohort_activity.active_users + EXCLUDED.active_users
+                       )
+                       UPDATE user_cohorts c
+                       SET last_active_period = latest.period
+                       FROM (SELECT telegram_id, MAX(period) AS period FROM fresh GROUP BY telegram_id) latest
+                       WHERE c.telegram_id = latest.telegram_id""",
+                    last_id, upper_id, COHORT_EVENT_TYPES
+                )
+            
+            await conn.execute(
+                """UPDATE analytics_watermarks
+                   SET last_id = $1, gap_check_id = $2, gap_check_xid = $3, updated_at = NOW()
+                   WHERE name = $4""",
+                upper_id, gap_check_id, gap_check_xid, COHORT_WATERMARK_NAME
+            )
+    
+    events = sum(1 for event_id in ids if event_id <= upper_id)
+    logger.debug(f"Cohort events processed: events={events}, watermark {last_id} -> {upper_id}")
+    return events
+
+
+async def get_cohort_retention(weeks: int = 8, periods: int = 8) -> List[Dict[str, Any]]:
+    """
+    Получить таблицу удержания по недельным когортам
+    
+    Args:
+        weeks: Количество последних когорт
+        periods: Количество недель от старта когорты
+    
+    Returns:
+        Список словарей (от новых когорт к старым):
+        - cohort_week: Понедельник недели когорты (date)
+        - size: Размер когорты (пользователи, оплатившие в неделю 0)
+        - retention: Список процентов удержания по неделям 0..periods-1
+          (None - неделя ещё не наступила)
+        - churn_percent: Отток на последней наступившей неделе (100 - удержание)
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """WITH cohorts AS (
+                   SELECT cohort_week, active_users AS size
+                   FROM cohort_activity
+                   WHERE period = 0
+                   ORDER BY cohort_week DESC
+                   LIMIT $1
+               )
+               SELECT c.cohort_week, c.size, a.period, a.active_users
+               FROM cohorts c
+               LEFT JOIN cohort_activity a
+                   ON a.cohort_week = c.cohort_week AND a.period < $2
+               ORDER BY c.cohort_week DESC, a.period""",
+            weeks, periods
+        )
+    
+    today = datetime.now().date()
+    current_week = today - timedelta(days=today.weekday())
+    cohorts: Dict[Any, Dict[str, Any]] = {}
+    for row in rows:
+        cohort_week = row["cohort_week"]
+        cohort = cohorts.get(cohort_week)
+        if cohort is None:
+            elapsed_periods = (current_week - cohort_week).days // 7 + 1
+            cohort = {
+                "cohort_week": cohort_week,
+                "size": safe_int(row["size"]),
+                "retention": [0.0 if p < elapsed_periods else None for p in range(periods)],
+            }
+            cohorts[cohort_week] = cohort
+        period = row["period"]
+        # Оплаченные наперёд недели не показываются, пока не наступили
+        if period is not None and cohort["size"] > 0 and cohort["retention"][period] is not None:
+            cohort["retention"][period] = round(safe_int(row["active_users"]) / cohort["size"] * 100, 1)
+    
+    result = list(cohorts.values())
+    for cohort in result:
+        elapsed = [value for value in cohort["retention"] if value is not None]
+        cohort["churn_percent"] = round(100.0 - elapsed[-1], 1) if elapsed else 0.0
+    return result
+
+
+# Помесячно секционированные журналы (миграция 019, перевод - convert_log_partitions.py):
+# таблица -> колонка ключа секционирования
+PARTITIONED_LOG_TABLES: Dict[str, str] = {
+    "audit_log": "created_at",
+    "broadcast_log": "sent_at",
+    "balance_transactions": "created_at",
+}
+
+
+def _check_partitioned_table(table: str) -> None:
+    if table not in PARTITIONED_LOG_TABLES:
+        raise ValueError(f"Unknown partitioned table: {table}")
+
+
+async def ensure_monthly_partitions(table: str, months_ahead: int) -> int:
+    """
+    Создать недостающие секции таблицы с текущего месяца на months_ahead месяцев вперёд
+    
+    Returns:
+        Количество созданных секций
+    """
+    _check_partitioned_table(table)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        created = await conn.fetchval(
+            """SELECT create_monthly_partitions(
+                   $1, CURRENT_DATE, (date_trunc('month', CURRENT_DATE) + make_interval(months => $2))::date
+               )""",
+            table, months_ahead
+        )
+    return safe_int(created)
+
+
+async def get_monthly_partitions(table: str) -> List[Dict[str, Any]]:
+    """
+    Получить секции таблицы, созданные create_monthly_partitions
+    
+    Returns:
+        Список словарей {"name": имя секции, "month": первый день месяца (date)},
+        отсортированный по месяцу
+    """
+    _check_partitioned_table(table)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """SELECT c.relname
+               FROM pg_inherits i
+               JOIN pg_class c ON c.oid = i.inhrelid
+               WHERE i.inhparent = $1::regclass""",
+            table
+        )
+    
+    partitions = []
+    prefix = f"{table}_"
+    for row in rows:
+        suffix = row["relname"][len(prefix):]
+        try:
+            month = datetime.strptime(suffix, "%Y_%m").date()
+        except ValueError:
+            # Секция не из create_monthly_partitions (создана вручную) - не трогаем
+            continue
+        partitions.append({"name": row["relname"], "month": month})
+    partitions.sort(key=lambda p: p["month"])
+    return partitions
+
+
+# Таймаут команд перевода таблицы в секционированную (MIN по всей таблице, хвост под блокировкой)
+PARTITION_CONVERSION_TIMEOUT_SECONDS = float(os.getenv("PARTITION_CONVERSION_TIMEOUT_SECONDS", "3600"))
+# Сколько ждать ACCESS EXCLUSIVE при переключении, прежде чем отступить и повторить
+PARTITION_CONVERSION_LOCK_TIMEOUT = os.getenv("PARTITION_CONVERSION_LOCK_TIMEOUT", "5s")
+
+
+async def is_partitioned_table(table: str) -> bool:
+    """Переведена ли таблица в секционированную (convert_log_partitions.py)"""
+    _check_partitioned_table(table)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        relkind = await conn.fetchval(
+            "SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass($1)", table
+        )
+    return relkind == "p"
+
+
+async def start_partition_conversion(table: str, premake_months: int) -> bool:
+    """
+    Создать секционированную копию <table>_partitioned (шаг 1 перевода, миграция 019)
+    
+    Returns:
+        False если таблица уже секционирована
+    """
+    _check_partitioned_table(table)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return bool(await conn.fetchval(
+            "SELECT start_partition_conversion($1, $2, $3)",
+            table, PARTITIONED_LOG_TABLES[table], premake_months,
+            timeout=PARTITION_CONVERSION_TIMEOUT_SECONDS
+        ))
+
+
+async def copy_partition_conversion_batch(table: str, batch_size: int) -> int:
+    """Скопировать очередной пакет строк в секционированную копию (шаг 2). Возвращает число строк"""
+    _check_partitioned_table(table)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        copied = await conn.fetchval(
+            "SELECT copy_partition_conversion_batch($1, $2)", table, batch_size
+        )
+    return safe_int(copied)
+
+
+async def finish_partition_conversion(table: str) -> Optional[int]:
+    """
+    Докопировать хвост под ACCESS EXCLUSIVE и подменить таблицу секционированной (шаг 3)
+    
+    Блокировка ждётся не дольше PARTITION_CONVERSION_LOCK_TIMEOUT: очередь запросов
+    за ожидающим ACCESS EXCLUSIVE не растёт.
+    
+    Returns:
+        Число строк, скопированных под блокировкой; None если блокировку не дождались
+    """
+    _check_partitioned_table(table)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                await conn.execute(f"SET LOCAL lock_timeout = '{PARTITION_CONVERSION_LOCK_TIMEOUT}'")
+                copied = await conn.fetchval(
+                    "SELECT finish_partition_conversion($1)", table,
+                    timeout=PARTITION_CONVERSION_TIMEOUT_SECONDS
+                )
+        except asyncpg.LockNotAvailableError:
+            return None
+    return safe_int(copied)
+
+
+async def has_default_partition_rows(table: str) -> bool:
+    """Есть ли строки в DEFAULT-секции таблицы (месяц без заранее созданной секции)"""
+    _check_partitioned_table(table)
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return bool(await conn.fetchval(f'SELECT EXISTS(SELECT 1 FROM "{table}_default")'))
+
+
+async def archive_and_drop_partition(table: str, partition: str, path: str) -> int:
+    """
+    Выгрузить секцию в gzip-сжатый CSV, затем отсоединить и удалить её
+    
+    Секция удаляется только после успешной записи архива; при ошибке выгрузки
+    исключение пробрасывается, секция остаётся на месте.
+    
+    Returns:
+        Количество строк в архиве
+    """
+    _check_partitioned_table(table)
+    if not partition.startswith(f"{table}_"):
+        raise ValueError(f"Partition {partition} does not belong to {table}")
+    
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        rows = await _copy_query_to_csv_gz(conn, path, f'SELECT * FROM "{partition}"')
+        async with conn.transaction():
+            await conn.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{partition}"')
+            await conn.execute(f'DROP TABLE "{partition}"')
+    
+    logger.info(f"Partition archived and dropped: {partition}, rows={rows}, path={path}")
+    return rows
@@ -0,0 +1,187 @@
+"""
+DB Records - компактные типизированные строки для горячих запросов
+
+Вместо dict(row) по SELECT * горячие запросы database.py выбирают явный список
+колонок (User.columns_sql()) и упаковывают asyncpg.Record в объект с __slots__:
+нет словаря на каждую строку и в Python не попадают неиспользуемые колонки
+(флаги smart_notif_* / trial_notif_* подписки и т.п.).
+
+Записи совместимы с прежним словарным доступом (record["language"],
+record.get("uuid"), dict(record)), поэтому обработчики менять не нужно.
+Колонка, не вошедшая в проекцию, ведёт себя как отсутствующий ключ словаря.
+"""
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any, Iterator, Optional, Tuple
+
+import asyncpg
+
+
+class SlotsRecord(Mapping):
+    """Базовый класс: строка таблицы с фиксированным набором колонок в __slots__"""
+
+    __slots__: Tuple[str, ...] = ()
+
+    def __init__(self, *values: Any):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_row(cls, row: Optional[asyncpg.Record]):
+        """Упаковать строку, выбранную по columns_sql() (порядок колонок совпадает)"""
+        if row is None:
+            return None
+        return cls(*row.values())
+
+    @classmethod
+    def columns_sql(cls, alias: Optional[str] = None) -> str:
+        """Список колонок для SELECT (с префиксом таблицы, если передан alias)"""
+        if alias:
+            return ", ".join(f"{alias}.{name}" for name in cls.__slots__)
+        return ", ".join(cls.__slots__)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class User(SlotsRecord):
+    """Пользователь (users) без служебных флагов уведомлений"""
+
+    __slots__ = (
+        "telegram_id",
+        "username",
+        "language",
+        "created_at",
+        "balance",
+        "referral_code",
+        "referrer_id",
+        "referral_level",
+        "trial_used_at",
+        "trial_expires_at",
+    )
+
+    telegram_id: int
+    username: Optional[str]
+    language: Optional[str]
+    created_at: Optional[datetime]
+    balance: int
+    referral_code: Optional[str]
+    referrer_id: Optional[int]
+    referral_level: Optional[str]
+    trial_used_at: Optional[datetime]
+    trial_expires_at: Optional[datetime]
+
+
+class Subscription(SlotsRecord):
+    """Подписка (subscriptions) без флагов smart_notif_* и trial_notif_*"""
+
+    __slots__ = (
+        "id",
+        "telegram_id",
+        "uuid",
+        "vpn_key",
+        "outline_key_id",
+        "expires_at",
+        "status",
+        "source",
+        "activated_at",
+        "auto_renew",
+        "last_auto_renewal_at",
+        "admin_grant_days",
+        "reminder_sent",
+        "reminder_3d_sent",
+        "reminder_24h_sent",
+        "reminder_3h_sent",
+        "reminder_6h_sent",
+        "last_bytes",
+        "first_traffic_at",
+        "last_notification_sent_at",
+    )
+
+    id: int
+    telegram_id: int
+    uuid: Optional[str]
+    vpn_key: Optional[str]
+    outline_key_id: Optional[int]
+    expires_at: datetime
+    status: Optional[str]
+    source: Optional[str]
+    activated_at: Optional[datetime]
+    auto_renew: Optional[bool]
+    last_auto_renewal_at: Optional[datetime]
+    admin_grant_days: Optional[int]
+    reminder_sent: Optional[bool]
+    reminder_3d_sent: Optional[bool]
+    reminder_24h_sent: Optional[bool]
+    reminder_3h_sent: Optional[bool]
+    reminder_6h_sent: Optional[bool]
+    last_bytes: Optional[int]
+    first_traffic_at: Optional[datetime]
+    last_notification_sent_at: Optional[datetime]
+
+
+class Payment(SlotsRecord):
+    """Платёж (payments). Сумма в копейках"""
+
+    __slots__ = (
+        "id",
+        "telegram_id",
+        "tariff",
+        "amount",
+        "status",
+        "created_at",
+        "purchase_id",
+    )
+
+    id: int
+    telegram_id: int
+    tariff: str
+    amount: Optional[int]
+    status: Optional[str]
+    created_at: Optional[datetime]
+    purchase_id: Optional[str]
+
+
+class PendingPurchase(SlotsRecord):
+    """Контекст покупки (pending_purchases). Цена в копейках"""
+
+    __slots__ = (
+        "id",
+        "purchase_id",
+        "telegram_id",
+        "tariff",
+        "period_days",
+        "price_kopecks",
+        "promo_code",
+        "status",
+        "created_at",
+        "expires_at",
+        "provider_invoice_id",
+    )
+
+    id: int
+    purchase_id: str
+    telegram_id: int
+    tariff: str
+    period_days: int
+    price_kopecks: int
+    promo_code: Optional[str]
+    status: Optional[str]
+    created_at: Optional[datetime]
+    expires_at: Optional[datetime]
+    provider_invoice_id: Optional[str]
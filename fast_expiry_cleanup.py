@@ -73,24 +73,17 @@ async def fast_expiry_cleanup_task():
             
             # Получаем истёкшие подписки с активными UUID
             # Используем expires_at (в БД) - это и есть subscription_end
-            pool = await database.get_pool()
-            async with pool.acquire() as conn:
-                rows = await conn.fetch(
-                    """SELECT telegram_id, uuid, vpn_key, expires_at, status 
-                       FROM subscriptions 
-                       WHERE status = 'active'
-                       AND expires_at < $1
-                       AND uuid IS NOT NULL
-                       ORDER BY expires_at ASC""",
-                    now_utc
-                )
-            
-            if not rows:
-                continue
-            
-            logger.info(f"cleanup: FOUND_EXPIRED [count={len(rows)}]")
-            
-            for row in rows:
+            # Потоково пакетами (database.stream_rows): память не зависит от числа истёкших подписок
+            found_count = 0
+            async for row in database.stream_rows(
+                """SELECT telegram_id, uuid, vpn_key, expires_at, status 
+                   FROM subscriptions 
+                   WHERE status = 'active'
+                   AND expires_at < $1
+                   AND uuid IS NOT NULL""",
+                now_utc
+            ):
+                found_count += 1
                 telegram_id = row["telegram_id"]
                 uuid = row["uuid"]
                 expires_at = row["expires_at"]
@@ -99,7 +92,7 @@ async def fast_expiry_cleanup_task():
                 if expires_at >= now_utc:
                     logger.warning(
                         f"cleanup: SKIP_NOT_EXPIRED [user={telegram_id}, expires_at={expires_at.isoformat()}, "
-                        f"now={now.isoformat()}]"
+                        f"now={now_utc.isoformat()}]"
                     )
                     continue
                 
@@ -272,6 +265,9 @@ async def fast_expiry_cleanup_task():
                     # Удаляем UUID из множества обрабатываемых
                     processing_uuids.discard(uuid)
             
+            if found_count:
+                logger.info(f"cleanup: FOUND_EXPIRED [count={found_count}]")
+            
         except asyncio.CancelledError:
             logger.info("Fast expiry cleanup task cancelled")
             raise
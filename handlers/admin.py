@@ -8,10 +8,11 @@ from aiogram.filters import StateFilter
 from datetime import datetime, timedelta
 import logging
 import database
+import admin_dashboard_snapshot
+import telegram_gateway
 import localization
 import config
 import time
-import csv
 import tempfile
 import os
 import asyncio
@@ -21,8 +22,8 @@ from keyboards.admin import (
     get_admin_dashboard_keyboard, get_admin_back_keyboard,
     get_reissue_notification_keyboard, get_broadcast_test_type_keyboard,
     get_broadcast_type_keyboard, get_broadcast_segment_keyboard,
-    get_broadcast_confirm_keyboard, get_ab_test_list_keyboard,
-    get_admin_export_keyboard, get_admin_user_keyboard,
+    get_broadcast_confirm_keyboard, get_ab_test_list_keyboard, get_broadcast_jobs_keyboard,
+    get_admin_export_keyboard, get_admin_export_period_keyboard, get_admin_user_keyboard,
     get_admin_payment_keyboard
 )
 from states import (
@@ -205,9 +206,10 @@ async def callback_admin_metrics(callback: CallbackQuery):
         return
     
     try:
-        metrics = await database.get_business_metrics()
+        metrics, as_of = await admin_dashboard_snapshot.get_metrics()
         
-        text = "📈 Бизнес-метрики\n\n"
+        text = "📈 Бизнес-метрики\n"
+        text += f"🕒 Данные на {as_of.strftime('%d.%m.%Y %H:%M:%S')}\n\n"
         
         # Среднее время подтверждения оплаты
         approval_time = metrics.get('avg_payment_approval_time_seconds')
@@ -252,9 +254,10 @@ async def callback_admin_stats(callback: CallbackQuery):
         return
     
     try:
-        stats = await database.get_admin_stats()
+        stats, as_of = await admin_dashboard_snapshot.get_stats()
         
-        text = "📊 Статистика\n\n"
+        text = "📊 Статистика\n"
+        text += f"🕒 Данные на {as_of.strftime('%d.%m.%Y %H:%M:%S')}\n\n"
         text += f"👥 Всего пользователей: {stats['total_users']}\n"
         text += f"🔑 Активных подписок: {stats['active_subscriptions']}\n"
         text += f"⛔ Истёкших подписок: {stats['expired_subscriptions']}\n"
@@ -292,8 +295,7 @@ async def callback_admin_referral_stats(callback: CallbackQuery):
             search_query=None,
             sort_by="total_revenue",
             sort_order="DESC",
-            limit=10,
-            offset=0
+            limit=10
         )
         
         # Безопасная обработка статистики с дефолтами
@@ -421,9 +423,12 @@ async def callback_admin_referral_stats(callback: CallbackQuery):
             await callback.answer("Ошибка при получении реферальной статистики", show_alert=True)
 
 
+REFERRAL_STATS_PAGE_SIZE = 10
+
+
 @router.callback_query(F.data.startswith("admin:referral_sort:"))
 async def callback_admin_referral_sort(callback: CallbackQuery):
-    """Сортировка реферальной статистики"""
+    """Сортировка реферальной статистики (keyset-пагинация: admin:referral_sort:<key>[:<value>:<id>])"""
     if callback.from_user.id != config.ADMIN_TELEGRAM_ID:
         await callback.answer("Недостаточно прав доступа", show_alert=True)
         return
@@ -431,16 +436,18 @@ async def callback_admin_referral_sort(callback: CallbackQuery):
     await callback.answer()
     
     try:
-        # Извлекаем параметр сортировки
-        sort_by = callback.data.split(":")[-1]
+        # Извлекаем параметр сортировки и курсор следующей страницы (если есть)
+        parts = callback.data.split(":")
+        sort_by = parts[2]
+        after = (int(parts[3]), int(parts[4])) if len(parts) >= 5 else None
         
-        # Получаем статистику с новой сортировкой
+        # Получаем страницу статистики (+1 строка, чтобы понять, есть ли следующая)
         stats_list = await database.get_admin_referral_stats(
             search_query=None,
             sort_by=sort_by,
             sort_order="DESC",
-            limit=20,
-            offset=0
+            limit=REFERRAL_STATS_PAGE_SIZE + 1,
+            after=after
         )
         
         if not stats_list:
@@ -451,6 +458,9 @@ async def callback_admin_referral_sort(callback: CallbackQuery):
             await safe_edit_text(callback.message, text, reply_markup=keyboard)
             return
         
+        has_next_page = len(stats_list) > REFERRAL_STATS_PAGE_SIZE
+        page = stats_list[:REFERRAL_STATS_PAGE_SIZE]
+        
         # Формируем текст со статистикой
         sort_labels = {
             "total_revenue": "По доходу",
@@ -460,10 +470,8 @@ async def callback_admin_referral_sort(callback: CallbackQuery):
         sort_label = sort_labels.get(sort_by, "По доходу")
         
         text = f"📊 Реферальная статистика\nСортировка: {sort_label}\n\n"
-        text += f"Всего рефереров: {len(stats_list)}\n\n"
         
-        # Показываем топ-10 рефереров
-        for idx, stat in enumerate(stats_list[:10], 1):
+        for idx, stat in enumerate(page, 1):
             username = stat["username"]
             invited_count = stat["invited_count"]
             paid_count = stat["paid_count"]
@@ -476,11 +484,17 @@ async def callback_admin_referral_sort(callback: CallbackQuery):
             text += f"   Приглашено: {invited_count} | Оплатили: {paid_count} ({conversion}%)\n"
             text += f"   Доход: {revenue:.2f} ₽ | Кешбэк: {cashback:.2f} ₽ ({cashback_percent}%)\n\n"
         
-        if len(stats_list) > 10:
-            text += f"... и еще {len(stats_list) - 10} рефереров\n\n"
-        
         # Клавиатура с кнопками фильтров и сортировки
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        inline_keyboard = []
+        if has_next_page:
+            last = page[-1]
+            inline_keyboard.append([
+                InlineKeyboardButton(
+                    text="➡️ Далее",
+                    callback_data=f"admin:referral_sort:{sort_by}:{last['sort_value']}:{last['referrer_id']}"
+                )
+            ])
+        inline_keyboard.extend([
             [
                 InlineKeyboardButton(text="📈 По доходу", callback_data="admin:referral_sort:total_revenue"),
                 InlineKeyboardButton(text="👥 По приглашениям", callback_data="admin:referral_sort:invited_count")
@@ -491,6 +505,7 @@ async def callback_admin_referral_sort(callback: CallbackQuery):
             ],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="admin:main")]
         ])
+        keyboard = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
         
         await safe_edit_text(callback.message, text, reply_markup=keyboard)
         
@@ -914,6 +929,10 @@ async def callback_admin_analytics(callback: CallbackQuery):
         
         # Клавиатура
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(text="📅 По месяцам", callback_data="admin:analytics:monthly"),
+                InlineKeyboardButton(text="👥 Когорты", callback_data="admin:analytics:cohorts")
+            ],
             [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin:analytics")],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="admin:main")]
         ])
@@ -993,6 +1012,44 @@ async def callback_admin_analytics_monthly(callback: CallbackQuery):
         await callback.answer("Ошибка при получении ежемесячной сводки", show_alert=True)
 
 
+@router.callback_query(F.data == "admin:analytics:cohorts")
+async def callback_admin_analytics_cohorts(callback: CallbackQuery):
+    """Когорты удержания: неделя первой оплаты → доля оплативших в последующие недели"""
+    if callback.from_user.id != config.ADMIN_TELEGRAM_ID:
+        await callback.answer("Недостаточно прав доступа", show_alert=True)
+        return
+    
+    try:
+        cohorts = await database.get_cohort_retention(weeks=8, periods=6)
+        
+        text = "👥 Когорты удержания (по неделе первой оплаты)\n\n"
+        if not cohorts:
+            text += "Данных пока нет."
+        else:
+            text += "Неделя | Размер | W0 W1 W2 W3 W4 W5 | Отток\n"
+            for cohort in cohorts:
+                cells = " ".join(
+                    "—" if value is None else f"{value:.0f}%"
+                    for value in cohort["retention"]
+                )
+                text += (
+                    f"{cohort['cohort_week'].strftime('%d.%m')} | {cohort['size']} | "
+                    f"{cells} | {cohort['churn_percent']:.0f}%\n"
+                )
+            text += "\nW0..W5 - доля когорты, оплатившей подписку в N-ю неделю от старта"
+        
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Назад к аналитике", callback_data="admin:analytics")]
+        ])
+        
+        await safe_edit_text(callback.message, text, reply_markup=keyboard)
+        await callback.answer()
+        
+    except Exception as e:
+        logger.exception(f"Error in cohort analytics: {e}")
+        await callback.answer("Ошибка при получении когорт", show_alert=True)
+
+
 @router.callback_query(F.data == "admin:audit")
 async def callback_admin_audit(callback: CallbackQuery):
     """Раздел Аудит (переиспользование логики /admin_audit)"""
@@ -1151,12 +1208,14 @@ async def callback_admin_keys_reissue_all(callback: CallbackQuery, bot: Bot):
         async with pool.acquire() as conn:
             now = datetime.now()
             subscriptions = await conn.fetch(
-                """SELECT telegram_id, uuid, vpn_key, expires_at 
-                   FROM subscriptions 
-                   WHERE status = 'active' 
-                   AND expires_at > $1 
-                   AND uuid IS NOT NULL
-                   ORDER BY telegram_id""",
+                """SELECT s.telegram_id, s.uuid, s.vpn_key, s.expires_at,
+                          u.unreachable_since IS NOT NULL AS unreachable
+                   FROM subscriptions s
+                   LEFT JOIN users u ON u.telegram_id = s.telegram_id
+                   WHERE s.status = 'active' 
+                   AND s.expires_at > $1 
+                   AND s.uuid IS NOT NULL
+                   ORDER BY s.telegram_id""",
                 now
             )
         
@@ -1178,6 +1237,9 @@ async def callback_admin_keys_reissue_all(callback: CallbackQuery, bot: Bot):
         status_message = await callback.message.edit_text(status_text, reply_markup=None)
         # Примечание: status_message используется для динамического обновления, защита не нужна
         
+        # Уведомления о перевыпуске идут полосой рассылок telegram_gateway
+        telegram_gateway.set_lane(telegram_gateway.LANE_BROADCAST)
+        
         # Обрабатываем каждую подписку
         for idx, sub_row in enumerate(subscriptions, 1):
             subscription = dict(sub_row)
@@ -1196,25 +1258,27 @@ async def callback_admin_keys_reissue_all(callback: CallbackQuery, bot: Bot):
                 
                 success_count += 1
                 
-                # Отправляем уведомление пользователю
-                try:
-                    user_lang = await database.get_user(telegram_id)
-                    language = user_lang.get("language", "ru") if user_lang else "ru"
-                    
+                # Отправляем уведомление пользователю (ключ перевыпускается и недоступным,
+                # уведомление им не отправляем)
+                if not subscription["unreachable"]:
                     try:
-                        user_text = localization.get_text(
-                            language,
-                            "admin_reissue_user_notification",
-                            vpn_key=f"<code>{new_vpn_key}</code>"
-                        )
-                    except (KeyError, TypeError):
-                        # Fallback to default if localization not found
-                        user_text = get_reissue_notification_text(new_vpn_key)
+                        user_lang = await database.get_user(telegram_id)
+                        language = user_lang.get("language", "ru") if user_lang else "ru"
                     
-                    keyboard = get_reissue_notification_keyboard()
-                    await bot.send_message(telegram_id, user_text, reply_markup=keyboard, parse_mode="HTML")
-                except Exception as e:
-                    logging.warning(f"Failed to send reissue notification to user {telegram_id}: {e}")
+                        try:
+                            user_text = localization.get_text(
+                                language,
+                                "admin_reissue_user_notification",
+                                vpn_key=f"<code>{new_vpn_key}</code>"
+                            )
+                        except (KeyError, TypeError):
+                            # Fallback to default if localization not found
+                            user_text = get_reissue_notification_text(new_vpn_key)
+                    
+                        keyboard = get_reissue_notification_keyboard()
+                        await bot.send_message(telegram_id, user_text, reply_markup=keyboard, parse_mode="HTML")
+                    except Exception as e:
+                        logging.warning(f"Failed to send reissue notification to user {telegram_id}: {e}")
                 
                 # Обновляем статус каждые 10 пользователей или в конце
                 if idx % 10 == 0 or idx == total_count:
@@ -1407,6 +1471,9 @@ async def callback_admin_reissue_all_active(callback: CallbackQuery, bot: Bot):
         status_message = await callback.message.edit_text(status_text, reply_markup=None)
         # Примечание: status_message используется для динамического обновления, защита не нужна
         
+        # Уведомления о перевыпуске идут полосой рассылок telegram_gateway
+        telegram_gateway.set_lane(telegram_gateway.LANE_BROADCAST)
+        
         # Обрабатываем каждую подписку ИТЕРАТИВНО (НЕ параллельно)
         for idx, subscription in enumerate(subscriptions, 1):
             subscription_id = subscription.get("id")
@@ -2651,7 +2718,7 @@ async def callback_admin_export(callback: CallbackQuery):
 
 @router.callback_query(F.data.startswith("admin:export:"))
 async def callback_admin_export_data(callback: CallbackQuery):
-    """Обработка экспорта данных"""
+    """Обработка экспорта данных (admin:export:<type>[:<days>], потоковый gzip CSV)"""
     if callback.from_user.id != config.ADMIN_TELEGRAM_ID:
         await callback.answer("Недостаточно прав доступа", show_alert=True)
         return
@@ -2659,82 +2726,45 @@ async def callback_admin_export_data(callback: CallbackQuery):
     await callback.answer()
     
     try:
-        export_type = callback.data.split(":")[2]  # users или subscriptions
-        
-        # Получаем данные из БД
-        if export_type == "users":
-            data = await database.get_all_users_for_export()
-            filename = "users_export.csv"
-            headers = ["ID", "Telegram ID", "Username", "Language", "Created At"]
-        elif export_type == "subscriptions":
-            data = await database.get_active_subscriptions_for_export()
-            filename = "active_subscriptions_export.csv"
-            headers = ["ID", "Telegram ID", "VPN Key", "Expires At", "Reminder Sent"]
-        else:
+        parts = callback.data.split(":")
+        export_type = parts[2]
+        
+        if export_type not in database.EXPORT_QUERIES:
             await callback.message.answer("Неверный тип экспорта")
             return
         
-        if not data:
-            await callback.message.answer("Нет данных для экспорта")
-            return
+        # Для таблиц с фильтром по датам сначала выбираем период
+        date_from = None
+        period_label = ""
+        if database.export_supports_date_range(export_type):
+            if len(parts) < 4:
+                text = "📤 Экспорт данных\n\nВыберите период:"
+                await safe_edit_text(
+                    callback.message, text, reply_markup=get_admin_export_period_keyboard(export_type)
+                )
+                return
+            days = int(parts[3])
+            if days > 0:
+                date_from = datetime.now() - timedelta(days=days)
+                period_label = f" за {days} дн."
         
-        # Создаём временный файл
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, encoding='utf-8', newline='') as tmp_file:
+        filename = f"{export_type}_export_{datetime.now().strftime('%Y%m%d_%H%M')}.csv.gz"
+        with tempfile.NamedTemporaryFile(suffix='.csv.gz', delete=False) as tmp_file:
             csv_file_path = tmp_file.name
+        
+        try:
+            # COPY ... TO STDOUT → gzip: память не зависит от размера таблицы
+            rows_count = await database.stream_export_csv_gz(export_type, csv_file_path, date_from=date_from)
             
-            # Записываем CSV
-            writer = csv.writer(tmp_file)
-            writer.writerow(headers)
-            
-            # Маппинг заголовков на ключи в данных
-            if export_type == "users":
-                key_mapping = {
-                    "ID": "id",
-                    "Telegram ID": "telegram_id",
-                    "Username": "username",
-                    "Language": "language",
-                    "Created At": "created_at"
-                }
-            else:  # subscriptions
-                key_mapping = {
-                    "ID": "id",
-                    "Telegram ID": "telegram_id",
-                    "VPN Key": "vpn_key",
-                    "Expires At": "expires_at",
-                    "Reminder Sent": "reminder_sent"
-                }
+            if rows_count == 0:
+                await callback.message.answer("Нет данных для экспорта")
+                return
             
-            for row in data:
-                csv_row = []
-                for header in headers:
-                    key = key_mapping[header]
-                    value = row.get(key)
-                    
-                    if key == "created_at" or key == "expires_at":
-                        # Форматируем дату
-                        if value:
-                            if isinstance(value, datetime):
-                                csv_row.append(value.strftime("%Y-%m-%d %H:%M:%S"))
-                            elif isinstance(value, str):
-                                csv_row.append(value)
-                            else:
-                                csv_row.append(str(value))
-                        else:
-                            csv_row.append("")
-                    elif key == "reminder_sent":
-                        # Преобразуем boolean в строку
-                        csv_row.append("Да" if value else "Нет")
-                    else:
-                        csv_row.append(str(value) if value is not None else "")
-                writer.writerow(csv_row)
-        
-        # Отправляем файл
-        try:
             file_to_send = FSInputFile(csv_file_path, filename=filename)
             await callback.bot.send_document(
                 config.ADMIN_TELEGRAM_ID,
                 file_to_send,
-                caption=f"📤 Экспорт: {export_type}"
+                caption=f"📤 Экспорт: {export_type}{period_label} ({rows_count} строк)"
             )
             await callback.message.answer("✅ Файл отправлен")
             
@@ -2743,7 +2773,7 @@ async def callback_admin_export_data(callback: CallbackQuery):
                 "admin_export_data",
                 callback.from_user.id,
                 None,
-                f"Exported {export_type}: {len(data)} records"
+                f"Exported {export_type}{period_label}: {rows_count} records"
             )
         finally:
             # Удаляем временный файл
@@ -2874,6 +2904,7 @@ async def callback_admin_broadcast(callback: CallbackQuery):
     text = "📣 Уведомления\n\nВыберите действие:"
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Создать уведомление", callback_data="broadcast:create")],
+        [InlineKeyboardButton(text="📋 Рассылки", callback_data="broadcast:jobs")],
         [InlineKeyboardButton(text="📊 A/B статистика", callback_data="broadcast:ab_stats")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="admin:main")],
     ])
@@ -3098,89 +3129,27 @@ async def callback_broadcast_confirm_send(callback: CallbackQuery, state: FSMCon
             return
     
     try:
-        # Создаем уведомление в БД
+        # Создаем задание рассылки: отправку выполняет broadcast_worker в фоне
         broadcast_id = await database.create_broadcast(
             title, message_text, broadcast_type, segment, callback.from_user.id,
-            is_ab_test=is_ab_test, message_a=message_a, message_b=message_b
+            is_ab_test=is_ab_test, message_a=message_a, message_b=message_b,
+            queue_job=True
         )
         
-        # Формируем сообщения для отправки
-        type_emoji = {
-            "info": "ℹ️",
-            "maintenance": "🔧",
-            "security": "🔒",
-            "promo": "🎯"
-        }
-        emoji = type_emoji.get(broadcast_type, "📢")
-        
-        if is_ab_test:
-            final_message_a = f"{emoji} {title}\n\n{message_a}"
-            final_message_b = f"{emoji} {title}\n\n{message_b}"
-        else:
-            final_message = f"{emoji} {title}\n\n{message_text}"
-        
-        # Получаем список пользователей по сегменту
-        user_ids = await database.get_users_by_segment(segment)
-        total_users = len(user_ids)
-        
-        await callback.message.edit_text(
-            f"📤 Отправка уведомления...\n\nПользователей: {total_users}\nОжидайте завершения.",
-            reply_markup=None
-        )
-        
-        # Отправляем уведомления с задержкой
-        sent_count = 0
-        failed_count = 0
-        
-        for user_id in user_ids:
-            try:
-                if is_ab_test:
-                    # Случайно выбираем вариант A или B (50/50)
-                    variant = "A" if random.random() < 0.5 else "B"
-                    message_to_send = final_message_a if variant == "A" else final_message_b
-                    await bot.send_message(user_id, message_to_send)
-                    await database.log_broadcast_send(broadcast_id, user_id, "sent", variant)
-                else:
-                    await bot.send_message(user_id, final_message)
-                    await database.log_broadcast_send(broadcast_id, user_id, "sent")
-                
-                sent_count += 1
-                
-                # Задержка между отправками (0.3-0.5 сек)
-                await asyncio.sleep(0.4)
-                
-            except Exception as e:
-                logging.error(f"Error sending broadcast to user {user_id}: {e}")
-                variant = None
-                if is_ab_test:
-                    # Для неудачных отправок тоже логируем вариант, если можем определить
-                    variant = "A" if random.random() < 0.5 else "B"
-                await database.log_broadcast_send(broadcast_id, user_id, "failed", variant)
-                failed_count += 1
-        
-        # Логируем действие
         await database._log_audit_event_atomic_standalone(
-            "broadcast_sent",
+            "broadcast_queued",
             callback.from_user.id,
             None,
-            f"Broadcast ID: {broadcast_id}, Segment: {segment}, Sent: {sent_count}, Failed: {failed_count}"
+            f"Broadcast ID: {broadcast_id}, Segment: {segment}"
         )
         
-        # Показываем результат
-        result_text = (
-            f"✅ Уведомление отправлено\n\n"
-            f"📊 Статистика:\n"
-            f"✅ Отправлено: {sent_count}\n"
-            f"❌ Ошибок: {failed_count}\n"
-            f"📝 ID уведомления: {broadcast_id}"
+        await callback.message.edit_text(
+            f"📤 Уведомление #{broadcast_id} поставлено в очередь\n\n"
+            f"Отправка идёт в фоне, по завершении придёт отчёт.\n"
+            f"Прогресс, пауза и отмена - в разделе «Рассылки».",
+            reply_markup=get_broadcast_jobs_keyboard([])
         )
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin:broadcast")],
-        ])
-        
-        await callback.message.edit_text(result_text, reply_markup=keyboard)
-        
     except Exception as e:
         logging.exception(f"Error in broadcast send: {e}")
         await callback.message.answer(f"Ошибка при отправке уведомления: {e}")
@@ -3189,6 +3158,83 @@ async def callback_broadcast_confirm_send(callback: CallbackQuery, state: FSMCon
         await state.clear()
 
 
+BROADCAST_JOB_STATUS_LABELS = {
+    "queued": "⏳ в очереди",
+    "running": "📤 отправляется",
+    "paused": "⏸ на паузе",
+    "cancelled": "✖️ отменена",
+    "completed": "✅ завершена",
+}
+
+
+async def _show_broadcast_jobs(message: Message):
+    """Перерисовать экран заданий рассылки (без ответа на callback)"""
+    jobs = await database.get_broadcast_jobs(limit=10)
+    lines = ["📋 Рассылки\n"]
+    for job in jobs:
+        processed = job["sent_count"] + job["failed_count"]
+        total = job["total_recipients"]
+        progress = f"{processed}/{total}" if total is not None else str(processed)
+        label = BROADCAST_JOB_STATUS_LABELS.get(job["job_status"], job["job_status"])
+        lines.append(
+            f"#{job['id']} {job['title'][:30]} - {label}\n"
+            f"   Обработано: {progress}, ✅ {job['sent_count']}, ❌ {job['failed_count']}"
+        )
+    if not jobs:
+        lines.append("Рассылок пока нет.")
+    
+    try:
+        await safe_edit_text(message, "\n".join(lines), reply_markup=get_broadcast_jobs_keyboard(jobs))
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+
+
+@router.callback_query(F.data == "broadcast:jobs")
+async def callback_broadcast_jobs(callback: CallbackQuery):
+    """Задания рассылки: прогресс и управление"""
+    if callback.from_user.id != config.ADMIN_TELEGRAM_ID:
+        await callback.answer("Недостаточно прав доступа", show_alert=True)
+        return
+    
+    await _show_broadcast_jobs(callback.message)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("broadcast:job:"))
+async def callback_broadcast_job_control(callback: CallbackQuery):
+    """Пауза / продолжение / отмена задания рассылки"""
+    if callback.from_user.id != config.ADMIN_TELEGRAM_ID:
+        await callback.answer("Недостаточно прав доступа", show_alert=True)
+        return
+    
+    try:
+        _, _, command, broadcast_id_str = callback.data.split(":")
+        broadcast_id = int(broadcast_id_str)
+    except ValueError:
+        await callback.answer("Некорректная команда", show_alert=True)
+        return
+    
+    if command not in database.BROADCAST_JOB_TRANSITIONS:
+        await callback.answer("Некорректная команда", show_alert=True)
+        return
+    
+    changed = await database.set_broadcast_job_status(broadcast_id, command)
+    if changed:
+        await database._log_audit_event_atomic_standalone(
+            f"broadcast_{command}",
+            callback.from_user.id,
+            None,
+            f"Broadcast ID: {broadcast_id}"
+        )
+        await callback.answer()
+    else:
+        await callback.answer("Статус рассылки уже изменился", show_alert=True)
+    
+    # На callback отвечаем один раз (повторный ответ - TelegramBadRequest), экран обновляем в обоих случаях
+    await _show_broadcast_jobs(callback.message)
+
+
 @router.callback_query(F.data == "broadcast:ab_stats")
 async def callback_broadcast_ab_stats(callback: CallbackQuery):
     """Список A/B тестов"""
@@ -1102,34 +1102,21 @@ async def callback_pay_balance(callback: CallbackQuery, state: FSMContext):
         # Создаем запись о платеже для аналитики
         pool = await database.get_pool()
         async with pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO payments (telegram_id, tariff, amount, status) VALUES ($1, $2, $3, 'approved')",
+            balance_payment_id = await conn.fetchval(
+                "INSERT INTO payments (telegram_id, tariff, amount, status) VALUES ($1, $2, $3, 'approved') RETURNING id",
                 telegram_id, f"{tariff_type}_{period_days}", final_price_kopecks
             )
         
-        # Начисляем реферальный кешбэк при оплате с баланса
+        # Ставим реферальный кешбэк в очередь (начисление и уведомление - referral_outbox_worker)
         try:
-            reward_result = await database.process_referral_reward(
+            await database.enqueue_referral_reward(
                 buyer_id=telegram_id,
-                purchase_id=None,  # Оплата с баланса не имеет purchase_id
-                amount_rubles=final_price_rubles
+                amount_rubles=final_price_rubles,
+                event_key=f"payment:{balance_payment_id}",
+                action_type="покупку" if not is_renewal else "продление"
             )
-            
-            if reward_result.get("success"):
-                await send_referral_cashback_notification(
-                    bot=callback.message.bot,
-                    referrer_id=reward_result.get("referrer_id"),
-                    referred_id=telegram_id,
-                    purchase_amount=final_price_rubles,
-                    cashback_amount=reward_result.get("reward_amount"),
-                    cashback_percent=reward_result.get("percent"),
-                    paid_referrals_count=reward_result.get("paid_referrals_count", 0),
-                    referrals_needed=reward_result.get("referrals_needed", 0),
-                    action_type="покупка" if not is_renewal else "продление"
-                )
-                logger.info(f"Referral cashback processed for balance payment: user={telegram_id}, amount={final_price_rubles} RUB")
         except Exception as e:
-            logger.exception(f"Error processing referral cashback for balance payment: user={telegram_id}: {e}")
+            logger.exception(f"Error queueing referral cashback for balance payment: user={telegram_id}: {e}")
         
         # ЗАЩИТА ОТ РЕГРЕССА: Валидируем VLESS ссылку перед отправкой
         import vpn_utils
@@ -2206,7 +2193,8 @@ async def process_successful_payment(message: Message, state: FSMContext):
                 telegram_id=telegram_id,
                 amount=payment_amount_rubles,
                 source="telegram_payment",
-                description=f"Пополнение баланса через Telegram Payments"
+                description=f"Пополнение баланса через Telegram Payments",
+                idempotency_key=f"telegram_payment:{payment.telegram_payment_charge_id}"
             )
             
             if success:
@@ -2224,29 +2212,16 @@ async def process_successful_payment(message: Message, state: FSMContext):
                 )
                 await message.answer(text)
                 
-                # Начисляем реферальный кешбэк при пополнении баланса
+                # Ставим реферальный кешбэк в очередь (начисление и уведомление - referral_outbox_worker)
                 try:
-                    reward_result = await database.process_referral_reward(
+                    await database.enqueue_referral_reward(
                         buyer_id=telegram_id,
-                        purchase_id=None,  # Пополнение баланса не имеет purchase_id
-                        amount_rubles=payment_amount_rubles
+                        amount_rubles=payment_amount_rubles,
+                        event_key=f"telegram_payment:{payment.telegram_payment_charge_id}",
+                        action_type="пополнение"
                     )
-                    
-                    if reward_result.get("success"):
-                        await send_referral_cashback_notification(
-                            bot=message.bot,
-                            referrer_id=reward_result.get("referrer_id"),
-                            referred_id=telegram_id,
-                            purchase_amount=payment_amount_rubles,
-                            cashback_amount=reward_result.get("reward_amount"),
-                            cashback_percent=reward_result.get("percent"),
-                            paid_referrals_count=reward_result.get("paid_referrals_count", 0),
-                            referrals_needed=reward_result.get("referrals_needed", 0),
-                            action_type="пополнение"
-                        )
-                        logger.info(f"Referral cashback processed for balance topup: user={telegram_id}, amount={payment_amount_rubles} RUB")
                 except Exception as e:
-                    logger.exception(f"Error processing referral cashback for balance topup: user={telegram_id}: {e}")
+                    logger.exception(f"Error queueing referral cashback for balance topup: user={telegram_id}: {e}")
                 
                 # Логируем событие
                 logger.info(f"Balance topup successful: user={telegram_id}, amount={payment_amount_rubles} RUB, new_balance={new_balance} RUB")
@@ -2542,9 +2517,13 @@ async def process_successful_payment(message: Message, state: FSMContext):
                 price_before = base_price
                 price_after = payment_amount_rubles
                 
-                # Увеличиваем счетчик использований
-                await database.increment_promo_code_use(promo_code_used)
-                
+                # Увеличиваем счетчик использований (условным UPDATE, без блокировки на чтение)
+                counted = await database.increment_promo_code_use(promo_code_used)
+                if not counted:
+                    logger.warning(
+                        f"Promo code limit reached at redemption: code={promo_code_used}, user={telegram_id}"
+                    )
+
                 # Логируем использование промокода
                 await database.log_promo_code_usage(
                     promo_code=promo_code_used,
@@ -2621,24 +2600,8 @@ async def process_successful_payment(message: Message, state: FSMContext):
             # Ключ есть в БД, пользователь может получить через профиль
     
     # КРИТИЧНО: pending_purchase уже помечен как paid в finalize_purchase
-    # Реферальный кешбэк уже обработан в finalize_purchase через process_referral_reward
-    # Отправляем уведомление рефереру (если кешбэк был начислен)
-    try:
-        referral_reward = result.get("referral_reward")
-        if referral_reward and referral_reward.get("success"):
-            await send_referral_cashback_notification(
-                bot=message.bot,
-                referrer_id=referral_reward.get("referrer_id"),
-                referred_id=telegram_id,
-                purchase_amount=payment_amount_rubles,
-                cashback_amount=referral_reward.get("reward_amount"),
-                cashback_percent=referral_reward.get("percent"),
-                paid_referrals_count=referral_reward.get("paid_referrals_count", 0),
-                referrals_needed=referral_reward.get("referrals_needed", 0),
-                action_type="покупку"
-            )
-    except Exception as e:
-        logger.warning(f"Failed to send referral notification: {e}")
+    # Реферальный кешбэк поставлен в очередь в finalize_purchase (outbox),
+    # начисление и уведомление рефереру выполняет referral_outbox_worker
     
     logger.info(
         f"process_successful_payment: PAYMENT_COMPLETE [user={telegram_id}, payment_id={payment_id}, "
@@ -2927,10 +2890,8 @@ async def callback_referral(callback: CallbackQuery):
         next_level = level_info.get("next_level")
         referrals_to_next = level_info.get("referrals_to_next")
         
-        # Получаем общую сумму заработанного кешбэка (всегда возвращает float >= 0)
-        total_cashback = await database.get_total_cashback_earned(telegram_id)
-        if total_cashback is None:
-            total_cashback = 0.0
+        # Общая сумма заработанного кешбэка (из того же чтения referrer_stats)
+        total_cashback = database.safe_float(level_info.get("total_cashback", 0.0))
         
         # Получаем username бота для реферальной ссылки
         bot_info = await callback.bot.get_me()
@@ -3135,10 +3096,8 @@ async def callback_referral_stats(callback: CallbackQuery):
         else:
             remaining_count = next_threshold - current_referrals
         
-        # Получаем общий кешбэк
-        total_cashback = await database.get_total_cashback_earned(telegram_id)
-        if total_cashback is None:
-            total_cashback = 0.0
+        # Общий кешбэк (из того же чтения referrer_stats)
+        total_cashback = database.safe_float(level_info.get("total_cashback", 0.0))
         
         # Формируем текст статистики (без жирного форматирования)
         text = (
@@ -5905,114 +5864,6 @@ async def callback_admin_export(callback: CallbackQuery):
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("admin:export:"))
-async def callback_admin_export_data(callback: CallbackQuery):
-    """Обработка экспорта данных"""
-    if callback.from_user.id != config.ADMIN_TELEGRAM_ID:
-        await callback.answer("Недостаточно прав доступа", show_alert=True)
-        return
-    
-    await callback.answer()
-    
-    try:
-        export_type = callback.data.split(":")[2]  # users или subscriptions
-        
-        # Получаем данные из БД
-        if export_type == "users":
-            data = await database.get_all_users_for_export()
-            filename = "users_export.csv"
-            headers = ["ID", "Telegram ID", "Username", "Language", "Created At"]
-        elif export_type == "subscriptions":
-            data = await database.get_active_subscriptions_for_export()
-            filename = "active_subscriptions_export.csv"
-            headers = ["ID", "Telegram ID", "VPN Key", "Expires At", "Reminder Sent"]
-        else:
-            await callback.message.answer("Неверный тип экспорта")
-            return
-        
-        if not data:
-            await callback.message.answer("Нет данных для экспорта")
-            return
-        
-        # Создаём временный файл
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, encoding='utf-8', newline='') as tmp_file:
-            csv_file_path = tmp_file.name
-            
-            # Записываем CSV
-            writer = csv.writer(tmp_file)
-            writer.writerow(headers)
-            
-            # Маппинг заголовков на ключи в данных
-            if export_type == "users":
-                key_mapping = {
-                    "ID": "id",
-                    "Telegram ID": "telegram_id",
-                    "Username": "username",
-                    "Language": "language",
-                    "Created At": "created_at"
-                }
-            else:  # subscriptions
-                key_mapping = {
-                    "ID": "id",
-                    "Telegram ID": "telegram_id",
-                    "VPN Key": "vpn_key",
-                    "Expires At": "expires_at",
-                    "Reminder Sent": "reminder_sent"
-                }
-            
-            for row in data:
-                csv_row = []
-                for header in headers:
-                    key = key_mapping[header]
-                    value = row.get(key)
-                    
-                    if key == "created_at" or key == "expires_at":
-                        # Форматируем дату
-                        if value:
-                            if isinstance(value, datetime):
-                                csv_row.append(value.strftime("%Y-%m-%d %H:%M:%S"))
-                            elif isinstance(value, str):
-                                csv_row.append(value)
-                            else:
-                                csv_row.append(str(value))
-                        else:
-                            csv_row.append("")
-                    elif key == "reminder_sent":
-                        # Преобразуем boolean в строку
-                        csv_row.append("Да" if value else "Нет")
-                    else:
-                        csv_row.append(str(value) if value is not None else "")
-                writer.writerow(csv_row)
-        
-        # Отправляем файл
-        try:
-            file_to_send = FSInputFile(csv_file_path, filename=filename)
-            await callback.bot.send_document(
-                config.ADMIN_TELEGRAM_ID,
-                file_to_send,
-                caption=f"📤 Экспорт: {export_type}"
-            )
-            await callback.message.answer("✅ Файл отправлен")
-            
-            # Логируем экспорт
-            await database._log_audit_event_atomic_standalone(
-                "admin_export_data",
-                callback.from_user.id,
-                None,
-                f"Exported {export_type}: {len(data)} records"
-            )
-        finally:
-            # Удаляем временный файл
-            try:
-                os.unlink(csv_file_path)
-            except Exception as e:
-                logging.error(f"Error deleting temp file {csv_file_path}: {e}")
-        
-    except Exception as e:
-        logging.exception(f"Error in callback_admin_export_data: {e}")
-        await callback.message.answer("Ошибка при экспорте данных. Проверь логи.")
-
-
 @router.callback_query(F.data == "admin:incident")
 async def callback_admin_incident(callback: CallbackQuery):
     """Раздел управления инцидентом"""
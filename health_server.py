@@ -12,6 +12,13 @@ from aiohttp import web
 from aiogram import Bot
 import database
 import redis_client
+import startup
+import audit_writer
+import auto_renewal
+import crypto_payment_watcher
+import cryptobot_service
+import partition_maintenance
+import telegram_gateway
 
 logger = logging.getLogger(__name__)
 
@@ -27,12 +34,22 @@ async def health_handler(request: web.Request) -> web.Response:
         {
             "status": "ok" | "degraded",
             "db_ready": true | false,
+            "db_init_timings": {"migrations_ms": ..., "legacy_schema_ms": ..., ...},
+            "startup_timings": {"imports": ..., "redis": ..., "database": ..., "total": ...},
+            "audit_writer": {"enqueued": ..., "written": ..., "delayed": ..., "dropped": ..., ...},
+            "telegram_gateway": {"queue_depth": {...}, "sent": {...}, "retry_after": ..., "send_ms_p95": ..., ...},
+            "auto_renewal": {"cycles": ..., "renewed": ..., "failed": ..., "last_cycle": {...}},
+            "crypto_watcher": {"api_calls": ..., "confirmed_by_poll": ..., "webhook_healthy": ..., ...},
+            "cryptobot_webhook": {"received": ..., "duplicates": ..., "enqueued": ..., "workers": ..., ...},
+            "partitions": {"months_ahead": {...}, "default_rows": [...], "alert": ..., ...},
             "timestamp": "2024-01-01T12:00:00Z"
         }
     
     Status rules:
         - "ok" if DB_INIT_STATUS == READY and DB_READY == True
-        - "degraded" if DB_INIT_STATUS != READY or DB_READY == False
+        - "degraded" if DB_INIT_STATUS != READY or DB_READY == False,
+          or partition maintenance raised an alert (few months of partitions ahead,
+          rows in a DEFAULT partition)
     
     IMPORTANT: This endpoint MUST NOT depend on database.
     It only reads the global DB_READY and DB_INIT_STATUS flags.
@@ -50,7 +67,7 @@ async def health_handler(request: web.Request) -> web.Response:
         elif db_init_status != database.DBInitStatus.READY:
             status = "fail"
             http_status = 503  # Service Unavailable
-        elif db_ready:
+        elif db_ready and not partition_maintenance.PARTITION_STATS["alert"]:
             status = "ok"
             http_status = 200
         else:
@@ -63,6 +80,14 @@ async def health_handler(request: web.Request) -> web.Response:
             "redis_ready": redis_ok,
             "db_ready": db_ready,
             "db_init_status": db_init_status.value,
+            "db_init_timings": database.DB_INIT_TIMINGS,
+            "startup_timings": startup.STARTUP_TIMINGS,
+            "audit_writer": audit_writer.get_stats(),
+            "telegram_gateway": telegram_gateway.get_stats(),
+            "auto_renewal": auto_renewal.get_stats(),
+            "crypto_watcher": crypto_payment_watcher.get_stats(),
+            "cryptobot_webhook": cryptobot_service.get_stats(),
+            "partitions": partition_maintenance.get_stats(),
             "timestamp": datetime.utcnow().isoformat() + "Z"
         }
         
@@ -100,11 +125,8 @@ async def create_health_app(bot: Optional[Bot] = None) -> web.Application:
     # Register Crypto Bot webhook if enabled
     if bot:
         try:
-            import cryptobot_service
             if cryptobot_service.is_enabled():
                 await cryptobot_service.register_webhook_route(app, bot)
-        except ImportError:
-            pass
         except Exception as e:
             logger.error(f"Failed to register Crypto Bot webhook: {e}")
     
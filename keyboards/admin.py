@@ -96,16 +96,54 @@ def get_ab_test_list_keyboard(ab_tests: list) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+def get_broadcast_jobs_keyboard(jobs: list) -> InlineKeyboardMarkup:
+    """Клавиатура заданий рассылки: пауза / продолжение / отмена незавершённых"""
+    buttons = []
+    for job in jobs:
+        job_id = job["id"]
+        if job["job_status"] in ("queued", "running"):
+            buttons.append([
+                InlineKeyboardButton(text=f"⏸ Пауза #{job_id}", callback_data=f"broadcast:job:pause:{job_id}"),
+                InlineKeyboardButton(text=f"✖️ Отменить #{job_id}", callback_data=f"broadcast:job:cancel:{job_id}"),
+            ])
+        elif job["job_status"] == "paused":
+            buttons.append([
+                InlineKeyboardButton(text=f"▶️ Продолжить #{job_id}", callback_data=f"broadcast:job:resume:{job_id}"),
+                InlineKeyboardButton(text=f"✖️ Отменить #{job_id}", callback_data=f"broadcast:job:cancel:{job_id}"),
+            ])
+    
+    buttons.append([InlineKeyboardButton(text="🔄 Обновить", callback_data="broadcast:jobs")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin:broadcast")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
 def get_admin_export_keyboard():
     """Клавиатура выбора типа экспорта"""
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👥 Пользователи", callback_data="admin:export:users")],
         [InlineKeyboardButton(text="🔑 Активные подписки", callback_data="admin:export:subscriptions")],
+        [InlineKeyboardButton(text="💳 Платежи", callback_data="admin:export:payments")],
+        [InlineKeyboardButton(text="💰 Операции по балансу", callback_data="admin:export:balance_transactions")],
+        [InlineKeyboardButton(text="🤝 Реферальные начисления", callback_data="admin:export:referral_rewards")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="admin:main")],
     ])
     return keyboard
 
 
+def get_admin_export_period_keyboard(export_type: str):
+    """Клавиатура выбора периода экспорта (в днях, 0 - за всё время)"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="7 дней", callback_data=f"admin:export:{export_type}:7"),
+            InlineKeyboardButton(text="30 дней", callback_data=f"admin:export:{export_type}:30"),
+            InlineKeyboardButton(text="90 дней", callback_data=f"admin:export:{export_type}:90"),
+        ],
+        [InlineKeyboardButton(text="За всё время", callback_data=f"admin:export:{export_type}:0")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin:export")],
+    ])
+    return keyboard
+
+
 def get_admin_user_keyboard(has_active_subscription: bool = False, user_id: int = None, has_discount: bool = False, is_vip: bool = False):
     """Клавиатура для раздела пользователя"""
     buttons = []
@@ -1,3 +1,6 @@
+import time
+_IMPORTS_STARTED = time.perf_counter()
+
 import asyncio
 import logging
 import os
@@ -16,6 +19,19 @@ import auto_renewal
 import health_server
 import admin_notifications
 import trial_notifications
+import balance_reconciliation
+import referral_outbox_worker
+import admin_dashboard_snapshot
+import cohort_analytics
+import partition_maintenance
+import broadcast_worker
+import audit_writer
+import cryptobot_service
+import telegram_gateway
+import startup
+from payments import cryptobot
+
+startup.record_timing("imports", _IMPORTS_STARTED)
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,13 +41,31 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def connect_redis_storage():
+    """Проверить подключение к Redis и создать storage для FSM"""
+    logger.info("🔌 Connecting to Redis...")
+    # Проверяем подключение к Redis перед созданием storage
+    await redis_client.check_redis_connection()
+    storage = RedisStorage.from_url(config.REDIS_URL)
+    logger.info(f"✅ Redis Storage initialized at {config.REDIS_URL}")
+    return storage
+
+
+async def import_user_routers():
+    """Импортировать роутеры пользовательских сценариев (в потоке, параллельно с Redis и БД)"""
+    user_module = await startup.import_in_thread("handlers.user")
+    payments_module = await startup.import_in_thread("handlers.payments")
+    return user_module.router, payments_module.router
+
+
 async def main():
     """
     Main startup sequence:
     1. Validate environment variables (config.py)
-    2. Connect Redis (fail-fast if unavailable)
-    3. Connect Database
-    4. Run migrations (fail-fast if failed)
+    2. In parallel: connect Redis (fail-fast if unavailable), connect Database and
+       run migrations (fail-fast if failed), import user-facing routers
+    3. Register routers (admin router is loaded lazily after polling starts)
+    4. Start background workers (staggered)
     5. Start polling
     """
     # ====================================================================================
@@ -40,20 +74,31 @@ async def main():
     # Конфигурация уже проверена в config.py
     # Если переменные окружения не заданы, программа завершится с ошибкой
     logger.info("✅ Environment variables validated")
+    startup_started = time.perf_counter()
+    
+    bot = Bot(token=config.BOT_TOKEN)
+    # Все исходящие сообщения проходят через общий лимит и приоритет полос
+    bot.session.middleware(telegram_gateway.GatewayMiddleware())
+    
+    # Сбрасываем флаги уведомлений при старте (чтобы уведомления отправлялись при каждом старте)
+    admin_notifications.reset_notification_flags()
     
     # ====================================================================================
-    # STEP 2: Connect Redis (FAIL-FAST)
+    # STEP 2: Redis, Database + Migrations, user routers - PARALLEL
     # ====================================================================================
+    # Фазы не зависят друг от друга: сетевое ожидание Redis и миграций
+    # перекрывается импортом больших модулей handlers в отдельном потоке
+    logger.info("🔌 Connecting to Database...")
+    redis_result, db_result, routers_result = await asyncio.gather(
+        startup.timed_phase("redis", connect_redis_storage()),
+        startup.timed_phase("database", database.init_db()),
+        startup.timed_phase("routers", import_user_routers()),
+        return_exceptions=True,
+    )
+    
     # Redis is REQUIRED - no fallback to MemoryStorage in production
-    logger.info("🔌 Connecting to Redis...")
-    try:
-        # Проверяем подключение к Redis перед созданием storage
-        await redis_client.check_redis_connection()
-        
-        # Создаём Redis storage для FSM
-        storage = RedisStorage.from_url(config.REDIS_URL)
-        logger.info(f"✅ Redis Storage initialized at {config.REDIS_URL}")
-    except Exception as e:
+    if isinstance(redis_result, BaseException):
+        e = redis_result
         error_msg = (
             f"❌ CRITICAL: Cannot connect to Redis!\n"
             f"Error: {type(e).__name__}: {e}\n"
@@ -65,73 +110,21 @@ async def main():
         # В production режиме запрещаем запуск без Redis
         if config.IS_PRODUCTION:
             logger.error("Production mode: Redis is mandatory. Exiting.")
+            await database.close_pool()
+            await bot.session.close()
             sys.exit(1)
         else:
             # В dev режиме разрешаем MemoryStorage с предупреждением
             logger.warning("Dev mode: Falling back to MemoryStorage (NOT for production!)")
             from aiogram.fsm.storage.memory import MemoryStorage
             storage = MemoryStorage()
-    
-    # ====================================================================================
-    # STEP 3: Initialize Bot and Dispatcher
-    # ====================================================================================
-    bot = Bot(token=config.BOT_TOKEN)
-    dp = Dispatcher(storage=storage)
-    
-    # ====================================================================================
-    # STEP 3.5: Register Handlers (CRITICAL ORDER)
-    # ====================================================================================
-    # КРИТИЧНО: В aiogram 3.x порядок регистрации handlers определяет порядок их обработки
-    # Более специфичные handlers должны быть зарегистрированы ПЕРВЫМИ
-    # 
-    # ВАЖНО: Регистрируем handlers напрямую на Dispatcher в правильном порядке:
-    # 1. Сначала конкретные handlers из подроутеров (user, admin, payments)
-    # 2. Затем fallback handler (только для необработанных callback_query)
-    # 
-    # В aiogram 3.x handlers обрабатываются в порядке регистрации:
-    # - Первый зарегистрированный router проверяется первым
-    # - Если handler не матчится, проверяется следующий router
-    # - Fallback handler должен быть последним, чтобы ловить только необработанные
-    logger.info("📋 Registering handlers...")
-    
-    # Импортируем роутеры (handlers регистрируются в момент импорта через декораторы)
-    from handlers.user import router as user_router
-    from handlers.admin import router as admin_router
-    from handlers.payments import router as payments_router
-    from handlers import router as fallback_router
-    
-    # КРИТИЧНО: Порядок регистрации определяет порядок обработки
-    # Регистрируем в порядке от наиболее специфичных к наименее специфичным
-    
-    # 1. User handlers (lang_*, menu_main, menu_profile, etc.)
-    dp.include_router(user_router)
-    logger.info("✅ User router registered")
-    
-    # 2. Admin handlers (admin:*, admin_promo_stats, etc.)
-    dp.include_router(admin_router)
-    logger.info("✅ Admin router registered")
-    
-    # 3. Payment handlers (pay:*, topup_*, tariff:*, etc.)
-    dp.include_router(payments_router)
-    logger.info("✅ Payments router registered")
-    
-    # 4. Fallback handler (только для необработанных callback_query)
-    # ДОЛЖЕН быть зарегистрирован ПОСЛЕДНИМ
-    dp.include_router(fallback_router)
-    logger.info("✅ Fallback router registered (LAST)")
-    
-    logger.info("✅ All handlers registered successfully in correct order")
-    
-    # ====================================================================================
-    # STEP 4: Connect Database and Run Migrations (FAIL-FAST)
-    # ====================================================================================
-    
-    logger.info("🔌 Connecting to Database...")
-    # Сбрасываем флаги уведомлений при старте (чтобы уведомления отправлялись при каждом старте)
-    admin_notifications.reset_notification_flags()
+    else:
+        storage = redis_result
     
     try:
-        success = await database.init_db()
+        if isinstance(db_result, BaseException):
+            raise db_result
+        success = db_result
         if success:
             logger.info("✅ Database initialized successfully")
             database.DB_READY = True
@@ -187,10 +180,73 @@ async def main():
         # Завершаем процесс с ошибкой
         raise RuntimeError(f"Database initialization failed: {e}") from e
     
+    # Ошибка импорта роутеров - ошибка кода, запуск невозможен
+    if isinstance(routers_result, BaseException):
+        raise routers_result
+    user_router, payments_router = routers_result
+    
+    # ====================================================================================
+    # STEP 3: Initialize Dispatcher and Register Handlers (CRITICAL ORDER)
+    # ====================================================================================
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(telegram_gateway.reachability_middleware)
+    
+    # КРИТИЧНО: В aiogram 3.x порядок регистрации handlers определяет порядок их обработки
+    # Более специфичные handlers должны быть зарегистрированы ПЕРВЫМИ
+    # 
+    # ВАЖНО: Регистрируем handlers напрямую на Dispatcher в правильном порядке:
+    # 1. Сначала конкретные handlers из подроутеров (user, admin, payments)
+    # 2. Затем fallback handler (только для необработанных callback_query)
+    # 
+    # В aiogram 3.x handlers обрабатываются в порядке регистрации:
+    # - Первый зарегистрированный router проверяется первым
+    # - Если handler не матчится, проверяется следующий router
+    # - Fallback handler должен быть последним, чтобы ловить только необработанные
+    logger.info("📋 Registering handlers...")
+    
+    from handlers import router as fallback_router
+    
+    # Админский роутер нужен только администраторам: модуль handlers.admin импортируется
+    # в фоне после старта polling, на его месте в порядке обработки стоит заглушка
+    admin_router_loader = startup.LazyRouter("handlers.admin")
+    
+    # КРИТИЧНО: Порядок регистрации определяет порядок обработки
+    # Регистрируем в порядке от наиболее специфичных к наименее специфичным
+    
+    # 1. User handlers (lang_*, menu_main, menu_profile, etc.)
+    dp.include_router(user_router)
+    logger.info("✅ User router registered")
+    
+    # 2. Admin handlers (admin:*, admin_promo_stats, etc.) - ленивая загрузка
+    dp.include_router(admin_router_loader.router)
+    logger.info("✅ Admin router registered (lazy)")
+    
+    # 3. Payment handlers (pay:*, topup_*, tariff:*, etc.)
+    dp.include_router(payments_router)
+    logger.info("✅ Payments router registered")
+    
+    # 4. Fallback handler (только для необработанных callback_query)
+    # ДОЛЖЕН быть зарегистрирован ПОСЛЕДНИМ
+    dp.include_router(fallback_router)
+    logger.info("✅ Fallback router registered (LAST)")
+    
+    logger.info("✅ All handlers registered successfully in correct order")
+    
+    # ====================================================================================
+    # STEP 4: Background Tasks (staggered start)
+    # ====================================================================================
+    # Задачи создаются сразу, но стартуют с паузой WORKER_START_STAGGER_SECONDS друг от друга
+    worker_index = 0
+    
+    # Буфер событий аудита: запускается первым, воркеры пишут audit_log через него
+    if database.DB_READY:
+        audit_writer.start()
+    
     # Запуск фоновой задачи для напоминаний (только если БД готова)
     reminder_task = None
     if database.DB_READY:
-        reminder_task = asyncio.create_task(reminders.reminders_task(bot))
+        reminder_task = asyncio.create_task(startup.staggered(worker_index, reminders.reminders_task(bot)))
+        worker_index += 1
         logger.info("Reminders task started")
     else:
         logger.warning("Reminders task skipped (DB not ready)")
@@ -198,7 +254,8 @@ async def main():
     # Запуск фоновой задачи для trial-уведомлений (только если БД готова)
     trial_notifications_task = None
     if database.DB_READY:
-        trial_notifications_task = asyncio.create_task(trial_notifications.run_trial_scheduler(bot))
+        trial_notifications_task = asyncio.create_task(startup.staggered(worker_index, trial_notifications.run_trial_scheduler(bot)))
+        worker_index += 1
         logger.info("Trial notifications scheduler started")
     else:
         logger.warning("Trial notifications scheduler skipped (DB not ready)")
@@ -235,7 +292,8 @@ async def main():
     # Запуск фоновой задачи для быстрой очистки истёкших подписок (только если БД готова)
     fast_cleanup_task = None
     if database.DB_READY:
-        fast_cleanup_task = asyncio.create_task(fast_expiry_cleanup.fast_expiry_cleanup_task())
+        fast_cleanup_task = asyncio.create_task(startup.staggered(worker_index, fast_expiry_cleanup.fast_expiry_cleanup_task()))
+        worker_index += 1
         logger.info("Fast expiry cleanup task started")
     else:
         logger.warning("Fast expiry cleanup task skipped (DB not ready)")
@@ -243,17 +301,73 @@ async def main():
     # Запуск фоновой задачи для автопродления подписок (только если БД готова)
     auto_renewal_task = None
     if database.DB_READY:
-        auto_renewal_task = asyncio.create_task(auto_renewal.auto_renewal_task(bot))
+        auto_renewal_task = asyncio.create_task(startup.staggered(worker_index, auto_renewal.auto_renewal_task(bot)))
+        worker_index += 1
         logger.info("Auto-renewal task started")
     else:
         logger.warning("Auto-renewal task skipped (DB not ready)")
     
+    # Запуск воркера реферального outbox (начисление кешбэка и уведомления реферерам)
+    referral_outbox_task = None
+    if database.DB_READY:
+        referral_outbox_task = asyncio.create_task(startup.staggered(worker_index, referral_outbox_worker.referral_outbox_task(bot)))
+        worker_index += 1
+        logger.info("Referral outbox worker started")
+    else:
+        logger.warning("Referral outbox worker skipped (DB not ready)")
+    
+    # Запуск фоновой задачи сверки баланса с ledger (только если БД готова)
+    reconciliation_task = None
+    if database.DB_READY:
+        reconciliation_task = asyncio.create_task(startup.staggered(worker_index, balance_reconciliation.balance_reconciliation_task(bot)))
+        worker_index += 1
+        logger.info("Balance reconciliation task started")
+    else:
+        logger.warning("Balance reconciliation task skipped (DB not ready)")
+    
+    # Запуск фонового обновления снапшота админ-дашборда (только если БД готова)
+    dashboard_snapshot_task = None
+    if database.DB_READY:
+        dashboard_snapshot_task = asyncio.create_task(startup.staggered(worker_index, admin_dashboard_snapshot.dashboard_snapshot_task(bot)))
+        worker_index += 1
+        logger.info("Dashboard snapshot task started")
+    else:
+        logger.warning("Dashboard snapshot task skipped (DB not ready)")
+    
+    # Запуск инкрементального расчёта когорт удержания (только если БД готова)
+    cohort_task = None
+    if database.DB_READY:
+        cohort_task = asyncio.create_task(startup.staggered(worker_index, cohort_analytics.cohort_analytics_task(bot)))
+        worker_index += 1
+        logger.info("Cohort analytics task started")
+    else:
+        logger.warning("Cohort analytics task skipped (DB not ready)")
+    
+    # Запуск обслуживания помесячных секций журналов (только если БД готова)
+    partition_task = None
+    if database.DB_READY:
+        partition_task = asyncio.create_task(startup.staggered(worker_index, partition_maintenance.partition_maintenance_task(bot)))
+        worker_index += 1
+        logger.info("Partition maintenance task started")
+    else:
+        logger.warning("Partition maintenance task skipped (DB not ready)")
+    
+    # Запуск воркера заданий рассылки (только если БД готова)
+    broadcast_task = None
+    if database.DB_READY:
+        broadcast_task = asyncio.create_task(startup.staggered(worker_index, broadcast_worker.broadcast_worker_task(bot)))
+        worker_index += 1
+        logger.info("Broadcast worker started")
+    else:
+        logger.warning("Broadcast worker skipped (DB not ready)")
+    
     # Запуск фоновой задачи для автоматической проверки CryptoBot платежей (только если БД готова)
     crypto_watcher_task = None
     if database.DB_READY:
         try:
             import crypto_payment_watcher
-            crypto_watcher_task = asyncio.create_task(crypto_payment_watcher.crypto_payment_watcher_task(bot))
+            crypto_watcher_task = asyncio.create_task(startup.staggered(worker_index, crypto_payment_watcher.crypto_payment_watcher_task(bot)))
+            worker_index += 1
             logger.info("Crypto payment watcher task started")
         except Exception as e:
             logger.warning(f"Crypto payment watcher task skipped: {e}")
@@ -280,9 +394,14 @@ async def main():
         # Завершаем процесс с ошибкой
         raise RuntimeError(f"Database migrations not applied: {database.DB_INIT_STATUS.value}")
     
+    startup.record_timing("total", startup_started)
+    logger.info(f"⏱ Startup timings (ms): {startup.STARTUP_TIMINGS}, database init: {database.DB_INIT_TIMINGS}")
     logger.info("✅ Bot starting in full functionality mode")
     logger.info("🚀 Starting bot polling...")
     
+    # Импорт админского роутера идёт в фоне, параллельно со стартом polling
+    admin_router_loader.start_loading()
+    
     try:
         await dp.start_polling(bot)
     finally:
@@ -306,6 +425,18 @@ async def main():
             fast_cleanup_task.cancel()
         if crypto_watcher_task:
             crypto_watcher_task.cancel()
+        if reconciliation_task:
+            reconciliation_task.cancel()
+        if referral_outbox_task:
+            referral_outbox_task.cancel()
+        if dashboard_snapshot_task:
+            dashboard_snapshot_task.cancel()
+        if cohort_task:
+            cohort_task.cancel()
+        if partition_task:
+            partition_task.cancel()
+        if broadcast_task:
+            broadcast_task.cancel()
         
         # Ожидаем завершения всех задач
         tasks_to_wait = [
@@ -317,6 +448,12 @@ async def main():
             cleanup_task,
             fast_cleanup_task,
             crypto_watcher_task,
+            reconciliation_task,
+            referral_outbox_task,
+            dashboard_snapshot_task,
+            cohort_task,
+            partition_task,
+            broadcast_task,
         ]
         
         for task in tasks_to_wait:
@@ -326,6 +463,21 @@ async def main():
                 except asyncio.CancelledError:
                     pass
         
+        # Дообрабатываем принятые webhook CryptoBot до закрытия пула БД
+        try:
+            await cryptobot_service.stop_workers()
+        except Exception as e:
+            logger.error(f"Error stopping Crypto Bot webhook workers: {e}")
+        
+        await telegram_gateway.gateway.close()
+        await cryptobot.close()
+        
+        # Дописываем буфер аудита до закрытия пула
+        try:
+            await audit_writer.stop()
+        except Exception as e:
+            logger.error(f"Error flushing audit writer: {e}")
+        
         # Закрываем пул соединений к БД
         try:
             await database.close_pool()
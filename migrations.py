@@ -3,12 +3,18 @@ Database Migration System
 
 Manages versioned database schema migrations.
 Each migration is applied in a transaction and recorded in schema_migrations table.
+
+Migrations whose first line is "-- migrate:no-transaction" run outside a transaction
+(required for CREATE INDEX CONCURRENTLY). Every statement in such a migration must be
+idempotent on its own: a failure leaves the previous statements applied.
 """
 import os
 import re
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Set, Optional
+from typing import AsyncIterator, List, Set, Optional
 import asyncpg
 
 logger = logging.getLogger(__name__)
@@ -16,6 +22,59 @@ logger = logging.getLogger(__name__)
 # Путь к папке с миграциями
 MIGRATIONS_DIR = Path(__file__).parent / "migrations"
 
+# Ключ advisory lock: миграции и легаси-DDL выполняет только одна реплика за раз
+MIGRATIONS_LOCK_KEY = 7240318017
+# Сколько ждать блокировку, пока миграции применяет другая реплика
+MIGRATIONS_LOCK_TIMEOUT_SECONDS = int(os.getenv("MIGRATIONS_LOCK_TIMEOUT_SECONDS", "600"))
+MIGRATIONS_LOCK_POLL_SECONDS = 1.0
+# Таймаут одной команды миграции: command_timeout пула (30 с) рассчитан на запросы
+# бота, а не на DDL и переносы данных по большим таблицам
+MIGRATION_STATEMENT_TIMEOUT_SECONDS = float(os.getenv("MIGRATION_STATEMENT_TIMEOUT_SECONDS", "3600"))
+
+# Маркер первой строки миграции, которую нельзя выполнять в транзакции
+NO_TRANSACTION_MARKER = "-- migrate:no-transaction"
+
+CONCURRENT_INDEX_PATTERN = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)',
+    re.IGNORECASE
+)
+
+
+@asynccontextmanager
+async def migration_lock(conn: asyncpg.Connection) -> AsyncIterator[None]:
+    """
+    Сессионный advisory lock на время миграций
+    
+    Блокировка берётся опросом pg_try_advisory_lock, а не блокирующим pg_advisory_lock:
+    ожидание не упирается в command_timeout пула и ограничено MIGRATIONS_LOCK_TIMEOUT_SECONDS.
+    
+    Args:
+        conn: Соединение с БД (блокировка живёт в его сессии)
+        
+    Raises:
+        TimeoutError: Если блокировка не получена за MIGRATIONS_LOCK_TIMEOUT_SECONDS
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MIGRATIONS_LOCK_TIMEOUT_SECONDS
+    waited = False
+    
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATIONS_LOCK_KEY):
+        if loop.time() >= deadline:
+            raise TimeoutError(
+                f"Migration lock not acquired within {MIGRATIONS_LOCK_TIMEOUT_SECONDS}s"
+            )
+        if not waited:
+            logger.info("Migration lock is held by another instance, waiting...")
+            waited = True
+        await asyncio.sleep(MIGRATIONS_LOCK_POLL_SECONDS)
+    
+    if waited:
+        logger.info("Migration lock acquired")
+    try:
+        yield
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
+
 
 async def ensure_migrations_table(conn: asyncpg.Connection):
     """
@@ -74,12 +133,58 @@ def get_migration_files() -> List[tuple[str, Path]]:
     return migrations
 
 
+def is_no_transaction_migration(migration_path: Path) -> bool:
+    """
+    Проверить, помечена ли миграция маркером no-transaction
+    
+    Args:
+        migration_path: Путь к SQL файлу миграции
+        
+    Returns:
+        True если первая строка файла - NO_TRANSACTION_MARKER
+    """
+    with migration_path.open(encoding='utf-8') as f:
+        first_line = f.readline().strip()
+    return first_line.lower() == NO_TRANSACTION_MARKER
+
+
+async def drop_invalid_concurrent_indexes(conn: asyncpg.Connection, migration_path: Path) -> None:
+    """
+    Удалить недостроенные (INVALID) индексы миграции перед повторным запуском
+    
+    Прерванный CREATE INDEX CONCURRENTLY оставляет индекс в состоянии INVALID,
+    и повторный CREATE INDEX ... IF NOT EXISTS его пропускает. Такие индексы
+    удаляются, чтобы миграция построила их заново.
+    
+    Args:
+        conn: Соединение с БД (вне транзакции)
+        migration_path: Путь к SQL файлу миграции
+    """
+    index_names = CONCURRENT_INDEX_PATTERN.findall(migration_path.read_text(encoding='utf-8'))
+    if not index_names:
+        return
+    
+    rows = await conn.fetch(
+        """SELECT c.relname
+           FROM pg_index i
+           JOIN pg_class c ON c.oid = i.indexrelid
+           WHERE c.relname = ANY($1::text[]) AND NOT i.indisvalid""",
+        index_names
+    )
+    for row in rows:
+        logger.warning(f"Dropping invalid index left by interrupted migration: {row['relname']}")
+        await conn.execute(
+            f'DROP INDEX CONCURRENTLY IF EXISTS "{row["relname"]}"',
+            timeout=MIGRATION_STATEMENT_TIMEOUT_SECONDS
+        )
+
+
 async def apply_migration(conn: asyncpg.Connection, version: str, migration_path: Path) -> bool:
     """
-    Применить одну миграцию в транзакции
+    Применить одну миграцию
     
     Args:
-        conn: Соединение с БД (уже в транзакции)
+        conn: Соединение с БД (уже в транзакции, кроме миграций no-transaction)
         version: Версия миграции (например, "001")
         migration_path: Путь к SQL файлу миграции
         
@@ -114,8 +219,19 @@ async def apply_migration(conn: asyncpg.Connection, version: str, migration_path
         
         while i < len(sql_content):
             char = sql_content[i]
+
+            # Однострочный комментарий (-- ...) вне строк пропускаем до конца строки,
+            # иначе команда после комментария отбрасывается целиком (startswith('--'))
+            if (char == '-' and not in_single_quote and not in_double_quote and not in_dollar_quote
+                    and sql_content.startswith('--', i)):
+                newline_pos = sql_content.find('\n', i)
+                if newline_pos == -1:
+                    break
+                i = newline_pos
+                continue
+
             current_command.append(char)
-            
+
             if not in_single_quote and not in_double_quote and not in_dollar_quote:
                 # Проверяем начало dollar-quoted строки ($tag$ или $$)
                 if char == '$':
@@ -205,7 +321,7 @@ async def apply_migration(conn: asyncpg.Connection, version: str, migration_path
                 if cmd.endswith(';'):
                     cmd = cmd[:-1].strip()
                 if cmd:
-                    await conn.execute(cmd)
+                    await conn.execute(cmd, timeout=MIGRATION_STATEMENT_TIMEOUT_SECONDS)
         
         # Записываем версию в schema_migrations
         await conn.execute(
@@ -258,8 +374,14 @@ async def run_migrations(conn: asyncpg.Connection) -> bool:
             # Каждая миграция выполняется в отдельной транзакции
             # Если миграция падает, она откатывается, но уже применённые остаются
             try:
-                async with conn.transaction():
+                if is_no_transaction_migration(migration_path):
+                    # CREATE INDEX CONCURRENTLY не выполняется внутри транзакции
+                    logger.info(f"Migration {version} runs outside a transaction")
+                    await drop_invalid_concurrent_indexes(conn, migration_path)
                     await apply_migration(conn, version, migration_path)
+                else:
+                    async with conn.transaction():
+                        await apply_migration(conn, version, migration_path)
             except Exception as e:
                 logger.exception(f"Failed to apply migration {version}: {e}")
                 raise  # Пробрасываем исключение, чтобы остановить процесс миграций
@@ -276,6 +398,9 @@ async def run_migrations_safe(pool: asyncpg.Pool) -> bool:
     """
     Безопасное применение миграций с использованием пула соединений
     
+    Миграции выполняются под advisory lock (migration_lock): реплики, стартующие
+    одновременно, применяют их по очереди, а не конкурируют за блокировки DDL.
+    
     Args:
         pool: Пул соединений с БД
         
@@ -283,5 +408,6 @@ async def run_migrations_safe(pool: asyncpg.Pool) -> bool:
         True если все миграции применены успешно, False если ошибка
     """
     async with pool.acquire() as conn:
-        return await run_migrations(conn)
+        async with migration_lock(conn):
+            return await run_migrations(conn)
 
@@ -0,0 +1,53 @@
+-- Migration 010: Normalize promo code storage
+-- Коды промокодов хранятся в верхнем регистре, поиск выполняется точным сравнением
+-- по первичному ключу вместо WHERE UPPER(code) = UPPER($1) (который не использует индекс)
+
+-- Коды, совпадающие без учёта регистра ("abc", "Abc", "ABC"), сливаются в один.
+-- Остаётся вариант в верхнем регистре, иначе активный, иначе самый новый;
+-- на него переносятся суммарный счётчик использований и активность группы.
+UPDATE promo_codes p
+SET used_count = m.used_count,
+    is_active = m.is_active
+FROM (
+    SELECT UPPER(code) AS norm,
+           SUM(COALESCE(used_count, 0)) AS used_count,
+           BOOL_OR(COALESCE(is_active, FALSE)) AS is_active
+    FROM promo_codes
+    GROUP BY UPPER(code)
+    HAVING COUNT(*) > 1
+) m
+WHERE UPPER(p.code) = m.norm
+  AND p.code = (
+      SELECT d.code FROM promo_codes d
+      WHERE UPPER(d.code) = m.norm
+      ORDER BY (d.code = UPPER(d.code)) DESC, d.is_active DESC NULLS LAST, d.created_at DESC NULLS LAST, d.code
+      LIMIT 1
+  );
+
+-- Остальные варианты группы удаляются (порядок выбора тот же; активность оставшегося
+-- варианта после слияния только растёт, поэтому он остаётся первым)
+DELETE FROM promo_codes p
+WHERE EXISTS (
+    SELECT 1 FROM promo_codes o
+    WHERE UPPER(o.code) = UPPER(p.code) AND o.code <> p.code
+)
+AND p.code <> (
+    SELECT d.code FROM promo_codes d
+    WHERE UPPER(d.code) = UPPER(p.code)
+    ORDER BY (d.code = UPPER(d.code)) DESC, d.is_active DESC NULLS LAST, d.created_at DESC NULLS LAST, d.code
+    LIMIT 1
+);
+
+-- Дубликатов не осталось: приводим коды к верхнему регистру
+UPDATE promo_codes
+SET code = UPPER(code)
+WHERE code <> UPPER(code);
+
+-- Журнал использований ссылается на код текстом: приводим к тому же виду,
+-- использования слитых вариантов относятся к оставшемуся коду
+UPDATE promo_usage_logs
+SET promo_code = UPPER(promo_code)
+WHERE promo_code <> UPPER(promo_code);
+
+-- Гарантируем регистронезависимую уникальность кодов
+CREATE UNIQUE INDEX IF NOT EXISTS idx_promo_codes_code_upper ON promo_codes (UPPER(code));
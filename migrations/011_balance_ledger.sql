@@ -0,0 +1,49 @@
+-- Migration 011: Append-only balance ledger
+-- balance_transactions становится неизменяемым журналом проводок (ledger),
+-- users.balance - кэшированный снапшот текущего баланса (сумма проводок)
+
+-- Ключ идемпотентности: повторное применение той же операции не создаёт вторую проводку
+ALTER TABLE balance_transactions ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+
+-- Баланс пользователя после применения проводки (в копейках)
+ALTER TABLE balance_transactions ADD COLUMN IF NOT EXISTS balance_after BIGINT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_balance_transactions_idempotency_key
+    ON balance_transactions (idempotency_key)
+    WHERE idempotency_key IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_balance_transactions_user_id ON balance_transactions (user_id);
+
+-- Запрет UPDATE/DELETE проводок: исправления оформляются компенсирующей проводкой
+CREATE OR REPLACE FUNCTION balance_transactions_append_only()
+RETURNS TRIGGER AS $$
+BEGIN
+    RAISE EXCEPTION 'balance_transactions is append-only (% is not allowed)', TG_OP;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_balance_transactions_append_only ON balance_transactions;
+
+CREATE TRIGGER trg_balance_transactions_append_only
+    BEFORE UPDATE OR DELETE ON balance_transactions
+    FOR EACH ROW EXECUTE FUNCTION balance_transactions_append_only();
+
+-- Начальная проводка: баланс, накопленный до появления ledger, оформляется одной
+-- проводкой type=opening на разницу между снапшотом и суммой существующих проводок,
+-- чтобы сверка снапшота с ledger не отмечала всех старых пользователей.
+-- Повторный запуск ничего не вставляет: после первой вставки разница равна нулю
+INSERT INTO balance_transactions (user_id, amount, type, source, description, idempotency_key, balance_after)
+SELECT u.telegram_id,
+       u.balance - COALESCE(l.ledger_sum, 0),
+       'opening',
+       'migration',
+       'Начальный баланс до перехода на ledger',
+       'opening:' || u.telegram_id || ':' || (u.balance - COALESCE(l.ledger_sum, 0)),
+       u.balance
+FROM users u
+LEFT JOIN (
+    SELECT user_id, SUM(amount) AS ledger_sum
+    FROM balance_transactions
+    GROUP BY user_id
+) l ON l.user_id = u.telegram_id
+WHERE u.balance <> COALESCE(l.ledger_sum, 0);
@@ -0,0 +1,26 @@
+-- Migration 012: Transactional outbox for referral cashback
+-- Финализация платежа пишет одну строку в outbox в своей транзакции,
+-- начисление кешбэка и уведомление реферера выполняет фоновый воркер пакетами
+
+CREATE TABLE IF NOT EXISTS referral_reward_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event_key TEXT NOT NULL,
+    buyer_id BIGINT NOT NULL,
+    purchase_id TEXT,
+    amount_kopecks BIGINT NOT NULL,
+    action_type TEXT NOT NULL DEFAULT 'покупку',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    processed_at TIMESTAMP
+);
+
+-- Одно событие оплаты - одна строка outbox (повторная финализация не создаёт дубликат)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_reward_outbox_event_key ON referral_reward_outbox (event_key);
+
+-- Выборка очереди воркером
+CREATE INDEX IF NOT EXISTS idx_referral_reward_outbox_pending
+    ON referral_reward_outbox (available_at, id)
+    WHERE status = 'pending';
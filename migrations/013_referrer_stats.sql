@@ -0,0 +1,82 @@
+-- Migration 013: Denormalized per-referrer counters
+-- Счётчики реферальной программы поддерживаются инкрементально
+-- (register_referral, process_referral_reward), экран «Пригласить друга»
+-- читает одну строку по первичному ключу вместо COUNT/SUM по истории.
+-- Та же таблица - источник админ-лидерборда (индексы сортировки в миграции 014)
+
+CREATE TABLE IF NOT EXISTS referrer_stats (
+    referrer_id BIGINT PRIMARY KEY,
+    invited_count INTEGER NOT NULL DEFAULT 0,
+    paid_count INTEGER NOT NULL DEFAULT 0,
+    total_cashback_kopecks BIGINT NOT NULL DEFAULT 0,
+    total_revenue_kopecks BIGINT NOT NULL DEFAULT 0,
+    first_referral_date TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Пересчёт счётчиков из истории: первичное заполнение, а также repair из
+-- database.rebuild_referrer_stats (p_referrer_id = NULL - все рефереры).
+-- Источники: referrals (приглашённые и дата первого приглашения), referral_rewards
+-- (оплатившие и доход от их оплат), balance_transactions с type=cashback (кешбэк).
+-- Возвращает количество пересчитанных рефереров
+CREATE OR REPLACE FUNCTION rebuild_referrer_stats(p_referrer_id BIGINT DEFAULT NULL)
+RETURNS INTEGER AS $$
+DECLARE
+    v_count INTEGER;
+BEGIN
+    WITH invited AS (
+        SELECT referrer_user_id AS referrer_id, COUNT(*) AS cnt, MIN(created_at) AS first_referral_date
+        FROM referrals
+        WHERE p_referrer_id IS NULL OR referrer_user_id = p_referrer_id
+        GROUP BY referrer_user_id
+    ),
+    paid AS (
+        SELECT referrer_id, COUNT(DISTINCT buyer_id) AS cnt, SUM(purchase_amount) AS revenue
+        FROM referral_rewards
+        WHERE p_referrer_id IS NULL OR referrer_id = p_referrer_id
+        GROUP BY referrer_id
+    ),
+    cashback AS (
+        SELECT user_id AS referrer_id, SUM(amount) AS total
+        FROM balance_transactions
+        WHERE type = 'cashback' AND (p_referrer_id IS NULL OR user_id = p_referrer_id)
+        GROUP BY user_id
+    ),
+    ids AS (
+        SELECT referrer_id FROM invited
+        UNION
+        SELECT referrer_id FROM paid
+        UNION
+        SELECT referrer_id FROM cashback
+        UNION
+        SELECT referrer_id FROM referrer_stats WHERE p_referrer_id IS NULL OR referrer_id = p_referrer_id
+    )
+    INSERT INTO referrer_stats (
+        referrer_id, invited_count, paid_count, total_cashback_kopecks,
+        total_revenue_kopecks, first_referral_date, updated_at
+    )
+    SELECT ids.referrer_id,
+           COALESCE(invited.cnt, 0),
+           COALESCE(paid.cnt, 0),
+           COALESCE(cashback.total, 0)::BIGINT,
+           COALESCE(paid.revenue, 0)::BIGINT,
+           invited.first_referral_date,
+           NOW()
+    FROM ids
+    LEFT JOIN invited ON invited.referrer_id = ids.referrer_id
+    LEFT JOIN paid ON paid.referrer_id = ids.referrer_id
+    LEFT JOIN cashback ON cashback.referrer_id = ids.referrer_id
+    ON CONFLICT (referrer_id) DO UPDATE SET
+        invited_count = EXCLUDED.invited_count,
+        paid_count = EXCLUDED.paid_count,
+        total_cashback_kopecks = EXCLUDED.total_cashback_kopecks,
+        total_revenue_kopecks = EXCLUDED.total_revenue_kopecks,
+        first_referral_date = EXCLUDED.first_referral_date,
+        updated_at = NOW();
+
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_referrer_stats();
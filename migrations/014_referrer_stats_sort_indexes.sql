@@ -0,0 +1,13 @@
+-- Migration 014: Sort indexes for the admin referral stats page on referrer_stats
+-- Админ-статистика рефереров читает страницу referrer_stats по индексу ключа сортировки
+-- (keyset) вместо GROUP BY по истории. Счётчики поддерживаются инкрементально (миграция 013)
+
+-- Индекс на каждый ключ сортировки (referrer_id - tie-breaker для keyset пагинации)
+CREATE INDEX IF NOT EXISTS idx_referrer_stats_revenue
+    ON referrer_stats (total_revenue_kopecks, referrer_id);
+
+CREATE INDEX IF NOT EXISTS idx_referrer_stats_invited
+    ON referrer_stats (invited_count, referrer_id);
+
+CREATE INDEX IF NOT EXISTS idx_referrer_stats_cashback
+    ON referrer_stats (total_cashback_kopecks, referrer_id);
@@ -0,0 +1,194 @@
+-- Migration 015: Daily business metrics rollup
+-- Доход, число оплат, новые пользователи, новые подписки и новые платящие
+-- пользователи агрегируются по дням триггерами на payments, users и subscriptions.
+-- Финансовая аналитика читает несколько строк daily_metrics вместо SUM/COUNT(DISTINCT) по истории.
+-- День разбит на слоты (day, slot): конкурентные оплаты и регистрации обновляют разные строки,
+-- а не ждут блокировку одной строки текущего дня. Читатели суммируют слоты по дню
+
+CREATE TABLE IF NOT EXISTS daily_metrics (
+    day DATE NOT NULL,
+    slot SMALLINT NOT NULL DEFAULT 0,
+    revenue_kopecks BIGINT NOT NULL DEFAULT 0,
+    payments_count INTEGER NOT NULL DEFAULT 0,
+    new_users INTEGER NOT NULL DEFAULT 0,
+    new_subscriptions INTEGER NOT NULL DEFAULT 0,
+    new_paying_users INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (day, slot)
+);
+
+CREATE OR REPLACE FUNCTION daily_metrics_add(
+    p_day DATE,
+    p_revenue_kopecks BIGINT,
+    p_payments_count INTEGER,
+    p_new_users INTEGER,
+    p_new_subscriptions INTEGER,
+    p_new_paying_users INTEGER
+)
+RETURNS VOID AS $$
+BEGIN
+    -- Слот определяется серверным процессом соединения: одна транзакция всегда пишет в одну
+    -- строку дня, разные соединения - в разные (16 слотов на день)
+    INSERT INTO daily_metrics (
+        day, slot, revenue_kopecks, payments_count, new_users, new_subscriptions, new_paying_users, updated_at
+    )
+    VALUES (
+        p_day, (pg_backend_pid() % 16)::SMALLINT,
+        p_revenue_kopecks, p_payments_count, p_new_users, p_new_subscriptions, p_new_paying_users, NOW()
+    )
+    ON CONFLICT (day, slot) DO UPDATE SET
+        revenue_kopecks = daily_metrics.revenue_kopecks + EXCLUDED.revenue_kopecks,
+        payments_count = daily_metrics.payments_count + EXCLUDED.payments_count,
+        new_users = daily_metrics.new_users + EXCLUDED.new_users,
+        new_subscriptions = daily_metrics.new_subscriptions + EXCLUDED.new_subscriptions,
+        new_paying_users = daily_metrics.new_paying_users + EXCLUDED.new_paying_users,
+        updated_at = NOW();
+END;
+$$ LANGUAGE plpgsql;
+
+-- Оплата перешла в approved (или вышла из него). День - дата создания платежа, как в прежних отчётах.
+-- Проверка "первая оплата пользователя" выполняется под транзакционной advisory-блокировкой
+-- пользователя: две конкурентные первые оплаты иначе не видят друг друга и обе считают
+-- пользователя новым платящим
+CREATE OR REPLACE FUNCTION daily_metrics_on_payment()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_sign INTEGER;
+    v_has_other_approved BOOLEAN;
+BEGIN
+    IF NEW.status = 'approved' AND (TG_OP = 'INSERT' OR OLD.status IS DISTINCT FROM 'approved') THEN
+        v_sign := 1;
+    ELSIF TG_OP = 'UPDATE' AND OLD.status = 'approved' AND NEW.status IS DISTINCT FROM 'approved' THEN
+        v_sign := -1;
+    ELSE
+        RETURN NULL;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(hashtextextended('daily_metrics_payer:' || NEW.telegram_id, 0));
+
+    SELECT EXISTS(
+        SELECT 1 FROM payments
+        WHERE telegram_id = NEW.telegram_id AND status = 'approved' AND id <> NEW.id
+    ) INTO v_has_other_approved;
+
+    PERFORM daily_metrics_add(
+        COALESCE(NEW.created_at, NOW())::DATE,
+        v_sign * COALESCE(NEW.amount, 0)::BIGINT,
+        v_sign,
+        0,
+        0,
+        CASE WHEN v_has_other_approved THEN 0 ELSE v_sign END
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_daily_metrics_on_payment ON payments;
+
+CREATE TRIGGER trg_daily_metrics_on_payment
+    AFTER INSERT OR UPDATE OF status ON payments
+    FOR EACH ROW EXECUTE FUNCTION daily_metrics_on_payment();
+
+CREATE OR REPLACE FUNCTION daily_metrics_on_user()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM daily_metrics_add(COALESCE(NEW.created_at, NOW())::DATE, 0, 0, 1, 0, 0);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_daily_metrics_on_user ON users;
+
+CREATE TRIGGER trg_daily_metrics_on_user
+    AFTER INSERT ON users
+    FOR EACH ROW EXECUTE FUNCTION daily_metrics_on_user();
+
+-- Строка subscriptions создаётся один раз на пользователя (UNIQUE telegram_id), продления - UPDATE
+CREATE OR REPLACE FUNCTION daily_metrics_on_subscription()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM daily_metrics_add(CURRENT_DATE, 0, 0, 0, 1, 0);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_daily_metrics_on_subscription ON subscriptions;
+
+CREATE TRIGGER trg_daily_metrics_on_subscription
+    AFTER INSERT ON subscriptions
+    FOR EACH ROW EXECUTE FUNCTION daily_metrics_on_subscription();
+
+-- Пересчёт daily_metrics из истории (первичное заполнение, а также repair из database.rebuild_daily_metrics).
+-- В subscriptions нет created_at: день создания подписки - первая запись subscription_history.
+-- EXCLUSIVE-блокировка таблицы на время пересчёта: триггеры конкурентных транзакций
+-- допишут свои события после него, а не в удаляемые строки.
+-- Возвращает количество пересчитанных дней
+CREATE OR REPLACE FUNCTION rebuild_daily_metrics()
+RETURNS INTEGER AS $$
+DECLARE
+    v_days INTEGER;
+BEGIN
+    LOCK TABLE daily_metrics IN EXCLUSIVE MODE;
+    DELETE FROM daily_metrics;
+
+    WITH pay AS (
+        SELECT created_at::DATE AS day, SUM(amount) AS revenue, COUNT(*) AS cnt
+        FROM payments
+        WHERE status = 'approved' AND created_at IS NOT NULL
+        GROUP BY 1
+    ),
+    first_pay AS (
+        SELECT day, COUNT(*) AS cnt
+        FROM (
+            SELECT telegram_id, MIN(created_at)::DATE AS day
+            FROM payments
+            WHERE status = 'approved' AND created_at IS NOT NULL
+            GROUP BY telegram_id
+        ) payers
+        GROUP BY day
+    ),
+    usr AS (
+        SELECT created_at::DATE AS day, COUNT(*) AS cnt
+        FROM users
+        WHERE created_at IS NOT NULL
+        GROUP BY 1
+    ),
+    subs AS (
+        SELECT day, COUNT(*) AS cnt
+        FROM (
+            SELECT s.telegram_id, MIN(h.created_at)::DATE AS day
+            FROM subscriptions s
+            JOIN subscription_history h ON h.telegram_id = s.telegram_id
+            GROUP BY s.telegram_id
+        ) first_subs
+        WHERE day IS NOT NULL
+        GROUP BY day
+    ),
+    days AS (
+        SELECT day FROM pay
+        UNION SELECT day FROM usr
+        UNION SELECT day FROM subs
+    )
+    INSERT INTO daily_metrics (
+        day, slot, revenue_kopecks, payments_count, new_users, new_subscriptions, new_paying_users, updated_at
+    )
+    SELECT days.day,
+           0,
+           COALESCE(pay.revenue, 0)::BIGINT,
+           COALESCE(pay.cnt, 0),
+           COALESCE(usr.cnt, 0),
+           COALESCE(subs.cnt, 0),
+           COALESCE(first_pay.cnt, 0),
+           NOW()
+    FROM days
+    LEFT JOIN pay ON pay.day = days.day
+    LEFT JOIN first_pay ON first_pay.day = days.day
+    LEFT JOIN usr ON usr.day = days.day
+    LEFT JOIN subs ON subs.day = days.day;
+
+    GET DIAGNOSTICS v_days = ROW_COUNT;
+    RETURN v_days;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_daily_metrics();
@@ -0,0 +1,39 @@
+-- Migration 016: Subscription cohort and churn analytics
+-- Пользователи группируются по неделе первой оплаченной подписки (когорта),
+-- cohort_activity хранит число пользователей когорты с оплаченной подпиской
+-- (период start_date..end_date события) по неделям от старта.
+-- Заполняется инкрементально из subscription_history по водяному знаку (id последнего события)
+
+CREATE TABLE IF NOT EXISTS user_cohorts (
+    telegram_id BIGINT PRIMARY KEY,
+    cohort_week DATE NOT NULL,
+    first_purchase_at TIMESTAMP NOT NULL,
+    -- Последняя неделя (от старта когорты), в которую пользователь уже учтён как активный
+    last_active_period INTEGER NOT NULL DEFAULT -1
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_cohorts_cohort_week ON user_cohorts (cohort_week);
+
+CREATE TABLE IF NOT EXISTS cohort_activity (
+    cohort_week DATE NOT NULL,
+    period INTEGER NOT NULL,
+    active_users INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (cohort_week, period)
+);
+
+-- Водяные знаки инкрементальных аналитических обработчиков.
+-- Пропуск в id может оказаться незакоммиченной вставкой: водяной знак не переходит его,
+-- пока не завершатся все транзакции, начатые до того, как пропуск был замечен.
+-- gap_check_id - наибольший id на момент проверки, gap_check_xid - xmax снимка в тот момент:
+-- когда xmin текущего снимка достигает gap_check_xid, пропуски до gap_check_id окончательны
+CREATE TABLE IF NOT EXISTS analytics_watermarks (
+    name TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    gap_check_id BIGINT,
+    gap_check_xid BIGINT,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO analytics_watermarks (name, last_id)
+VALUES ('subscription_cohorts', 0)
+ON CONFLICT (name) DO NOTHING;
@@ -0,0 +1,29 @@
+-- migrate:no-transaction
+-- Migration 017: Indexes for hot background and admin queries
+-- Индексы строятся CREATE INDEX CONCURRENTLY, без блокировки записи в таблицы,
+-- поэтому миграция выполняется вне транзакции (маркер no-transaction в первой строке).
+-- Недостроенный (INVALID) индекс после сбоя удаляется раннером перед повторным запуском
+-- Команды выполняются с MIGRATION_STATEMENT_TIMEOUT_SECONDS, а не с таймаутом пула (30 с):
+-- построение индекса на большой таблице не обрывается на старте
+
+-- Очистка истёкших, напоминания и автопродление: активные подписки с ключом по сроку
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_subscriptions_status_expires_at
+    ON subscriptions (status, expires_at)
+    WHERE uuid IS NOT NULL;
+
+-- Оплаты пользователя по статусу: ожидающая оплата, подтверждённые оплаты
+-- (WHERE telegram_id = $1 AND status = ...)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payments_telegram_id_status
+    ON payments (telegram_id, status);
+
+-- Последнее действие пользователя в истории (коррелированный подзапрос напоминаний)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_subscription_history_telegram_id_created_at
+    ON subscription_history (telegram_id, created_at DESC);
+
+-- Счётчики доставки рассылки
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_broadcast_log_broadcast_id_status
+    ON broadcast_log (broadcast_id, status);
+
+-- Аудит и бизнес-метрики за период
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_audit_log_created_at
+    ON audit_log (created_at);
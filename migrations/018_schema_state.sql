@@ -0,0 +1,9 @@
+-- Migration 018: Schema state for the startup fast path
+-- init_db записывает сюда отпечаток легаси-DDL и пропускает его на следующих стартах,
+-- пока отпечаток (исходный код DDL и список миграций) не изменится
+
+CREATE TABLE IF NOT EXISTS schema_state (
+    name TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,348 @@
+-- Migration 019: Monthly range partitioning for audit_log, broadcast_log and balance_transactions
+-- Журналы растут без ограничений; помесячные секции позволяют запросам за период
+-- читать только нужные месяцы, а старые секции архивировать и удалять целиком
+-- (partition_maintenance.py) без DELETE по большой таблице.
+--
+-- Сама миграция таблицы не переписывает: копирование всех строк при старте бота
+-- упирается в таймауты и держит журналы под ACCESS EXCLUSIVE. Здесь создаются только
+-- функции перевода и таблица их состояния; перевод выполняет отдельный шаг
+-- convert_log_partitions.py (в окно низкой нагрузки, можно прерывать и перезапускать):
+--
+-- 1. start_partition_conversion: рядом создаётся секционированная таблица
+--    <таблица>_partitioned (секции по месяцам существующих строк и на premake месяцев
+--    вперёд, DEFAULT-секция, первичный ключ (id, ключ секционирования), индексы)
+-- 2. copy_partition_conversion_batch: строки копируются пакетами по id, каждый пакет -
+--    отдельная короткая транзакция; живую таблицу пакет не блокирует
+-- 3. finish_partition_conversion: ACCESS EXCLUSIVE на живую таблицу только на время
+--    докопирования строк, вставленных после последнего пакета, и переименования;
+--    старая таблица удаляется, новая получает её имя, индексы и триггеры
+--
+-- Пока таблица не переведена, бот работает с обычной таблицей, partition_maintenance
+-- её пропускает (отмечает в /health как unpartitioned).
+--
+-- DEFAULT-секция (<таблица>_default) принимает строки, для месяца которых секция
+-- не была создана заранее: вставка не падает, а partition_maintenance поднимает тревогу
+-- в /health. create_monthly_partitions переносит такие строки в созданную секцию месяца.
+
+-- Создать помесячные секции parent_YYYY_MM за месяцы from_month..to_month (включительно)
+-- Строки месяца, уже попавшие в DEFAULT-секцию, переносятся в новую секцию
+CREATE OR REPLACE FUNCTION create_monthly_partitions(parent TEXT, from_month DATE, to_month DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', from_month)::date;
+    month_end DATE;
+    partition_name TEXT;
+    default_name TEXT := parent || '_default';
+    key_col TEXT;
+    has_rows BOOLEAN;
+    created INTEGER := 0;
+BEGIN
+    key_col := substring(pg_get_partkeydef(to_regclass(parent)) from '\((.*)\)');
+    WHILE month_start <= to_month LOOP
+        partition_name := parent || '_' || to_char(month_start, 'YYYY_MM');
+        month_end := (month_start + INTERVAL '1 month')::date;
+        IF to_regclass(partition_name) IS NULL THEN
+            has_rows := FALSE;
+            IF to_regclass(default_name) IS NOT NULL THEN
+                EXECUTE format(
+                    'SELECT EXISTS(SELECT 1 FROM %I WHERE %s >= %L AND %s < %L)',
+                    default_name, key_col, month_start, key_col, month_end
+                ) INTO has_rows;
+            END IF;
+
+            IF has_rows THEN
+                EXECUTE format(
+                    'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                    partition_name, parent
+                );
+                -- Разрешает DELETE из append-only ledger только на время переноса
+                PERFORM set_config('partition_maintenance.moving_rows', 'on', true);
+                EXECUTE format(
+                    'WITH moved AS (DELETE FROM %I WHERE %s >= %L AND %s < %L RETURNING *) '
+                    'INSERT INTO %I SELECT * FROM moved',
+                    default_name, key_col, month_start, key_col, month_end, partition_name
+                );
+                PERFORM set_config('partition_maintenance.moving_rows', 'off', true);
+                EXECUTE format(
+                    'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                    parent, partition_name, month_start, month_end
+                );
+            ELSE
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, parent, month_start, month_end
+                );
+            END IF;
+            created := created + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Состояние перевода таблиц (convert_log_partitions.py)
+-- certified_id: все закоммиченные строки с id <= certified_id уже скопированы;
+-- pending_id/pending_xid: пакет скопирован до pending_id, но транзакции, начатые до
+-- его снимка (xid < pending_xid), могли ещё не закоммитить строки с меньшими id
+CREATE TABLE IF NOT EXISTS partition_conversions (
+    table_name TEXT PRIMARY KEY,
+    ts_col TEXT NOT NULL,
+    certified_id BIGINT NOT NULL DEFAULT 0,
+    pending_id BIGINT,
+    pending_xid BIGINT,
+    copied_rows BIGINT NOT NULL DEFAULT 0,
+    started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- Список колонок tbl для SELECT: NULL в ключе секционирования заменяется временем вставки
+CREATE OR REPLACE FUNCTION partition_conversion_columns(tbl TEXT, ts_col TEXT, qualified BOOLEAN)
+RETURNS TEXT AS $$
+    SELECT string_agg(
+        CASE
+            WHEN NOT qualified THEN quote_ident(a.attname)
+            WHEN a.attname = ts_col THEN format('COALESCE(t.%I, CURRENT_TIMESTAMP)', a.attname)
+            ELSE format('t.%I', a.attname)
+        END,
+        ', ' ORDER BY a.attnum
+    )
+    FROM pg_attribute a
+    WHERE a.attrelid = to_regclass(tbl) AND a.attnum > 0 AND NOT a.attisdropped;
+$$ LANGUAGE sql STABLE;
+
+-- Шаг 1: создать секционированную копию <tbl>_partitioned (повторный вызов ничего не делает)
+-- Возвращает FALSE, если таблица уже секционирована
+CREATE OR REPLACE FUNCTION start_partition_conversion(tbl TEXT, ts_col TEXT, premake_months INTEGER)
+RETURNS BOOLEAN AS $$
+DECLARE
+    shadow TEXT := tbl || '_partitioned';
+    first_month DATE;
+    last_month DATE;
+BEGIN
+    IF (SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass(tbl)) IS DISTINCT FROM 'r' THEN
+        RETURN FALSE;
+    END IF;
+
+    INSERT INTO partition_conversions (table_name, ts_col) VALUES (tbl, ts_col)
+    ON CONFLICT (table_name) DO NOTHING;
+    IF to_regclass(shadow) IS NOT NULL THEN
+        RETURN TRUE;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (%I)',
+        shadow, tbl, ts_col
+    );
+    EXECUTE format('ALTER TABLE %I ALTER COLUMN %I SET NOT NULL', shadow, ts_col);
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id, %I)', shadow, ts_col);
+
+    EXECUTE format('SELECT MIN(%I)::date, MAX(%I)::date FROM %I', ts_col, ts_col, tbl)
+        INTO first_month, last_month;
+    PERFORM create_monthly_partitions(
+        shadow,
+        LEAST(COALESCE(first_month, CURRENT_DATE), CURRENT_DATE),
+        GREATEST(
+            COALESCE(last_month, CURRENT_DATE),
+            (date_trunc('month', CURRENT_DATE) + make_interval(months => premake_months))::date
+        )
+    );
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', shadow || '_default', shadow);
+
+    -- Индексы строятся на пустой таблице; суффикс _shadow снимается при переключении.
+    -- Триггеры создаются только при переключении: копирование их не вызывает
+    IF tbl = 'audit_log' THEN
+        CREATE INDEX idx_audit_log_uuid_shadow ON audit_log_partitioned (uuid) WHERE uuid IS NOT NULL;
+        CREATE INDEX idx_audit_log_action_shadow ON audit_log_partitioned (action);
+        CREATE INDEX idx_audit_log_source_shadow ON audit_log_partitioned (source) WHERE source IS NOT NULL;
+        CREATE INDEX idx_audit_log_created_at_shadow ON audit_log_partitioned (created_at);
+    ELSIF tbl = 'broadcast_log' THEN
+        ALTER TABLE broadcast_log_partitioned
+            ADD CONSTRAINT broadcast_log_broadcast_id_fkey_shadow
+            FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id) ON DELETE CASCADE;
+        CREATE INDEX idx_broadcast_log_broadcast_id_status_shadow ON broadcast_log_partitioned (broadcast_id, status);
+    ELSIF tbl = 'balance_transactions' THEN
+        -- Уникальный индекс секционированной таблицы обязан включать ключ секционирования:
+        -- глобальную уникальность ключа держит balance_idempotency_keys
+        CREATE INDEX idx_balance_transactions_idempotency_key_shadow
+            ON balance_transactions_partitioned (idempotency_key)
+            WHERE idempotency_key IS NOT NULL;
+        CREATE INDEX idx_balance_transactions_user_id_shadow ON balance_transactions_partitioned (user_id);
+    END IF;
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Шаг 2: скопировать следующий пакет (до batch_size строк), вернуть число скопированных строк
+-- Пакет ищет ещё не скопированные строки с id > certified_id; certified_id сдвигается
+-- до pending_id, когда все транзакции, начатые до снимка прошлого пакета, завершились
+-- (тот же приём, что у водяного знака когорт, миграция 016)
+CREATE OR REPLACE FUNCTION copy_partition_conversion_batch(tbl TEXT, batch_size INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    shadow TEXT := tbl || '_partitioned';
+    state partition_conversions%ROWTYPE;
+    snapshot_xmin BIGINT := pg_snapshot_xmin(pg_current_snapshot())::TEXT::BIGINT;
+    snapshot_xmax BIGINT;
+    settled BOOLEAN;
+    copied INTEGER;
+    max_id BIGINT;
+BEGIN
+    SELECT * INTO state FROM partition_conversions WHERE table_name = tbl FOR UPDATE;
+    IF NOT FOUND OR state.finished_at IS NOT NULL THEN
+        RETURN 0;
+    END IF;
+    settled := state.pending_id IS NOT NULL AND snapshot_xmin >= state.pending_xid;
+
+    EXECUTE format(
+        'WITH batch AS ('
+        '    SELECT %s FROM %I t'
+        '    WHERE t.id > $1 AND NOT EXISTS (SELECT 1 FROM %I s WHERE s.id = t.id)'
+        '    ORDER BY t.id LIMIT $2'
+        '), moved AS (INSERT INTO %I (%s) SELECT * FROM batch RETURNING id) '
+        'SELECT COUNT(*), MAX(id) FROM moved',
+        partition_conversion_columns(tbl, state.ts_col, TRUE), tbl, shadow,
+        shadow, partition_conversion_columns(tbl, state.ts_col, FALSE)
+    ) INTO copied, max_id USING state.certified_id, batch_size;
+    -- Снимок после копирования: транзакции, невидимые пакету, имеют xid < snapshot_xmax
+    snapshot_xmax := pg_snapshot_xmax(pg_current_snapshot())::TEXT::BIGINT;
+
+    -- Пакет просмотрел все строки до pending_id (или все видимые строки вообще)
+    IF settled AND (copied < batch_size OR max_id >= state.pending_id) THEN
+        state.certified_id := state.pending_id;
+        state.pending_id := NULL;
+    END IF;
+    IF state.pending_id IS NULL AND max_id IS NOT NULL THEN
+        state.pending_id := max_id;
+        state.pending_xid := snapshot_xmax;
+    END IF;
+
+    UPDATE partition_conversions
+    SET certified_id = state.certified_id,
+        pending_id = state.pending_id,
+        pending_xid = state.pending_xid,
+        copied_rows = copied_rows + copied
+    WHERE table_name = tbl;
+    RETURN copied;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Шаг 3: докопировать хвост под ACCESS EXCLUSIVE и подменить таблицу секционированной
+-- Возвращает число строк, скопированных под блокировкой
+CREATE OR REPLACE FUNCTION finish_partition_conversion(tbl TEXT)
+RETURNS INTEGER AS $$
+DECLARE
+    shadow TEXT := tbl || '_partitioned';
+    state partition_conversions%ROWTYPE;
+    seq TEXT;
+    copied INTEGER;
+    rel RECORD;
+BEGIN
+    SELECT * INTO state FROM partition_conversions WHERE table_name = tbl FOR UPDATE;
+    IF NOT FOUND OR to_regclass(shadow) IS NULL THEN
+        RAISE EXCEPTION 'Partition conversion of % is not started', tbl;
+    END IF;
+
+    -- Ждём завершения пишущих транзакций; новые ждут коммита переключения
+    EXECUTE format('LOCK TABLE %I IN ACCESS EXCLUSIVE MODE', tbl);
+    EXECUTE format(
+        'INSERT INTO %I (%s) SELECT %s FROM %I t '
+        'WHERE t.id > $1 AND NOT EXISTS (SELECT 1 FROM %I s WHERE s.id = t.id)',
+        shadow, partition_conversion_columns(tbl, state.ts_col, FALSE),
+        partition_conversion_columns(tbl, state.ts_col, TRUE), tbl, shadow
+    ) USING state.certified_id;
+    GET DIAGNOSTICS copied = ROW_COUNT;
+
+    -- Последовательность id переживает удаление старой таблицы
+    seq := pg_get_serial_sequence(tbl, 'id');
+    IF seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', seq);
+    END IF;
+    EXECUTE format('DROP TABLE %I', tbl);
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', shadow, tbl);
+    IF seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', seq, tbl);
+    END IF;
+
+    -- Имена секций, индексов и ограничений - как у прежней таблицы
+    FOR rel IN
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(tbl) AND c.relname LIKE shadow || '\_%'
+    LOOP
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', rel.relname, tbl || substring(rel.relname from length(shadow) + 1));
+    END LOOP;
+    FOR rel IN
+        SELECT c.relname FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE x.indrelid = to_regclass(tbl) AND c.relname LIKE '%\_shadow'
+    LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', rel.relname, left(rel.relname, -length('_shadow')));
+    END LOOP;
+    EXECUTE format('ALTER TABLE %I RENAME CONSTRAINT %I TO %I', tbl, shadow || '_pkey', tbl || '_pkey');
+    IF tbl = 'broadcast_log' THEN
+        ALTER TABLE broadcast_log RENAME CONSTRAINT broadcast_log_broadcast_id_fkey_shadow TO broadcast_log_broadcast_id_fkey;
+    ELSIF tbl = 'balance_transactions' THEN
+        CREATE TRIGGER trg_balance_transactions_idempotency_key
+            AFTER INSERT ON balance_transactions
+            FOR EACH ROW
+            WHEN (NEW.idempotency_key IS NOT NULL)
+            EXECUTE FUNCTION balance_transactions_claim_idempotency_key();
+        CREATE TRIGGER trg_balance_transactions_append_only
+            BEFORE UPDATE OR DELETE ON balance_transactions
+            FOR EACH ROW EXECUTE FUNCTION balance_transactions_append_only();
+    END IF;
+
+    UPDATE partition_conversions
+    SET finished_at = CURRENT_TIMESTAMP, copied_rows = copied_rows + copied
+    WHERE table_name = tbl;
+    RETURN copied;
+END;
+$$ LANGUAGE plpgsql;
+
+-- balance_transactions: уникальный индекс секционированной таблицы обязан включать
+-- ключ секционирования, поэтому глобальная уникальность idempotency_key
+-- обеспечивается отдельной таблицей ключей (вставка дубликата - unique_violation).
+-- Триггер ключей работает и на обычной таблице (до перевода), уникальный индекс
+-- миграции 011 остаётся на ней до переключения.
+CREATE TABLE IF NOT EXISTS balance_idempotency_keys (
+    idempotency_key TEXT PRIMARY KEY,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO balance_idempotency_keys (idempotency_key)
+SELECT DISTINCT idempotency_key FROM balance_transactions
+WHERE idempotency_key IS NOT NULL
+ON CONFLICT (idempotency_key) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION balance_transactions_claim_idempotency_key()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO balance_idempotency_keys (idempotency_key) VALUES (NEW.idempotency_key);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_balance_transactions_idempotency_key ON balance_transactions;
+
+CREATE TRIGGER trg_balance_transactions_idempotency_key
+    AFTER INSERT ON balance_transactions
+    FOR EACH ROW
+    WHEN (NEW.idempotency_key IS NOT NULL)
+    EXECUTE FUNCTION balance_transactions_claim_idempotency_key();
+
+-- Триггер миграции 011; finish_partition_conversion создаёт его заново на новой таблице.
+-- DELETE разрешён только при переносе строк из DEFAULT-секции (create_monthly_partitions)
+CREATE OR REPLACE FUNCTION balance_transactions_append_only()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND current_setting('partition_maintenance.moving_rows', true) = 'on' THEN
+        RETURN OLD;
+    END IF;
+    RAISE EXCEPTION 'balance_transactions is append-only (% is not allowed)', TG_OP;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_balance_transactions_append_only ON balance_transactions;
+
+CREATE TRIGGER trg_balance_transactions_append_only
+    BEFORE UPDATE OR DELETE ON balance_transactions
+    FOR EACH ROW EXECUTE FUNCTION balance_transactions_append_only();
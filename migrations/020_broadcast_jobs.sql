@@ -0,0 +1,30 @@
+-- Migration 020: Broadcasts as resumable background jobs
+-- Рассылку выполняет фоновый воркер (broadcast_worker.py), а не обработчик кнопки.
+-- Прогресс сохраняется контрольными точками: после каждого пакета получателей
+-- фиксируются last_telegram_id и счётчики, после рестарта рассылка продолжается
+-- с получателя после last_telegram_id.
+-- Выполняющий воркер держит аренду (locked_by, lease_until) и продлевает её на
+-- каждой контрольной точке; задание running с действующей арендой другие
+-- реплики не берут, с истёкшей - продолжают с контрольной точки.
+--
+-- job_status: queued | running | paused | cancelled | completed
+-- Уже разосланные ранее уведомления помечаются completed
+
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS job_status TEXT;
+UPDATE broadcasts SET job_status = 'completed' WHERE job_status IS NULL;
+ALTER TABLE broadcasts ALTER COLUMN job_status SET DEFAULT 'completed';
+ALTER TABLE broadcasts ALTER COLUMN job_status SET NOT NULL;
+
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS last_telegram_id BIGINT;
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS total_recipients INTEGER;
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS sent_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS failed_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS started_at TIMESTAMP;
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS finished_at TIMESTAMP;
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS locked_by TEXT;
+ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP;
+
+-- Воркер ищет незавершённые задания
+CREATE INDEX IF NOT EXISTS idx_broadcasts_pending_jobs
+    ON broadcasts (id)
+    WHERE job_status IN ('queued', 'running');
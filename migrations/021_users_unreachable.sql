@@ -0,0 +1,13 @@
+-- Migration 021: Unreachable users
+-- users.unreachable_since выставляется при постоянной ошибке отправки
+-- (бот заблокирован, аккаунт удалён, чат не найден) и сбрасывается
+-- при следующем входящем апдейте от пользователя.
+-- Массовые отправки (рассылки, напоминания, trial-уведомления, уведомления
+-- о перевыпуске ключей) исключают таких пользователей на уровне SQL.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_since TIMESTAMP;
+
+-- Недоступных пользователей мало: частичный индекс для фильтра NOT IN
+CREATE INDEX IF NOT EXISTS idx_users_unreachable
+    ON users (telegram_id)
+    WHERE unreachable_since IS NOT NULL;
@@ -0,0 +1,30 @@
+-- Migration 022: Durable inbox for Crypto Bot webhooks
+-- Webhook подтверждается (200) только после записи invoice в эту таблицу,
+-- обработку (finalize_purchase, выдача ключа, уведомления) выполняют воркеры
+-- cryptobot_service. Строка переживает рестарт и деплой: взятая в работу строка
+-- держится арендой locked_until, после её истечения событие берёт другой воркер.
+-- Уникальный invoice_id - долговременная защита от повторной доставки.
+--
+-- status: pending | processing | done | failed
+
+CREATE TABLE IF NOT EXISTS cryptobot_webhook_events (
+    id BIGSERIAL PRIMARY KEY,
+    invoice_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    last_error TEXT,
+    available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    processed_at TIMESTAMP
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_cryptobot_webhook_events_invoice
+    ON cryptobot_webhook_events (invoice_id);
+
+-- Выборка очереди воркерами (ожидающие и с истёкшей арендой)
+CREATE INDEX IF NOT EXISTS idx_cryptobot_webhook_events_open
+    ON cryptobot_webhook_events (id)
+    WHERE status IN ('pending', 'processing');
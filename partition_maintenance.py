@@ -0,0 +1,152 @@
+"""
+Partition Maintenance - обслуживание помесячных секций журналов
+
+audit_log, broadcast_log и balance_transactions секционированы по месяцам
+(миграция 019, перевод - convert_log_partitions.py). Фоновая задача:
+- заранее создаёт секции на PARTITION_PREMAKE_MONTHS месяцев вперёд
+  (без секции на текущий месяц вставка в журнал завершится ошибкой);
+- секции старше срока хранения выгружает в gzip-сжатый CSV
+  (PARTITION_ARCHIVE_DIR/<секция>.csv.gz), затем отсоединяет и удаляет;
+- поднимает тревогу (/health, лог ERROR), если секций вперёд осталось меньше
+  PARTITION_MIN_MONTHS_AHEAD месяцев или строки попали в DEFAULT-секцию.
+
+Таблицы, ещё не переведённые в секционированные, пропускаются (unpartitioned в /health).
+
+balance_transactions не архивируется: ledger - источник истины для users.balance,
+сверка (balance_reconciliation) суммирует все проводки пользователя.
+"""
+import asyncio
+import logging
+import os
+from datetime import date
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot
+import database
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL_SECONDS", "21600"))
+PARTITION_PREMAKE_MONTHS = int(os.getenv("PARTITION_PREMAKE_MONTHS", "3"))
+PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR", "archive/partitions")
+PARTITION_MIN_MONTHS_AHEAD = int(os.getenv("PARTITION_MIN_MONTHS_AHEAD", "1"))
+
+# Срок хранения секций в месяцах (0 - хранить всегда)
+PARTITION_RETENTION_MONTHS: Dict[str, int] = {
+    "audit_log": int(os.getenv("AUDIT_LOG_RETENTION_MONTHS", "12")),
+    "broadcast_log": int(os.getenv("BROADCAST_LOG_RETENTION_MONTHS", "6")),
+    "balance_transactions": 0,
+}
+
+# Состояние секций после последнего прохода (отдаётся в /health)
+PARTITION_STATS: Dict[str, Any] = {
+    "passes": 0,
+    "months_ahead": {},
+    "default_rows": [],
+    "unpartitioned": [],
+    "alert": False,
+    "last_pass_at": None,
+}
+
+
+def retention_cutoff(today: date, retention_months: int) -> date:
+    """Первый день самого старого хранимого месяца: секции раньше него архивируются"""
+    month_index = today.year * 12 + (today.month - 1) - retention_months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def months_ahead(today: date, partitions: List[Dict[str, Any]]) -> int:
+    """На сколько месяцев после текущего созданы секции (-1 - нет секции даже на текущий месяц)"""
+    if not partitions:
+        return -1
+    last = partitions[-1]["month"]
+    return (last.year * 12 + last.month) - (today.year * 12 + today.month)
+
+
+async def run_partition_maintenance(today: Optional[date] = None) -> Dict[str, int]:
+    """
+    Один проход обслуживания секций
+
+    Args:
+        today: Текущая дата (по умолчанию date.today())
+
+    Returns:
+        {"created": созданных секций, "archived": архивированных и удалённых секций}
+    """
+    created = 0
+    archived = 0
+    today = today or date.today()
+
+    horizon: Dict[str, int] = {}
+    default_rows: List[str] = []
+    unpartitioned: List[str] = []
+
+    for table in database.PARTITIONED_LOG_TABLES:
+        if not await database.is_partitioned_table(table):
+            unpartitioned.append(table)
+            continue
+
+        created += await database.ensure_monthly_partitions(table, PARTITION_PREMAKE_MONTHS)
+
+        partitions = await database.get_monthly_partitions(table)
+        horizon[table] = months_ahead(today, partitions)
+        if await database.has_default_partition_rows(table):
+            default_rows.append(table)
+
+        retention_months = PARTITION_RETENTION_MONTHS.get(table, 0)
+        if retention_months <= 0:
+            continue
+
+        cutoff = retention_cutoff(today, retention_months)
+        for partition in partitions:
+            if partition["month"] >= cutoff:
+                break
+            os.makedirs(PARTITION_ARCHIVE_DIR, exist_ok=True)
+            path = os.path.join(PARTITION_ARCHIVE_DIR, f"{partition['name']}.csv.gz")
+            await database.archive_and_drop_partition(table, partition["name"], path)
+            archived += 1
+
+    low = {table: months for table, months in horizon.items() if months < PARTITION_MIN_MONTHS_AHEAD}
+    PARTITION_STATS.update({
+        "passes": PARTITION_STATS["passes"] + 1,
+        "months_ahead": horizon,
+        "default_rows": default_rows,
+        "unpartitioned": unpartitioned,
+        "alert": bool(low or default_rows),
+        "last_pass_at": today.isoformat(),
+    })
+    if low or default_rows:
+        logger.error(
+            f"Partition alert: months_ahead below {PARTITION_MIN_MONTHS_AHEAD}: {low}, "
+            f"rows in default partition: {default_rows}"
+        )
+
+    if unpartitioned:
+        logger.warning(f"Partition maintenance skipped unpartitioned tables (run convert_log_partitions.py): {unpartitioned}")
+
+    return {"created": created, "archived": archived}
+
+
+def get_stats() -> Dict[str, Any]:
+    """Состояние секций после последнего прохода обслуживания"""
+    return dict(PARTITION_STATS)
+
+
+async def partition_maintenance_task(bot: Bot):
+    """Фоновая задача обслуживания секций журналов"""
+    logger.info(f"Partition maintenance task started (interval: {PARTITION_MAINTENANCE_INTERVAL_SECONDS} seconds)")
+
+    while True:
+        try:
+            result = await run_partition_maintenance()
+            if result["created"] or result["archived"]:
+                logger.info(
+                    f"Partition maintenance: created={result['created']}, archived={result['archived']}"
+                )
+        except asyncio.CancelledError:
+            logger.info("Partition maintenance task cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Error in partition_maintenance_task: {e}")
+
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL_SECONDS)
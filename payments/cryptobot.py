@@ -6,7 +6,7 @@ Handles invoice creation and status checking via polling (no webhooks).
 import os
 import json
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import httpx
 
 logger = logging.getLogger(__name__)
@@ -21,6 +21,13 @@ ALLOWED_ASSETS = [asset.strip().upper() for asset in CRYPTOBOT_ASSETS if asset.s
 # Exchange rate: RUB to USD (fixed rate for conversion)
 RUB_TO_USD_RATE = 95.0
 
+# getInvoices returns at most `count` invoices per request (API maximum is 1000)
+CRYPTOBOT_INVOICES_PER_REQUEST = int(os.getenv("CRYPTOBOT_INVOICES_PER_REQUEST", "1000"))
+CRYPTOBOT_HTTP_TIMEOUT_SECONDS = float(os.getenv("CRYPTOBOT_HTTP_TIMEOUT_SECONDS", "30"))
+
+# Shared HTTP client (connection pooling / keep-alive), created lazily
+_client: Optional[httpx.AsyncClient] = None
+
 
 def rub_kopecks_to_usd(kopecks: int) -> float:
     """
@@ -50,6 +57,51 @@ def _get_auth_headers() -> Dict[str, str]:
     }
 
 
+def _get_client() -> httpx.AsyncClient:
+    """Get the shared HTTP client (keep-alive connections are reused between calls)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=CRYPTOBOT_HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+    return _client
+
+
+async def close() -> None:
+    """Close the shared HTTP client (on bot shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _call(method: str, request_body: Dict[str, Any]) -> Any:
+    """
+    Call a Crypto Pay API method and return its result
+    
+    Raises:
+        Exception on HTTP or API errors
+    """
+    response = await _get_client().post(
+        f"{CRYPTOBOT_API_URL}/{method}",
+        headers=_get_auth_headers(),
+        json=request_body
+    )
+    
+    if response.status_code != 200:
+        logger.error(f"CryptoBot API error: {response.status_code} - {response.text}")
+        raise Exception(f"CryptoBot API error: {response.status_code} - {response.text}")
+    
+    data = response.json()
+    if not data.get("ok"):
+        error_msg = data.get("error", {}).get("name", "Unknown error")
+        logger.error(f"CryptoBot API error: {error_msg}")
+        raise Exception(f"CryptoBot API error: {error_msg}")
+    
+    return data.get("result", {})
+
+
 async def create_invoice(
     amount_rub: float,
     description: str,
@@ -90,24 +142,7 @@ async def create_invoice(
         "allow_anonymous": False,
     }
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            f"{CRYPTOBOT_API_URL}/createInvoice",
-            headers=_get_auth_headers(),
-            json=request_body
-        )
-    
-    if response.status_code != 200:
-        logger.error(f"CryptoBot API error: {response.status_code} - {response.text}")
-        raise Exception(f"CryptoBot API error: {response.status_code} - {response.text}")
-    
-    data = response.json()
-    if not data.get("ok"):
-        error_msg = data.get("error", {}).get("name", "Unknown error")
-        logger.error(f"CryptoBot API error: {error_msg}")
-        raise Exception(f"CryptoBot API error: {error_msg}")
-    
-    result = data.get("result", {})
+    result = await _call("createInvoice", request_body)
     if not result.get("invoice_id") or not result.get("pay_url"):
         raise Exception("Invalid response from CryptoBot API: missing invoice_id or pay_url")
     
@@ -121,51 +156,9 @@ async def create_invoice(
     }
 
 
-async def check_invoice_status(invoice_id: int) -> Dict[str, Any]:
-    """
-    Check invoice status via CryptoBot API
-    
-    Args:
-        invoice_id: Invoice ID from CryptoBot
-        
-    Returns:
-        Invoice data with status and payment info
-        
-    Raises:
-        Exception on API errors
-    """
-    if not is_enabled():
-        raise Exception("CryptoBot not configured")
-    
-    request_body = {
-        "invoice_ids": [invoice_id]
-    }
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            f"{CRYPTOBOT_API_URL}/getInvoices",
-            headers=_get_auth_headers(),
-            json=request_body
-        )
-    
-    if response.status_code != 200:
-        logger.error(f"CryptoBot API error: {response.status_code} - {response.text}")
-        raise Exception(f"CryptoBot API error: {response.status_code} - {response.text}")
-    
-    data = response.json()
-    if not data.get("ok"):
-        error_msg = data.get("error", {}).get("name", "Unknown error")
-        logger.error(f"CryptoBot API error: {error_msg}")
-        raise Exception(f"CryptoBot API error: {error_msg}")
-    
-    items = data.get("result", {}).get("items", [])
-    if not items:
-        raise Exception(f"Invoice not found: invoice_id={invoice_id}")
-    
-    invoice = items[0]
+def _parse_invoice(invoice: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalize a getInvoices item: status paid / pending / failed, amount as string"""
     raw_status = invoice.get("status", "")
-    payload = invoice.get("payload", "")
-    paid_at = invoice.get("paid_at")
     
     # Parse amount (API returns string, not nested object)
     amount_str = ""
@@ -187,13 +180,66 @@ async def check_invoice_status(invoice_id: int) -> Dict[str, Any]:
     else:
         normalized_status = "pending"
     
-    logger.info(f"CryptoBot invoice status checked: invoice_id={invoice_id}, status={raw_status} -> {normalized_status}")
-    
     return {
         "invoice_id": invoice.get("invoice_id"),
         "status": normalized_status,
         "raw_status": raw_status,
-        "payload": payload,
-        "paid_at": paid_at,
+        "payload": invoice.get("payload", ""),
+        "paid_at": invoice.get("paid_at"),
         "amount": amount_str,
     }
+
+
+async def check_invoices_status(invoice_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """
+    Check status of many invoices via CryptoBot API
+    
+    One getInvoices request per CRYPTOBOT_INVOICES_PER_REQUEST invoices,
+    over the shared keep-alive client.
+    
+    Args:
+        invoice_ids: Invoice IDs from CryptoBot
+        
+    Returns:
+        invoice_id -> invoice data (see check_invoice_status); invoices
+        unknown to the API are absent
+        
+    Raises:
+        Exception on API errors
+    """
+    if not is_enabled():
+        raise Exception("CryptoBot not configured")
+    
+    statuses: Dict[int, Dict[str, Any]] = {}
+    unique_ids = list(dict.fromkeys(invoice_ids))
+    for start in range(0, len(unique_ids), CRYPTOBOT_INVOICES_PER_REQUEST):
+        chunk = unique_ids[start:start + CRYPTOBOT_INVOICES_PER_REQUEST]
+        result = await _call("getInvoices", {"invoice_ids": chunk, "count": len(chunk)})
+        for invoice in result.get("items", []):
+            parsed = _parse_invoice(invoice)
+            statuses[parsed["invoice_id"]] = parsed
+    
+    logger.info(
+        f"CryptoBot invoices status checked: requested={len(unique_ids)}, found={len(statuses)}, "
+        f"paid={sum(1 for status in statuses.values() if status['status'] == 'paid')}"
+    )
+    return statuses
+
+
+async def check_invoice_status(invoice_id: int) -> Dict[str, Any]:
+    """
+    Check invoice status via CryptoBot API
+    
+    Args:
+        invoice_id: Invoice ID from CryptoBot
+        
+    Returns:
+        Invoice data with status and payment info
+        
+    Raises:
+        Exception on API errors
+    """
+    statuses = await check_invoices_status([invoice_id])
+    if invoice_id not in statuses:
+        raise Exception(f"Invoice not found: invoice_id={invoice_id}")
+    return statuses[invoice_id]
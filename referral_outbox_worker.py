@@ -0,0 +1,69 @@
+"""
+Referral Outbox Worker - начисление реферального кешбэка из outbox
+
+Платёжные пути (finalize_purchase, approve_payment_atomic, оплата/пополнение баланса)
+только записывают событие в referral_reward_outbox. Воркер забирает события пакетами,
+начисляет кешбэк (process_referral_reward) и после коммита отправляет уведомления рефереру.
+
+Это укорачивает платёжную транзакцию и позволяет начислениям догонять поток
+оплат под нагрузкой, не блокируя покупки.
+"""
+import asyncio
+import logging
+import os
+from aiogram import Bot
+import database
+import telegram_gateway
+from utils.referral import send_referral_cashback_notification
+
+logger = logging.getLogger(__name__)
+
+# Размер пакета и интервал опроса очереди, когда она пуста
+OUTBOX_BATCH_SIZE = int(os.getenv("REFERRAL_OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL_SECONDS = int(os.getenv("REFERRAL_OUTBOX_POLL_INTERVAL_SECONDS", "5"))
+
+
+async def _notify_referrers(bot: Bot, processed: list):
+    """Отправить уведомления реферерам по успешно начисленным событиям"""
+    for item in processed:
+        result = item["result"]
+        if not result.get("success"):
+            continue
+        await send_referral_cashback_notification(
+            bot=bot,
+            referrer_id=result.get("referrer_id"),
+            referred_id=item["buyer_id"],
+            purchase_amount=item["amount_rubles"],
+            cashback_amount=result.get("reward_amount"),
+            cashback_percent=result.get("percent"),
+            paid_referrals_count=result.get("paid_referrals_count", 0),
+            referrals_needed=result.get("referrals_needed", 0),
+            action_type=item["action_type"]
+        )
+
+
+async def referral_outbox_task(bot: Bot):
+    """Фоновая задача обработки referral_reward_outbox"""
+    logger.info(
+        f"Referral outbox worker started (batch_size={OUTBOX_BATCH_SIZE}, "
+        f"poll_interval={OUTBOX_POLL_INTERVAL_SECONDS}s)"
+    )
+    telegram_gateway.set_lane(telegram_gateway.LANE_REMINDER)
+
+    while True:
+        try:
+            processed, claimed = await database.process_referral_reward_outbox_batch(OUTBOX_BATCH_SIZE)
+            # Уведомления отправляются после коммита пакета: начисление не зависит от Telegram API
+            await _notify_referrers(bot, processed)
+
+            # Полный пакет - в очереди, вероятно, есть ещё события: продолжаем без паузы.
+            # Считаем взятые строки, а не успешные: ошибочные события не должны обрывать разбор очереди
+            if claimed >= OUTBOX_BATCH_SIZE:
+                continue
+        except asyncio.CancelledError:
+            logger.info("Referral outbox worker cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Error in referral_outbox_task: {e}")
+
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL_SECONDS)
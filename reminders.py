@@ -1,17 +1,24 @@
 """Модуль для отправки умных напоминаний об окончании подписки и уведомлений на основе трафика"""
 import asyncio
 import logging
+import os
+import time
 from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.exceptions import TelegramForbiddenError
 import database
 import localization
+import telegram_gateway
 import config
 # import outline_api  # DISABLED - мигрировали на Xray Core (VLESS)
 
 logger = logging.getLogger(__name__)
 
+REMINDER_SEND_CONCURRENCY = int(os.getenv("REMINDER_SEND_CONCURRENCY", "20"))
+REMINDER_STREAM_BATCH_SIZE = int(os.getenv("REMINDER_STREAM_BATCH_SIZE", "5000"))
+
 
 def get_renewal_keyboard(language: str) -> InlineKeyboardMarkup:
     """Клавиатура для продления доступа"""
@@ -57,258 +64,227 @@ def get_vip_offer_keyboard(language: str) -> InlineKeyboardMarkup:
     return keyboard
 
 
-async def _send_notification_with_anti_spam(
+# Уведомление к отправке: (telegram_id, язык, флаг подписки, ключ текста, клавиатура, anti-spam, описание)
+PendingNotification = Tuple[int, str, str, str, Optional[Callable[[str], InlineKeyboardMarkup]], bool, str]
+
+
+def decide_smart_notification(subscription, now: datetime) -> Optional[PendingNotification]:
+    """Выбрать одно умное уведомление для подписки (или None)
+
+    Правила проверяются по порядку, отправляется только первое подходящее.
+    """
+    telegram_id = subscription["telegram_id"]
+    language = subscription["language"]
+    activated_at = subscription["activated_at"]
+    expires_at = subscription["expires_at"]
+    last_bytes = subscription["last_bytes"] or 0
+    first_traffic_at = subscription["first_traffic_at"]
+    
+    # ANTI-SPAM: минимальный интервал между уведомлениями - 60 минут
+    last_notification_sent_at = subscription["last_notification_sent_at"]
+    if last_notification_sent_at and now - last_notification_sent_at < timedelta(minutes=60):
+        return None
+    
+    # XRAY CORE: трафик через API не поддерживается, используется last_bytes из БД
+    current_bytes = last_bytes
+    
+    # 1. НЕТ ТРАФИКА ЧЕРЕЗ 20 МИНУТ
+    if (activated_at and 
+        (now - activated_at) >= timedelta(minutes=20) and 
+        current_bytes == 0 and 
+        not subscription["smart_notif_no_traffic_20m_sent"]):
+        return (telegram_id, language, "smart_notif_no_traffic_20m_sent", "smart_notif_no_traffic_20m",
+                None, True, "no traffic 20m")
+    
+    # 2. НЕТ ТРАФИКА ЧЕРЕЗ 24 ЧАСА
+    if (activated_at and 
+        (now - activated_at) >= timedelta(hours=24) and 
+        current_bytes == 0 and 
+        not subscription["smart_notif_no_traffic_24h_sent"]):
+        return (telegram_id, language, "smart_notif_no_traffic_24h_sent", "smart_notif_no_traffic_24h",
+                None, False, "no traffic 24h")
+    
+    # 3. ПЕРВОЕ ПОДКЛЮЧЕНИЕ (ЕСТЬ ТРАФИК)
+    if (current_bytes > 0 and 
+        last_bytes == 0 and 
+        first_traffic_at and 
+        timedelta(hours=1) <= (now - first_traffic_at) <= timedelta(hours=2) and
+        not subscription["smart_notif_first_connection_sent"]):
+        return (telegram_id, language, "smart_notif_first_connection_sent", "smart_notif_first_connection",
+                None, False, "first connection")
+    
+    # 4. 3 ДНЯ ИСПОЛЬЗОВАНИЯ
+    if (first_traffic_at and 
+        (now - first_traffic_at) >= timedelta(days=3) and 
+        not subscription["smart_notif_3days_usage_sent"]):
+        return (telegram_id, language, "smart_notif_3days_usage_sent", "smart_notif_3days_usage",
+                None, False, "3 days usage")
+    
+    # 5. ЗА 7 ДНЕЙ ДО ОКОНЧАНИЯ
+    time_until_expiry = expires_at - now
+    if (timedelta(days=6.9) <= time_until_expiry <= timedelta(days=7.1) and 
+        not subscription["smart_notif_7days_before_expiry_sent"]):
+        return (telegram_id, language, "smart_notif_7days_before_expiry_sent", "smart_notif_7days_before_expiry",
+                get_renewal_keyboard, False, "7 days before expiry")
+    
+    # 6. ЗА 3 ДНЯ ДО ОКОНЧАНИЯ (КЛЮЧЕВОЕ)
+    if (timedelta(days=2.9) <= time_until_expiry <= timedelta(days=3.1) and 
+        not subscription["smart_notif_3days_before_expiry_sent"]):
+        return (telegram_id, language, "smart_notif_3days_before_expiry_sent", "smart_notif_3days_before_expiry",
+                get_renewal_keyboard, False, "3 days before expiry")
+    
+    # 7. В ДЕНЬ ОКОНЧАНИЯ (УТРОМ)
+    if (expires_at.date() == now.date() and 
+        8 <= now.hour < 12 and
+        not subscription["smart_notif_expiry_day_sent"]):
+        return (telegram_id, language, "smart_notif_expiry_day_sent", "smart_notif_expiry_day",
+                get_renewal_keyboard, False, "expiry day")
+    
+    # 8. ПОСЛЕ ОКОНЧАНИЯ (ЧЕРЕЗ 24 ЧАСА)
+    if (expires_at < now and 
+        (now - expires_at) >= timedelta(hours=24) and
+        not subscription["smart_notif_expired_24h_sent"]):
+        return (telegram_id, language, "smart_notif_expired_24h_sent", "smart_notif_expired_24h",
+                get_subscription_keyboard, False, "expired 24h")
+    
+    # 9. VIP / АПГРЕЙД (ТОЛЬКО АКТИВНЫЕ ПОЛЬЗОВАТЕЛИ)
+    if (first_traffic_at and 
+        (now - first_traffic_at) >= timedelta(days=14) and 
+        current_bytes > 0 and
+        not subscription["smart_notif_vip_offer_sent"]):
+        return (telegram_id, language, "smart_notif_vip_offer_sent", "smart_notif_vip_offer",
+                get_vip_offer_keyboard, False, "VIP offer")
+    
+    return None
+
+
+def decide_reminder(subscription, now: datetime) -> Optional[PendingNotification]:
+    """Выбрать напоминание об окончании подписки (или None)"""
+    telegram_id = subscription["telegram_id"]
+    language = subscription["language"]
+    time_until_expiry = subscription["expires_at"] - now
+    admin_grant_days = subscription.get("admin_grant_days")
+    
+    # АДМИН-ВЫДАННЫЙ ДОСТУП
+    if admin_grant_days is not None or subscription.get("last_action_type") == "admin_grant":
+        # 1 день - напоминание за 6 часов
+        if (admin_grant_days == 1 and
+            timedelta(hours=5.5) <= time_until_expiry <= timedelta(hours=6.5) and 
+            not subscription.get("reminder_6h_sent", False)):
+            return (telegram_id, language, "reminder_6h_sent", "reminder_admin_1day_6h",
+                    get_subscription_keyboard, False, "Admin 1-day reminder (6h before expiry)")
+        # 7 дней - напоминание за 24 часа
+        if (admin_grant_days == 7 and
+            timedelta(hours=23) <= time_until_expiry <= timedelta(hours=25) and 
+            not subscription.get("reminder_24h_sent", False)):
+            return (telegram_id, language, "reminder_24h_sent", "reminder_admin_7days_24h",
+                    get_tariff_1_month_keyboard, False, "Admin 7-day reminder (24h before expiry)")
+        return None
+    
+    # ОПЛАЧЕННЫЕ ТАРИФЫ
+    if (timedelta(days=2.9) <= time_until_expiry <= timedelta(days=3.1) and 
+        not subscription.get("reminder_3d_sent", False)):
+        return (telegram_id, language, "reminder_3d_sent", "reminder_paid_3d",
+                get_renewal_keyboard, False, "Paid subscription reminder (3d before expiry)")
+    if (timedelta(hours=23) <= time_until_expiry <= timedelta(hours=25) and 
+        not subscription.get("reminder_24h_sent", False)):
+        return (telegram_id, language, "reminder_24h_sent", "reminder_paid_24h",
+                get_renewal_keyboard, False, "Paid subscription reminder (24h before expiry)")
+    if (timedelta(hours=2.5) <= time_until_expiry <= timedelta(hours=3.5) and 
+        not subscription.get("reminder_3h_sent", False)):
+        return (telegram_id, language, "reminder_3h_sent", "reminder_paid_3h",
+                get_renewal_keyboard, False, "Paid subscription reminder (3h before expiry)")
+    return None
+
+
+async def send_pending_notifications(
     bot: Bot,
-    pool,
-    telegram_id: int,
-    text: str,
-    sent_flag_column: str,
-    notification_name: str
-):
-    """Отправить уведомление с обновлением anti-spam полей"""
-    try:
-        await bot.send_message(telegram_id, text)
-        async with pool.acquire() as update_conn:
-            await update_conn.execute(
-                f"""UPDATE subscriptions 
-                   SET {sent_flag_column} = TRUE, 
-                       last_notification_sent_at = $1 
-                   WHERE telegram_id = $2""",
-                datetime.now(), telegram_id
-            )
-        logger.info(f"Smart notification ({notification_name}) sent to user {telegram_id}")
-        return True
-    except TelegramForbiddenError:
-        logger.info(f"User {telegram_id} blocked bot, skipping notification ({notification_name})")
-        return False
-    except Exception as e:
-        logger.error(f"Error sending notification ({notification_name}) to user {telegram_id}: {e}")
-        return False
+    pending: List[PendingNotification],
+    now: datetime,
+    audit_action: Optional[str] = None
+) -> int:
+    """Отправить уведомления (не больше REMINDER_SEND_CONCURRENCY одновременно)
+    и отметить отправленные одним UPDATE (database.mark_notification_flags_sent)
+
+    Returns:
+        Количество отправленных уведомлений
+    """
+    semaphore = asyncio.Semaphore(REMINDER_SEND_CONCURRENCY)
+    
+    async def _send(notification: PendingNotification) -> Optional[Tuple[int, str, Optional[datetime]]]:
+        telegram_id, language, flag, text_key, keyboard, anti_spam, name = notification
+        async with semaphore:
+            try:
+                text = localization.get_text(language, text_key)
+                reply_markup = keyboard(language) if keyboard else None
+                await bot.send_message(telegram_id, text, reply_markup=reply_markup)
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота - это ожидаемое поведение, не ошибка
+                logger.info(f"User {telegram_id} blocked bot, skipping notification ({name})")
+                return None
+            except Exception as e:
+                # Ошибка для одного пользователя не должна ломать цикл
+                logger.error(f"Error sending notification ({name}) to user {telegram_id}: {e}")
+                return None
+        if audit_action:
+            await database._log_audit_event_atomic_standalone(audit_action, telegram_id, telegram_id, name)
+        logger.info(f"Notification ({name}) sent to user {telegram_id}")
+        return telegram_id, flag, now if anti_spam else None
+    
+    results = await asyncio.gather(*(_send(notification) for notification in pending))
+    sent = [result for result in results if result is not None]
+    await database.mark_notification_flags_sent(sent)
+    return len(sent)
 
 
 async def send_smart_notifications(bot: Bot):
-    """Отправить умные уведомления на основе трафика и времени"""
+    """Отправить умные уведомления на основе трафика и времени
+    
+    Один потоковый проход по активным подпискам (язык выбирается тем же запросом)
+    решает, кому что отправить; отправка - с ограниченной параллельностью,
+    флаги отправленных уведомлений - одним UPDATE за цикл.
+    """
     try:
-        pool = await database.get_pool()
-        async with pool.acquire() as conn:
-            # Получаем все активные подписки с UUID (Xray VLESS)
-            rows = await conn.fetch("""
-                SELECT telegram_id, uuid, activated_at, expires_at, last_bytes,
-                       first_traffic_at,
-                       smart_notif_no_traffic_20m_sent,
-                       smart_notif_no_traffic_24h_sent,
-                       smart_notif_first_connection_sent,
-                       smart_notif_3days_usage_sent,
-                       smart_notif_7days_before_expiry_sent,
-                       smart_notif_3days_before_expiry_sent,
-                       smart_notif_expiry_day_sent,
-                       smart_notif_expired_24h_sent,
-                       smart_notif_vip_offer_sent,
-                       last_notification_sent_at
-                FROM subscriptions
-                WHERE status = 'active'
-                AND uuid IS NOT NULL
-                AND expires_at > NOW()
-            """)
+        started = time.monotonic()
+        now = datetime.now()
+        checked_count = 0
+        pending: List[PendingNotification] = []
         
-        if not rows:
-            return
+        # Все активные подписки с UUID (Xray VLESS), потоково пакетами (постоянная память);
+        # недоступные пользователи (users.unreachable_since) исключаются
+        async for subscription in database.stream_rows("""
+            SELECT s.telegram_id, s.activated_at, s.expires_at, s.last_bytes,
+                   s.first_traffic_at,
+                   s.smart_notif_no_traffic_20m_sent,
+                   s.smart_notif_no_traffic_24h_sent,
+                   s.smart_notif_first_connection_sent,
+                   s.smart_notif_3days_usage_sent,
+                   s.smart_notif_7days_before_expiry_sent,
+                   s.smart_notif_3days_before_expiry_sent,
+                   s.smart_notif_expiry_day_sent,
+                   s.smart_notif_expired_24h_sent,
+                   s.smart_notif_vip_offer_sent,
+                   s.last_notification_sent_at,
+                   COALESCE(u.language, 'ru') AS language
+            FROM subscriptions s
+            LEFT JOIN users u ON u.telegram_id = s.telegram_id
+            WHERE s.status = 'active'
+            AND s.uuid IS NOT NULL
+            AND s.expires_at > NOW()
+            AND u.unreachable_since IS NULL
+        """, batch_size=REMINDER_STREAM_BATCH_SIZE):
+            checked_count += 1
+            notification = decide_smart_notification(subscription, now)
+            if notification is not None:
+                pending.append(notification)
         
-        logger.info(f"Found {len(rows)} active subscriptions for smart notifications check")
+        sent_count = await send_pending_notifications(bot, pending, now) if pending else 0
         
-        now = datetime.now()
-        
-        for row in rows:
-            subscription = dict(row)
-            telegram_id = subscription["telegram_id"]
-            uuid = subscription.get("uuid")  # Xray VLESS UUID
-            activated_at = subscription.get("activated_at")
-            expires_at = subscription["expires_at"]
-            last_bytes = subscription.get("last_bytes", 0) or 0
-            first_traffic_at = subscription.get("first_traffic_at")
-            
-            if isinstance(expires_at, str):
-                expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-            if activated_at and isinstance(activated_at, str):
-                activated_at = datetime.fromisoformat(activated_at.replace('Z', '+00:00'))
-            if first_traffic_at and isinstance(first_traffic_at, str):
-                first_traffic_at = datetime.fromisoformat(first_traffic_at.replace('Z', '+00:00'))
-            
-            try:
-                # ANTI-SPAM: Проверяем, прошло ли достаточно времени с последнего уведомления
-                last_notification_sent_at = subscription.get("last_notification_sent_at")
-                if last_notification_sent_at:
-                    if isinstance(last_notification_sent_at, str):
-                        last_notification_sent_at = datetime.fromisoformat(last_notification_sent_at.replace('Z', '+00:00'))
-                    time_since_last = now - last_notification_sent_at
-                    # Минимальный интервал между уведомлениями: 60 минут
-                    if time_since_last < timedelta(minutes=60):
-                        continue  # Пропускаем этого пользователя, чтобы не спамить
-                
-                # Получаем язык пользователя
-                user = await database.get_user(telegram_id)
-                language = user.get("language", "ru") if user else "ru"
-                
-                # XRAY CORE: Получение трафика через API не поддерживается
-                # Используем last_bytes из БД (обновляется другим механизмом при необходимости)
-                current_bytes = last_bytes  # Используем сохраненное значение трафика
-                if current_bytes is None:
-                    current_bytes = 0
-                
-                # Не обновляем last_bytes в БД, так как Xray API не предоставляет статистику трафика
-                # Используем сохраненное значение из БД для проверок
-                
-                # Проверяем, появился ли трафик впервые
-                if current_bytes > 0 and last_bytes == 0 and not first_traffic_at:
-                    # Первый трафик - сохраняем время
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET first_traffic_at = $1 WHERE telegram_id = $2",
-                            now, telegram_id
-                        )
-                    first_traffic_at = now
-                
-                # 1. УВЕДОМЛЕНИЕ: НЕТ ТРАФИКА ЧЕРЕЗ 20 МИНУТ
-                if (activated_at and 
-                    (now - activated_at) >= timedelta(minutes=20) and 
-                    current_bytes == 0 and 
-                    not subscription.get("smart_notif_no_traffic_20m_sent", False)):
-                    text = localization.get_text(language, "smart_notif_no_traffic_20m")
-                    await _send_notification_with_anti_spam(
-                        bot, pool, telegram_id, text,
-                        "smart_notif_no_traffic_20m_sent", "no traffic 20m"
-                    )
-                    continue  # Отправляем только одно уведомление за раз
-                
-                # 2. УВЕДОМЛЕНИЕ: НЕТ ТРАФИКА ЧЕРЕЗ 24 ЧАСА
-                if (activated_at and 
-                    (now - activated_at) >= timedelta(hours=24) and 
-                    current_bytes == 0 and 
-                    not subscription.get("smart_notif_no_traffic_24h_sent", False)):
-                    text = localization.get_text(language, "smart_notif_no_traffic_24h")
-                    await bot.send_message(telegram_id, text)
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET smart_notif_no_traffic_24h_sent = TRUE WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                    logger.info(f"Smart notification (no traffic 24h) sent to user {telegram_id}")
-                    continue
-                
-                # 3. УВЕДОМЛЕНИЕ: ПЕРВОЕ ПОДКЛЮЧЕНИЕ (ЕСТЬ ТРАФИК)
-                if (current_bytes > 0 and 
-                    last_bytes == 0 and 
-                    first_traffic_at and 
-                    (now - first_traffic_at) >= timedelta(hours=1) and 
-                    (now - first_traffic_at) <= timedelta(hours=2) and
-                    not subscription.get("smart_notif_first_connection_sent", False)):
-                    text = localization.get_text(language, "smart_notif_first_connection")
-                    await bot.send_message(telegram_id, text)
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET smart_notif_first_connection_sent = TRUE WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                    logger.info(f"Smart notification (first connection) sent to user {telegram_id}")
-                    continue
-                
-                # 4. УВЕДОМЛЕНИЕ: 3 ДНЯ ИСПОЛЬЗОВАНИЯ
-                if (first_traffic_at and 
-                    (now - first_traffic_at) >= timedelta(days=3) and 
-                    not subscription.get("smart_notif_3days_usage_sent", False)):
-                    text = localization.get_text(language, "smart_notif_3days_usage")
-                    await bot.send_message(telegram_id, text)
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET smart_notif_3days_usage_sent = TRUE WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                    logger.info(f"Smart notification (3 days usage) sent to user {telegram_id}")
-                    continue
-                
-                # 5. УВЕДОМЛЕНИЕ: ЗА 7 ДНЕЙ ДО ОКОНЧАНИЯ
-                time_until_expiry = expires_at - now
-                if (timedelta(days=6.9) <= time_until_expiry <= timedelta(days=7.1) and 
-                    not subscription.get("smart_notif_7days_before_expiry_sent", False)):
-                    text = localization.get_text(language, "smart_notif_7days_before_expiry")
-                    keyboard = get_renewal_keyboard(language)
-                    await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET smart_notif_7days_before_expiry_sent = TRUE WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                    logger.info(f"Smart notification (7 days before expiry) sent to user {telegram_id}")
-                    continue
-                
-                # 6. УВЕДОМЛЕНИЕ: ЗА 3 ДНЯ ДО ОКОНЧАНИЯ (КЛЮЧЕВОЕ)
-                if (timedelta(days=2.9) <= time_until_expiry <= timedelta(days=3.1) and 
-                    not subscription.get("smart_notif_3days_before_expiry_sent", False)):
-                    text = localization.get_text(language, "smart_notif_3days_before_expiry")
-                    keyboard = get_renewal_keyboard(language)
-                    await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET smart_notif_3days_before_expiry_sent = TRUE WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                    logger.info(f"Smart notification (3 days before expiry) sent to user {telegram_id}")
-                    continue
-                
-                # 7. УВЕДОМЛЕНИЕ: В ДЕНЬ ОКОНЧАНИЯ (УТРОМ)
-                if (expires_at.date() == now.date() and 
-                    now.hour >= 8 and now.hour < 12 and
-                    not subscription.get("smart_notif_expiry_day_sent", False)):
-                    text = localization.get_text(language, "smart_notif_expiry_day")
-                    keyboard = get_renewal_keyboard(language)
-                    await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET smart_notif_expiry_day_sent = TRUE WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                    logger.info(f"Smart notification (expiry day) sent to user {telegram_id}")
-                    continue
-                
-                # 8. УВЕДОМЛЕНИЕ: ПОСЛЕ ОКОНЧАНИЯ (ЧЕРЕЗ 24 ЧАСА)
-                if (expires_at < now and 
-                    (now - expires_at) >= timedelta(hours=24) and
-                    not subscription.get("smart_notif_expired_24h_sent", False)):
-                    text = localization.get_text(language, "smart_notif_expired_24h")
-                    keyboard = get_subscription_keyboard(language)
-                    await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET smart_notif_expired_24h_sent = TRUE WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                    logger.info(f"Smart notification (expired 24h) sent to user {telegram_id}")
-                    continue
-                
-                # 9. VIP / АПГРЕЙД (ТОЛЬКО АКТИВНЫЕ ПОЛЬЗОВАТЕЛИ)
-                if (first_traffic_at and 
-                    (now - first_traffic_at) >= timedelta(days=14) and 
-                    current_bytes > 0 and
-                    not subscription.get("smart_notif_vip_offer_sent", False)):
-                    text = localization.get_text(language, "smart_notif_vip_offer")
-                    keyboard = get_vip_offer_keyboard(language)
-                    await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                    async with pool.acquire() as update_conn:
-                        await update_conn.execute(
-                            "UPDATE subscriptions SET smart_notif_vip_offer_sent = TRUE WHERE telegram_id = $1",
-                            telegram_id
-                        )
-                    logger.info(f"Smart notification (VIP offer) sent to user {telegram_id}")
-                    continue
-                
-            except TelegramForbiddenError:
-                # Пользователь заблокировал бота - это ожидаемое поведение, не ошибка
-                logger.info(f"User {telegram_id} blocked bot, skipping smart notification")
-                continue
-            except Exception as e:
-                # Ошибка для одного пользователя не должна ломать цикл
-                logger.error(f"Error sending smart notification to user {telegram_id}: {e}", exc_info=True)
-                continue
+        if checked_count:
+            logger.info(
+                f"Smart notifications: checked={checked_count}, pending={len(pending)}, "
+                f"sent={sent_count}, cycle={time.monotonic() - started:.2f}s"
+            )
                 
     except Exception as e:
         logger.exception(f"Error in send_smart_notifications: {e}")
@@ -325,135 +301,14 @@ async def send_smart_reminders(bot: Bot):
         logger.info(f"Found {len(subscriptions)} subscriptions for reminders check")
         
         now = datetime.now()
-        
-        for subscription in subscriptions:
-            telegram_id = subscription["telegram_id"]
-            expires_at = subscription["expires_at"]
-            if isinstance(expires_at, str):
-                expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-            
-            admin_grant_days = subscription.get("admin_grant_days")
-            last_action_type = subscription.get("last_action_type")
-            
-            # Определяем тип подписки
-            is_admin_grant = admin_grant_days is not None or last_action_type == "admin_grant"
-            
-            try:
-                # Получаем язык пользователя
-                user = await database.get_user(telegram_id)
-                language = user.get("language", "ru") if user else "ru"
-                
-                time_until_expiry = expires_at - now
-                
-                # АДМИН-ВЫДАННЫЙ ДОСТУП
-                if is_admin_grant:
-                    if admin_grant_days == 1:
-                        # 1 день - напоминание за 6 часов
-                        if (timedelta(hours=5.5) <= time_until_expiry <= timedelta(hours=6.5) and 
-                            not subscription.get("reminder_6h_sent", False)):
-                            text = localization.get_text(
-                                language, 
-                                "reminder_admin_1day_6h"
-                            )
-                            keyboard = get_subscription_keyboard(language)
-                            await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                            await database.mark_reminder_flag_sent(telegram_id, "reminder_6h_sent")
-                            # Логируем в audit_log
-                            await database._log_audit_event_atomic_standalone(
-                                "reminder_sent",
-                                telegram_id,
-                                telegram_id,
-                                f"Admin 1-day reminder (6h before expiry)"
-                            )
-                            logger.info(f"Admin 1-day reminder (6h) sent to user {telegram_id}")
-                    
-                    elif admin_grant_days == 7:
-                        # 7 дней - напоминание за 24 часа
-                        if (timedelta(hours=23) <= time_until_expiry <= timedelta(hours=25) and 
-                            not subscription.get("reminder_24h_sent", False)):
-                            text = localization.get_text(
-                                language, 
-                                "reminder_admin_7days_24h"
-                            )
-                            keyboard = get_tariff_1_month_keyboard(language)
-                            await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                            await database.mark_reminder_flag_sent(telegram_id, "reminder_24h_sent")
-                            # Логируем в audit_log
-                            await database._log_audit_event_atomic_standalone(
-                                "reminder_sent",
-                                telegram_id,
-                                telegram_id,
-                                f"Admin 7-day reminder (24h before expiry)"
-                            )
-                            logger.info(f"Admin 7-day reminder (24h) sent to user {telegram_id}")
-                
-                # ОПЛАЧЕННЫЕ ТАРИФЫ
-                else:
-                    # Напоминание за 3 дня
-                    if (timedelta(days=2.9) <= time_until_expiry <= timedelta(days=3.1) and 
-                        not subscription.get("reminder_3d_sent", False)):
-                        text = localization.get_text(
-                            language, 
-                            "reminder_paid_3d"
-                        )
-                        keyboard = get_renewal_keyboard(language)
-                        await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                        await database.mark_reminder_flag_sent(telegram_id, "reminder_3d_sent")
-                        # Логируем в audit_log
-                        await database._log_audit_event_atomic_standalone(
-                            "reminder_sent",
-                            telegram_id,
-                            telegram_id,
-                            f"Paid subscription reminder (3d before expiry)"
-                        )
-                        logger.info(f"Paid subscription reminder (3d) sent to user {telegram_id}")
-                    
-                    # Напоминание за 24 часа
-                    elif (timedelta(hours=23) <= time_until_expiry <= timedelta(hours=25) and 
-                          not subscription.get("reminder_24h_sent", False)):
-                        text = localization.get_text(
-                            language, 
-                            "reminder_paid_24h"
-                        )
-                        keyboard = get_renewal_keyboard(language)
-                        await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                        await database.mark_reminder_flag_sent(telegram_id, "reminder_24h_sent")
-                        # Логируем в audit_log
-                        await database._log_audit_event_atomic_standalone(
-                            "reminder_sent",
-                            telegram_id,
-                            telegram_id,
-                            f"Paid subscription reminder (24h before expiry)"
-                        )
-                        logger.info(f"Paid subscription reminder (24h) sent to user {telegram_id}")
-                    
-                    # Напоминание за 3 часа
-                    elif (timedelta(hours=2.5) <= time_until_expiry <= timedelta(hours=3.5) and 
-                          not subscription.get("reminder_3h_sent", False)):
-                        text = localization.get_text(
-                            language, 
-                            "reminder_paid_3h"
-                        )
-                        keyboard = get_renewal_keyboard(language)
-                        await bot.send_message(telegram_id, text, reply_markup=keyboard)
-                        await database.mark_reminder_flag_sent(telegram_id, "reminder_3h_sent")
-                        # Логируем в audit_log
-                        await database._log_audit_event_atomic_standalone(
-                            "reminder_sent",
-                            telegram_id,
-                            telegram_id,
-                            f"Paid subscription reminder (3h before expiry)"
-                        )
-                        logger.info(f"Paid subscription reminder (3h) sent to user {telegram_id}")
-                
-            except TelegramForbiddenError:
-                # Пользователь заблокировал бота - это ожидаемое поведение, не ошибка
-                logger.info(f"User {telegram_id} blocked bot, skipping reminder")
-                continue
-            except Exception as e:
-                # Ошибка для одного пользователя не должна ломать цикл
-                logger.error(f"Error sending reminder to user {telegram_id}: {e}", exc_info=True)
-                continue
+        pending = [
+            notification
+            for notification in (decide_reminder(subscription, now) for subscription in subscriptions)
+            if notification is not None
+        ]
+        if pending:
+            sent_count = await send_pending_notifications(bot, pending, now, audit_action="reminder_sent")
+            logger.info(f"Reminders sent: {sent_count}/{len(pending)}")
                 
     except Exception as e:
         logger.exception(f"Error in send_smart_reminders: {e}")
@@ -461,6 +316,7 @@ async def send_smart_reminders(bot: Bot):
 
 async def reminders_task(bot: Bot):
     """Фоновая задача для отправки умных напоминаний и уведомлений (выполняется каждые 30-60 минут)"""
+    telegram_gateway.set_lane(telegram_gateway.LANE_REMINDER)
     # Небольшая задержка при старте, чтобы БД успела инициализироваться
     await asyncio.sleep(60)
     
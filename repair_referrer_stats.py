@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Backfill / repair счётчиков реферальной программы (referrer_stats)
+
+Пересчитывает invited_count, paid_count, total_cashback_kopecks, total_revenue_kopecks
+и first_referral_date из истории (referrals, referral_rewards, balance_transactions).
+Те же счётчики читает админ-лидерборд. Безопасно запускать повторно.
+
+Запуск:
+    python repair_referrer_stats.py              # все рефереры
+    python repair_referrer_stats.py <telegram_id> # один реферер
+"""
+import asyncio
+import logging
+import sys
+
+import database
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+
+async def main():
+    referrer_id = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    try:
+        count = await database.rebuild_referrer_stats(referrer_id)
+        print(f"✅ Referrer stats rebuilt for {count} referrer(s)")
+    finally:
+        await database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,113 @@
+"""
+Startup - оркестрация запуска бота
+
+- timed_phase: замер длительности фазы запуска (STARTUP_TIMINGS, мс), фазы
+  без зависимостей друг от друга main.py выполняет параллельно (asyncio.gather)
+- import_in_thread: импорт тяжёлого модуля в потоке, пока event loop ждёт сеть
+- LazyRouter: роутер-заглушка на месте админского роутера; сам модуль
+  импортируется в фоне после старта polling, апдейты на это место ждут загрузки
+- staggered: разнесённый по времени старт фоновых воркеров
+"""
+import asyncio
+import importlib
+import logging
+import os
+import time
+from types import ModuleType
+from typing import Any, Awaitable, Coroutine, Dict, Optional
+
+from aiogram import Router
+
+logger = logging.getLogger(__name__)
+
+# Длительность фаз запуска (мс): импорты, Redis, БД, роутеры, итог до старта polling
+STARTUP_TIMINGS: Dict[str, float] = {}
+
+# Пауза между стартами фоновых воркеров
+WORKER_START_STAGGER_SECONDS = float(os.getenv("WORKER_START_STAGGER_SECONDS", "2"))
+
+
+def record_timing(name: str, started: float) -> float:
+    """Записать длительность фазы от started (time.perf_counter) в STARTUP_TIMINGS"""
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    STARTUP_TIMINGS[name] = elapsed_ms
+    return elapsed_ms
+
+
+async def timed_phase(name: str, awaitable: Awaitable[Any]) -> Any:
+    """Выполнить фазу запуска и записать её длительность (в том числе при ошибке)"""
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        elapsed_ms = record_timing(name, started)
+        logger.info(f"Startup phase '{name}' finished in {elapsed_ms}ms")
+
+
+async def import_in_thread(module_name: str) -> ModuleType:
+    """
+    Импортировать модуль в отдельном потоке и записать время импорта (import:<module>)
+
+    Выполнение кода модуля не блокирует event loop: параллельно идут
+    подключение к Redis, миграции и приём апдейтов.
+    """
+    started = time.perf_counter()
+    module = await asyncio.to_thread(importlib.import_module, module_name)
+    record_timing(f"import:{module_name}", started)
+    return module
+
+
+async def staggered(index: int, worker: Coroutine[Any, Any, Any]) -> Any:
+    """
+    Запустить фоновый воркер с задержкой index * WORKER_START_STAGGER_SECONDS
+
+    Задача создаётся сразу (её можно отменить при остановке), а первые проходы
+    воркеров по БД не совпадают по времени со стартом и друг с другом.
+    """
+    if index and WORKER_START_STAGGER_SECONDS > 0:
+        try:
+            await asyncio.sleep(index * WORKER_START_STAGGER_SECONDS)
+        except asyncio.CancelledError:
+            # Остановка до старта воркера: закрываем не запущенную корутину
+            worker.close()
+            raise
+    return await worker
+
+
+class LazyRouter:
+    """
+    Роутер с отложенным импортом модуля handlers
+
+    self.router включается в Dispatcher на своё место в порядке роутеров
+    (порядок обработки не меняется). Модуль импортируется в фоне (start_loading),
+    его router становится вложенным в self.router. Апдейт, дошедший до этого места
+    раньше окончания загрузки, ждёт её, поэтому он не уходит в следующие роутеры.
+
+    Типы апдейтов для polling aiogram собирает из роутеров на старте, поэтому
+    ленивый модуль не должен добавлять новых типов (сейчас это message/callback_query).
+    """
+
+    def __init__(self, module_name: str):
+        self.module_name = module_name
+        self.router = Router(name=f"lazy:{module_name}")
+        self._loading: Optional[asyncio.Task] = None
+        for observer in self.router.observers.values():
+            observer.outer_middleware(self._wait_loaded)
+
+    def start_loading(self) -> asyncio.Task:
+        """Начать фоновый импорт модуля (повторный вызов возвращает ту же задачу)"""
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._load())
+        return self._loading
+
+    async def _load(self) -> None:
+        module = await import_in_thread(self.module_name)
+        self.router.include_router(module.router)
+        logger.info(
+            f"Lazy router loaded: {self.module_name} "
+            f"({STARTUP_TIMINGS.get(f'import:{self.module_name}')}ms)"
+        )
+
+    async def _wait_loaded(self, handler, event, data):
+        await self.start_loading()
+        return await handler(event, data)
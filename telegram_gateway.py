@@ -0,0 +1,338 @@
+"""
+Telegram Gateway - единый контроль исходящих сообщений бота
+
+Подключается к сессии бота как request middleware (main.py), поэтому охватывает
+все вызовы bot.send_message / send_document / copy_message и т.п., где бы они
+ни находились. Для методов отправки:
+
+- глобальный token bucket (TELEGRAM_GLOBAL_RATE сообщений/с, всплеск TELEGRAM_GLOBAL_BURST)
+- лимит на чат для массовых полос (напоминания, рассылки): не чаще одного
+  сообщения в TELEGRAM_PER_CHAT_INTERVAL_SECONDS; ответы пользователю и оплаты
+  не ждут интервала, но сдвигают следующий слот чата для массовых полос
+- приоритетные полосы: свободный токен получает ожидающий с наивысшим приоритетом
+  (оплаты -> ответы пользователю -> напоминания -> рассылки)
+- TelegramRetryAfter: отправка в этот чат (или во все чаты, если чат у метода
+  не задан) приостанавливается на retry_after, запрос повторяется
+  (до TELEGRAM_RETRY_AFTER_MAX_ATTEMPTS раз)
+- метрики: глубина очереди по полосам, задержка в очереди и время отправки (p50/p95)
+- постоянная ошибка отправки пользователю (бот заблокирован, аккаунт удалён, чат
+  не найден) отмечает его недоступным (users.unreachable_since), массовые отправки
+  его пропускают; отметку снимает следующий входящий апдейт (reachability_middleware)
+
+Полоса задаётся контекстом вызывающего кода:
+    telegram_gateway.set_lane(telegram_gateway.LANE_REMINDER)  # на всю фоновую задачу
+    with telegram_gateway.lane(telegram_gateway.LANE_PAYMENT):  # на участок кода
+        await bot.send_message(...)
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "28"))
+TELEGRAM_GLOBAL_BURST = float(os.getenv("TELEGRAM_GLOBAL_BURST", "5"))
+TELEGRAM_PER_CHAT_INTERVAL_SECONDS = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL_SECONDS", "1"))
+TELEGRAM_RETRY_AFTER_MAX_ATTEMPTS = int(os.getenv("TELEGRAM_RETRY_AFTER_MAX_ATTEMPTS", "3"))
+
+# Полосы: меньшее значение - выше приоритет
+LANE_PAYMENT = 0
+LANE_INTERACTIVE = 1
+LANE_REMINDER = 2
+LANE_BROADCAST = 3
+
+LANE_NAMES = {
+    LANE_PAYMENT: "payment",
+    LANE_INTERACTIVE: "interactive",
+    LANE_REMINDER: "reminder",
+    LANE_BROADCAST: "broadcast",
+}
+
+# Полосы, на которые действует интервал между сообщениями в один чат
+PER_CHAT_PACED_LANES = {LANE_REMINDER, LANE_BROADCAST}
+
+# Методы API, отправляющие сообщение в чат (на них действуют лимиты Telegram)
+RATE_LIMITED_METHODS = {
+    "SendMessage", "SendPhoto", "SendDocument", "SendVideo", "SendAnimation",
+    "SendAudio", "SendVoice", "SendSticker", "SendMediaGroup", "SendLocation",
+    "SendContact", "SendPoll", "SendInvoice", "CopyMessage", "ForwardMessage",
+}
+
+LATENCY_SAMPLES = 1000
+
+# Ответы TelegramBadRequest, после которых повторять отправку бессмысленно
+PERMANENT_BAD_REQUEST_MARKERS = ("chat not found", "user is deactivated", "user not found")
+
+_current_lane: contextvars.ContextVar[int] = contextvars.ContextVar("telegram_lane", default=LANE_INTERACTIVE)
+
+
+def set_lane(value: int) -> None:
+    """Задать полосу для текущего контекста (например, на всю фоновую задачу)"""
+    _current_lane.set(value)
+
+
+@contextmanager
+def lane(value: int) -> Iterator[None]:
+    """Выполнить участок кода с заданной полосой исходящих сообщений"""
+    token = _current_lane.set(value)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def is_permanent_send_error(error: Exception) -> bool:
+    """Ошибка отправки, после которой чат недоступен до действия пользователя"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        message = str(error).lower()
+        return any(marker in message for marker in PERMANENT_BAD_REQUEST_MARKERS)
+    return False
+
+
+async def _mark_unreachable(chat_id: Any, error: Exception) -> None:
+    # Группы и каналы (отрицательные ID) в users не хранятся
+    if not isinstance(chat_id, int) or chat_id <= 0:
+        return
+    try:
+        if await database.mark_user_unreachable(chat_id):
+            logger.info(f"User {chat_id} marked unreachable: {error}")
+    except Exception as e:
+        logger.warning(f"Failed to mark user {chat_id} unreachable: {e}")
+
+
+def _percentile(samples: Deque[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 1)
+
+
+class TelegramGateway:
+    """Планировщик отправки: token bucket + лимит на чат + приоритет полос"""
+
+    def __init__(
+        self,
+        rate: float = TELEGRAM_GLOBAL_RATE,
+        burst: float = TELEGRAM_GLOBAL_BURST,
+        per_chat_interval: float = TELEGRAM_PER_CHAT_INTERVAL_SECONDS,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.per_chat_interval = per_chat_interval
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next_at: Dict[Any, float] = {}
+        self._chat_paused_until: Dict[Any, float] = {}
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._queue_depth = {name: 0 for name in LANE_NAMES.values()}
+        self._sent = {name: 0 for name in LANE_NAMES.values()}
+        self._retry_after_count = 0
+        self._wait_seconds: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self._send_seconds: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+
+    # --- Лимиты ---
+
+    def _reserve_chat_slot(self, chat_id: Any, paced: bool) -> float:
+        """
+        Зарезервировать слот чата, вернуть задержку до него (секунды)
+
+        Пауза чата после retry_after действует на все полосы; интервал между
+        сообщениями - только на массовые (paced), остальные отправляются сразу.
+        """
+        now = time.monotonic()
+        slot = max(now, self._chat_paused_until.get(chat_id, 0.0))
+        if paced and self.per_chat_interval > 0:
+            slot = max(slot, self._chat_next_at.get(chat_id, 0.0))
+        if self.per_chat_interval > 0:
+            self._chat_next_at[chat_id] = max(self._chat_next_at.get(chat_id, 0.0), slot + self.per_chat_interval)
+        if len(self._chat_next_at) > 10000:
+            # Забываем чаты, чьи слоты уже прошли
+            self._chat_next_at = {c: t for c, t in self._chat_next_at.items() if t > now}
+            self._chat_paused_until = {c: t for c, t in self._chat_paused_until.items() if t > now}
+        return slot - now
+
+    def _token_delay(self) -> float:
+        """Взять токен, если он есть (0), иначе вернуть время до появления токена"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def pause(self, seconds: float, chat_id: Any = None) -> None:
+        """
+        Ответ 429 с retry_after: приостановить отправку в чат chat_id,
+        а если чат не задан - во всех полосах
+        """
+        until = time.monotonic() + seconds
+        if chat_id is None:
+            self._paused_until = max(self._paused_until, until)
+            self._tokens = 0
+        else:
+            self._chat_paused_until[chat_id] = max(self._chat_paused_until.get(chat_id, 0.0), until)
+        self._retry_after_count += 1
+
+    # --- Очередь ---
+
+    def _ensure_dispatcher(self) -> None:
+        if (
+            self._dispatcher is None
+            or self._dispatcher.done()
+            or self._dispatcher.get_loop() is not asyncio.get_running_loop()
+        ):
+            # Ожидания прежнего event loop (перезапуск) уже никто не ждёт
+            self._waiters = [w for w in self._waiters if not w[2].done() and w[2].get_loop() is asyncio.get_running_loop()]
+            heapq.heapify(self._waiters)
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self) -> None:
+        """Выдавать токены ожидающим по приоритету полос"""
+        while True:
+            # Отменённые ожидания не получают токен
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._token_delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Ожидание отменили, пока ждали токен - возвращаем его
+                self._tokens = min(self.burst, self._tokens + 1)
+                continue
+            future.set_result(None)
+
+    async def acquire(self, lane_value: int, chat_id: Any = None) -> float:
+        """
+        Дождаться права на отправку сообщения
+
+        Returns:
+            Время ожидания (секунды)
+        """
+        started = time.monotonic()
+        lane_name = LANE_NAMES.get(lane_value, LANE_NAMES[LANE_INTERACTIVE])
+        self._queue_depth[lane_name] += 1
+        try:
+            if chat_id is not None:
+                chat_delay = self._reserve_chat_slot(chat_id, lane_value in PER_CHAT_PACED_LANES)
+                if chat_delay > 0:
+                    await asyncio.sleep(chat_delay)
+            self._ensure_dispatcher()
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (lane_value, next(self._seq), future))
+            self._wakeup.set()
+            await future
+        finally:
+            self._queue_depth[lane_name] -= 1
+        waited = time.monotonic() - started
+        self._wait_seconds.append(waited)
+        return waited
+
+    async def close(self) -> None:
+        """Остановить диспетчер (при остановке бота)"""
+        if self._dispatcher is not None and not self._dispatcher.done():
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+        self._dispatcher = None
+
+    def record_sent(self, lane_value: int, send_seconds: float) -> None:
+        self._sent[LANE_NAMES.get(lane_value, LANE_NAMES[LANE_INTERACTIVE])] += 1
+        self._send_seconds.append(send_seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики шлюза: глубина очереди, отправлено по полосам, задержки (мс)"""
+        return {
+            "queue_depth": dict(self._queue_depth),
+            "sent": dict(self._sent),
+            "retry_after": self._retry_after_count,
+            "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 1),
+            "wait_ms_p50": _percentile(self._wait_seconds, 0.5),
+            "wait_ms_p95": _percentile(self._wait_seconds, 0.95),
+            "send_ms_p50": _percentile(self._send_seconds, 0.5),
+            "send_ms_p95": _percentile(self._send_seconds, 0.95),
+        }
+
+
+gateway = TelegramGateway()
+
+
+class GatewayMiddleware(BaseRequestMiddleware):
+    """Request middleware сессии бота: пропускает методы отправки через gateway"""
+
+    def __init__(self, telegram_gateway: TelegramGateway = gateway):
+        self.gateway = telegram_gateway
+
+    async def __call__(self, make_request, bot, method):
+        if type(method).__name__ not in RATE_LIMITED_METHODS:
+            return await make_request(bot, method)
+
+        lane_value = _current_lane.get()
+        chat_id = getattr(method, "chat_id", None)
+        attempt = 0
+        while True:
+            await self.gateway.acquire(lane_value, chat_id)
+            started = time.monotonic()
+            try:
+                response = await make_request(bot, method)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                if is_permanent_send_error(e):
+                    await _mark_unreachable(chat_id, e)
+                raise
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self.gateway.pause(e.retry_after, chat_id)
+                logger.warning(
+                    f"Telegram flood control: retry_after={e.retry_after}s, chat={chat_id}, "
+                    f"lane={LANE_NAMES.get(lane_value)}, attempt={attempt}"
+                )
+                if attempt >= TELEGRAM_RETRY_AFTER_MAX_ATTEMPTS:
+                    raise
+                continue
+            self.gateway.record_sent(lane_value, time.monotonic() - started)
+            return response
+
+
+async def reachability_middleware(handler, event, data):
+    """Outer middleware апдейтов: входящий апдейт снимает отметку недоступности"""
+    user = data.get("event_from_user")
+    if user is not None and database.DB_READY:
+        try:
+            if await database.clear_user_unreachable(user.id):
+                logger.info(f"User {user.id} is reachable again")
+        except Exception as e:
+            logger.warning(f"Failed to clear unreachable mark for user {user.id}: {e}")
+    return await handler(event, data)
+
+
+def get_stats() -> Dict[str, Any]:
+    return gateway.get_stats()
@@ -7,3 +7,21 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 
+from unittest.mock import AsyncMock, MagicMock
+
+
+@pytest.fixture
+def mock_db(mocker):
+    """Соединение БД без сервера: database.get_pool() -> pool, pool.acquire() -> mock_db
+
+    conn.transaction() - асинхронный контекстный менеджер (в том числе вложенный, savepoint)
+    """
+    conn = AsyncMock()
+    conn.transaction = MagicMock(return_value=AsyncMock())
+    acquire_ctx = AsyncMock()
+    acquire_ctx.__aenter__.return_value = conn
+    acquire_ctx.__aexit__.return_value = None
+    pool = MagicMock()
+    pool.acquire.return_value = acquire_ctx
+    mocker.patch('database.get_pool', new_callable=AsyncMock, return_value=pool)
+    return conn
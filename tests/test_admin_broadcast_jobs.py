@@ -0,0 +1,25 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import config
+from handlers.admin import admin_legacy
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("changed, alert", [(True, False), (False, True)])
+async def test_broadcast_job_control_answers_callback_once(mocker, changed, alert):
+    mocker.patch('database.set_broadcast_job_status', new_callable=AsyncMock, return_value=changed)
+    mocker.patch('database._log_audit_event_atomic_standalone', new_callable=AsyncMock)
+    mocker.patch('database.get_broadcast_jobs', new_callable=AsyncMock, return_value=[])
+    edit = mocker.patch.object(admin_legacy, 'safe_edit_text', new_callable=AsyncMock)
+    callback = MagicMock(data="broadcast:job:pause:7")
+    callback.from_user.id = config.ADMIN_TELEGRAM_ID
+    callback.answer = AsyncMock()
+
+    await admin_legacy.callback_broadcast_job_control(callback)
+
+    # Повторный ответ на тот же callback Telegram отклоняет, и алерт бы потерялся
+    callback.answer.assert_awaited_once()
+    assert callback.answer.await_args.kwargs.get("show_alert", False) is alert
+    edit.assert_awaited_once()
@@ -0,0 +1,60 @@
+from unittest.mock import AsyncMock
+
+import pytest
+
+import audit_writer
+import database
+
+
+@pytest.mark.asyncio
+async def test_audit_writer_batches_and_flushes_on_stop(mocker):
+    mocker.patch.object(audit_writer, 'AUDIT_QUEUE_MAX_SIZE', 3)
+    mocker.patch.object(audit_writer, 'AUDIT_FLUSH_INTERVAL_MS', 60000)
+    mocker.patch.dict(audit_writer.AUDIT_WRITER_STATS, {key: 0 for key in audit_writer.AUDIT_WRITER_STATS})
+    write = mocker.patch('audit_writer.write_records', new_callable=AsyncMock)
+
+    audit_writer.start()
+    for i in range(3):
+        await database._log_audit_event_atomic_standalone("admin_view_stats", 1, None, f"event {i}")
+    # Очередь заполнена: без ожидания событие отбрасывается
+    assert audit_writer.submit_nowait("admin_view_stats", 1) is False
+
+    await audit_writer.stop()
+
+    written = [record for call in write.await_args_list for record in call.args[0]]
+    assert [r[6] for r in written] == ["event 0", "event 1", "event 2"]
+    stats = audit_writer.AUDIT_WRITER_STATS
+    assert stats["written"] == 3 and stats["enqueued"] == 3 and stats["dropped"] == 1
+    assert not audit_writer.is_running()
+
+
+@pytest.mark.asyncio
+async def test_audit_writer_retries_then_writes_rows_one_by_one(mocker, mock_db):
+    mocker.patch.object(audit_writer, 'AUDIT_FLUSH_RETRY_BASE_MS', 0)
+    mocker.patch.dict(audit_writer.AUDIT_WRITER_STATS, {key: 0 for key in audit_writer.AUDIT_WRITER_STATS})
+    write = mocker.patch('audit_writer.write_records', new_callable=AsyncMock, side_effect=Exception("bad row"))
+    # Второе событие не записывается и по одному: отбрасывается только оно
+    mock_db.copy_records_to_table.side_effect = [None, Exception("bad row"), None]
+    batch = [audit_writer._record("admin_view_stats", 1, None, None, None, None, f"event {i}") for i in range(3)]
+
+    await audit_writer._flush(batch)
+
+    assert write.await_count == audit_writer.AUDIT_FLUSH_RETRIES
+    assert [c.kwargs["records"][0][6] for c in mock_db.copy_records_to_table.await_args_list] == [
+        "event 0", "event 1", "event 2"
+    ]
+    stats = audit_writer.AUDIT_WRITER_STATS
+    assert stats["retries"] == audit_writer.AUDIT_FLUSH_RETRIES - 1
+    assert stats["failed_batches"] == 1 and stats["written"] == 2 and stats["dropped"] == 1
+
+
+@pytest.mark.asyncio
+async def test_audit_writer_retry_recovers_whole_batch(mocker):
+    mocker.patch.object(audit_writer, 'AUDIT_FLUSH_RETRY_BASE_MS', 0)
+    mocker.patch.dict(audit_writer.AUDIT_WRITER_STATS, {key: 0 for key in audit_writer.AUDIT_WRITER_STATS})
+    mocker.patch('audit_writer.write_records', new_callable=AsyncMock, side_effect=[Exception("connection reset"), None])
+
+    await audit_writer._flush([audit_writer._record("admin_view_stats", 1, None, None, None, None, None)])
+
+    stats = audit_writer.AUDIT_WRITER_STATS
+    assert stats["written"] == 1 and stats["retries"] == 1 and stats["dropped"] == 0 and stats["failed_batches"] == 0
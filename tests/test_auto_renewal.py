@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import auto_renewal
+import database
+
+
+@pytest.mark.asyncio
+async def test_auto_renewal_preloads_tariffs_and_collects_cycle_metrics(mocker):
+    async def fake_stream(query, *args):
+        for telegram_id in (1, 2, 3):
+            yield {"telegram_id": telegram_id, "language": "ru", "balance": 100000}
+
+    mocker.patch('database.stream_rows', side_effect=fake_stream)
+    tariffs = mocker.patch(
+        'database.get_last_approved_tariffs', new_callable=AsyncMock, return_value={1: "plus_90", 2: "3"}
+    )
+    outcomes = {1: auto_renewal.RENEWAL_RENEWED, 2: auto_renewal.RENEWAL_INSUFFICIENT_BALANCE}
+
+    async def fake_renew(bot, subscription, last_tariff, now):
+        if subscription["telegram_id"] == 3:
+            raise RuntimeError("db error")
+        return outcomes[subscription["telegram_id"]]
+
+    renew = mocker.patch('auto_renewal.renew_subscription', side_effect=fake_renew)
+    mocker.patch.dict(auto_renewal.AUTO_RENEWAL_STATS, {"cycles": 0, "renewed": 0, "failed": 0, "last_cycle": {}})
+
+    cycle = await auto_renewal.process_auto_renewals(MagicMock())
+
+    tariffs.assert_awaited_once_with([1, 2, 3])
+    assert sorted(c.args[2] for c in renew.call_args_list if c.args[2]) == ["3", "plus_90"]
+    assert (cycle["candidates"], cycle["renewed"], cycle["insufficient_balance"], cycle["failed"]) == (3, 1, 1, 1)
+    assert auto_renewal.get_stats()["failed"] == 1
+    assert auto_renewal.parse_tariff("3") == ("basic", 90) and auto_renewal.parse_tariff(None) == ("basic", 30)
+
+
+@pytest.mark.asyncio
+async def test_renew_subscription_debits_inside_its_transaction(mocker, mock_db):
+    now = datetime(2026, 3, 15, 10, 0)
+    expires_at = now + timedelta(hours=3)
+    mock_db.fetchrow.return_value = {"auto_renew": True, "expires_at": expires_at, "last_auto_renewal_at": None}
+    mocker.patch('auto_renewal._renewal_price', new_callable=AsyncMock, return_value=149.0)
+    ledger = mocker.patch(
+        'database._apply_ledger_entry', new_callable=AsyncMock,
+        return_value={"status": database.LEDGER_APPLIED, "balance": 100}
+    )
+    decrease = mocker.patch('database.decrease_balance', new_callable=AsyncMock)
+    increase = mocker.patch('database.increase_balance', new_callable=AsyncMock)
+    # UUID пересоздан: продление невалидно
+    mocker.patch('database.grant_access', new_callable=AsyncMock, return_value={
+        "subscription_end": expires_at + timedelta(days=30), "action": "new_issuance", "vless_url": "vless://x",
+    })
+    subscription = {"telegram_id": 5, "language": "ru", "balance": 20000}
+
+    outcome = await auto_renewal.renew_subscription(MagicMock(), subscription, "basic_30", now)
+
+    assert outcome == auto_renewal.RENEWAL_FAILED
+    conn, telegram_id, amount = ledger.await_args.args[:3]
+    assert conn is mock_db and (telegram_id, amount) == (5, -14900)
+    assert ledger.await_args.kwargs["idempotency_key"] == "auto_renew:5:20260315130000"
+    # Списание откатывается вместе с транзакцией: ни отдельного списания, ни возврата
+    exc_type = mock_db.transaction.return_value.__aexit__.await_args.args[0]
+    assert exc_type is auto_renewal._RenewalRollback
+    decrease.assert_not_awaited()
+    increase.assert_not_awaited()
+    mock_db.execute.assert_not_awaited()
+
+    # Повторный вызов за тот же период - проводка уже есть, продление пропускается
+    ledger.return_value = {"status": database.LEDGER_DUPLICATE, "balance": 100}
+    assert await auto_renewal.renew_subscription(MagicMock(), subscription, "basic_30", now) == auto_renewal.RENEWAL_SKIPPED
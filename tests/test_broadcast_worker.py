@@ -0,0 +1,66 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import broadcast_worker
+import database
+
+
+@pytest.mark.asyncio
+async def test_broadcast_job_resumes_from_checkpoint_and_stops_when_paused(mocker):
+    mocker.patch.object(broadcast_worker, 'BROADCAST_BATCH_SIZE', 2)
+
+    async def fake_stream(query, batch_size, after):
+        for telegram_id in (11, 12, 13, 14, 15):
+            if telegram_id > after:
+                yield {"telegram_id": telegram_id}
+
+    mocker.patch('database.stream_rows', side_effect=fake_stream)
+    checkpoint = mocker.patch(
+        'database.checkpoint_broadcast_job', new_callable=AsyncMock,
+        side_effect=["running", "paused"]
+    )
+    finish = mocker.patch('database.finish_broadcast_job', new_callable=AsyncMock)
+    bot = MagicMock()
+    bot.send_message = AsyncMock(side_effect=[None, Exception("blocked"), None, None])
+
+    job = {
+        "id": 7, "segment": "all_users", "type": "info", "title": "T", "message": "M",
+        "is_ab_test": False, "message_a": None, "message_b": None,
+        "total_recipients": 5, "last_telegram_id": 11,
+    }
+    status = await broadcast_worker.run_broadcast_job(bot, job)
+
+    assert status == "paused"
+    # Продолжение после контрольной точки 11, остановка после второго пакета
+    assert [c.args[0] for c in bot.send_message.await_args_list] == [12, 13, 14, 15]
+    first_results, first_last, worker_id = checkpoint.await_args_list[0].args[1:]
+    assert first_results == [(12, "sent", None), (13, "failed", None)] and first_last == 13
+    assert worker_id == broadcast_worker.BROADCAST_WORKER_ID
+    assert checkpoint.await_args_list[1].args[2] == 15
+    finish.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_broadcast_job_lease_keeps_running_job_on_one_replica(mock_db):
+    mock_db.fetchrow.side_effect = [
+        {"id": 7, "total_recipients": 5, "segment": "all_users"},
+        {"id": 7, "job_status": "running", "locked_by": "a:1"},
+    ]
+    job = await database.claim_next_broadcast_job("a:1")
+
+    claim_query = mock_db.fetchrow.await_args_list[0].args[0]
+    # running берётся только с истёкшей арендой
+    assert "job_status = 'running' AND (lease_until IS NULL OR lease_until < NOW())" in claim_query
+    assert mock_db.fetchrow.await_args_list[1].args[3:] == ("a:1", database.BROADCAST_JOB_LEASE_SECONDS)
+    assert job["locked_by"] == "a:1"
+
+    # Аренда перешла к другой реплике: пакет не записывается, воркер останавливается
+    mock_db.fetchval.return_value = None
+    assert await database.checkpoint_broadcast_job(7, [(12, "sent", None)], 12, "a:1") is None
+    assert "locked_by = $5" in mock_db.fetchval.await_args.args[0]
+    mock_db.copy_records_to_table.assert_not_awaited()
+
+    mock_db.fetchval.return_value = "running"
+    assert await database.checkpoint_broadcast_job(7, [(12, "sent", None)], 12, "a:1") == "running"
+    mock_db.copy_records_to_table.assert_awaited_once()
@@ -0,0 +1,39 @@
+from unittest.mock import AsyncMock
+
+import pytest
+
+import convert_log_partitions
+
+
+@pytest.mark.asyncio
+async def test_convert_table_copies_in_batches_then_retries_switch(mocker):
+    mocker.patch.object(convert_log_partitions, 'PARTITION_CONVERSION_BATCH_SIZE', 2)
+    mocker.patch.object(convert_log_partitions, 'PARTITION_CONVERSION_BATCH_PAUSE_SECONDS', 0)
+    mocker.patch.object(convert_log_partitions, 'PARTITION_CONVERSION_SWITCH_RETRY_SECONDS', 0)
+    start = mocker.patch('database.start_partition_conversion', new_callable=AsyncMock, return_value=True)
+    # Два полных пакета и неполный; затем пакет, докопировавший строки после неудачного переключения
+    batch = mocker.patch('database.copy_partition_conversion_batch', new_callable=AsyncMock, side_effect=[2, 2, 1, 1])
+    # Первое переключение не дождалось блокировки
+    finish = mocker.patch('database.finish_partition_conversion', new_callable=AsyncMock, side_effect=[None, 0])
+
+    assert await convert_log_partitions.convert_table("audit_log") is True
+
+    start.assert_awaited_once_with("audit_log", 3)
+    assert batch.await_count == 4
+    assert finish.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_convert_table_skips_partitioned_and_gives_up_without_lock(mocker):
+    mocker.patch.object(convert_log_partitions, 'PARTITION_CONVERSION_SWITCH_ATTEMPTS', 2)
+    mocker.patch.object(convert_log_partitions, 'PARTITION_CONVERSION_SWITCH_RETRY_SECONDS', 0)
+    mocker.patch('database.start_partition_conversion', new_callable=AsyncMock, side_effect=[False, True])
+    mocker.patch('database.copy_partition_conversion_batch', new_callable=AsyncMock, return_value=0)
+    finish = mocker.patch('database.finish_partition_conversion', new_callable=AsyncMock, return_value=None)
+
+    # Уже секционирована: ничего не копируем
+    assert await convert_log_partitions.convert_table("audit_log") is True
+    finish.assert_not_awaited()
+
+    assert await convert_log_partitions.convert_table("broadcast_log") is False
+    assert finish.await_count == 2
@@ -0,0 +1,43 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import crypto_payment_watcher as watcher
+
+
+@pytest.mark.asyncio
+async def test_crypto_watcher_polls_only_due_invoices_and_backs_off_when_webhooks_healthy(mocker, mock_db):
+    mock_db.fetch.return_value = [
+        {"purchase_id": "new", "telegram_id": 1, "provider_invoice_id": "11", "age_seconds": 10},
+        {"purchase_id": "old", "telegram_id": 2, "provider_invoice_id": "22", "age_seconds": 3600},
+    ]
+    mocker.patch('payments.cryptobot.is_enabled', return_value=True)
+    check = mocker.patch('payments.cryptobot.check_invoices_status', new_callable=AsyncMock, return_value={})
+    mocker.patch.object(watcher, '_last_checked', {"gone": 0.0})
+    mocker.patch.object(watcher, '_last_webhook_at', None)
+    mocker.patch.object(watcher, '_last_missed_webhook_at', None)
+    mocker.patch.dict(watcher.CRYPTO_WATCHER_STATS, {"api_calls": 0, "webhooks_received": 0})
+    clock = mocker.patch('crypto_payment_watcher.time.monotonic', return_value=1000.0)
+
+    assert await watcher.check_crypto_payments(MagicMock()) == 2
+    assert sorted(check.await_args.args[0]) == [11, 22]
+    assert set(watcher._last_checked) == {"new", "old"}
+
+    # Через 10 секунд пора проверить только новый invoice, старый - на интервале отступа
+    clock.return_value = 1010.0
+    assert await watcher.check_crypto_payments(MagicMock()) == 1
+    assert check.await_args.args[0] == [11]
+
+    # Webhook исправен: опрос только страховочный
+    watcher.record_webhook()
+    clock.return_value = 1020.0
+    assert watcher.webhooks_healthy()
+    assert await watcher.check_crypto_payments(MagicMock()) == 0
+    assert watcher.get_stats()["api_calls"] == 2
+
+    # Оплату нашёл опрос - webhook пропущен, снова частый опрос
+    watcher.record_confirmation("poll")
+    assert not watcher.webhooks_healthy()
+    assert watcher.poll_interval(10, False) == watcher.CRYPTO_POLL_MIN_INTERVAL_SECONDS
+    assert watcher.poll_interval(10, True) == watcher.CRYPTO_POLL_SAFETY_NET_SECONDS
+    assert watcher.poll_interval(10 ** 6, False) == watcher.CRYPTO_POLL_MAX_INTERVAL_SECONDS
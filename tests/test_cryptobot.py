@@ -0,0 +1,33 @@
+import json
+
+import httpx
+import pytest
+
+from payments import cryptobot
+
+
+@pytest.mark.asyncio
+async def test_cryptobot_checks_invoices_in_batched_requests(mocker):
+    requests = []
+
+    def handler(request):
+        body = json.loads(request.content)
+        requests.append(body)
+        items = [
+            {"invoice_id": invoice_id, "status": "paid" if invoice_id == 2 else "active",
+             "payload": f"purchase:{invoice_id}", "amount": "1.5"}
+            for invoice_id in body["invoice_ids"] if invoice_id != 4
+        ]
+        return httpx.Response(200, json={"ok": True, "result": {"items": items}})
+
+    mocker.patch.object(cryptobot, 'CRYPTOBOT_API_TOKEN', "token")
+    mocker.patch.object(cryptobot, 'CRYPTOBOT_INVOICES_PER_REQUEST', 3)
+    mocker.patch.object(cryptobot, '_client', httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+    statuses = await cryptobot.check_invoices_status([1, 2, 3, 4, 2])
+    await cryptobot.close()
+
+    assert [r["invoice_ids"] for r in requests] == [[1, 2, 3], [4]]
+    assert requests[0]["count"] == 3
+    assert sorted(statuses) == [1, 2, 3]
+    assert statuses[2]["status"] == "paid" and statuses[1]["status"] == "pending"
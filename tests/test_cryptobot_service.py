@@ -0,0 +1,116 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import cryptobot_service
+import database
+
+
+def _webhook_request(invoice_id):
+    body = {"update_type": "invoice_paid", "payload": {"invoice_id": invoice_id, "status": "paid"}}
+    request = MagicMock()
+    request.headers = {"X-Crypto-Pay-API-Signature": "sig"}
+    request.read = AsyncMock(return_value=json.dumps(body).encode())
+    return request
+
+
+@pytest.fixture
+def webhook(mocker):
+    mocker.patch('cryptobot_service.is_enabled', return_value=True)
+    mocker.patch('cryptobot_service._verify_webhook_signature', return_value=True)
+    mocker.patch('database.DB_READY', True)
+    mocker.patch('crypto_payment_watcher.record_webhook')
+    mocker.patch.dict(cryptobot_service.WEBHOOK_STATS, {key: 0 for key in cryptobot_service.WEBHOOK_STATS})
+    redis = MagicMock()
+    redis.exists = AsyncMock(side_effect=lambda key: key.endswith(":9"))
+    redis.set = AsyncMock()
+    mocker.patch('redis_client.get_redis_client', new_callable=AsyncMock, return_value=redis)
+    return redis
+
+
+@pytest.mark.asyncio
+async def test_cryptobot_webhook_acks_only_after_recording_the_invoice(mocker, webhook):
+    enqueue = mocker.patch(
+        'database.enqueue_cryptobot_webhook_event', new_callable=AsyncMock,
+        side_effect=[11, None, ConnectionError("db down")]
+    )
+    process = mocker.patch('cryptobot_service.process_paid_invoice', new_callable=AsyncMock)
+
+    async def status_of(invoice_id):
+        response = await cryptobot_service.handle_webhook(_webhook_request(invoice_id), MagicMock())
+        return response.status, json.loads(response.text)["status"]
+
+    assert await status_of(7) == (200, "queued")
+    # Повтор: уже записан в inbox (уникальный invoice_id)
+    assert await status_of(7) == (200, "duplicate")
+    # Не удалось записать - не подтверждаем, провайдер доставит повторно
+    assert await status_of(8) == (503, "retry")
+    # Уже обработан: отсекается по ключу Redis без обращения к БД
+    assert await status_of(9) == (200, "duplicate")
+
+    assert [c.args[0] for c in enqueue.await_args_list] == ["7", "7", "8"]
+    assert json.loads(enqueue.await_args_list[0].args[1])["invoice_id"] == 7
+    # Handler только записывает invoice, обработка - в воркерах
+    process.assert_not_awaited()
+    stats = cryptobot_service.get_stats()
+    assert (stats["enqueued"], stats["duplicates"], stats["enqueue_errors"]) == (1, 2, 1)
+
+
+@pytest.mark.asyncio
+async def test_cryptobot_webhook_event_marks_dedupe_only_after_success(mocker, webhook):
+    complete = mocker.patch('database.complete_cryptobot_webhook_event', new_callable=AsyncMock)
+    fail = mocker.patch('database.fail_cryptobot_webhook_event', new_callable=AsyncMock, return_value="pending")
+    mocker.patch(
+        'cryptobot_service.process_paid_invoice', new_callable=AsyncMock,
+        side_effect=["ok", "error", RuntimeError("vpn api down")]
+    )
+
+    def event(event_id, attempts=1):
+        return {"id": event_id, "invoice_id": str(event_id), "payload": json.dumps({"invoice_id": event_id}), "attempts": attempts}
+
+    assert await cryptobot_service.process_event(MagicMock(), event(1)) == "ok"
+    assert await cryptobot_service.process_event(MagicMock(), event(2)) == "error"
+    assert await cryptobot_service.process_event(MagicMock(), event(3, attempts=4)) == "error"
+
+    complete.assert_awaited_once_with(1, "ok")
+    webhook.set.assert_awaited_once()
+    assert webhook.set.await_args.args[0] == f"{cryptobot_service.WEBHOOK_DEDUPE_KEY_PREFIX}1"
+    assert [c.args[:2] for c in fail.await_args_list] == [(2, 1), (3, 4)]
+    assert fail.await_args_list[1].args[2] == "vpn api down"
+
+
+@pytest.mark.asyncio
+async def test_cryptobot_webhook_workers_return_cancelled_events_to_inbox(mocker, webhook):
+    mocker.patch.object(cryptobot_service, 'CRYPTOBOT_WEBHOOK_WORKERS', 1)
+    mocker.patch.object(cryptobot_service, 'CRYPTOBOT_WEBHOOK_STOP_TIMEOUT_SECONDS', 0.05)
+    events = [{"id": 5, "invoice_id": "5", "payload": json.dumps({"invoice_id": 5}), "attempts": 1}]
+    mocker.patch(
+        'database.claim_cryptobot_webhook_event', new_callable=AsyncMock,
+        side_effect=lambda: events.pop() if events else None
+    )
+    release = mocker.patch('database.release_cryptobot_webhook_event', new_callable=AsyncMock)
+    started = asyncio.Event()
+
+    async def slow_process(bot, invoice):
+        started.set()
+        await asyncio.sleep(10)
+
+    mocker.patch('cryptobot_service.process_paid_invoice', side_effect=slow_process)
+
+    cryptobot_service.start_workers(MagicMock())
+    await started.wait()
+    await cryptobot_service.stop_workers()
+
+    release.assert_awaited_once_with(5)
+    assert not cryptobot_service.is_running()
+
+
+@pytest.mark.asyncio
+async def test_cryptobot_webhook_event_fails_after_max_attempts(mock_db):
+    status = await database.fail_cryptobot_webhook_event(1, 1, "timeout")
+    assert status == "pending" and mock_db.execute.await_args.args[2:] == ("pending", "timeout", 30)
+
+    status = await database.fail_cryptobot_webhook_event(1, database.CRYPTOBOT_WEBHOOK_MAX_ATTEMPTS, "timeout")
+    assert status == "failed"
@@ -1,5 +1,8 @@
 import pytest
-from unittest.mock import MagicMock, AsyncMock
+import gzip
+import asyncpg
+from datetime import date, datetime
+from unittest.mock import AsyncMock
 import database
 
 # Test Helper Functions
@@ -17,29 +20,7 @@ def test_safe_float():
 
 # Mock DB Logic
 @pytest.mark.asyncio
-async def test_increase_balance(mocker):
-    # Mock the pool (AsyncMock for get_pool return value, but acquire is synchronous returning context manager)
-    mock_pool = MagicMock()
-    mock_conn = AsyncMock()
-    mock_transaction = AsyncMock()
-    
-    # Configure context managers
-    # pool.acquire() returns an async context manager
-    mock_acquire_ctx = AsyncMock()
-    mock_acquire_ctx.__aenter__.return_value = mock_conn
-    mock_acquire_ctx.__aexit__.return_value = None
-    mock_pool.acquire.return_value = mock_acquire_ctx
-
-    # conn.transaction() returns an async context manager, but the method itself is synchronous
-    mock_transaction_ctx = AsyncMock()
-    mock_transaction_ctx.__aenter__.return_value = mock_transaction
-    mock_transaction_ctx.__aexit__.return_value = None
-    mock_conn.transaction = MagicMock(return_value=mock_transaction_ctx)
-    
-    # Patch get_pool to return our mock pool
-    # get_pool is async, so it returns a coroutine that returns result
-    mocker.patch('database.get_pool', new_callable=AsyncMock, return_value=mock_pool)
-    
+async def test_increase_balance(mocker, mock_db):
     # Run the function
     result = await database.increase_balance(
         telegram_id=123,
@@ -52,11 +33,399 @@ async def test_increase_balance(mocker):
     assert result is True
     
     # Verify SQL execution
-    # Balance update (amount converted to kopecks: 100.0 * 100 = 10000)
-    mock_conn.execute.assert_any_call(
-        "UPDATE users SET balance = balance + $1 WHERE telegram_id = $2",
-        10000, 123
-    )
+    # Balance snapshot update (amount converted to kopecks: 100.0 * 100 = 10000)
+    update_sql, *update_args = mock_db.fetchval.await_args_list[0].args
+    assert update_sql.startswith("UPDATE users SET balance = balance + $1")
+    assert update_args == [10000, 123, False]
     
-    # Transaction log
-    assert mock_conn.execute.call_count == 2
+    # Ledger entry with balance_after taken from UPDATE ... RETURNING
+    assert mock_db.execute.call_count == 1
+    insert_sql, *insert_args = mock_db.execute.await_args.args
+    assert "INSERT INTO balance_transactions" in insert_sql
+    assert insert_args == [123, 10000, "topup", "test", "test deposit", None, None, mock_db.fetchval.return_value]
+
+
+@pytest.mark.asyncio
+async def test_promo_code_cache_and_redemption(mocker, mock_db):
+    database.invalidate_promo_cache()
+
+    mock_db.fetchrow.return_value = {
+        "code": "FAM50", "discount_percent": 50, "max_uses": 50, "used_count": 0, "is_active": True
+    }
+    # Код нормализуется, повторная проверка обслуживается из кэша
+    assert (await database.check_promo_code_valid(" fam50 "))["discount_percent"] == 50
+    assert (await database.check_promo_code_valid("FAM50"))["discount_percent"] == 50
+    assert mock_db.fetchrow.await_count == 1
+    assert mock_db.fetchrow.await_args.args[1] == "FAM50"
+
+    # Лимит исчерпан: условный UPDATE ничего не вернул, кэш сброшен
+    mock_db.fetchrow.return_value = None
+    assert await database.increment_promo_code_use("fam50") is False
+    assert "FAM50" not in database._promo_cache
+
+
+@pytest.mark.asyncio
+async def test_admin_referral_stats_keyset_page(mocker, mock_db):
+    mock_db.fetch.return_value = [{
+        "referrer_id": 42, "username": None, "invited_count": 40, "paid_count": 30,
+        "total_revenue_kopecks": 29900, "total_cashback_kopecks": 2990,
+        "first_referral_date": None, "sort_value": 2990,
+    }]
+    stats = await database.get_admin_referral_stats(sort_by="cashback_paid", limit=11, after=(5000, 77))
+
+    query, *params = mock_db.fetch.await_args.args
+    assert "(l.total_cashback_kopecks, l.referrer_id) < ($1, $2)" in query
+    assert "OFFSET" not in query
+    assert params == [5000, 77, 11]
+    assert stats[0]["username"] == "ID42"
+    assert stats[0]["conversion_percent"] == 75.0
+    assert stats[0]["total_cashback_paid"] == 29.9
+    assert stats[0]["current_cashback_percent"] == 25
+    assert stats[0]["sort_value"] == 2990
+
+
+@pytest.mark.asyncio
+async def test_business_metrics_read_daily_rollup(mocker, mock_db):
+    mock_db.fetchrow.return_value = {"revenue_kopecks": 90000, "paying_users": 3}
+    assert await database.get_arpu() == 300.0
+    assert await database.get_ltv() == 300.0
+    assert "FROM daily_metrics" in mock_db.fetchrow.await_args.args[0]
+
+    mock_db.fetchrow.return_value = {
+        "revenue_kopecks": 59800, "payments_count": 2, "new_users": 10,
+        "new_subscriptions": 4, "new_paying_users": 1,
+    }
+    summary = await database.get_monthly_summary(2025, 12)
+    _, start_day, end_day = mock_db.fetchrow.await_args.args
+    assert (start_day, end_day) == (date(2025, 12, 1), date(2026, 1, 1))
+    assert summary["revenue"] == 598.0
+    assert summary["new_subscriptions"] == 4
+
+
+@pytest.mark.asyncio
+async def test_admin_stats_single_filter_query_per_table(mocker):
+    queries = []
+
+    async def fake_fetchrow(query, *args):
+        queries.append(query)
+        if "FROM users" in query:
+            return {"total": 7}
+        if "FROM subscriptions" in query:
+            return {"active": 3, "expired": 2}
+        if "FROM payments" in query:
+            return {"total": 5, "approved": 4, "rejected": 1}
+        return {"free": None}
+
+    mocker.patch('database._fetchrow_on_own_connection', side_effect=fake_fetchrow)
+    stats = await database.get_admin_stats()
+
+    assert len(queries) == 4
+    assert stats == {
+        "total_users": 7,
+        "active_subscriptions": 3,
+        "expired_subscriptions": 2,
+        "total_payments": 5,
+        "approved_payments": 4,
+        "rejected_payments": 1,
+        "free_vpn_keys": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_cohort_retention_table(mocker, mock_db):
+    week = date(2020, 1, 6)
+    mock_db.fetch.return_value = [
+        {"cohort_week": week, "size": 4, "period": 0, "active_users": 4},
+        {"cohort_week": week, "size": 4, "period": 2, "active_users": 1},
+    ]
+    cohorts = await database.get_cohort_retention(weeks=8, periods=3)
+
+    assert cohorts == [{
+        "cohort_week": week,
+        "size": 4,
+        "retention": [100.0, 0.0, 25.0],
+        "churn_percent": 75.0,
+    }]
+
+
+def test_cohort_batch_stops_at_unsettled_gap():
+    # 13 может быть незакоммиченной вставкой: водяной знак останавливается на 12
+    assert database._cohort_batch_upper_id(10, [11, 12, 14, 15], settled_id=10) == 12
+    # Все транзакции, которые могли занимать id до 15, завершены: пропуск окончателен
+    assert database._cohort_batch_upper_id(10, [11, 12, 14, 15, 17], settled_id=15) == 15
+    assert database._cohort_batch_upper_id(10, [12], settled_id=10) == 10
+
+
+@pytest.mark.asyncio
+async def test_cohort_events_batch_records_gap_check(mocker, mock_db):
+    mock_db.fetchrow.return_value = {
+        "last_id": 10, "gap_check_id": None, "gap_check_xid": None, "snapshot_xmin": 500, "snapshot_xmax": 510,
+    }
+    mock_db.fetch.return_value = [{"id": 11}, {"id": 12}, {"id": 14}]
+
+    assert await database.process_cohort_events_batch(limit=100) == 2
+
+    cohort_insert, activity, watermark = [c.args for c in mock_db.execute.await_args_list]
+    assert cohort_insert[1:3] == (10, 12)
+    # Неделя активна, если её покрывает оплаченный период события, а не только дата оплаты
+    assert "generate_series" in activity[0] and "h.end_date" in activity[0]
+    assert watermark[1:4] == (12, 14, 510)
+
+
+@pytest.mark.asyncio
+async def test_cohort_events_batch_waits_for_gap_check(mocker, mock_db):
+    # Транзакции, начатые до проверки, ещё идут (xmin < gap_check_xid): пропуск не переходим
+    mock_db.fetchrow.return_value = {
+        "last_id": 12, "gap_check_id": 14, "gap_check_xid": 510, "snapshot_xmin": 505, "snapshot_xmax": 520,
+    }
+    mock_db.fetch.return_value = [{"id": 14}]
+
+    assert await database.process_cohort_events_batch(limit=100) == 0
+
+    (watermark,) = [c.args for c in mock_db.execute.await_args_list]
+    assert watermark[1:4] == (12, 14, 510)
+
+
+@pytest.mark.asyncio
+async def test_stream_export_csv_gz(mocker, mock_db, tmp_path):
+    async def fake_copy(query, *args, output, format, header, timeout):
+        await output(b"ID,Telegram ID\n")
+        await output(b"1,100\n2,200\n")
+        return "COPY 2"
+
+    mock_db.copy_from_query.side_effect = fake_copy
+    to_thread = mocker.spy(database.asyncio, "to_thread")
+    path = tmp_path / "payments.csv.gz"
+    rows = await database.stream_export_csv_gz("payments", str(path), date_from=datetime(2025, 1, 1))
+
+    assert rows == 2
+    # Открытие, запись каждого фрагмента и закрытие gzip - вне event loop
+    assert to_thread.call_count == 4
+    assert gzip.decompress(path.read_bytes()) == b"ID,Telegram ID\n1,100\n2,200\n"
+    args = mock_db.copy_from_query.await_args.args
+    assert args[1] == datetime(2025, 1, 1)
+    # Выгрузка не ограничена таймаутом команд пула (30 с)
+    assert mock_db.copy_from_query.await_args.kwargs["timeout"] == database.EXPORT_TIMEOUT_SECONDS
+    with pytest.raises(ValueError):
+        await database.stream_export_csv_gz("vpn_keys", str(path))
+
+
+@pytest.mark.asyncio
+async def test_stream_rows_keyset_batches(mocker, mock_db):
+    mock_db.fetch.side_effect = [
+        [{"telegram_id": 1}, {"telegram_id": 2}],
+        [{"telegram_id": 5}],
+    ]
+    rows = [row async for row in database.stream_rows(
+        "SELECT telegram_id FROM subscriptions WHERE status = $1", "active", batch_size=2
+    )]
+
+    assert [row["telegram_id"] for row in rows] == [1, 2, 5]
+    first_call, second_call = mock_db.fetch.await_args_list
+    assert "LIMIT $2" in first_call.args[0] and first_call.args[1:] == ("active", 2)
+    assert "stream_q.telegram_id > $2" in second_call.args[0]
+    assert second_call.args[1:] == ("active", 2, 2)
+
+
+@pytest.mark.asyncio
+async def test_get_user_returns_slots_record(mocker, mock_db):
+    row = {name: None for name in database.User.__slots__}
+    row.update(telegram_id=42, language="en", balance=1500)
+    mock_db.fetchrow.return_value = row
+
+    user = await database.get_user(42)
+
+    query = mock_db.fetchrow.await_args.args[0]
+    assert "SELECT *" not in query and "referral_code" in query
+    assert not hasattr(user, "__dict__")
+    assert user.language == "en" and user["balance"] == 1500
+    assert user.get("smart_offer_sent") is None and "smart_offer_sent" not in user
+    assert dict(user)["telegram_id"] == 42
+
+
+@pytest.mark.asyncio
+async def test_init_db_skips_legacy_schema_when_fingerprint_matches(mocker, mock_db):
+    import migrations
+
+    mocker.patch.object(migrations, 'run_migrations_safe', new_callable=AsyncMock, return_value=True)
+    mocker.patch('database._legacy_schema_fingerprint', return_value="a" * 64)
+    apply_legacy = mocker.patch('database._apply_legacy_schema', new_callable=AsyncMock)
+
+    # pg_try_advisory_lock, затем сохранённый отпечаток
+    mock_db.fetchval.side_effect = [True, "a" * 64]
+
+    assert await database.init_db() is True
+
+    apply_legacy.assert_not_awaited()
+    assert database.DB_INIT_TIMINGS["legacy_schema_skipped"] is True
+    assert "total_ms" in database.DB_INIT_TIMINGS
+    unlock_query = mock_db.execute.await_args.args[0]
+    assert "pg_advisory_unlock" in unlock_query
+
+
+@pytest.mark.asyncio
+async def test_referral_outbox_batch_rewards_each_event_in_savepoint(mocker, mock_db):
+    mock_db.fetch.return_value = [
+        {"id": 1, "buyer_id": 10, "purchase_id": "p1", "amount_kopecks": 29900, "action_type": "покупку", "attempts": 0},
+        {"id": 2, "buyer_id": 20, "purchase_id": None, "amount_kopecks": 10000, "action_type": "продление", "attempts": 0},
+    ]
+    reward = mocker.patch('database._process_referral_reward_atomic', new_callable=AsyncMock, side_effect=[
+        {"success": True, "referrer_id": 5},
+        {"success": False, "message": "No referrer"},
+    ])
+
+    processed, claimed = await database.process_referral_reward_outbox_batch(limit=50)
+
+    assert "FOR UPDATE SKIP LOCKED" in mock_db.fetch.await_args.args[0]
+    # Внешняя транзакция пакета + savepoint на каждое событие
+    assert mock_db.transaction.call_count == 3
+    assert [c.args for c in reward.await_args_list] == [(mock_db, 10, "p1", 299.0), (mock_db, 20, None, 100.0)]
+    # Строка outbox отмечается обработанной в той же транзакции, что и начисление
+    done = [c.args for c in mock_db.execute.await_args_list]
+    assert all("status = 'done'" in args[0] for args in done)
+    assert [args[1:] for args in done] == [(1, None), (2, "No referrer")]
+    assert claimed == 2
+    assert [(item["id"], item["amount_rubles"], item["action_type"]) for item in processed] == [
+        (1, 299.0, "покупку"), (2, 100.0, "продление")
+    ]
+
+
+@pytest.mark.asyncio
+async def test_referral_outbox_batch_backs_off_and_fails_after_max_attempts(mocker, mock_db):
+    mock_db.fetch.return_value = [
+        {"id": i, "buyer_id": 10 + i, "purchase_id": None, "amount_kopecks": 100, "action_type": "покупку", "attempts": attempts}
+        for i, attempts in enumerate([0, 2, database.REFERRAL_OUTBOX_MAX_ATTEMPTS - 1], start=1)
+    ]
+    mocker.patch('database._process_referral_reward_atomic', new_callable=AsyncMock, side_effect=RuntimeError("db down"))
+
+    assert await database.process_referral_reward_outbox_batch() == ([], 3)
+
+    base = database.REFERRAL_OUTBOX_RETRY_BASE_SECONDS
+    assert [c.args[1:] for c in mock_db.execute.await_args_list] == [
+        (1, "pending", 1, "db down", base),
+        (2, "pending", 3, "db down", base * 4),
+        (3, "failed", database.REFERRAL_OUTBOX_MAX_ATTEMPTS, "db down", base * 16),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_enqueue_referral_reward_skips_buyer_without_referrer(mocker, mock_db):
+    # INSERT ... SELECT не нашёл покупателя с реферером
+    mock_db.execute.return_value = "INSERT 0 0"
+    assert await database.enqueue_referral_reward(10, 299.0, "purchase:p1", purchase_id="p1") is False
+
+    query, *params = mock_db.execute.await_args.args
+    assert "u.referrer_id IS NOT NULL" in query and "u.referrer_id <> u.telegram_id" in query
+    assert params == ["purchase:p1", 10, "p1", 29900, "покупку"]
+
+    mock_db.execute.return_value = "INSERT 0 1"
+    assert await database.enqueue_referral_reward(10, 299.0, "purchase:p1", purchase_id="p1") is True
+
+
+def _referrer_stats_increments(conn):
+    return [c.args[1:] for c in conn.execute.await_args_list if "INSERT INTO referrer_stats" in c.args[0]]
+
+
+@pytest.mark.asyncio
+async def test_register_referral_increments_invited_count(mocker, mock_db):
+    mock_db.fetchrow.return_value = None
+    mock_db.execute.return_value = "INSERT 0 1"
+
+    assert await database.register_referral(5, 10) is True
+    # (referrer, invited, paid, cashback, revenue)
+    assert _referrer_stats_increments(mock_db) == [(5, 1, 0, 0, 0)]
+
+    # Повторная регистрация того же приглашённого счётчики не меняет
+    mock_db.execute.reset_mock()
+    mock_db.execute.return_value = "INSERT 0 0"
+    assert await database.register_referral(5, 10) is False
+    assert _referrer_stats_increments(mock_db) == []
+
+
+@pytest.mark.asyncio
+async def test_referral_reward_increments_paid_cashback_and_revenue(mocker, mock_db):
+    ledger = mocker.patch('database._apply_ledger_entry', new_callable=AsyncMock,
+                          return_value={"status": database.LEDGER_APPLIED, "balance": 2990})
+    mocker.patch('database._log_audit_event_atomic', new_callable=AsyncMock)
+
+    def reward_rows():
+        # реферер покупателя; награды за эту покупку нет; реферал уже отмечен оплатившим
+        return [{"referrer_id": 5}, None, {"first_paid_at": datetime(2026, 1, 1)}]
+
+    # Первая оплата покупателя: +1 оплативший
+    mock_db.fetchrow.side_effect = reward_rows()
+    mock_db.fetchval.side_effect = [3, False]
+    result = await database._process_referral_reward_atomic(mock_db, 10, "p1", 299.0)
+    assert result["success"] is True and result["percent"] == 10
+    assert _referrer_stats_increments(mock_db) == [(5, 0, 1, 2990, 29900)]
+
+    # Повторная оплата того же покупателя: оплативших не прибавляется
+    mock_db.execute.reset_mock()
+    mock_db.fetchrow.side_effect = reward_rows()
+    mock_db.fetchval.side_effect = [3, True]
+    await database._process_referral_reward_atomic(mock_db, 10, "p2", 100.0)
+    assert _referrer_stats_increments(mock_db) == [(5, 0, 0, 1000, 10000)]
+
+    # Уровень берётся из referrer_stats.paid_count под блокировкой строки и учитывает
+    # первую оплату текущего покупателя: 25-й оплативший получает уже 25%
+    mock_db.execute.reset_mock()
+    mock_db.fetchval.reset_mock()
+    mock_db.fetchrow.side_effect = reward_rows()
+    mock_db.fetchval.side_effect = [24, False]
+    result = await database._process_referral_reward_atomic(mock_db, 11, "p4", 100.0)
+    assert result["percent"] == 25
+    paid_query, referrer = mock_db.fetchval.await_args_list[0].args
+    assert "FROM referrer_stats" in paid_query and "FOR UPDATE" in paid_query and referrer == 5
+    assert _referrer_stats_increments(mock_db) == [(5, 0, 1, 2500, 10000)]
+
+    # Проводка не применена (дубликат ключа): счётчики не трогаем
+    mock_db.execute.reset_mock()
+    ledger.return_value = {"status": database.LEDGER_DUPLICATE, "balance": None}
+    mock_db.fetchrow.side_effect = reward_rows()
+    mock_db.fetchval.side_effect = [3, False]
+    assert (await database._process_referral_reward_atomic(mock_db, 10, "p3", 100.0))["success"] is False
+    assert _referrer_stats_increments(mock_db) == []
+
+
+@pytest.mark.asyncio
+async def test_get_referrer_stats_defaults_to_zero(mocker, mock_db):
+    mock_db.fetchrow.return_value = {"invited_count": 4, "paid_count": 2, "total_cashback_kopecks": 5980}
+    assert await database.get_referrer_stats(5) == {"invited_count": 4, "paid_count": 2, "total_cashback_kopecks": 5980}
+    assert mock_db.fetchrow.await_args.args[1:] == (5,)
+
+    mock_db.fetchrow.return_value = None
+    assert await database.get_referrer_stats(6) == {"invited_count": 0, "paid_count": 0, "total_cashback_kopecks": 0}
+
+
+@pytest.mark.asyncio
+async def test_rebuild_referrer_stats_calls_sql_function(mocker, mock_db):
+    mock_db.fetchval.return_value = 7
+    assert await database.rebuild_referrer_stats() == 7
+    assert mock_db.fetchval.await_args.args == ("SELECT rebuild_referrer_stats($1::BIGINT)", None)
+
+    mock_db.fetchval.return_value = None
+    assert await database.rebuild_referrer_stats(5) == 0
+    assert mock_db.fetchval.await_args.args[1] == 5
+
+
+@pytest.mark.asyncio
+async def test_finish_partition_conversion_backs_off_when_lock_is_busy(mocker, mock_db):
+    mock_db.fetchval.side_effect = asyncpg.LockNotAvailableError("lock timeout")
+    assert await database.finish_partition_conversion("audit_log") is None
+    assert "lock_timeout" in mock_db.execute.await_args.args[0]
+
+    mock_db.fetchval.side_effect = None
+    mock_db.fetchval.return_value = 12
+    assert await database.finish_partition_conversion("audit_log") == 12
+    assert mock_db.fetchval.await_args.kwargs["timeout"] == database.PARTITION_CONVERSION_TIMEOUT_SECONDS
+
+
+@pytest.mark.asyncio
+async def test_clear_user_unreachable_always_checks_database(mocker, mock_db):
+    # Первый апдейт: отметки нет
+    mock_db.execute.return_value = "UPDATE 0"
+    assert await database.clear_user_unreachable(5) is False
+    # Другая реплика отметила пользователя недоступным; следующий апдейт снимает отметку
+    mock_db.execute.return_value = "UPDATE 1"
+    assert await database.clear_user_unreachable(5) is True
+    assert mock_db.execute.await_count == 2
@@ -0,0 +1,49 @@
+from unittest.mock import AsyncMock
+
+import pytest
+
+import migrations
+
+
+@pytest.mark.asyncio
+async def test_migration_statements_run_with_migration_timeout(tmp_path):
+    path = tmp_path / "099_example.sql"
+    path.write_text(
+        "-- Migration 099: example\n"
+        "CREATE TABLE example (id INT);\n"
+        "INSERT INTO example SELECT generate_series(1, 10);\n",
+        encoding="utf-8",
+    )
+    conn = AsyncMock()
+
+    assert await migrations.apply_migration(conn, "099", path) is True
+
+    statements = conn.execute.await_args_list[:-1]
+    assert [c.args[0] for c in statements] == [
+        "CREATE TABLE example (id INT)",
+        "INSERT INTO example SELECT generate_series(1, 10)",
+    ]
+    # Не command_timeout пула (30 с): длинный DDL не обрывается на старте
+    assert all(c.kwargs["timeout"] == migrations.MIGRATION_STATEMENT_TIMEOUT_SECONDS for c in statements)
+    assert "schema_migrations" in conn.execute.await_args.args[0]
+
+
+@pytest.mark.asyncio
+async def test_no_transaction_migration_rebuilds_invalid_index_without_pool_timeout(tmp_path):
+    path = tmp_path / "017_indexes.sql"
+    path.write_text(
+        "-- migrate:no-transaction\n"
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_big ON payments (telegram_id, status);\n",
+        encoding="utf-8",
+    )
+    assert migrations.is_no_transaction_migration(path)
+    conn = AsyncMock()
+    conn.fetch.return_value = [{"relname": "idx_big"}]
+
+    await migrations.drop_invalid_concurrent_indexes(conn, path)
+    await migrations.apply_migration(conn, "017", path)
+
+    drop, build = conn.execute.await_args_list[:2]
+    assert drop.args[0] == 'DROP INDEX CONCURRENTLY IF EXISTS "idx_big"'
+    assert build.args[0].startswith("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_big")
+    assert drop.kwargs["timeout"] == build.kwargs["timeout"] == migrations.MIGRATION_STATEMENT_TIMEOUT_SECONDS
@@ -0,0 +1,81 @@
+from datetime import date
+from unittest.mock import AsyncMock
+
+import pytest
+
+import partition_maintenance
+
+
+@pytest.mark.asyncio
+async def test_partition_maintenance_archives_only_expired_log_partitions(mocker, tmp_path):
+    assert partition_maintenance.retention_cutoff(date(2026, 3, 15), 12) == date(2025, 3, 1)
+
+    mocker.patch.object(partition_maintenance, 'PARTITION_ARCHIVE_DIR', str(tmp_path))
+    mocker.patch('database.is_partitioned_table', new_callable=AsyncMock, return_value=True)
+    mocker.patch('database.ensure_monthly_partitions', new_callable=AsyncMock, return_value=1)
+
+    async def fake_partitions(table):
+        return [
+            {"name": f"{table}_2024_12", "month": date(2024, 12, 1)},
+            {"name": f"{table}_2025_06", "month": date(2025, 6, 1)},
+            {"name": f"{table}_2026_03", "month": date(2026, 3, 1)},
+        ]
+
+    mocker.patch('database.get_monthly_partitions', side_effect=fake_partitions)
+    mocker.patch('database.has_default_partition_rows', new_callable=AsyncMock, return_value=False)
+    archive = mocker.patch('database.archive_and_drop_partition', new_callable=AsyncMock, return_value=10)
+
+    result = await partition_maintenance.run_partition_maintenance(today=date(2026, 3, 15))
+
+    # audit_log (12 мес.): только 2024_12; broadcast_log (6 мес.): 2024_12 и 2025_06; ledger не трогаем
+    archived = [c.args[1] for c in archive.await_args_list]
+    assert archived == ["audit_log_2024_12", "broadcast_log_2024_12", "broadcast_log_2025_06"]
+    assert result == {"created": 3, "archived": 3}
+    assert archive.await_args_list[0].args[2] == str(tmp_path / "audit_log_2024_12.csv.gz")
+
+
+@pytest.mark.asyncio
+async def test_partition_maintenance_alerts_on_low_horizon_and_default_rows(mocker):
+    mocker.patch('database.is_partitioned_table', new_callable=AsyncMock, return_value=True)
+    mocker.patch('database.ensure_monthly_partitions', new_callable=AsyncMock, return_value=0)
+    mocker.patch(
+        'database.get_monthly_partitions', new_callable=AsyncMock,
+        side_effect=lambda table: [{"name": f"{table}_2026_03", "month": date(2026, 3, 1)}],
+    )
+    mocker.patch(
+        'database.has_default_partition_rows', new_callable=AsyncMock,
+        side_effect=lambda table: table == "broadcast_log",
+    )
+    mocker.patch('database.archive_and_drop_partition', new_callable=AsyncMock)
+    mocker.patch.dict(partition_maintenance.PARTITION_STATS, {"alert": False})
+
+    await partition_maintenance.run_partition_maintenance(today=date(2026, 3, 15))
+
+    stats = partition_maintenance.get_stats()
+    # Секция есть только на текущий месяц: следующий месяц уйдёт в DEFAULT
+    assert stats["months_ahead"]["audit_log"] == 0
+    assert stats["default_rows"] == ["broadcast_log"]
+    assert stats["alert"] is True
+
+
+@pytest.mark.asyncio
+async def test_partition_maintenance_skips_unconverted_tables(mocker):
+    mocker.patch(
+        'database.is_partitioned_table', new_callable=AsyncMock,
+        side_effect=lambda table: table != "balance_transactions",
+    )
+    ensure = mocker.patch('database.ensure_monthly_partitions', new_callable=AsyncMock, return_value=0)
+    mocker.patch(
+        'database.get_monthly_partitions', new_callable=AsyncMock,
+        side_effect=lambda table: [{"name": f"{table}_2026_06", "month": date(2026, 6, 1)}],
+    )
+    mocker.patch('database.has_default_partition_rows', new_callable=AsyncMock, return_value=False)
+    mocker.patch.dict(partition_maintenance.PARTITION_STATS, {"alert": False})
+
+    await partition_maintenance.run_partition_maintenance(today=date(2026, 3, 15))
+
+    # Обычную (ещё не переведённую) таблицу не трогаем и тревогу по ней не поднимаем
+    assert [c.args[0] for c in ensure.await_args_list] == ["audit_log", "broadcast_log"]
+    stats = partition_maintenance.get_stats()
+    assert stats["unpartitioned"] == ["balance_transactions"]
+    assert stats["alert"] is False
@@ -0,0 +1,210 @@
+"""
+EXPLAIN-регрессия горячих запросов
+
+Поднимает схему (database.init_db) на отдельной локальной БД, заполняет большие
+таблицы синтетическими данными, делает ANALYZE и проверяет, что план каждого
+горячего запроса не содержит Seq Scan по большим таблицам.
+
+Запуск (нужна пустая локальная БД, она будет заполнена тестовыми данными):
+    TEST_DATABASE_URL=postgres://localhost/bot_plans pytest tests/test_query_plans.py
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from db_records import Payment, PendingPurchase, Subscription, User
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(
+    not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set (needs a seeded local Postgres)"
+)
+
+# Таблицы, полный просмотр которых в горячем запросе считается регрессией
+LARGE_TABLES = {"users", "subscriptions", "payments", "subscription_history", "broadcast_log", "audit_log"}
+
+SEED_USERS = 20000
+SEED_ACTIVE_SUBSCRIPTIONS = 1000
+
+SEED_SQL = [
+    f"""INSERT INTO users (telegram_id, username, language, created_at)
+        SELECT g, 'user_' || g, 'ru', NOW() - (g % 365) * INTERVAL '1 day'
+        FROM generate_series(1, {SEED_USERS}) g
+        ON CONFLICT (telegram_id) DO NOTHING""",
+    # Небольшая доля активных подписок с ключом, остальные давно истекли
+    f"""INSERT INTO subscriptions (telegram_id, uuid, vpn_key, expires_at, status, source)
+        SELECT g,
+               CASE WHEN g <= {SEED_ACTIVE_SUBSCRIPTIONS} THEN md5(g::text) END,
+               CASE WHEN g <= {SEED_ACTIVE_SUBSCRIPTIONS} THEN 'vless://' || g END,
+               CASE WHEN g <= {SEED_ACTIVE_SUBSCRIPTIONS}
+                    THEN NOW() + (g % 30 + 1) * INTERVAL '1 day'
+                    ELSE NOW() - (g % 365 + 1) * INTERVAL '1 day' END,
+               CASE WHEN g <= {SEED_ACTIVE_SUBSCRIPTIONS} THEN 'active' ELSE 'expired' END,
+               'payment'
+        FROM generate_series(1, {SEED_USERS}) g
+        ON CONFLICT (telegram_id) DO NOTHING""",
+    f"""INSERT INTO payments (telegram_id, tariff, amount, status, created_at)
+        SELECT g % {SEED_USERS} + 1, 'basic', 14900,
+               CASE WHEN g % 10 = 0 THEN 'rejected' ELSE 'approved' END,
+               NOW() - (g % 365) * INTERVAL '1 day'
+        FROM generate_series(1, {SEED_USERS * 3}) g""",
+    f"""INSERT INTO subscription_history (telegram_id, vpn_key, start_date, end_date, action_type, created_at)
+        SELECT g % {SEED_USERS} + 1, 'vless://' || g, NOW(), NOW() + INTERVAL '30 days',
+               'renewal', NOW() - (g % 365) * INTERVAL '1 day'
+        FROM generate_series(1, {SEED_USERS * 3}) g""",
+    """INSERT INTO broadcasts (title, message, type, segment, sent_by)
+       SELECT 'bench ' || g, 'text', 'info', 'all_users', 1
+       FROM generate_series(1, 200) g""",
+    f"""INSERT INTO broadcast_log (broadcast_id, telegram_id, status)
+        SELECT b.id, g, CASE WHEN g % 20 = 0 THEN 'failed' ELSE 'sent' END
+        FROM (SELECT id FROM broadcasts ORDER BY id LIMIT 200) b
+        CROSS JOIN generate_series(1, {SEED_USERS // 40}) g""",
+    f"""INSERT INTO audit_log (action, telegram_id, target_user, details, created_at)
+        SELECT 'payment_approved', 1, g % {SEED_USERS} + 1, 'Payment ID: ' || g,
+               NOW() - (g % 525600) * INTERVAL '1 minute'
+        FROM generate_series(1, {SEED_USERS * 5}) g""",
+]
+
+NOW = datetime.now()
+
+# (название, SQL, параметры): запросы database.py и фоновых задач на каждый тик / нажатие
+HOT_QUERIES = [
+    (
+        "get_user",
+        f"SELECT {User.columns_sql()} FROM users WHERE telegram_id = $1",
+        (500,),
+    ),
+    (
+        "get_subscription",
+        f"SELECT {Subscription.columns_sql()} FROM subscriptions "
+        "WHERE telegram_id = $1 AND status = 'active' AND expires_at > $2",
+        (500, NOW),
+    ),
+    (
+        "get_pending_payment_by_user",
+        f"SELECT {Payment.columns_sql()} FROM payments WHERE telegram_id = $1 AND status = 'pending'",
+        (500,),
+    ),
+    (
+        "get_last_approved_payment",
+        f"""SELECT {Payment.columns_sql()} FROM payments
+            WHERE telegram_id = $1 AND status = 'approved'
+            ORDER BY created_at DESC
+            LIMIT 1""",
+        (500,),
+    ),
+    (
+        "get_last_approved_tariffs",
+        """SELECT DISTINCT ON (telegram_id) telegram_id, tariff
+           FROM payments
+           WHERE telegram_id = ANY($1::bigint[]) AND status = 'approved'
+           ORDER BY telegram_id, created_at DESC""",
+        ([500, 501, 502],),
+    ),
+    (
+        "get_pending_purchase",
+        f"""SELECT {PendingPurchase.columns_sql()} FROM pending_purchases
+            WHERE purchase_id = $1 AND telegram_id = $2 AND status = 'pending'""",
+        ("purchase_500", 500),
+    ),
+    (
+        "get_subscriptions_for_reminders",
+        """SELECT s.*, COALESCE(u.language, 'ru') AS language,
+                  (SELECT action_type FROM subscription_history
+                   WHERE telegram_id = s.telegram_id
+                   ORDER BY created_at DESC LIMIT 1) as last_action_type
+           FROM subscriptions s
+           LEFT JOIN users u ON u.telegram_id = s.telegram_id
+           WHERE s.status = 'active'
+           AND s.uuid IS NOT NULL
+           AND s.expires_at > $1
+           AND u.unreachable_since IS NULL
+           ORDER BY s.expires_at ASC""",
+        (NOW,),
+    ),
+    (
+        "get_broadcast_stats",
+        """SELECT COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+                  COUNT(*) FILTER (WHERE status = 'failed') AS failed
+           FROM broadcast_log
+           WHERE broadcast_id = $1
+           AND sent_at >= COALESCE((SELECT created_at FROM broadcasts WHERE id = $1), '-infinity')""",
+        (100,),
+    ),
+    (
+        "get_last_audit_logs",
+        """SELECT * FROM audit_log
+           WHERE created_at >= NOW() - make_interval(days => $2)
+           ORDER BY created_at DESC
+           LIMIT $1""",
+        (10, database.AUDIT_LOG_RECENT_DAYS),
+    ),
+    (
+        "fast_expiry_cleanup",
+        """SELECT id, telegram_id, uuid, expires_at, status FROM subscriptions
+           WHERE status = 'active'
+           AND expires_at < $1
+           AND uuid IS NOT NULL""",
+        (NOW,),
+    ),
+    (
+        "smart_notifications",
+        """SELECT telegram_id, uuid, activated_at, expires_at FROM subscriptions
+           WHERE status = 'active'
+           AND uuid IS NOT NULL
+           AND expires_at > NOW()""",
+        (),
+    ),
+    (
+        "auto_renewals",
+        """SELECT s.*, u.language, u.balance
+           FROM subscriptions s
+           JOIN users u ON s.telegram_id = u.telegram_id
+           WHERE s.status = 'active'
+           AND s.auto_renew = TRUE
+           AND s.expires_at <= $1
+           AND s.expires_at > $2
+           AND s.uuid IS NOT NULL""",
+        (NOW + timedelta(hours=6), NOW),
+    ),
+]
+
+
+def _seq_scans(plan: dict) -> list:
+    """Большие таблицы, которые план читает полным просмотром"""
+    found = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in LARGE_TABLES:
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+@pytest.mark.asyncio
+async def test_hot_queries_avoid_seq_scans_on_large_tables(monkeypatch):
+    monkeypatch.setattr(database, "DATABASE_URL", TEST_DATABASE_URL)
+    await database.close_pool()
+    try:
+        assert await database.init_db()
+
+        pool = await database.get_pool()
+        async with pool.acquire() as conn:
+            if not await conn.fetchval("SELECT EXISTS(SELECT 1 FROM users WHERE telegram_id = $1)", SEED_USERS):
+                for statement in SEED_SQL:
+                    await conn.execute(statement)
+            await conn.execute("ANALYZE")
+
+            regressions = {}
+            for name, query, args in HOT_QUERIES:
+                plan_json = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+                plan = json.loads(plan_json)[0]["Plan"]
+                scans = _seq_scans(plan)
+                if scans:
+                    regressions[name] = scans
+
+        assert not regressions, f"Seq Scan on large tables in hot queries: {regressions}"
+    finally:
+        await database.close_pool()
@@ -0,0 +1,46 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import referral_outbox_worker
+
+
+@pytest.mark.asyncio
+async def test_notify_referrers_only_for_awarded_rewards(mocker):
+    notify = mocker.patch(
+        'referral_outbox_worker.send_referral_cashback_notification', new_callable=AsyncMock
+    )
+    bot = MagicMock()
+    processed = [
+        {"id": 1, "buyer_id": 10, "amount_rubles": 299.0, "action_type": "покупку", "result": {
+            "success": True, "referrer_id": 5, "reward_amount": 29.9, "percent": 10,
+            "paid_referrals_count": 1, "referrals_needed": 24,
+        }},
+        {"id": 2, "buyer_id": 20, "amount_rubles": 100.0, "action_type": "продление",
+         "result": {"success": False, "message": "Reward already processed for this purchase"}},
+    ]
+
+    await referral_outbox_worker._notify_referrers(bot, processed)
+
+    notify.assert_awaited_once_with(
+        bot=bot, referrer_id=5, referred_id=10, purchase_amount=299.0, cashback_amount=29.9,
+        cashback_percent=10, paid_referrals_count=1, referrals_needed=24, action_type="покупку"
+    )
+
+
+@pytest.mark.asyncio
+async def test_outbox_task_keeps_draining_full_batch_with_failures(mocker):
+    # Пакет взят целиком, но часть событий упала: очередь разбирается дальше без паузы
+    batch = mocker.patch('database.process_referral_reward_outbox_batch', new_callable=AsyncMock, side_effect=[
+        ([], referral_outbox_worker.OUTBOX_BATCH_SIZE),
+        ([], 0),
+    ])
+    mocker.patch('referral_outbox_worker.telegram_gateway.set_lane')
+    sleep = mocker.patch('referral_outbox_worker.asyncio.sleep', new_callable=AsyncMock, side_effect=asyncio.CancelledError)
+
+    with pytest.raises(asyncio.CancelledError):
+        await referral_outbox_worker.referral_outbox_task(MagicMock())
+
+    assert batch.await_count == 2
+    sleep.assert_awaited_once_with(referral_outbox_worker.OUTBOX_POLL_INTERVAL_SECONDS)
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import database
+import reminders
+
+
+@pytest.mark.asyncio
+async def test_reminders_send_concurrently_and_mark_flags_in_one_update(mocker):
+    now = datetime(2026, 3, 15, 10, 0)
+    base = {
+        "activated_at": now - timedelta(hours=1), "last_bytes": 0, "first_traffic_at": None,
+        "last_notification_sent_at": None, "language": "ru",
+        **{flag: False for flag in database.SUBSCRIPTION_NOTIFICATION_FLAGS if flag.startswith("smart_notif_")},
+    }
+    subscriptions = [
+        {**base, "telegram_id": 1, "expires_at": now + timedelta(days=30)},
+        # Anti-spam: уведомление было меньше часа назад
+        {**base, "telegram_id": 2, "expires_at": now + timedelta(days=30),
+         "last_notification_sent_at": now - timedelta(minutes=10)},
+        {**base, "telegram_id": 3, "expires_at": now + timedelta(days=3),
+         "smart_notif_no_traffic_20m_sent": True},
+    ]
+    pending = [n for n in (reminders.decide_smart_notification(s, now) for s in subscriptions) if n]
+    assert [(n[0], n[2]) for n in pending] == [
+        (1, "smart_notif_no_traffic_20m_sent"), (3, "smart_notif_3days_before_expiry_sent")
+    ]
+
+    mark = mocker.patch('database.mark_notification_flags_sent', new_callable=AsyncMock)
+    bot = MagicMock()
+    bot.send_message = AsyncMock(side_effect=[None, Exception("timeout")])
+
+    assert await reminders.send_pending_notifications(bot, pending, now) == 1
+    mark.assert_awaited_once_with([(1, "smart_notif_no_traffic_20m_sent", now)])
@@ -0,0 +1,30 @@
+from unittest.mock import AsyncMock
+
+import pytest
+
+import repair_referrer_stats
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("argv, scope", [(["repair_referrer_stats.py"], None), (["repair_referrer_stats.py", "42"], 42)])
+async def test_repair_rebuilds_stats_and_closes_pool(mocker, capsys, argv, scope):
+    mocker.patch('sys.argv', argv)
+    rebuild = mocker.patch('database.rebuild_referrer_stats', new_callable=AsyncMock, return_value=3)
+    close = mocker.patch('database.close_pool', new_callable=AsyncMock)
+
+    await repair_referrer_stats.main()
+
+    rebuild.assert_awaited_once_with(scope)
+    close.assert_awaited_once()
+    assert "3 referrer(s)" in capsys.readouterr().out
+
+
+@pytest.mark.asyncio
+async def test_repair_closes_pool_on_failure(mocker):
+    mocker.patch('sys.argv', ["repair_referrer_stats.py"])
+    mocker.patch('database.rebuild_referrer_stats', new_callable=AsyncMock, side_effect=RuntimeError("db down"))
+    close = mocker.patch('database.close_pool', new_callable=AsyncMock)
+
+    with pytest.raises(RuntimeError):
+        await repair_referrer_stats.main()
+    close.assert_awaited_once()
@@ -0,0 +1,103 @@
+import asyncio
+import types
+
+import pytest
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import CallbackQuery, Update, User
+
+import startup
+
+
+def _callback_update(update_id: int) -> Update:
+    user = User(id=1, is_bot=False, first_name="Test")
+    return Update(
+        update_id=update_id,
+        callback_query=CallbackQuery(id=str(update_id), from_user=user, chat_instance="1", data="admin:stats"),
+    )
+
+
+@pytest.mark.asyncio
+async def test_lazy_router_holds_updates_until_module_is_loaded(mocker):
+    handled = []
+    admin_module = types.ModuleType("handlers.admin")
+    admin_module.router = Router(name="admin")
+    payments_router = Router(name="payments")
+
+    @admin_module.router.callback_query()
+    async def admin_callback(callback: CallbackQuery):
+        handled.append("admin")
+
+    @payments_router.callback_query()
+    async def payments_callback(callback: CallbackQuery):
+        handled.append("payments")
+
+    import_started = asyncio.Event()
+    release_import = asyncio.Event()
+
+    async def slow_import(module_name):
+        import_started.set()
+        await release_import.wait()
+        return admin_module
+
+    mocker.patch('startup.import_in_thread', side_effect=slow_import)
+
+    lazy = startup.LazyRouter("handlers.admin")
+    dp = Dispatcher()
+    dp.include_router(lazy.router)
+    dp.include_router(payments_router)
+    bot = Bot("42:TEST")
+
+    # Апдейт пришёл до окончания импорта: ждёт его и не уходит в следующий роутер
+    pending = asyncio.create_task(dp.feed_update(bot, _callback_update(1)))
+    await asyncio.wait_for(import_started.wait(), 1)
+    await asyncio.sleep(0.05)
+    assert not pending.done() and handled == []
+
+    release_import.set()
+    await asyncio.wait_for(pending, 1)
+    assert handled == ["admin"]
+
+    # После загрузки апдейты обрабатываются сразу, модуль импортируется один раз
+    await dp.feed_update(bot, _callback_update(2))
+    assert handled == ["admin", "admin"]
+    assert startup.import_in_thread.await_count == 1
+    await bot.session.close()
+
+
+@pytest.mark.asyncio
+async def test_staggered_delays_worker_and_closes_it_on_cancel(mocker):
+    mocker.patch.object(startup, 'WORKER_START_STAGGER_SECONDS', 30)
+    started = []
+
+    async def worker():
+        started.append(True)
+        return "done"
+
+    # Первый воркер стартует без задержки
+    assert await startup.staggered(0, worker()) == "done"
+
+    coro = worker()
+    task = asyncio.create_task(startup.staggered(2, coro))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert started == [True]
+    assert coro.cr_frame is None  # корутина закрыта, а не брошена
+
+
+@pytest.mark.asyncio
+async def test_timed_phase_records_duration_even_on_failure(mocker):
+    mocker.patch.dict(startup.STARTUP_TIMINGS, clear=True)
+
+    async def ok():
+        return 1
+
+    async def fail():
+        raise RuntimeError("redis down")
+
+    assert await startup.timed_phase("database", ok()) == 1
+    with pytest.raises(RuntimeError):
+        await startup.timed_phase("redis", fail())
+    assert set(startup.STARTUP_TIMINGS) == {"database", "redis"}
+    assert all(isinstance(ms, float) and ms >= 0 for ms in startup.STARTUP_TIMINGS.values())
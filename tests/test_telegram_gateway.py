@@ -0,0 +1,109 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, SendMessage
+
+import telegram_gateway
+
+
+@pytest.mark.asyncio
+async def test_gateway_serves_higher_priority_lanes_first():
+    gateway = telegram_gateway.TelegramGateway(rate=50, burst=1, per_chat_interval=0)
+    await gateway.acquire(telegram_gateway.LANE_INTERACTIVE)  # забираем единственный токен
+
+    order = []
+
+    async def send(lane_value, name):
+        await gateway.acquire(lane_value)
+        order.append(name)
+
+    await asyncio.gather(
+        send(telegram_gateway.LANE_BROADCAST, "broadcast"),
+        send(telegram_gateway.LANE_REMINDER, "reminder"),
+        send(telegram_gateway.LANE_PAYMENT, "payment"),
+    )
+    await gateway.close()
+
+    assert order == ["payment", "reminder", "broadcast"]
+
+
+@pytest.mark.asyncio
+async def test_gateway_middleware_retries_after_flood_control():
+    gateway = telegram_gateway.TelegramGateway(rate=1000, burst=10, per_chat_interval=0)
+    middleware = telegram_gateway.GatewayMiddleware(gateway)
+    method = SendMessage(chat_id=1, text="hi")
+    calls = []
+
+    async def make_request(bot, request_method):
+        calls.append(request_method)
+        if len(calls) == 1:
+            raise TelegramRetryAfter(method=request_method, message="Too Many Requests", retry_after=0)
+        return "ok"
+
+    with telegram_gateway.lane(telegram_gateway.LANE_PAYMENT):
+        assert await middleware(make_request, None, method) == "ok"
+    # Не методы отправки проходят без лимитов
+    assert await middleware(make_request, None, AnswerCallbackQuery(callback_query_id="1")) == "ok"
+    await gateway.close()
+
+    stats = gateway.get_stats()
+    assert len(calls) == 3
+    assert stats["retry_after"] == 1 and stats["sent"]["payment"] == 1
+    assert stats["queue_depth"]["payment"] == 0
+
+
+@pytest.mark.asyncio
+async def test_gateway_paces_only_bulk_lanes_and_pauses_single_chat():
+    gateway = telegram_gateway.TelegramGateway(rate=1000, burst=10, per_chat_interval=5)
+
+    # Ответы пользователю в один чат не ждут интервала
+    assert await gateway.acquire(telegram_gateway.LANE_INTERACTIVE, 1) < 0.5
+    assert await gateway.acquire(telegram_gateway.LANE_PAYMENT, 1) < 0.5
+    # Напоминание в тот же чат ждёт интервала после ответа
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(gateway.acquire(telegram_gateway.LANE_REMINDER, 1), 0.1)
+
+    # retry_after одного чата не останавливает отправку в другие чаты
+    gateway.pause(30, chat_id=2)
+    assert await gateway.acquire(telegram_gateway.LANE_INTERACTIVE, 3) < 0.5
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(gateway.acquire(telegram_gateway.LANE_PAYMENT, 2), 0.1)
+    await gateway.close()
+
+    stats = gateway.get_stats()
+    assert stats["retry_after"] == 1 and stats["paused_for_seconds"] == 0
+
+
+@pytest.mark.asyncio
+async def test_gateway_marks_user_unreachable_on_forbidden(mocker):
+    gateway = telegram_gateway.TelegramGateway(rate=1000, burst=10, per_chat_interval=0)
+    middleware = telegram_gateway.GatewayMiddleware(gateway)
+    mark = mocker.patch('database.mark_user_unreachable', new_callable=AsyncMock, return_value=True)
+
+    async def make_request(bot, request_method):
+        if request_method.chat_id == 1:
+            raise TelegramForbiddenError(method=request_method, message="Forbidden: bot was blocked by the user")
+        raise TelegramBadRequest(method=request_method, message="Bad Request: message is too long")
+
+    with pytest.raises(TelegramForbiddenError):
+        await middleware(make_request, None, SendMessage(chat_id=1, text="hi"))
+    # Временная ошибка запроса не делает пользователя недоступным
+    with pytest.raises(TelegramBadRequest):
+        await middleware(make_request, None, SendMessage(chat_id=2, text="hi"))
+    await gateway.close()
+
+    mark.assert_awaited_once_with(1)
+
+
+@pytest.mark.asyncio
+async def test_reachability_middleware_clears_mark_on_inbound_update(mocker):
+    mocker.patch('database.DB_READY', True)
+    clear = mocker.patch('database.clear_user_unreachable', new_callable=AsyncMock, return_value=True)
+    handler = AsyncMock(return_value="handled")
+
+    result = await telegram_gateway.reachability_middleware(handler, object(), {"event_from_user": MagicMock(id=5)})
+
+    assert result == "handled"
+    clear.assert_awaited_once_with(5)
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import SendMessage
+
+import database
+import trial_notifications
+
+
+@pytest.mark.asyncio
+async def test_trial_notifications_computed_in_sql_and_marked_in_one_update(mocker, mock_db):
+    mock_db.fetch.return_value = [
+        {"telegram_id": 1, "language": "ru", "notification_key": "trial_notification_6h"},
+        {"telegram_id": 2, "language": "en", "notification_key": "trial_notification_60h"},
+        {"telegram_id": 3, "language": "ru", "notification_key": "trial_notification_18h"},
+    ]
+    mocker.patch('database.DB_READY', True)
+    mark = mocker.patch('database.mark_trial_notifications_sent', new_callable=AsyncMock)
+
+    async def send_message(chat_id, text, reply_markup=None):
+        if chat_id == 2:
+            raise TelegramForbiddenError(method=SendMessage(chat_id=2, text=text), message="Forbidden: bot was blocked")
+        if chat_id == 3:
+            raise Exception("timeout")
+
+    bot = MagicMock()
+    bot.send_message = AsyncMock(side_effect=send_message)
+
+    await trial_notifications.process_trial_notifications(bot)
+
+    # Один запрос на все положенные уведомления (anti-join против paid-подписок)
+    query = mock_db.fetch.await_args.args[0]
+    assert mock_db.fetch.await_count == 1
+    assert "NOT EXISTS" in query and "t.trial_notif_71h_sent IS NOT TRUE THEN 'trial_notification_71h'" in query
+    # Отправлено (1) и постоянная ошибка (2) помечаются, временная ошибка (3) - нет
+    mark.assert_awaited_once_with([(1, 6), (2, 60)])
+    assert bot.send_message.await_args_list[1].kwargs["reply_markup"] is not None
+
+
+@pytest.mark.asyncio
+async def test_expire_trials_releases_connection_before_sending(mocker, mock_db):
+    now = datetime.now()
+    rows = [{
+        "telegram_id": 1, "trial_used_at": now - timedelta(hours=72), "trial_expires_at": now - timedelta(minutes=5),
+        "unreachable_since": None, "uuid": None, "subscription_expires_at": None,
+    }]
+
+    async def stream_rows(query, *args):
+        for row in rows:
+            yield row
+
+    mocker.patch('database.DB_READY', True)
+    mocker.patch('database.stream_rows', side_effect=stream_rows)
+    mocker.patch('database.get_user', new_callable=AsyncMock, return_value={"language": "ru"})
+    mock_db.fetchrow.return_value = None
+    mock_db.execute.return_value = "UPDATE 1"
+    acquire_ctx = database.get_pool.return_value.acquire.return_value
+
+    async def send_message(chat_id, text, **kwargs):
+        # Во время отправки ни одно соединение пула не удерживается
+        assert acquire_ctx.__aexit__.await_count == acquire_ctx.__aenter__.await_count
+        raise Exception("timeout")
+
+    bot = MagicMock()
+    bot.send_message = AsyncMock(side_effect=send_message)
+
+    await trial_notifications.expire_trial_subscriptions(bot)
+
+    bot.send_message.assert_awaited_once()
+    # Флаг умного предложения откатывается после ошибки отправки на отдельном коротком соединении
+    assert "smart_offer_sent = FALSE" in mock_db.execute.await_args.args[0]
+    assert acquire_ctx.__aenter__.await_count == 2
@@ -3,16 +3,20 @@
 """
 import asyncio
 import logging
+import os
 from datetime import datetime, timedelta
-from typing import Tuple
+from typing import Optional, Tuple
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import database
 import localization
+import telegram_gateway
 import config
 
 logger = logging.getLogger(__name__)
 
+TRIAL_SEND_CONCURRENCY = int(os.getenv("TRIAL_SEND_CONCURRENCY", "20"))
+
 # Singleton guard: предотвращает повторный запуск scheduler
 _TRIAL_SCHEDULER_STARTED = False
 
@@ -39,10 +43,63 @@ def get_trial_buy_keyboard(language: str) -> InlineKeyboardMarkup:
     return keyboard
 
 
+def _build_due_notifications_query() -> str:
+    """SQL: уведомления trial, которые нужно отправить сейчас - (telegram_id, language, notification_key)
+
+    Окна расписания [hours, hours + 1) часа с момента активации не пересекаются,
+    поэтому пользователю положено не больше одного уведомления за проход.
+    """
+    cases = "\n".join(
+        f"                   WHEN t.hours_since_activation >= {n['hours']} "
+        f"AND t.hours_since_activation < {n['hours'] + 1} "
+        f"AND t.trial_notif_{n['hours']}h_sent IS NOT TRUE THEN '{n['key']}'"
+        for n in TRIAL_NOTIFICATION_SCHEDULE
+    )
+    return f"""
+        SELECT telegram_id, language, notification_key
+        FROM (
+            SELECT t.telegram_id, t.language,
+                   CASE
+{cases}
+                   END AS notification_key
+            FROM (
+                SELECT u.telegram_id, COALESCE(u.language, 'ru') AS language,
+                       -- trial длится 72 часа: с активации прошло 72 - (часов до окончания)
+                       72 - EXTRACT(EPOCH FROM (u.trial_expires_at - $1)) / 3600 AS hours_since_activation,
+                       s.trial_notif_6h_sent, s.trial_notif_18h_sent, s.trial_notif_30h_sent,
+                       s.trial_notif_42h_sent, s.trial_notif_54h_sent, s.trial_notif_60h_sent,
+                       s.trial_notif_71h_sent
+                FROM users u
+                INNER JOIN subscriptions s ON u.telegram_id = s.telegram_id
+                    AND s.source = 'trial'
+                    AND s.status = 'active'
+                    AND s.expires_at > $1
+                WHERE u.trial_used_at IS NOT NULL
+                  AND u.trial_expires_at IS NOT NULL
+                  AND u.trial_expires_at > $1
+                  AND u.unreachable_since IS NULL
+                  -- У пользователя НЕТ активной paid-подписки
+                  AND NOT EXISTS (
+                      SELECT 1 FROM subscriptions p
+                      WHERE p.telegram_id = u.telegram_id
+                      AND p.source = 'payment'
+                      AND p.status = 'active'
+                      AND p.expires_at > $1
+                  )
+            ) AS t
+        ) AS due
+        WHERE notification_key IS NOT NULL
+    """
+
+
+TRIAL_DUE_NOTIFICATIONS_QUERY = _build_due_notifications_query()
+TRIAL_NOTIFICATIONS_BY_KEY = {n["key"]: n for n in TRIAL_NOTIFICATION_SCHEDULE}
+
+
 async def send_trial_notification(
     bot: Bot,
-    pool,
     telegram_id: int,
+    language: str,
     notification_key: str,
     has_button: bool = False
 ) -> Tuple[bool, str]:
@@ -50,8 +107,8 @@ async def send_trial_notification(
     
     Args:
         bot: Bot instance
-        pool: Database connection pool
         telegram_id: Telegram ID пользователя
+        language: Язык пользователя
         notification_key: Ключ локализации для текста уведомления
         has_button: Показывать ли кнопку "Купить доступ"
     
@@ -62,19 +119,8 @@ async def send_trial_notification(
         - (False, "failed_temporary") - временная ошибка, можно повторить позже
     """
     try:
-        # Получаем язык пользователя
-        user = await database.get_user(telegram_id)
-        language = user.get("language", "ru") if user else "ru"
-        
-        # Получаем текст уведомления
         text = localization.get_text(language, notification_key)
-        
-        # Формируем клавиатуру (если нужно)
-        reply_markup = None
-        if has_button:
-            reply_markup = get_trial_buy_keyboard(language)
-        
-        # Отправляем уведомление
+        reply_markup = get_trial_buy_keyboard(language) if has_button else None
         await bot.send_message(telegram_id, text, reply_markup=reply_markup)
         
         logger.info(
@@ -84,18 +130,7 @@ async def send_trial_notification(
         
         return (True, "sent")
     except Exception as e:
-        error_str = str(e).lower()
-        
-        # Проверяем на постоянные ошибки (Forbidden/blocked)
-        permanent_errors = [
-            "forbidden",
-            "bot was blocked",
-            "user is deactivated",
-            "chat not found",
-            "user not found"
-        ]
-        
-        if any(keyword in error_str for keyword in permanent_errors):
+        if telegram_gateway.is_permanent_send_error(e):
             logger.warning(
                 f"trial_notification_failed_permanently: user={telegram_id}, notification={notification_key}, "
                 f"reason=forbidden_or_blocked, error={str(e)}"
@@ -113,10 +148,12 @@ async def send_trial_notification(
 async def process_trial_notifications(bot: Bot):
     """Обработать все уведомления о trial
     
-    Проверяет всех пользователей с активным trial и отправляет уведомления
-    согласно расписанию на основе trial_expires_at.
+    Положенные сейчас уведомления вычисляются одним запросом
+    (TRIAL_DUE_NOTIFICATIONS_QUERY), отправляются параллельно
+    (не больше TRIAL_SEND_CONCURRENCY, темп задаёт telegram_gateway)
+    и отмечаются одним UPDATE.
     
-    КРИТИЧЕСКИЕ ПРОВЕРКИ:
+    КРИТИЧЕСКИЕ ПРОВЕРКИ (в запросе):
     - subscription.source == "trial"
     - subscription.status == "active"
     - subscription.expires_at > now
@@ -128,159 +165,42 @@ async def process_trial_notifications(bot: Bot):
     
     try:
         pool = await database.get_pool()
+        now = datetime.now()
         async with pool.acquire() as conn:
-            now = datetime.now()
-            
-            # Получаем только пользователей с АКТИВНОЙ trial-подпиской
-            # ВАЖНО: INNER JOIN гарантирует наличие trial-подписки
-            rows = await conn.fetch("""
-                SELECT u.telegram_id, u.trial_expires_at,
-                       s.id as subscription_id,
-                       s.expires_at as subscription_expires_at,
-                       s.trial_notif_6h_sent, s.trial_notif_18h_sent, s.trial_notif_30h_sent,
-                       s.trial_notif_42h_sent, s.trial_notif_54h_sent, s.trial_notif_60h_sent,
-                       s.trial_notif_71h_sent
-                FROM users u
-                INNER JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                    AND s.source = 'trial' 
-                    AND s.status = 'active'
-                    AND s.expires_at > $1
-                WHERE u.trial_used_at IS NOT NULL
-                  AND u.trial_expires_at IS NOT NULL
-                  AND u.trial_expires_at > $1
-            """, now)
-            
-            for row in rows:
-                telegram_id = row["telegram_id"]
-                trial_expires_at = row["trial_expires_at"]
-                subscription_expires_at = row["subscription_expires_at"]
-                
-                if not trial_expires_at or not subscription_expires_at:
-                    continue
-                
-                # КРИТИЧЕСКАЯ ПРОВЕРКА: subscription.expires_at > now
-                if subscription_expires_at <= now:
-                    logger.info(
-                        f"trial_reminder_skipped: user={telegram_id}, reason=subscription_expired, "
-                        f"expires_at={subscription_expires_at.isoformat()}"
-                    )
-                    continue
-                
-                # КРИТИЧЕСКАЯ ПРОВЕРКА: у пользователя НЕТ активной paid-подписки
-                paid_subscription = await conn.fetchrow("""
-                    SELECT 1 FROM subscriptions 
-                    WHERE telegram_id = $1 
-                    AND source = 'payment'
-                    AND status = 'active'
-                    AND expires_at > $2
-                    LIMIT 1
-                """, telegram_id, now)
-                
-                if paid_subscription:
-                    logger.info(
-                        f"trial_reminder_skipped: user={telegram_id}, reason=has_active_paid_subscription"
-                    )
-                    continue
-                
-                # Вычисляем время до окончания trial
-                time_until_expiry = trial_expires_at - now
-                hours_until_expiry = time_until_expiry.total_seconds() / 3600
-                
-                # Вычисляем время с момента активации (для обратной совместимости с расписанием)
-                # trial_expires_at - now = 72h - hours_until_expiry
-                hours_since_activation = 72 - hours_until_expiry
-                
-                # Проверяем каждое уведомление в расписании
-                for notification in TRIAL_NOTIFICATION_SCHEDULE:
-                    hours = notification["hours"]
-                    key = notification["key"]
-                    has_button = notification["has_button"]
-                    
-                    # Проверяем, нужно ли отправить это уведомление
-                    sent_flag_column = f"trial_notif_{hours}h_sent"
-                    # Безопасная проверка флага: NULL считается как False
-                    already_sent = row.get(sent_flag_column) is True
-                    
-                    # Уведомление нужно отправить, если:
-                    # - прошло достаточно времени (hours_since_activation >= hours)
-                    # - но не слишком много (в пределах 1 часа после нужного времени)
-                    # - и ещё не отправлено
-                    if (hours_since_activation >= hours and 
-                        hours_since_activation < hours + 1 and 
-                        not already_sent):
-                        
-                        # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА перед отправкой (для безопасности)
-                        # Проверяем, что подписка всё ещё активна
-                        subscription_check = await conn.fetchrow("""
-                            SELECT id, source, status, expires_at
-                            FROM subscriptions
-                            WHERE telegram_id = $1
-                            AND source = 'trial'
-                            AND status = 'active'
-                            AND expires_at > $2
-                        """, telegram_id, now)
-                        
-                        if not subscription_check:
-                            logger.info(
-                                f"trial_reminder_skipped: user={telegram_id}, notification={key}, "
-                                f"reason=subscription_no_longer_active"
-                            )
-                            continue
-                        
-                        # Проверяем ещё раз отсутствие paid-подписки
-                        paid_check = await conn.fetchrow("""
-                            SELECT 1 FROM subscriptions 
-                            WHERE telegram_id = $1 
-                            AND source = 'payment'
-                            AND status = 'active'
-                            AND expires_at > $2
-                            LIMIT 1
-                        """, telegram_id, now)
-                        
-                        if paid_check:
-                            logger.info(
-                                f"trial_reminder_skipped: user={telegram_id}, notification={key}, "
-                                f"reason=has_active_paid_subscription"
-                            )
-                            continue
-                        
-                        # Отправляем уведомление
-                        success, status = await send_trial_notification(
-                            bot, pool, telegram_id, key, has_button
-                        )
-                        
-                        if success:
-                            # Помечаем как отправленное (idempotency)
-                            # sent_at логируется в send_trial_notification
-                            await conn.execute(
-                                f"UPDATE subscriptions SET {sent_flag_column} = TRUE "
-                                f"WHERE telegram_id = $1 AND source = 'trial' AND status = 'active'",
-                                telegram_id
-                            )
-                            logger.info(
-                                f"trial_reminder_sent: user={telegram_id}, notification={key}, "
-                                f"hours_since_activation={hours_since_activation:.1f}h, sent_at={datetime.now().isoformat()}"
-                            )
-                        elif status == "failed_permanently":
-                            # Помечаем как permanently failed (idempotency)
-                            # Используем sent_flag как failed_flag для постоянных ошибок
-                            # Это предотвращает повторные попытки
-                            await conn.execute(
-                                f"UPDATE subscriptions SET {sent_flag_column} = TRUE "
-                                f"WHERE telegram_id = $1 AND source = 'trial' AND status = 'active'",
-                                telegram_id
-                            )
-                            logger.warning(
-                                f"trial_reminder_failed_permanently: user={telegram_id}, notification={key}, "
-                                f"reason=forbidden_or_blocked, failed_at={datetime.now().isoformat()}, "
-                                f"will_not_retry=True"
-                            )
-                        else:
-                            # Временная ошибка - не помечаем как sent, попробуем позже
-                            logger.warning(
-                                f"trial_reminder_failed_temporary: user={telegram_id}, notification={key}, "
-                                f"reason=temporary_error, will_retry=True"
-                            )
+            due = await conn.fetch(TRIAL_DUE_NOTIFICATIONS_QUERY, now)
+        if not due:
+            return
+        
+        semaphore = asyncio.Semaphore(TRIAL_SEND_CONCURRENCY)
+        
+        async def _send(row) -> Optional[Tuple[int, int]]:
+            telegram_id = row["telegram_id"]
+            notification = TRIAL_NOTIFICATIONS_BY_KEY[row["notification_key"]]
+            async with semaphore:
+                success, status = await send_trial_notification(
+                    bot, telegram_id, row["language"], notification["key"], notification["has_button"]
+                )
+            if success:
+                logger.info(f"trial_reminder_sent: user={telegram_id}, notification={notification['key']}")
+            elif status == "failed_permanently":
+                # Постоянная ошибка тоже помечается отправленной (idempotency): повторов не будет
+                logger.warning(
+                    f"trial_reminder_failed_permanently: user={telegram_id}, notification={notification['key']}, "
+                    f"reason=forbidden_or_blocked, will_not_retry=True"
+                )
+            else:
+                # Временная ошибка - не помечаем как sent, попробуем позже
+                logger.warning(
+                    f"trial_reminder_failed_temporary: user={telegram_id}, notification={notification['key']}, "
+                    f"reason=temporary_error, will_retry=True"
+                )
+                return None
+            return telegram_id, notification["hours"]
+        
+        results = await asyncio.gather(*(_send(row) for row in due))
+        marked = [result for result in results if result is not None]
+        await database.mark_trial_notifications_sent(marked)
+        logger.info(f"Trial notifications: due={len(due)}, marked={len(marked)}")
     
     except Exception as e:
         logger.exception(f"Error processing trial notifications: {e}")
@@ -294,50 +214,51 @@ async def expire_trial_subscriptions(bot: Bot):
     - Удаляет UUID из VPN API
     - Отправляет финальное сообщение пользователю
     - Логирует завершение trial
+    
+    Соединение берётся из пула только на запросы по одному пользователю и не удерживается
+    во время вызовов VPN API и Telegram API.
     """
     if not database.DB_READY:
         return
     
     try:
         pool = await database.get_pool()
-        async with pool.acquire() as conn:
-            now = datetime.now()
-            
-            # Получаем всех пользователей с истёкшим trial (trial_expires_at <= now)
-            # и их trial-подписки для отзыва доступа
-            # ВАЖНО: Выбираем только тех, у кого trial_expires_at в пределах последних 24 часов
-            # Это предотвращает повторную обработку и отправку умного предложения
-            rows = await conn.fetch("""
-                SELECT u.telegram_id, u.trial_used_at, u.trial_expires_at,
-                       s.uuid, s.expires_at as subscription_expires_at
-                FROM users u
-                LEFT JOIN subscriptions s ON u.telegram_id = s.telegram_id AND s.source = 'trial' AND s.status = 'active'
-                WHERE u.trial_used_at IS NOT NULL
-                  AND u.trial_expires_at IS NOT NULL
-                  AND u.trial_expires_at <= $1
-                  AND u.trial_expires_at > $1 - INTERVAL '24 hours'
-            """, now)
+        now = datetime.now()
+        
+        # Получаем всех пользователей с истёкшим trial (trial_expires_at <= now)
+        # и их trial-подписки для отзыва доступа
+        # ВАЖНО: Выбираем только тех, у кого trial_expires_at в пределах последних 24 часов
+        # Это предотвращает повторную обработку и отправку умного предложения
+        async for row in database.stream_rows("""
+            SELECT u.telegram_id, u.trial_used_at, u.trial_expires_at, u.unreachable_since,
+                   s.uuid, s.expires_at as subscription_expires_at
+            FROM users u
+            LEFT JOIN subscriptions s ON u.telegram_id = s.telegram_id AND s.source = 'trial' AND s.status = 'active'
+            WHERE u.trial_used_at IS NOT NULL
+              AND u.trial_expires_at IS NOT NULL
+              AND u.trial_expires_at <= $1
+              AND u.trial_expires_at > $1 - INTERVAL '24 hours'
+        """, now):
+            telegram_id = row["telegram_id"]
+            uuid = row["uuid"]
+            trial_used_at = row["trial_used_at"]
+            trial_expires_at = row["trial_expires_at"]
             
-            for row in rows:
-                telegram_id = row["telegram_id"]
-                uuid = row["uuid"]
-                trial_used_at = row["trial_used_at"]
-                trial_expires_at = row["trial_expires_at"]
+            try:
+                # Удаляем UUID из VPN API (если подписка существует)
+                if uuid:
+                    import vpn_utils
+                    try:
+                        await vpn_utils.remove_vless_user(uuid)
+                        logger.info(
+                            f"trial_expired: VPN access revoked: user={telegram_id}, uuid={uuid[:8]}..."
+                        )
+                    except Exception as e:
+                        logger.warning(
+                            f"Failed to remove VPN UUID for expired trial: user={telegram_id}, error={e}"
+                        )
                 
-                try:
-                    # Удаляем UUID из VPN API (если подписка существует)
-                    if uuid:
-                        import vpn_utils
-                        try:
-                            await vpn_utils.remove_vless_user(uuid)
-                            logger.info(
-                                f"trial_expired: VPN access revoked: user={telegram_id}, uuid={uuid[:8]}..."
-                            )
-                        except Exception as e:
-                            logger.warning(
-                                f"Failed to remove VPN UUID for expired trial: user={telegram_id}, error={e}"
-                            )
-                    
+                async with pool.acquire() as conn:
                     # Помечаем подписку как expired (если существует)
                     await conn.execute("""
                         UPDATE subscriptions 
@@ -345,6 +266,11 @@ async def expire_trial_subscriptions(bot: Bot):
                         WHERE telegram_id = $1 AND source = 'trial' AND status = 'active'
                     """, telegram_id)
                     
+                    # Доступ отозван; недоступному пользователю уведомления не отправляем
+                    if row["unreachable_since"] is not None:
+                        logger.info(f"trial_expired: notifications skipped (unreachable): user={telegram_id}")
+                        continue
+                    
                     # Проверяем, есть ли у пользователя платная подписка
                     # Если есть - пропускаем умное предложение
                     paid_subscription = await conn.fetchrow(
@@ -355,9 +281,6 @@ async def expire_trial_subscriptions(bot: Bot):
                         telegram_id
                     )
                     
-                    user = await database.get_user(telegram_id)
-                    language = user.get("language", "ru") if user else "ru"
-                    
                     # Атомарная проверка и отправка trial_completed уведомления
                     # Обновляем флаг только если он был FALSE (idempotency)
                     trial_completed_result = await conn.execute("""
@@ -370,24 +293,8 @@ async def expire_trial_subscriptions(bot: Bot):
                     # asyncpg execute returns string like "UPDATE 1" or "UPDATE 0"
                     trial_completed_sent = "1" in trial_completed_result
                     
-                    # Если нет платной подписки - отправляем умное предложение
+                    smart_offer_should_send = False
                     if not paid_subscription and trial_used_at:
-                        # Вычисляем длительность использования trial
-                        # usage_hours = now - trial_used_at (время с момента активации до истечения)
-                        usage_duration = now - trial_used_at
-                        usage_hours = usage_duration.total_seconds() / 3600
-                        
-                        # Определяем рекомендуемый тариф
-                        if usage_hours < 24:
-                            recommended_tariff = "basic"
-                            tariff_name = "Basic"
-                        elif usage_hours < 48:
-                            recommended_tariff = "plus"
-                            tariff_name = "Plus"
-                        else:
-                            recommended_tariff = "plus"
-                            tariff_name = "Plus"
-                        
                         # Атомарная проверка и отправка smart_offer уведомления
                         # Обновляем флаг только если он был FALSE (idempotency)
                         smart_offer_result = await conn.execute("""
@@ -396,87 +303,108 @@ async def expire_trial_subscriptions(bot: Bot):
                             WHERE telegram_id = $1 
                             AND smart_offer_sent = FALSE
                         """, telegram_id)
-                        
-                        # asyncpg execute returns string like "UPDATE 1" or "UPDATE 0"
                         smart_offer_should_send = "1" in smart_offer_result
+                
+                user = await database.get_user(telegram_id)
+                language = user.get("language", "ru") if user else "ru"
+                
+                # Если нет платной подписки - отправляем умное предложение
+                if not paid_subscription and trial_used_at:
+                    # Вычисляем длительность использования trial
+                    # usage_hours = now - trial_used_at (время с момента активации до истечения)
+                    usage_duration = now - trial_used_at
+                    usage_hours = usage_duration.total_seconds() / 3600
+                    
+                    # Определяем рекомендуемый тариф
+                    if usage_hours < 24:
+                        recommended_tariff = "basic"
+                        tariff_name = "Basic"
+                    elif usage_hours < 48:
+                        recommended_tariff = "plus"
+                        tariff_name = "Plus"
+                    else:
+                        recommended_tariff = "plus"
+                        tariff_name = "Plus"
+                    
+                    if smart_offer_should_send:
+                        # Формируем текст умного предложения
+                        smart_offer_text = (
+                            "🔓 <b>Пробный доступ завершён</b>\n\n"
+                            "Вы активно пользовались VPN — защита и стабильность были с вами эти 3 дня.\n\n"
+                            f"🔍 <b>Рекомендуем тариф: {tariff_name}</b>\n"
+                            "Он лучше подойдёт под ваш стиль использования.\n\n"
+                            "🎁 <b>Для вас промокод -30%: YABX30</b>\n"
+                            "Введите его на экране выбора тарифа.\n\n"
+                            "Один клик — и защита вернётся."
+                        )
                         
-                        if smart_offer_should_send:
-                            # Формируем текст умного предложения
-                            smart_offer_text = (
-                                "🔓 <b>Пробный доступ завершён</b>\n\n"
-                                "Вы активно пользовались VPN — защита и стабильность были с вами эти 3 дня.\n\n"
-                                f"🔍 <b>Рекомендуем тариф: {tariff_name}</b>\n"
-                                "Он лучше подойдёт под ваш стиль использования.\n\n"
-                                "🎁 <b>Для вас промокод -30%: YABX30</b>\n"
-                                "Введите его на экране выбора тарифа.\n\n"
-                                "Один клик — и защита вернётся."
+                        # Создаём клавиатуру с кнопками
+                        smart_offer_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                            [InlineKeyboardButton(
+                                text=localization.get_text(language, "buy_vpn", default="🔐 Купить доступ"),
+                                callback_data="menu_buy_vpn"
+                            )],
+                            [InlineKeyboardButton(
+                                text=localization.get_text(language, "profile", default="👤 Мой профиль"),
+                                callback_data="menu_profile"
+                            )]
+                        ])
+                        
+                        try:
+                            await bot.send_message(telegram_id, smart_offer_text, parse_mode="HTML", reply_markup=smart_offer_keyboard)
+                            logger.info(
+                                f"smart_offer_sent: user={telegram_id}, usage_hours={usage_hours:.1f}, "
+                                f"recommended_tariff={recommended_tariff}, trial_used_at={trial_used_at.isoformat()}, "
+                                f"trial_expires_at={trial_expires_at.isoformat()}"
                             )
-                            
-                            # Создаём клавиатуру с кнопками
-                            smart_offer_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                                [InlineKeyboardButton(
-                                    text=localization.get_text(language, "buy_vpn", default="🔐 Купить доступ"),
-                                    callback_data="menu_buy_vpn"
-                                )],
-                                [InlineKeyboardButton(
-                                    text=localization.get_text(language, "profile", default="👤 Мой профиль"),
-                                    callback_data="menu_profile"
-                                )]
-                            ])
-                            
-                            try:
-                                await bot.send_message(telegram_id, smart_offer_text, parse_mode="HTML", reply_markup=smart_offer_keyboard)
-                                logger.info(
-                                    f"smart_offer_sent: user={telegram_id}, usage_hours={usage_hours:.1f}, "
-                                    f"recommended_tariff={recommended_tariff}, trial_used_at={trial_used_at.isoformat()}, "
-                                    f"trial_expires_at={trial_expires_at.isoformat()}"
-                                )
-                            except Exception as e:
-                                logger.warning(f"Failed to send smart offer to user {telegram_id}: {e}")
-                                # Откатываем флаг при ошибке отправки
+                        except Exception as e:
+                            logger.warning(f"Failed to send smart offer to user {telegram_id}: {e}")
+                            # Откатываем флаг при ошибке отправки
+                            async with pool.acquire() as conn:
                                 await conn.execute("""
                                     UPDATE users 
                                     SET smart_offer_sent = FALSE 
                                     WHERE telegram_id = $1
                                 """, telegram_id)
-                        else:
+                    else:
+                        logger.info(
+                            f"smart_offer_skipped: user={telegram_id}, reason=already_sent"
+                        )
+                else:
+                    # Если есть платная подписка - отправляем стандартное сообщение
+                    if trial_completed_sent:
+                        expired_text = localization.get_text(language, "trial_expired_text")
+                        try:
+                            await bot.send_message(telegram_id, expired_text, parse_mode="HTML")
                             logger.info(
-                                f"smart_offer_skipped: user={telegram_id}, reason=already_sent"
+                                f"trial_expired: notification sent (paid subscription exists): user={telegram_id}, "
+                                f"trial_used_at={trial_used_at.isoformat() if trial_used_at else None}, "
+                                f"trial_expires_at={trial_expires_at.isoformat() if trial_expires_at else None}"
                             )
-                    else:
-                        # Если есть платная подписка - отправляем стандартное сообщение
-                        if trial_completed_sent:
-                            expired_text = localization.get_text(language, "trial_expired_text")
-                            try:
-                                await bot.send_message(telegram_id, expired_text, parse_mode="HTML")
-                                logger.info(
-                                    f"trial_expired: notification sent (paid subscription exists): user={telegram_id}, "
-                                    f"trial_used_at={trial_used_at.isoformat() if trial_used_at else None}, "
-                                    f"trial_expires_at={trial_expires_at.isoformat() if trial_expires_at else None}"
-                                )
-                            except Exception as e:
-                                logger.warning(f"Failed to send trial expiration notification to user {telegram_id}: {e}")
-                                # Откатываем флаг при ошибке отправки
+                        except Exception as e:
+                            logger.warning(f"Failed to send trial expiration notification to user {telegram_id}: {e}")
+                            # Откатываем флаг при ошибке отправки
+                            async with pool.acquire() as conn:
                                 await conn.execute("""
                                     UPDATE users 
                                     SET trial_completed_sent = FALSE 
                                     WHERE telegram_id = $1
                                 """, telegram_id)
-                        else:
-                            logger.info(
-                                f"trial_expired_skipped: user={telegram_id}, reason=already_sent"
-                            )
-                    
-                    if trial_completed_sent:
+                    else:
                         logger.info(
-                            f"trial_completed: user={telegram_id}, "
-                            f"trial_used_at={trial_used_at.isoformat() if trial_used_at else None}, "
-                            f"trial_expires_at={trial_expires_at.isoformat() if trial_expires_at else None}, "
-                            f"completed_at={now.isoformat()}"
+                            f"trial_expired_skipped: user={telegram_id}, reason=already_sent"
                         )
-                    
-                except Exception as e:
-                    logger.exception(f"Error expiring trial subscription for user {telegram_id}: {e}")
+                
+                if trial_completed_sent:
+                    logger.info(
+                        f"trial_completed: user={telegram_id}, "
+                        f"trial_used_at={trial_used_at.isoformat() if trial_used_at else None}, "
+                        f"trial_expires_at={trial_expires_at.isoformat() if trial_expires_at else None}, "
+                        f"completed_at={now.isoformat()}"
+                    )
+                
+            except Exception as e:
+                logger.exception(f"Error expiring trial subscription for user {telegram_id}: {e}")
     
     except Exception as e:
         logger.exception(f"Error expiring trial subscriptions: {e}")
@@ -499,6 +427,7 @@ async def run_trial_scheduler(bot: Bot):
     
     # Устанавливаем флаг перед запуском
     _TRIAL_SCHEDULER_STARTED = True
+    telegram_gateway.set_lane(telegram_gateway.LANE_REMINDER)
     logger.info("Trial notifications scheduler started")
     
     while True:
@@ -260,20 +260,15 @@ async def add_vless_user() -> Dict[str, str]:
                 # VPN AUDIT LOG: Логируем успешное создание UUID (non-blocking)
                 try:
                     import database
-                    # Создаём async task для логирования (не блокируем основной flow)
-                    import asyncio
-                    loop = asyncio.get_event_loop()
-                    if loop.is_running():
-                        asyncio.create_task(
-                            database._log_vpn_lifecycle_audit_async(
-                                action="vpn_add_user",
-                                telegram_id=0,  # Будет обновлено вызывающей стороной с реальным telegram_id
-                                uuid=str(uuid),
-                                source=None,  # Будет обновлено вызывающей стороной
-                                result="success",
-                                details=f"UUID created via VPN API, attempt={attempt + 1}"
-                            )
-                        )
+                    # Событие уходит в очередь audit_writer (без отдельной задачи)
+                    database._log_vpn_lifecycle_audit_fire_and_forget(
+                        action="vpn_add_user",
+                        telegram_id=0,  # Будет обновлено вызывающей стороной с реальным telegram_id
+                        uuid=str(uuid),
+                        source=None,  # Будет обновлено вызывающей стороной
+                        result="success",
+                        details=f"UUID created via VPN API, attempt={attempt + 1}"
+                    )
                 except Exception as e:
                     logger.warning(f"Failed to log VPN add_user audit (non-blocking): {e}")
                 
@@ -450,19 +445,15 @@ async def remove_vless_user(uuid: str) -> None:
                     # Примечание: Полный audit log будет записан в вызывающей функции с корректными telegram_id и source
                     try:
                         import database
-                        import asyncio
-                        loop = asyncio.get_event_loop()
-                        if loop.is_running():
-                            asyncio.create_task(
-                                database._log_vpn_lifecycle_audit_async(
-                                    action="vpn_remove_user",
-                                    telegram_id=0,  # Будет обновлено вызывающей стороной
-                                    uuid=uuid_clean,
-                                    source=None,  # Будет обновлено вызывающей стороной
-                                    result="success",
-                                    details=f"UUID already removed (idempotent), attempt={attempt + 1}"
-                                )
-                            )
+                        # Событие уходит в очередь audit_writer (без отдельной задачи)
+                        database._log_vpn_lifecycle_audit_fire_and_forget(
+                            action="vpn_remove_user",
+                            telegram_id=0,  # Будет обновлено вызывающей стороной
+                            uuid=uuid_clean,
+                            source=None,  # Будет обновлено вызывающей стороной
+                            result="success",
+                            details=f"UUID already removed (idempotent), attempt={attempt + 1}"
+                        )
                     except Exception as e:
                         logger.warning(f"Failed to log VPN remove_user audit (non-blocking): {e}")
                     return
@@ -476,19 +467,15 @@ async def remove_vless_user(uuid: str) -> None:
                 # Примечание: Полный audit log будет записан в вызывающей функции с корректными telegram_id и source
                 try:
                     import database
-                    import asyncio
-                    loop = asyncio.get_event_loop()
-                    if loop.is_running():
-                        asyncio.create_task(
-                            database._log_vpn_lifecycle_audit_async(
-                                action="vpn_remove_user",
-                                telegram_id=0,  # Будет обновлено вызывающей стороной
-                                uuid=uuid_clean,
-                                source=None,  # Будет обновлено вызывающей стороной
-                                result="success",
-                                details=f"UUID removed via VPN API, attempt={attempt + 1}"
-                            )
-                        )
+                    # Событие уходит в очередь audit_writer (без отдельной задачи)
+                    database._log_vpn_lifecycle_audit_fire_and_forget(
+                        action="vpn_remove_user",
+                        telegram_id=0,  # Будет обновлено вызывающей стороной
+                        uuid=uuid_clean,
+                        source=None,  # Будет обновлено вызывающей стороной
+                        result="success",
+                        details=f"UUID removed via VPN API, attempt={attempt + 1}"
+                    )
                 except Exception as e:
                     logger.warning(f"Failed to log VPN remove_user audit (non-blocking): {e}")
                 